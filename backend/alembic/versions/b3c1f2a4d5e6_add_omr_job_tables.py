@@ -0,0 +1,69 @@
+"""add omr job tables
+
+Revision ID: b3c1f2a4d5e6
+Revises: a99e1a944841
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'b3c1f2a4d5e6'
+down_revision = 'a99e1a944841'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('CONGVIECOMR',
+    sa.Column('maCongViec', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('maBaiKiemTra', sa.BigInteger(), nullable=True),
+    sa.Column('maMauPhieu', sa.BigInteger(), nullable=False),
+    sa.Column('maNguoiTao', sa.BigInteger(), nullable=True),
+    sa.Column('trangThai', sa.String(length=20), nullable=False),
+    sa.Column('tuyChonJson', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('tongSoAnh', sa.Integer(), nullable=False),
+    sa.Column('soAnhDaXuLy', sa.Integer(), nullable=False),
+    sa.Column('soAnhLoi', sa.Integer(), nullable=False),
+    sa.Column('thongBaoLoi', sa.Text(), nullable=True),
+    sa.Column('thoiGianTao', sa.TIMESTAMP(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+    sa.Column('thoiGianCapNhat', sa.TIMESTAMP(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+    sa.Column('thoiGianHoanTat', sa.TIMESTAMP(), nullable=True),
+    sa.ForeignKeyConstraint(['maBaiKiemTra'], ['BAIKIEMTRA.maBaiKiemTra'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['maMauPhieu'], ['MAUPHIEUTRALOI.maMauPhieu'], ),
+    sa.ForeignKeyConstraint(['maNguoiTao'], ['NGUOIDUNG.maNguoiDung'], ),
+    sa.PrimaryKeyConstraint('maCongViec')
+    )
+    op.create_index(op.f('ix_CONGVIECOMR_maCongViec'), 'CONGVIECOMR', ['maCongViec'], unique=False)
+    op.create_index(op.f('ix_CONGVIECOMR_maBaiKiemTra'), 'CONGVIECOMR', ['maBaiKiemTra'], unique=False)
+    op.create_index(op.f('ix_CONGVIECOMR_maNguoiTao'), 'CONGVIECOMR', ['maNguoiTao'], unique=False)
+    op.create_index('idx_congviecomr_trangthai', 'CONGVIECOMR', ['trangThai'], unique=False)
+
+    op.create_table('ANHCONGVIECOMR',
+    sa.Column('maAnh', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('maCongViec', sa.BigInteger(), nullable=False),
+    sa.Column('thuTu', sa.Integer(), nullable=False),
+    sa.Column('tenTapTin', sa.String(length=255), nullable=False),
+    sa.Column('duongDanAnh', sa.String(length=500), nullable=False),
+    sa.Column('trangThai', sa.String(length=20), nullable=False),
+    sa.Column('ketQuaJson', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('thongBaoLoi', sa.Text(), nullable=True),
+    sa.Column('thoiGianXuLy', sa.TIMESTAMP(), nullable=True),
+    sa.ForeignKeyConstraint(['maCongViec'], ['CONGVIECOMR.maCongViec'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('maAnh')
+    )
+    op.create_index(op.f('ix_ANHCONGVIECOMR_maAnh'), 'ANHCONGVIECOMR', ['maAnh'], unique=False)
+    op.create_index('idx_anhcongviecomr_congviec_trangthai', 'ANHCONGVIECOMR', ['maCongViec', 'trangThai', 'thuTu'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_anhcongviecomr_congviec_trangthai', table_name='ANHCONGVIECOMR')
+    op.drop_index(op.f('ix_ANHCONGVIECOMR_maAnh'), table_name='ANHCONGVIECOMR')
+    op.drop_table('ANHCONGVIECOMR')
+    op.drop_index('idx_congviecomr_trangthai', table_name='CONGVIECOMR')
+    op.drop_index(op.f('ix_CONGVIECOMR_maNguoiTao'), table_name='CONGVIECOMR')
+    op.drop_index(op.f('ix_CONGVIECOMR_maBaiKiemTra'), table_name='CONGVIECOMR')
+    op.drop_index(op.f('ix_CONGVIECOMR_maCongViec'), table_name='CONGVIECOMR')
+    op.drop_table('CONGVIECOMR')
@@ -0,0 +1,25 @@
+"""add student sbd suffix index
+
+Revision ID: c4d2e3f5a6b7
+Revises: b3c1f2a4d5e6
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d2e3f5a6b7'
+down_revision = 'b3c1f2a4d5e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Functional index cho tra cứu SBD (6 số cuối mã học sinh trường)
+    op.create_index('idx_hocsinh_sbd', 'HOCSINH', [sa.text('right("maHocSinhTruong", 6)')], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_hocsinh_sbd', table_name='HOCSINH')
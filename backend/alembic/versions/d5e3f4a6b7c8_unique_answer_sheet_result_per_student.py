@@ -0,0 +1,47 @@
+"""unique answer sheet and result per student
+
+Revision ID: d5e3f4a6b7c8
+Revises: c4d2e3f5a6b7
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e3f4a6b7c8'
+down_revision = 'c4d2e3f5a6b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Dọn bản ghi trùng (giữ bản mới nhất) trước khi thêm ràng buộc unique
+    op.execute('''
+        DELETE FROM "KETQUA" a USING "KETQUA" b
+        WHERE a."maBaiKiemTra" = b."maBaiKiemTra" AND a."maHocSinh" = b."maHocSinh"
+          AND a."maKetQua" < b."maKetQua"
+    ''')
+    # KETQUA còn lại trỏ về phiếu mới nhất của học sinh; KETQUA.maPhieuTraLoi có ON DELETE CASCADE
+    # nên nếu còn trỏ vào phiếu cũ thì kết quả duy nhất sẽ bị xóa theo phiếu đó
+    op.execute('''
+        UPDATE "KETQUA" k SET "maPhieuTraLoi" = p."newest"
+        FROM (
+            SELECT "maBaiKiemTra", "maHocSinh", MAX("maPhieuTraLoi") AS "newest"
+            FROM "PHIEUTRALOI" GROUP BY "maBaiKiemTra", "maHocSinh"
+        ) p
+        WHERE k."maBaiKiemTra" = p."maBaiKiemTra" AND k."maHocSinh" = p."maHocSinh"
+          AND k."maPhieuTraLoi" IS DISTINCT FROM p."newest"
+    ''')
+    op.execute('''
+        DELETE FROM "PHIEUTRALOI" a USING "PHIEUTRALOI" b
+        WHERE a."maBaiKiemTra" = b."maBaiKiemTra" AND a."maHocSinh" = b."maHocSinh"
+          AND a."maPhieuTraLoi" < b."maPhieuTraLoi"
+    ''')
+    op.create_unique_constraint('uq_phieutraloi_mabkt_mahs', 'PHIEUTRALOI', ['maBaiKiemTra', 'maHocSinh'])
+    op.create_unique_constraint('uq_ketqua_mabkt_mahs', 'KETQUA', ['maBaiKiemTra', 'maHocSinh'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_ketqua_mabkt_mahs', 'KETQUA', type_='unique')
+    op.drop_constraint('uq_phieutraloi_mabkt_mahs', 'PHIEUTRALOI', type_='unique')
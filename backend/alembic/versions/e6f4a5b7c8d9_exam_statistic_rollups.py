@@ -0,0 +1,34 @@
+"""exam statistic rollups: unique statistic row for students without a class
+
+Revision ID: e6f4a5b7c8d9
+Revises: d5e3f4a6b7c8
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6f4a5b7c8d9'
+down_revision = 'd5e3f4a6b7c8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Dọn dòng thống kê trùng (giữ bản mới nhất) trước khi thêm unique index;
+    # chạy `python -m app.services.exam_rollup_service rebuild` sau migration để backfill
+    op.execute('''
+        DELETE FROM "THONGKEKIEMTRA" a USING "THONGKEKIEMTRA" b
+        WHERE a."maBaiKiemTra" = b."maBaiKiemTra" AND a."maLopHoc" IS NULL AND b."maLopHoc" IS NULL
+          AND a."maThongKe" < b."maThongKe"
+    ''')
+    op.create_index(
+        'uq_thongkekiemtra_mabkt_khonglop', 'THONGKEKIEMTRA', ['maBaiKiemTra'],
+        unique=True, postgresql_where=sa.text('"maLopHoc" IS NULL')
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('uq_thongkekiemtra_mabkt_khonglop', table_name='THONGKEKIEMTRA')
@@ -27,6 +27,69 @@ class Settings(BaseSettings):
     STORAGE_PATH: str = os.getenv("STORAGE_PATH", os.path.join(OMR_DATA_DIR, "storage"))
     # OMR Service URL - for Docker containers
     OMR_API_URL: str = "http://localhost:8001"
+    # Model phân loại bubble mặc định, được preload khi worker khởi động
+    OMR_MODEL_PATH: str = os.getenv("OMR_MODEL_PATH", "app/omr/models/best.pt")
+    # Số ROI tối đa mỗi lần gọi model khi chấm gộp nhiều phiếu (batch-process-with-exam)
+    OMR_INFERENCE_BATCH_SIZE: int = int(os.getenv("OMR_INFERENCE_BATCH_SIZE", "1024"))
+    # Backend suy luận bubble: "ultralytics" (PyTorch) hoặc "onnx" (onnxruntime, chỉ CPU)
+    OMR_INFERENCE_BACKEND: str = os.getenv("OMR_INFERENCE_BACKEND", "ultralytics")
+    # Số thread intra-op cho onnxruntime, 0 = để onnxruntime tự chọn
+    OMR_ONNX_INTRA_OP_THREADS: int = int(os.getenv("OMR_ONNX_INTRA_OP_THREADS", "0"))
+    # Chế độ căn chỉnh phiếu: "standard" (ORB full-resolution, như trước đây) hoặc "pyramid" (coarse-to-fine, nhanh hơn;
+    # bật sau khi đã kiểm tra trên phiếu thật bằng app/omr/bench_align.py)
+    OMR_ALIGNMENT_MODE: str = os.getenv("OMR_ALIGNMENT_MODE", "standard")
+    # Căn chỉnh nhanh bằng 4 marker góc, chỉ dùng feature matching khi độ tin cậy marker thấp.
+    # Mặc định tắt (giữ đường căn chỉnh cũ); bật bằng OMR_MARKER_ALIGNMENT=true sau khi đã kiểm tra
+    # trên phiếu thật của template, giống OMR_ALIGNMENT_MODE
+    OMR_MARKER_ALIGNMENT: bool = os.getenv("OMR_MARKER_ALIGNMENT", "false").lower() == "true"
+    OMR_MARKER_MIN_CONFIDENCE: float = float(os.getenv("OMR_MARKER_MIN_CONFIDENCE", "0.6"))
+    # Classifier hai tầng: template đã hiệu chỉnh (cascade.json) chỉ gửi bubble không chắc chắn qua model
+    OMR_CASCADE_ENABLED: bool = os.getenv("OMR_CASCADE_ENABLED", "true").lower() == "true"
+    # Worker pool xử lý OMR: số process (0 = chạy trong thread), số job tối đa đang chờ/chạy,
+    # số job mỗi worker trước khi pool được thay mới và giới hạn bộ nhớ mỗi worker (MB, 0 = không giới hạn)
+    OMR_WORKERS: int = int(os.getenv("OMR_WORKERS", "2"))
+    OMR_MAX_QUEUE: int = int(os.getenv("OMR_MAX_QUEUE", "32"))
+    OMR_WORKER_MAX_JOBS: int = int(os.getenv("OMR_WORKER_MAX_JOBS", "200"))
+    OMR_WORKER_MAX_MEMORY_MB: int = int(os.getenv("OMR_WORKER_MAX_MEMORY_MB", "0"))
+    # Pipeline lean: decode ảnh thẳng sang grayscale và chỉ làm nét vùng bubble, tại chỗ trên ảnh align.
+    # Bộ nhớ ảnh mỗi phiếu 2084x2947 (ngoài model) khoảng 25 MB thay vì ~90 MB ở chế độ màu
+    # (ảnh gốc, ảnh normalize, ảnh align, ảnh blur, ảnh làm nét); đặt OMR_WORKER_MAX_MEMORY_MB theo mức này
+    OMR_LEAN_PIPELINE: bool = os.getenv("OMR_LEAN_PIPELINE", "false").lower() == "true"
+    # Công việc OMR chạy nền: số ảnh tối đa mỗi job, số job chạy song song, số ảnh mỗi lần gửi worker
+    # và thời gian (giây) không có heartbeat trước khi job đang chạy được coi là bị bỏ dở
+    OMR_JOB_MAX_IMAGES: int = int(os.getenv("OMR_JOB_MAX_IMAGES", "2000"))
+    OMR_JOB_CONCURRENCY: int = int(os.getenv("OMR_JOB_CONCURRENCY", "1"))
+    OMR_JOB_CHUNK_SIZE: int = int(os.getenv("OMR_JOB_CHUNK_SIZE", "16"))
+    OMR_JOB_STALE_SECONDS: int = int(os.getenv("OMR_JOB_STALE_SECONDS", "300"))
+    # Số phiếu mỗi lượt đọc/chấm/ghi khi chấm lại bài thi sau khi sửa đáp án
+    OMR_REGRADE_CHUNK_SIZE: int = int(os.getenv("OMR_REGRADE_CHUNK_SIZE", "500"))
+    # Ảnh annotation render khi được xem lần đầu: chiều rộng bản thumbnail (px), chất lượng JPEG,
+    # thời hạn (giây) của URL ký sẵn và dung lượng tối đa (MB) của cache trên đĩa
+    OMR_ANNOTATION_THUMB_WIDTH: int = int(os.getenv("OMR_ANNOTATION_THUMB_WIDTH", "480"))
+    OMR_ANNOTATION_JPEG_QUALITY: int = int(os.getenv("OMR_ANNOTATION_JPEG_QUALITY", "85"))
+    OMR_ANNOTATION_URL_TTL: int = int(os.getenv("OMR_ANNOTATION_URL_TTL", "86400"))
+    OMR_ANNOTATION_CACHE_MAX_MB: int = int(os.getenv("OMR_ANNOTATION_CACHE_MAX_MB", "1024"))
+    # Cache kết quả nhận dạng theo nội dung ảnh (+ template, model, confidence) trên đĩa: dung lượng tối đa (MB),
+    # bật so khớp perceptual hash cho ảnh trùng đã bị encode lại, khoảng cách Hamming tối đa của hash
+    # và khác biệt cục bộ tối đa (0-255) giữa hai ảnh thu nhỏ để coi là cùng một phiếu
+    OMR_RESULT_CACHE_ENABLED: bool = os.getenv("OMR_RESULT_CACHE_ENABLED", "true").lower() == "true"
+    OMR_RESULT_CACHE_MAX_MB: int = int(os.getenv("OMR_RESULT_CACHE_MAX_MB", "512"))
+    OMR_RESULT_CACHE_PERCEPTUAL: bool = os.getenv("OMR_RESULT_CACHE_PERCEPTUAL", "false").lower() == "true"
+    OMR_RESULT_CACHE_PHASH_DISTANCE: int = int(os.getenv("OMR_RESULT_CACHE_PHASH_DISTANCE", "6"))
+    OMR_RESULT_CACHE_MAX_DIFF: int = int(os.getenv("OMR_RESULT_CACHE_MAX_DIFF", "24"))
+    # Kiểm tra nhanh chất lượng frame quét trực tiếp (độ nét, tờ phiếu, phơi sáng, marker góc) trước pipeline OMR;
+    # ngưỡng nằm trong mục "quality" của template.json
+    OMR_QUALITY_GATE_ENABLED: bool = os.getenv("OMR_QUALITY_GATE_ENABLED", "true").lower() == "true"
+    # Quét trực tiếp qua Socket.IO: số frame tối đa được xử lý mỗi giây cho một phiên (0 = không giới hạn)
+    # và kích thước tối đa (MB) của một frame nhị phân
+    OMR_WS_MAX_FPS: float = float(os.getenv("OMR_WS_MAX_FPS", "2"))
+    OMR_WS_MAX_FRAME_MB: int = int(os.getenv("OMR_WS_MAX_FRAME_MB", "8"))
+    # Snapshot thống kê dashboard: thời gian (giây) snapshot được coi là mới, và thời gian thêm
+    # vẫn trả snapshot cũ trong lúc làm mới ở nền
+    DASHBOARD_CACHE_TTL: float = float(os.getenv("DASHBOARD_CACHE_TTL", "30"))
+    DASHBOARD_CACHE_STALE_SECONDS: float = float(os.getenv("DASHBOARD_CACHE_STALE_SECONDS", "300"))
+    # Số phiếu mỗi lượt đọc khi phân tích câu hỏi (độ khó, độ phân biệt, phương án nhiễu) của bài thi
+    ITEM_ANALYSIS_CHUNK_SIZE: int = int(os.getenv("ITEM_ANALYSIS_CHUNK_SIZE", "2000"))
 
     # JWT Settings - Nên được đặt trong file .env ở thư mục gốc của dự án hoặc .env_backend
     SECRET_KEY: str = "please_change_me_in_production_env_file"
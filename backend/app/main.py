@@ -13,6 +13,10 @@ from app.routes import auth, users, organizations, classes, students, exams, das
 from app.db.session import Base, engine, AsyncSessionLocal
 from app.services.student_service import StudentService
 from app.websocket import setup_omr_websocket
+from app.omr.model_registry import model_registry
+from app.services.omr_worker_pool import omr_worker_pool
+from app.services.omr_job_service import omr_job_runner
+from app.services.regrade_service import answer_key_regrader
 
 # Import tất cả các model để đảm bảo chúng được đăng ký với Base
 from app.models.user import User
@@ -88,6 +92,26 @@ app.include_router(omr.router, prefix=f"{settings.API_PREFIX}/v1")
 app.include_router(stats.router, prefix=f"{settings.API_PREFIX}/v1")
 app.include_router(manager.router, prefix=f"{settings.API_PREFIX}/v1/manager")
 
+# Load sẵn model OMR một lần cho mỗi worker
+@app.on_event("startup")
+async def preload_omr_model():
+    # Khi có worker pool, model chỉ cần nằm trong các worker
+    if omr_worker_pool.workers <= 0:
+        model_registry.preload(settings.OMR_MODEL_PATH)
+
+# Worker pool xử lý OMR (mỗi process tự preload model)
+@app.on_event("startup")
+async def start_omr_worker_pool():
+    omr_worker_pool.start()
+    # Chạy tiếp các công việc OMR bị ngắt bởi lần khởi động lại trước
+    await omr_job_runner.start()
+
+@app.on_event("shutdown")
+async def stop_omr_worker_pool():
+    await answer_key_regrader.stop()
+    await omr_job_runner.stop()
+    omr_worker_pool.shutdown()
+
 # Root endpoint
 @app.get("/")
 async def root():
@@ -6,4 +6,5 @@ from app.models.student import Student
 from app.models.answer_sheet_template import AnswerSheetTemplate
 from app.models.exam import Exam, ExamClassRoom, Answer, AnswerSheet, Result, ExamStatistic
 from app.models.setting import Setting
-from app.models.file import File 
\ No newline at end of file
+from app.models.file import File 
+from app.models.omr_job import OMRJob, OMRJobItem
@@ -77,6 +77,11 @@ class AnswerSheet(Base):
     thoiGianTao = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp())
     thoiGianCapNhat = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
     
+    __table_args__ = (
+        # Mỗi học sinh một phiếu cho mỗi bài thi, là đích ON CONFLICT khi ghi batch
+        UniqueConstraint('maBaiKiemTra', 'maHocSinh', name='uq_phieutraloi_mabkt_mahs'),
+    )
+    
     # Relationships
     baiKiemTra = relationship("Exam", back_populates="phieuTraLois")
     hocSinh = relationship("Student", back_populates="phieuTraLois")
@@ -104,6 +109,10 @@ class Result(Base):
     thoiGianTao = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp())
     thoiGianCapNhat = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
     
+    __table_args__ = (
+        UniqueConstraint('maBaiKiemTra', 'maHocSinh', name='uq_ketqua_mabkt_mahs'),
+    )
+    
     # Relationships
     phieuTraLoi = relationship("AnswerSheet", back_populates="ketQua")
     baiKiemTra = relationship("Exam", back_populates="ketQuas")
@@ -134,6 +143,9 @@ class ExamStatistic(Base):
     # Unique constraint
     __table_args__ = (
         UniqueConstraint('maBaiKiemTra', 'maLopHoc', name='uq_thongkekiemtra_mabkt_malop'),
+        # NULL không trùng nhau trong unique constraint: dòng thống kê không thuộc lớp nào cần index riêng
+        Index('uq_thongkekiemtra_mabkt_khonglop', 'maBaiKiemTra', unique=True,
+              postgresql_where=maLopHoc.is_(None)),
     )
     
     # Relationships
@@ -0,0 +1,58 @@
+from sqlalchemy import Column, Integer, String, Text, TIMESTAMP, BigInteger, func, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import relationship
+
+from app.db.session import Base
+
+class OMRJob(Base):
+    """
+    Model Công việc chấm OMR (batch lớn chạy nền)
+    Tương ứng với bảng CONGVIECOMR trong CSDL
+    """
+    __tablename__ = "CONGVIECOMR"
+
+    maCongViec = Column(BigInteger, primary_key=True, index=True, autoincrement=True)
+    maBaiKiemTra = Column(BigInteger, ForeignKey("BAIKIEMTRA.maBaiKiemTra", ondelete="CASCADE"), index=True)
+    maMauPhieu = Column(BigInteger, ForeignKey("MAUPHIEUTRALOI.maMauPhieu"), nullable=False)
+    maNguoiTao = Column(BigInteger, ForeignKey("NGUOIDUNG.maNguoiDung"), index=True)
+    trangThai = Column(String(20), nullable=False, default="choXuLy")  # choXuLy, dangXuLy, hoanTat, loi
+    tuyChonJson = Column(JSONB, nullable=True)  # confidence, auto_align, yolo_model, save_results
+    tongSoAnh = Column(Integer, nullable=False, default=0)
+    soAnhDaXuLy = Column(Integer, nullable=False, default=0)
+    soAnhLoi = Column(Integer, nullable=False, default=0)
+    thongBaoLoi = Column(Text, nullable=True)
+    thoiGianTao = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp())
+    # Được cập nhật sau mỗi ảnh, dùng làm heartbeat để nhận ra job bị bỏ dở
+    thoiGianCapNhat = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
+    thoiGianHoanTat = Column(TIMESTAMP, nullable=True)
+
+    __table_args__ = (
+        Index('idx_congviecomr_trangthai', 'trangThai'),
+    )
+
+    # Relationships
+    anhs = relationship("OMRJobItem", back_populates="congViec", cascade="all, delete-orphan", passive_deletes=True, order_by="OMRJobItem.thuTu")
+
+class OMRJobItem(Base):
+    """
+    Model Ảnh trong công việc chấm OMR, mỗi ảnh là một checkpoint
+    Tương ứng với bảng ANHCONGVIECOMR trong CSDL
+    """
+    __tablename__ = "ANHCONGVIECOMR"
+
+    maAnh = Column(BigInteger, primary_key=True, index=True, autoincrement=True)
+    maCongViec = Column(BigInteger, ForeignKey("CONGVIECOMR.maCongViec", ondelete="CASCADE"), nullable=False)
+    thuTu = Column(Integer, nullable=False)
+    tenTapTin = Column(String(255), nullable=False)
+    duongDanAnh = Column(String(500), nullable=False)
+    trangThai = Column(String(20), nullable=False, default="choXuLy")  # choXuLy, hoanTat, loi
+    ketQuaJson = Column(JSONB, nullable=True)
+    thongBaoLoi = Column(Text, nullable=True)
+    thoiGianXuLy = Column(TIMESTAMP, nullable=True)
+
+    __table_args__ = (
+        Index('idx_anhcongviecomr_congviec_trangthai', 'maCongViec', 'trangThai', 'thuTu'),
+    )
+
+    # Relationships
+    congViec = relationship("OMRJob", back_populates="anhs")
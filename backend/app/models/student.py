@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Date, TIMESTAMP, BigInteger, func, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Date, TIMESTAMP, BigInteger, func, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 
 from app.db.session import Base
@@ -30,6 +30,8 @@ class Student(Base):
     # Unique constraint cho maHocSinhTruong + maLopHoc
     __table_args__ = (
         UniqueConstraint('maHocSinhTruong', 'maLopHoc', name='uq_hocsinh_mahocsinhtruong_malophoc'),
+        # SBD trên phiếu là 6 số cuối mã học sinh: tra cứu right(...) = sbd dùng được index
+        Index('idx_hocsinh_sbd', func.right(maHocSinhTruong, 6)),
     )
     
     # Relationships
@@ -0,0 +1,126 @@
+# aligner_cache.py
+"""
+Cache keypoints/descriptors của ảnh reference dùng cho AdvancedFeatureAlignment.
+
+Key theo (đường dẫn reference, mtime, method, max_features, kích thước xử lý): trong bộ nhớ
+giữ LRU các reference đã tính, trên đĩa lưu sidecar `.npz` cạnh template.json để worker
+mới khởi động chỉ cần đọc lại descriptors thay vì chạy lại detectAndCompute.
+"""
+from collections import OrderedDict
+import logging
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from .src.processors.AdvancedFeatureAlignment import ReferenceFeatures, create_feature_detector
+from .src.utils.image import ImageUtils
+
+logger = logging.getLogger(__name__)
+
+MAX_CACHED_REFERENCES = 8
+
+_references = OrderedDict()
+_references_lock = threading.Lock()
+
+
+def sidecar_path(ref_path, method, max_features, width, height):
+    """vd `12-4-6.orb5000.2084x2947.npz` trong cùng thư mục với ảnh reference/template.json"""
+    stem = os.path.splitext(ref_path)[0]
+    return f"{stem}.{method.lower()}{max_features}.{width}x{height}.npz"
+
+
+def _keypoints_to_arrays(keypoints):
+    # octave/class_id là int (SIFT pack layer vào octave) nên lưu riêng, tránh mất chính xác khi ép float32
+    values = np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response) for k in keypoints], dtype=np.float32)
+    ids = np.array([(k.octave, k.class_id) for k in keypoints], dtype=np.int32)
+    return values.reshape(-1, 5), ids.reshape(-1, 2)
+
+
+def _arrays_to_keypoints(values, ids):
+    return [
+        cv2.KeyPoint(float(x), float(y), float(size), float(angle), float(response), int(octave), int(class_id))
+        for (x, y, size, angle, response), (octave, class_id) in zip(values.tolist(), ids.tolist())
+    ]
+
+
+def _save_sidecar(path, mtime, keypoints, descriptors):
+    values, ids = _keypoints_to_arrays(keypoints)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    try:
+        np.savez(
+            tmp_path,
+            source_mtime=np.float64(mtime),
+            keypoints=values,
+            keypoint_ids=ids,
+            descriptors=descriptors if descriptors is not None else np.empty((0, 0), dtype=np.uint8),
+        )
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write reference feature sidecar {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _load_sidecar(path, mtime):
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if float(data["source_mtime"]) != mtime:
+                return None
+            keypoints = _arrays_to_keypoints(data["keypoints"], data["keypoint_ids"])
+            descriptors = data["descriptors"] if data["descriptors"].size else None
+            return keypoints, descriptors
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable reference feature sidecar {path}: {e}")
+        return None
+
+
+def get_reference_features(ref_path, method="ORB", max_features=5000, width=2084, height=2947):
+    """
+    Lấy ReferenceFeatures (ảnh reference xám đã resize, keypoints, descriptors) từ cache.
+    Thứ tự: cache bộ nhớ -> sidecar `.npz` -> detectAndCompute (rồi ghi sidecar).
+    """
+    actual_path = os.path.abspath(ref_path)
+    mtime = os.path.getmtime(actual_path)
+    key = (actual_path, mtime, method, int(max_features), int(width), int(height))
+
+    with _references_lock:
+        cached = _references.get(key)
+        if cached is not None:
+            _references.move_to_end(key)
+            return cached
+
+    ref_img = cv2.imread(actual_path, cv2.IMREAD_GRAYSCALE)
+    if ref_img is None:
+        raise FileNotFoundError(f"Reference image not found at {actual_path}")
+    ref_img = ImageUtils.resize_util(ref_img, width, height)
+
+    path = sidecar_path(actual_path, method, max_features, width, height)
+    loaded = _load_sidecar(path, mtime)
+    if loaded is not None:
+        keypoints, descriptors = loaded
+        logger.info(f"Loaded {len(keypoints)} reference keypoints from {path}")
+    else:
+        detector, _ = create_feature_detector(method, max_features)
+        keypoints, descriptors = detector.detectAndCompute(ref_img, None)
+        logger.info(f"Computed {len(keypoints)} reference keypoints for {actual_path}")
+        _save_sidecar(path, mtime, keypoints, descriptors)
+
+    features = ReferenceFeatures(ref_img, keypoints, descriptors)
+    with _references_lock:
+        # Xoá các entry cũ của cùng reference (mtime khác) trước khi thêm
+        for stale in [k for k in _references if k[0] == actual_path and k[1] != mtime]:
+            del _references[stale]
+        _references[key] = features
+        _references.move_to_end(key)
+        while len(_references) > MAX_CACHED_REFERENCES:
+            _references.popitem(last=False)
+    return features
+
+
+def clear_reference_cache():
+    with _references_lock:
+        _references.clear()
@@ -0,0 +1,77 @@
+# bench_align.py
+"""
+Benchmark căn chỉnh phiếu: chế độ "standard" so với "pyramid" của AdvancedFeatureAlignment.
+
+Ảnh đầu vào được sinh bằng cách warp ảnh reference với homography ngẫu nhiên (đã biết),
+nên sai số lưới bubble (px) được đo chính xác tại tâm các bubble của template.
+
+    python -m app.omr.bench_align -t app/omr/templates/12-4-6/template.json -n 6
+"""
+import argparse
+import os
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from .aligner_cache import get_reference_features
+from .src.processors.AdvancedFeatureAlignment import AdvancedFeatureAlignment
+from .template import get_compiled_template
+
+
+def synthetic_scan(ref, seed, scale):
+    """Warp phối cảnh + blur + nhiễu, trả về (ảnh, homography reference -> ảnh)"""
+    rng = np.random.RandomState(seed)
+    h, w = ref.shape[:2]
+    src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    dst = (src + rng.uniform(-60, 60, (4, 2)).astype(np.float32)) * scale + np.float32([80, 80])
+    M = cv2.getPerspectiveTransform(src, dst)
+    scan = cv2.warpPerspective(ref, M, (int(w * scale) + 160, int(h * scale) + 160), borderValue=(180, 180, 180))
+    scan = cv2.GaussianBlur(scan, (3, 3), 0)
+    noise = rng.normal(0, 6, scan.shape)
+    return np.clip(scan.astype(np.int16) + noise, 0, 255).astype(np.uint8), M
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark standard vs pyramid sheet alignment.")
+    parser.add_argument("-t", "--template", type=str, required=True, help="Đường dẫn template.json.")
+    parser.add_argument("-n", "--samples", type=int, default=6, help="Số ảnh sinh ra (default: 6).")
+    args = parser.parse_args()
+
+    template_dir = os.path.dirname(args.template)
+    ref_path = next(os.path.join(template_dir, f) for f in sorted(os.listdir(template_dir))
+                    if f.lower().endswith((".png", ".jpg", ".jpeg")))
+    config = SimpleNamespace(
+        dimensions=SimpleNamespace(processing_width=2084, processing_height=2947),
+        outputs=SimpleNamespace(show_image_level=0),
+    )
+    features = get_reference_features(ref_path, "ORB", 5000, 2084, 2947)
+
+    bounds = get_compiled_template(args.template).bounds.astype(np.float64)
+    centers = np.stack([(bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2], axis=1)
+    centers = centers.reshape(-1, 1, 2)
+
+    ref = cv2.resize(cv2.imread(ref_path), (2084, 2947))
+    scans = [synthetic_scan(ref, seed, 1.0 + 0.4 * (seed % 2)) for seed in range(args.samples)]
+
+    for mode in ("standard", "pyramid"):
+        aligner = AdvancedFeatureAlignment(
+            options={"reference": ref_path, "alignmentMode": mode},
+            tuning_config=config,
+            reference_features=features,
+        )
+        times, errors = [], []
+        for scan, M in scans:
+            start = time.perf_counter()
+            aligner.apply_filter(scan, "")
+            times.append(time.perf_counter() - start)
+            mapped = cv2.perspectiveTransform(cv2.perspectiveTransform(centers, M), aligner.last_homography)
+            errors.append(np.linalg.norm(mapped - centers, axis=2))
+        errors = np.concatenate(errors)
+        print(f"{mode:<9}: {np.mean(times) * 1000:7.1f} ms/sheet | bubble error mean {errors.mean():.2f}px "
+              f"max {errors.max():.2f}px | last stages (ms) {aligner.last_stats.get('stages_ms')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# bench_roi.py
+"""
+Microbenchmark cắt ROI bubble cho một phiếu đầy đủ: vòng lặp Python cũ so với extract_bubble_rois.
+
+    python -m app.omr.bench_roi path/to/sheet.jpg -t app/omr/templates/12-4-6/template.json
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from .detection import extract_bubble_rois, BUBBLE_INPUT_SIZE
+from .template import get_compiled_template
+
+
+def extract_rois_loop(image, bubbles):
+    """Cách cắt ROI trước đây trong classify_bubbles_batch (giữ lại để so sánh)"""
+    rois = []
+    h, w = image.shape[:2]
+    for bubble in bubbles:
+        x1, y1, x2, y2 = [max(0, val) if i < 2 else min(bound, val) for i, (val, bound) in
+                          enumerate(zip(bubble['bounds'], [w, h, w, h]))]
+        if x2 > x1 and y2 > y1 and (roi := image[y1:y2, x1:x2]).size > 0:
+            if len(roi.shape) == 2:
+                roi = cv2.cvtColor(roi, cv2.COLOR_GRAY2RGB)
+            elif roi.shape[2] == 4:
+                roi = cv2.cvtColor(roi, cv2.COLOR_BGRA2BGR)
+            rois.append(cv2.resize(roi, (BUBBLE_INPUT_SIZE, BUBBLE_INPUT_SIZE)))
+    return rois
+
+
+def _time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bubble ROI extraction on a full sheet.")
+    parser.add_argument("image", type=str, help="Ảnh phiếu (đã căn chỉnh theo template).")
+    parser.add_argument("-t", "--template", type=str, required=True, help="Đường dẫn template.json.")
+    parser.add_argument("-n", "--repeat", type=int, default=20, help="Số lần lặp (default: 20).")
+    args = parser.parse_args()
+
+    image = cv2.imread(args.image)
+    if image is None:
+        raise SystemExit(f"Could not read image {args.image}")
+    template = get_compiled_template(args.template)
+    bubbles = template.bubbles
+
+    legacy = np.stack(extract_rois_loop(image, bubbles))
+    batch, _ = extract_bubble_rois(image, template.bounds)
+    print(f"Bubbles: {len(template)} | identical output: {np.array_equal(legacy, batch)}")
+
+    loop_s = _time(lambda: extract_rois_loop(image, bubbles), args.repeat)
+    vec_s = _time(lambda: extract_bubble_rois(image, template.bounds), args.repeat)
+    print(f"Python loop : {loop_s * 1000:.2f} ms/sheet")
+    print(f"Batched     : {vec_s * 1000:.2f} ms/sheet ({loop_s / vec_s:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
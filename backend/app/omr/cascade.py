@@ -0,0 +1,289 @@
+# cascade.py
+"""
+Phân loại bubble hai tầng.
+
+Tầng 1 tính tỉ lệ pixel tối trong lõi mỗi bubble từ integral image của phiếu đã căn chỉnh
+(vector hóa trên toàn bộ mảng bounds của template): bubble rõ ràng trống hoặc rõ ràng đã tô được
+quyết định ngay. Tầng 2 chỉ gửi các bubble nằm trong dải không chắc chắn qua model.
+
+Dải ngưỡng hiệu chỉnh riêng cho từng template, lưu trong `cascade.json` cạnh template.json
+(hoặc mục "cascade" trong template.json); template chưa hiệu chỉnh thì mọi bubble vẫn qua model.
+
+    python -m app.omr.cascade calibrate scans/*.jpg -t app/omr/templates/12-4-6/template.json -m best.pt --write
+    python -m app.omr.cascade evaluate --dataset ../AI/dataset -m best.pt
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, NamedTuple, Optional
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CASCADE_FILENAME = "cascade.json"
+# Bỏ viền in của bubble: chỉ đếm pixel tối trong phần lõi (cắt `inset` mỗi cạnh)
+DEFAULT_INSET = 0.2
+
+
+class CascadeBand(NamedTuple):
+    """
+    Dải không chắc chắn của một template: tỉ lệ < empty_below là trống, > filled_above là đã tô,
+    còn lại qua model. dark_threshold None = ngưỡng Otsu trên từng phiếu.
+    """
+    empty_below: float
+    filled_above: float
+    inset: float = DEFAULT_INSET
+    dark_threshold: Optional[int] = None
+
+    @classmethod
+    def from_config(cls, config) -> Optional["CascadeBand"]:
+        if not config:
+            return None
+        try:
+            return cls(
+                empty_below=float(config["empty_below"]),
+                filled_above=float(config["filled_above"]),
+                inset=float(config.get("inset", DEFAULT_INSET)),
+                dark_threshold=config.get("dark_threshold")
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Ignoring invalid cascade config {config}: {e}")
+            return None
+
+    def to_config(self) -> Dict:
+        return {k: (round(v, 4) if isinstance(v, float) else v) for k, v in self._asdict().items()}
+
+
+def clamp_bounds(bounds, shape):
+    """Clamp bounds (N, 4) vào ảnh, trả về (clamped, valid_idx) với valid_idx là bubble có diện tích > 0."""
+    bounds = np.asarray(bounds, dtype=np.int32).reshape(-1, 4)
+    h, w = shape[:2]
+    clamped = np.clip(bounds, 0, [w, h, w, h])
+    valid_idx = np.flatnonzero((clamped[:, 2] > clamped[:, 0]) & (clamped[:, 3] > clamped[:, 1]))
+    return clamped, valid_idx
+
+
+def fill_ratios(image, bounds, inset=DEFAULT_INSET, dark_threshold=None):
+    """
+    Tỉ lệ pixel tối trong lõi của từng bubble (bounds đã clamp, diện tích > 0), float32 (N,).
+
+    Ảnh được nhị phân hóa một lần trên khung bao các bubble, rồi mọi tổng được lấy từ một integral image
+    bằng 4 phép tra cứu mỗi bubble, không có vòng lặp Python.
+    """
+    bounds = np.asarray(bounds, dtype=np.int32).reshape(-1, 4)
+    if len(bounds) == 0:
+        return np.zeros(0, dtype=np.float32)
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    # Lõi của bubble, tối thiểu 1 px mỗi chiều
+    size = bounds[:, 2:] - bounds[:, :2]
+    margin = np.minimum((size * inset).astype(np.int32), (size - 1) // 2)
+    inner = np.concatenate([bounds[:, :2] + margin, bounds[:, 2:] - margin], axis=1)
+
+    x0, y0 = inner[:, 0].min(), inner[:, 1].min()
+    x1, y1 = inner[:, 2].max(), inner[:, 3].max()
+    region = gray[y0:y1, x0:x1]
+    if dark_threshold is None:
+        _, dark = cv2.threshold(region, 0, 1, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    else:
+        _, dark = cv2.threshold(region, int(dark_threshold) - 1, 1, cv2.THRESH_BINARY_INV)
+    integral = cv2.integral(dark, sdepth=cv2.CV_32S)
+
+    bx1, by1, bx2, by2 = (inner - [x0, y0, x0, y0]).T
+    counts = integral[by2, bx2] - integral[by1, bx2] - integral[by2, bx1] + integral[by1, bx1]
+    return (counts / ((bx2 - bx1) * (by2 - by1))).astype(np.float32)
+
+
+def cascade_decisions(ratios, band: CascadeBand):
+    """(filled, uncertain): quyết định của tầng 1 và mặt nạ các bubble cần qua model."""
+    ratios = np.asarray(ratios)
+    filled = ratios > band.filled_above
+    uncertain = ~filled & (ratios >= band.empty_below)
+    return filled, uncertain
+
+
+def calibrate_band(ratios, model_filled, max_error=0.0, margin=0.02, inset=DEFAULT_INSET,
+                   dark_threshold=None) -> CascadeBand:
+    """
+    Chọn dải ngưỡng từ tỉ lệ pixel tối và quyết định của model trên các phiếu mẫu: ngoài dải, tỉ lệ
+    lỗi so với model không quá `max_error` mỗi phía, cộng thêm `margin` cho an toàn.
+    """
+    ratios = np.asarray(ratios, dtype=np.float64)
+    model_filled = np.asarray(model_filled, dtype=bool)
+    if not model_filled.any() or model_filled.all():
+        raise ValueError("Calibration needs both filled and empty bubbles")
+    empty_below = max(0.0, float(np.quantile(ratios[model_filled], max_error)) - margin)
+    filled_above = min(1.0, float(np.quantile(ratios[~model_filled], 1.0 - max_error)) + margin)
+    return CascadeBand(min(empty_below, filled_above), filled_above, inset, dark_threshold)
+
+
+def model_fraction(ratios, band: Optional[CascadeBand]) -> float:
+    """Tỉ lệ bubble phải qua model với dải `band` (1.0 khi không có dải)."""
+    if band is None or len(ratios) == 0:
+        return 1.0
+    return float(cascade_decisions(ratios, band)[1].mean())
+
+
+def cascade_path_for(template_path) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(template_path)), CASCADE_FILENAME)
+
+
+def load_cascade_config(template_path) -> Optional[Dict]:
+    path = cascade_path_for(template_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Cannot read cascade calibration {path}: {e}")
+        return None
+
+
+def write_cascade_config(template_path, band: CascadeBand, **report):
+    path = cascade_path_for(template_path)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({**band.to_config(), **report, "calibrated_at": datetime.now().isoformat(timespec="seconds")},
+                  f, ensure_ascii=False, indent=2)
+    return path
+
+
+def calibrate_template(image_paths, template_path, model_path, conf=0.4, max_error=0.0, margin=0.02,
+                       inset=DEFAULT_INSET):
+    """Căn chỉnh các phiếu mẫu như pipeline, chạy model trên mọi bubble và hiệu chỉnh dải ngưỡng."""
+    from .detection import extract_bubble_rois, predict_filled
+    from .jobs import _make_aligner
+    from .main_pipeline import _load_and_align
+    from .model_registry import get_yolo_model
+    from .template import get_compiled_template
+
+    compiled = get_compiled_template(template_path)
+    aligner = _make_aligner(template_path)
+    model = get_yolo_model(model_path)
+    all_ratios, all_filled = [], []
+    for image_path in image_paths:
+        image, _, _ = _load_and_align(image_path, aligner, compiled=compiled)
+        if image is None:
+            logger.warning(f"Skipping unreadable image {image_path}")
+            continue
+        clamped, valid_idx = clamp_bounds(compiled.bounds, image.shape)
+        rois, _ = extract_bubble_rois(image, clamped[valid_idx])
+        all_ratios.append(fill_ratios(image, clamped[valid_idx], inset))
+        all_filled.append(predict_filled(rois, model, conf))
+    if not all_ratios:
+        raise ValueError("No readable calibration images")
+    ratios, filled = np.concatenate(all_ratios), np.concatenate(all_filled)
+    band = calibrate_band(ratios, filled, max_error, margin, inset)
+    decided_filled, uncertain = cascade_decisions(ratios, band)
+    report = {
+        "sheets": len(all_ratios),
+        "bubbles": int(len(ratios)),
+        "model_fraction": round(float(uncertain.mean()), 4),
+        "disagreements": int(np.sum((decided_filled != filled) & ~uncertain)),
+    }
+    return band, report
+
+
+def _load_dataset_split(dataset_dir, split):
+    """Crop bubble 54x54 của AI/dataset và nhãn "đã tô" (class 0 trong data.yaml)."""
+    images, labels = [], []
+    for path in sorted(glob.glob(os.path.join(dataset_dir, split, "images", "*.jpg"))):
+        label_path = os.path.join(dataset_dir, split, "labels", os.path.splitext(os.path.basename(path))[0] + ".txt")
+        with open(label_path) as f:
+            tokens = f.read().split()
+        image = cv2.imread(path)
+        if image is not None:
+            images.append(image)
+            labels.append(bool(tokens) and int(tokens[0]) == 0)
+    return images, np.array(labels, dtype=bool)
+
+
+def evaluate_dataset(dataset_dir, model, conf=0.4, band: Optional[CascadeBand] = None, **calibration):
+    """
+    So độ chính xác (theo nhãn) của model đơn thuần và cascade trên tập valid + test của AI/dataset.
+    Không truyền `band` thì dải được hiệu chỉnh trên tập train, dùng model làm chuẩn.
+    """
+    from .detection import predict_filled
+
+    def ratios_of(images):
+        return np.array([fill_ratios(img, [(0, 0, img.shape[1], img.shape[0])],
+                                     band.inset if band else calibration.get("inset", DEFAULT_INSET),
+                                     band.dark_threshold if band else None)[0]
+                         for img in images], dtype=np.float32)
+
+    if band is None:
+        train_images, _ = _load_dataset_split(dataset_dir, "train")
+        band = calibrate_band(ratios_of(train_images), predict_filled(train_images, model, conf), **calibration)
+
+    images, labels = [], []
+    for split in ("valid", "test"):
+        split_images, split_labels = _load_dataset_split(dataset_dir, split)
+        images += split_images
+        labels.append(split_labels)
+    labels = np.concatenate(labels)
+    model_filled = predict_filled(images, model, conf)
+    decided_filled, uncertain = cascade_decisions(ratios_of(images), band)
+    cascade_filled = np.where(uncertain, model_filled, decided_filled)
+    return {
+        "band": band.to_config(),
+        "samples": int(len(labels)),
+        "model_accuracy": float(np.mean(model_filled == labels)),
+        "cascade_accuracy": float(np.mean(cascade_filled == labels)),
+        "model_fraction": float(uncertain.mean()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate and evaluate the two-stage bubble classifier.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    calibrate = sub.add_parser("calibrate", help="Hiệu chỉnh dải ngưỡng cho một template từ các phiếu mẫu.")
+    calibrate.add_argument("images", nargs="+", help="Ảnh phiếu mẫu (chưa căn chỉnh).")
+    calibrate.add_argument("-t", "--template", required=True, help="Đường dẫn template.json.")
+    calibrate.add_argument("--write", action="store_true", help=f"Ghi kết quả vào {CASCADE_FILENAME} cạnh template.")
+
+    evaluate = sub.add_parser("evaluate", help="So độ chính xác model / cascade trên AI/dataset.")
+    evaluate.add_argument("--dataset", required=True, help="Thư mục AI/dataset (train/valid/test).")
+    evaluate.add_argument("-t", "--template", help="Dùng dải của template thay vì hiệu chỉnh trên tập train.")
+
+    for command in (calibrate, evaluate):
+        command.add_argument("-m", "--model", required=True, help="Model phân loại bubble (best.pt).")
+        command.add_argument("-c", "--conf", type=float, default=0.4, help="Confidence threshold (default: 0.4).")
+        command.add_argument("--max-error", type=float, default=0.0,
+                             help="Tỉ lệ lỗi tối đa so với model ngoài dải, mỗi phía (default: 0).")
+        command.add_argument("--margin", type=float, default=0.02, help="Biên an toàn cộng vào dải (default: 0.02).")
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        band, report = calibrate_template(args.images, args.template, args.model, args.conf,
+                                          args.max_error, args.margin)
+        print(f"Band: {band.to_config()}")
+        print(f"Sheets: {report['sheets']} | bubbles: {report['bubbles']} | "
+              f"sent to model: {report['model_fraction']:.1%} | disagreements: {report['disagreements']}")
+        if args.write:
+            print(f"Written to {write_cascade_config(args.template, band, **report)}")
+        return
+
+    from .model_registry import get_yolo_model
+    band = None
+    if args.template:
+        band = CascadeBand.from_config(load_cascade_config(args.template))
+        if band is None:
+            raise SystemExit(f"Template {args.template} has no cascade calibration")
+    report = evaluate_dataset(args.dataset, get_yolo_model(args.model), args.conf, band,
+                              max_error=args.max_error, margin=args.margin)
+    print(f"Band: {report['band']}")
+    print(f"Samples: {report['samples']} | sent to model: {report['model_fraction']:.1%}")
+    print(f"Model accuracy  : {report['model_accuracy']:.4f}")
+    print(f"Cascade accuracy: {report['cascade_accuracy']:.4f}")
+    if report["cascade_accuracy"] < report["model_accuracy"]:
+        raise SystemExit("Cascade accuracy regressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,125 @@
 import cv2
 import os
+import numpy as np
+
+from .cascade import cascade_decisions, clamp_bounds, fill_ratios
+from .template import CompiledTemplate
 
 def sharpen_image_cv(img, strength=1.0):
     blurred = cv2.GaussianBlur(img, (9, 9), 10.0)
     sharpened = cv2.addWeighted(img, 1.0 + strength, blurred, -strength, 0)
     return sharpened
 
-def classify_bubbles_batch(image, bubbles, yolo_model, conf):
-    results, rois_batch, valid_bubbles = {}, [], []
-    if not bubbles: return results
+def sharpen_regions(image, regions, strength=1.0, ksize=9, sigma=10.0):
+    """
+    Unsharp mask như sharpen_image_cv nhưng chỉ trên các vùng `regions` (x1, y1, x2, y2), ghi tại chỗ
+    vào `image` và trả về chính nó. Mỗi vùng được blur kèm viền ksize // 2 px nên pixel trong vùng giống
+    hệt khi làm nét cả trang; mọi vùng được tính từ ảnh gốc trước khi ghi nên vùng chồng nhau không bị
+    làm nét hai lần.
+    """
     h, w = image.shape[:2]
-    for bubble in bubbles:
-        x1, y1, x2, y2 = [max(0, val) if i < 2 else min(bound, val) for i, (val, bound) in
-                          enumerate(zip(bubble['bounds'], [w, h, w, h]))]
-        if x2 > x1 and y2 > y1 and (roi := image[y1:y2, x1:x2]).size > 0:
-            if len(roi.shape) == 2:
-                roi = cv2.cvtColor(roi, cv2.COLOR_GRAY2RGB)
-            elif roi.shape[2] == 4:
-                roi = cv2.cvtColor(roi, cv2.COLOR_BGRA2BGR)
-            roi = cv2.resize(roi, (54, 54))
-            rois_batch.append(roi)
-            valid_bubbles.append(bubble)
-    if not rois_batch: return results
-    for i, pred in enumerate(yolo_model(rois_batch, verbose=False, conf=conf)):
-        if hasattr(pred, 'boxes') and len(pred.boxes) > 0 and int(pred.boxes.cls[0]) == 0:
-            bubble = valid_bubbles[i]
-            results.setdefault(bubble['qid'], []).append(bubble['choice'])
+    pad = ksize // 2
+    patches = []
+    for x1, y1, x2, y2 in np.clip(np.asarray(regions, dtype=np.int64).reshape(-1, 4), 0, [w, h, w, h]).tolist():
+        if x2 <= x1 or y2 <= y1:
+            continue
+        wx1, wy1, wx2, wy2 = max(0, x1 - pad), max(0, y1 - pad), min(w, x2 + pad), min(h, y2 + pad)
+        window = image[wy1:wy2, wx1:wx2]
+        blurred = cv2.GaussianBlur(window, (ksize, ksize), sigma)
+        sharpened = cv2.addWeighted(window, 1.0 + strength, blurred, -strength, 0)
+        patches.append(((x1, y1, x2, y2), sharpened[y1 - wy1:y2 - wy1, x1 - wx1:x2 - wx1]))
+    for (x1, y1, x2, y2), patch in patches:
+        image[y1:y2, x1:x2] = patch
+    return image
+
+BUBBLE_INPUT_SIZE = 54
+
+def _bubble_arrays(bubbles):
+    """Trả về (bounds, labels) cho CompiledTemplate hoặc list dict từ get_all_bubbles"""
+    if isinstance(bubbles, CompiledTemplate):
+        return bubbles.bounds, bubbles.labels
+    return np.array([b['bounds'] for b in bubbles], dtype=np.int32).reshape(-1, 4), \
+        [(b['qid'], b['choice']) for b in bubbles]
+
+def extract_bubble_rois(image, bounds, size=BUBBLE_INPUT_SIZE):
+    """
+    Cắt tất cả bubble ROI vào một tensor liên tục (N, size, size, 3) uint8.
+
+    Bounds được clamp cùng lúc bằng NumPy, mỗi ROI (view, không copy) được resize
+    thẳng vào slot của nó trong tensor cấp phát sẵn; ROI đã đúng kích thước thì copy trực tiếp.
+    Trả về (batch, valid_idx) với valid_idx là chỉ số bubble hợp lệ trong `bounds`.
+    """
+    clamped, valid_idx = clamp_bounds(bounds, image.shape)
+
+    batch = np.empty((len(valid_idx), size, size, 3), dtype=np.uint8)
+    gray = image.ndim == 2
+    bgra = not gray and image.shape[2] == 4
+    for out, (x1, y1, x2, y2) in zip(batch, clamped[valid_idx].tolist()):
+        roi = image[y1:y2, x1:x2]
+        if gray:
+            roi = cv2.cvtColor(roi, cv2.COLOR_GRAY2RGB)
+        elif bgra:
+            roi = cv2.cvtColor(roi, cv2.COLOR_BGRA2BGR)
+        if roi.shape[0] == size and roi.shape[1] == size:
+            out[...] = roi
+        else:
+            cv2.resize(roi, (size, size), dst=out)
+    return batch, valid_idx
+
+def prepare_bubbles(image, bounds, band=None):
+    """
+    Tầng 1 của cascade: quyết định sẵn các bubble rõ ràng bằng tỉ lệ pixel tối (khi có `band`)
+    và chỉ cắt ROI cho các bubble còn lại.
+
+    Trả về (filled, valid_idx, model_pos, rois): filled là mảng bool theo valid_idx, rois là ROI cần
+    chạy model và model_pos là vị trí tương ứng của chúng trong filled. Không có band thì mọi bubble qua model.
+    """
+    clamped, valid_idx = clamp_bounds(bounds, image.shape)
+    if band is None:
+        rois, _ = extract_bubble_rois(image, clamped[valid_idx])
+        return np.zeros(len(valid_idx), dtype=bool), valid_idx, np.arange(len(valid_idx)), rois
+    filled, uncertain = cascade_decisions(
+        fill_ratios(image, clamped[valid_idx], band.inset, band.dark_threshold), band
+    )
+    model_pos = np.flatnonzero(uncertain)
+    rois, _ = extract_bubble_rois(image, clamped[valid_idx[model_pos]])
+    return filled, valid_idx, model_pos, rois
+
+def predict_filled(rois, yolo_model, conf):
+    """Chạy model trên các ROI 54x54, trả về mảng bool (True = bubble được tô)"""
+    if len(rois) == 0:
+        return np.zeros(0, dtype=bool)
+    # Backend khác ultralytics (vd OnnxBubbleClassifier) tự trả về mảng bool
+    if hasattr(yolo_model, 'predict_filled'):
+        return yolo_model.predict_filled(rois, conf)
+    preds = yolo_model(list(rois), verbose=False, conf=conf)
+    return np.array([hasattr(pred, 'boxes') and len(pred.boxes) > 0 and int(pred.boxes.cls[0]) == 0
+                     for pred in preds], dtype=bool)
+
+def decode_bubble_results(filled, valid_idx, labels):
+    """Ghép kết quả bool theo từng ROI hợp lệ thành dict {qid: đáp án}"""
+    results = {}
+    for i in valid_idx[filled].tolist():
+        qid, choice = labels[i]
+        results.setdefault(qid, []).append(choice)
     for k in results:
         results[k] = ''.join(sorted(results[k])) if len(results[k]) > 1 else results[k][0]
     return results
 
+def classify_bubbles_batch(image, bubbles, yolo_model, conf, band=None, stats=None):
+    """
+    Phân loại mọi bubble của phiếu; có `band` (CascadeBand) thì chỉ bubble không chắc chắn qua model.
+    `stats` (dict, tùy chọn) nhận số bubble và số bubble đã qua model.
+    """
+    if bubbles is None or len(bubbles) == 0: return {}
+    bounds, labels = _bubble_arrays(bubbles)
+    filled, valid_idx, model_pos, rois = prepare_bubbles(image, bounds, band)
+    # ROI là các view trên cùng một tensor liên tục, không copy thêm ROI nào
+    filled[model_pos] = predict_filled(rois, yolo_model, conf)
+    if stats is not None:
+        stats.update(bubbles=len(valid_idx), model=len(model_pos))
+    return decode_bubble_results(filled, valid_idx, labels)
+
 def draw_selected_answers(image, bubbles, results, out_path):
     img, lookup = image.copy(), {f"{b['qid']}_{b['choice']}": b for b in bubbles}
     for qid, answer in results.items():
@@ -76,8 +166,12 @@ def draw_scoring_overlay(image, bubbles, student_results, answer_key, out_path):
     - Xanh: Đúng (student chọn + đáp án đúng)
     - Đỏ: Sai (student chọn + đáp án sai)
     """
-    img = image.copy()
-    lookup = {f"{b['qid']}_{b['choice']}": b for b in bubbles}
+    # Ảnh grayscale (pipeline lean) được chuyển sang BGR để vẽ màu; bản chuyển đổi đã là ảnh mới
+    img = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+    if isinstance(bubbles, CompiledTemplate):
+        lookup = bubbles.bounds_lookup
+    else:
+        lookup = {f"{b['qid']}_{b['choice']}": b['bounds'] for b in bubbles}
 
     # Tạo sets để lookup nhanh
     answer_correct_keys = set()
@@ -97,8 +191,8 @@ def draw_scoring_overlay(image, bubbles, student_results, answer_key, out_path):
     WRONG_COLOR = (0, 0, 255)        # Đỏ - Sai
     
     # Vẽ từng bubble
-    for key, bubble in lookup.items():
-        x1, y1, x2, y2 = bubble['bounds']
+    for key, bounds in lookup.items():
+        x1, y1, x2, y2 = bounds
         
         # Chỉ vẽ những bubble student đã chọn
         if key in student_selected_keys:
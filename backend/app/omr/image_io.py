@@ -0,0 +1,140 @@
+# image_io.py
+"""
+Đọc ảnh phiếu từ đường dẫn, bytes đã mã hóa hoặc mảng đã decode.
+
+Ảnh upload / frame WebSocket đi thẳng vào pipeline dưới dạng SheetImage (bytes picklable, gửi được
+sang worker) và chỉ được decode một lần bằng cv2.imdecode, không qua file tạm. Kiểm tra magic bytes
+chạy trên buffer thay vì mở lại file.
+"""
+import logging
+import os
+from typing import Any, NamedTuple, Optional
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"BM", "bmp"),
+)
+
+
+class SheetImage(NamedTuple):
+    """
+    Ảnh phiếu trong bộ nhớ: `data` là bytes JPEG/PNG/BMP hoặc ndarray đã decode, `name` để đặt tên
+    kết quả, `path` là nơi ảnh gốc được (hoặc sẽ được) lưu, dùng để đặt ảnh căn chỉnh khi save_files.
+    """
+    data: Any
+    name: str
+    path: Optional[str] = None
+
+
+def sniff_image_format(data) -> Optional[str]:
+    """"jpeg" / "png" / "bmp" / "webp" theo magic bytes đầu buffer, None nếu không phải ảnh hỗ trợ."""
+    header = bytes(memoryview(data)[:12])
+    for signature, kind in _SIGNATURES:
+        if header.startswith(signature):
+            return kind
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def decode_image(data, flags=cv2.IMREAD_COLOR):
+    """
+    Decode bytes ảnh một lần bằng cv2.imdecode. `flags` cho phép đọc thẳng sang grayscale
+    (cv2.IMREAD_GRAYSCALE) hoặc thu nhỏ khi decode (cv2.IMREAD_REDUCED_COLOR_2/4/8).
+    Trả về None nếu buffer không phải ảnh hợp lệ.
+    """
+    if sniff_image_format(data) is None:
+        return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+
+def image_name(img) -> str:
+    """Tên file (có phần mở rộng) của đầu vào, dùng cho log và thông báo lỗi."""
+    if isinstance(img, SheetImage):
+        return os.path.basename(img.name)
+    return os.path.basename(str(img))
+
+
+def image_stem(img) -> str:
+    return os.path.splitext(image_name(img))[0]
+
+
+def image_path(img) -> Optional[str]:
+    """Đường dẫn lưu ảnh gốc nếu có (ảnh trong bộ nhớ có thể chưa được ghi xuống đĩa)."""
+    if isinstance(img, SheetImage):
+        return img.path
+    return str(img)
+
+
+def read_image(img, flags=cv2.IMREAD_COLOR, check_format=False):
+    """
+    Đọc ảnh từ đường dẫn hoặc SheetImage; None nếu không tồn tại hoặc không decode được.
+    Bytes trong bộ nhớ luôn được kiểm tra magic bytes; file trên đĩa chỉ khi `check_format`
+    (đọc bytes một lần, kiểm tra và decode trên cùng buffer).
+    """
+    if isinstance(img, SheetImage):
+        if isinstance(img.data, np.ndarray):
+            return img.data
+        image = decode_image(img.data, flags)
+        if image is None:
+            logger.warning(f"Could not decode image {img.name}")
+        return image
+
+    if not os.path.exists(img):
+        logger.error(f"Image file not found: {img}")
+        return None
+    if check_format:
+        image = decode_image(np.fromfile(img, dtype=np.uint8), flags)
+    else:
+        image = cv2.imread(img, flags)
+    if image is None:
+        logger.warning(f"Could not read image {img}")
+    return image
+
+
+def persist_image(img: SheetImage) -> Optional[str]:
+    """Ghi ảnh gốc của SheetImage xuống `img.path` (gọi ngoài đường xử lý, vd qua asyncio.to_thread)."""
+    if not img.path:
+        return None
+    os.makedirs(os.path.dirname(img.path) or ".", exist_ok=True)
+    if isinstance(img.data, np.ndarray):
+        cv2.imwrite(img.path, img.data)
+    else:
+        with open(img.path, "wb") as f:
+            f.write(img.data)
+    return img.path
+
+
+# Ảnh thu nhỏ để so khớp phiếu trùng: đủ lớn để một bubble được tô (~5 px) vẫn thấy rõ
+FINGERPRINT_SIZE = 256
+
+
+def sheet_fingerprint(img):
+    """
+    (perceptual hash 64 bit, ảnh xám thu nhỏ FINGERPRINT_SIZE x FINGERPRINT_SIZE) của một ảnh phiếu, dùng
+    nhận ra cùng một ảnh đã bị encode lại hoặc đổi kích thước. None nếu không decode được.
+    Ảnh thu nhỏ được làm mịn sẵn để nhiễu encode / nội suy không bị tính là khác biệt.
+    """
+    if isinstance(img, np.ndarray):
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = decode_image(img, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    thumb = cv2.GaussianBlur(
+        cv2.resize(gray, (FINGERPRINT_SIZE, FINGERPRINT_SIZE), interpolation=cv2.INTER_AREA), (3, 3), 0
+    )
+    dct = cv2.dct(np.float32(cv2.resize(thumb, (32, 32), interpolation=cv2.INTER_AREA)))[:8, :8].flatten()
+    bits = dct > np.median(dct[1:])
+    return int(np.packbits(bits).view(">u8")[0]), thumb
+
+
+def fingerprint_distance(thumb_a, thumb_b) -> int:
+    """Khác biệt cục bộ lớn nhất (0-255) giữa hai ảnh thu nhỏ; một bubble được tô thêm cho giá trị vài chục trở lên."""
+    return int(cv2.GaussianBlur(cv2.absdiff(thumb_a, thumb_b), (5, 5), 0).max())
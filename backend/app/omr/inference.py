@@ -0,0 +1,121 @@
+# inference.py
+"""
+Backend suy luận ONNX Runtime cho model phân loại bubble (chạy CPU, không cần PyTorch).
+
+Model `.pt` được export sang `.onnx` một lần (cạnh file `.pt`, export lại khi `.pt` mới hơn).
+Tiền xử lý và quyết định "đã tô" giống hệt đường ultralytics với model `.pt`:
+letterbox ROI về imgsz của model (giữ tỷ lệ, viền 114; khi mọi ROI cùng kích thước chỉ pad tới bội
+của stride như LetterBox(auto=True)), BGR->RGB, /255, và bubble được tô khi box có confidence
+cao nhất (> conf) thuộc class 0. Model export với dynamic=True nhận được kích thước đầu vào khác imgsz.
+"""
+import ast
+import logging
+import os
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Số ROI mỗi lần session.run, giữ tensor float32 đầu vào ở mức vài MB
+ONNX_CHUNK_SIZE = 256
+# Màu viền letterbox của ultralytics
+LETTERBOX_COLOR = (114, 114, 114)
+
+
+def letterbox(img, new_shape, auto=False, stride=32):
+    """Như ultralytics LetterBox(new_shape, auto, stride=stride) với scaleup và căn giữa mặc định."""
+    shape = img.shape[:2]
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]
+    if auto:
+        dw, dh = np.mod(dw, stride), np.mod(dh, stride)
+    dw /= 2
+    dh /= 2
+    if shape[::-1] != new_unpad:
+        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    if top or bottom or left or right:
+        img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+    return img
+
+
+def export_onnx(model_path, onnx_path=None):
+    """Export model ultralytics `.pt` sang ONNX (batch động) nếu chưa có hoặc đã cũ."""
+    onnx_path = onnx_path or os.path.splitext(model_path)[0] + ".onnx"
+    if os.path.exists(onnx_path) and os.path.getmtime(onnx_path) >= os.path.getmtime(model_path):
+        return onnx_path
+
+    from ultralytics import YOLO
+    logger.info(f"Exporting {model_path} to ONNX: {onnx_path}")
+    exported = YOLO(model_path).export(format="onnx", dynamic=True, simplify=False)
+    if os.path.abspath(exported) != os.path.abspath(onnx_path):
+        os.replace(exported, onnx_path)
+    return onnx_path
+
+
+class OnnxBubbleClassifier:
+    """Phân loại bubble bằng onnxruntime, gọi được như model ultralytics trong predict_filled."""
+
+    def __init__(self, onnx_path, intra_op_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+
+        self.onnx_path = onnx_path
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.imgsz = self._read_imgsz(metadata)
+        self.stride = int(ast.literal_eval(metadata["stride"])) if "stride" in metadata else 32
+
+    def _read_imgsz(self, metadata):
+        # ultralytics ghi imgsz vào metadata của file ONNX, vd "[64, 64]"
+        if "imgsz" in metadata:
+            h, w = ast.literal_eval(metadata["imgsz"])
+            return int(h), int(w)
+        _, _, h, w = self.session.get_inputs()[0].shape
+        return int(h), int(w)
+
+    def _preprocess(self, rois, auto):
+        boxed = [letterbox(roi, self.imgsz, auto=auto, stride=self.stride) for roi in rois]
+        h, w = boxed[0].shape[:2]
+        blob = np.empty((len(boxed), 3, h, w), dtype=np.float32)
+        for out, roi in zip(blob, boxed):
+            out[...] = roi[..., ::-1].transpose(2, 0, 1)
+        blob *= 1.0 / 255.0
+        return blob
+
+    def predict_filled(self, rois, conf):
+        """Trả về mảng bool (True = bubble được tô) cho list/tensor ROI BGR uint8."""
+        filled = np.zeros(len(rois), dtype=bool)
+        if len(rois) == 0:
+            return filled
+        # ultralytics chỉ dùng letterbox tối thiểu (auto) khi mọi ảnh của lần predict cùng kích thước
+        auto = isinstance(rois, np.ndarray) or len({roi.shape for roi in rois}) == 1
+        for start in range(0, len(rois), ONNX_CHUNK_SIZE):
+            chunk = rois[start:start + ONNX_CHUNK_SIZE]
+            # Output head detect: (B, 4 + nc, anchors), cột 4: là điểm theo từng class
+            scores = self.session.run(None, {self.input_name: self._preprocess(chunk, auto)})[0][:, 4:, :]
+            flat = scores.reshape(len(chunk), -1)
+            best = flat.argmax(axis=1)
+            best_score = flat[np.arange(len(chunk)), best]
+            best_cls = best // scores.shape[2]
+            filled[start:start + len(chunk)] = (best_score > conf) & (best_cls == 0)
+        return filled
+
+    def __call__(self, images, verbose=False, conf=0.25):
+        return self.predict_filled(images, conf)
+
+
+def load_onnx_classifier(model_path, intra_op_threads=0):
+    """Export (nếu cần) và mở session ONNX cho model `.pt` (hoặc mở trực tiếp file `.onnx`)."""
+    onnx_path = model_path if model_path.endswith(".onnx") else export_onnx(model_path)
+    return OnnxBubbleClassifier(onnx_path, intra_op_threads=intra_op_threads)
@@ -0,0 +1,130 @@
+# jobs.py
+"""
+Các job OMR chạy trong worker process (xem app/services/omr_worker_pool.py).
+
+Tham số và kết quả đều picklable; model, template và reference features được cache
+theo từng process nên worker chỉ load chúng ở job đầu tiên (model được preload lúc khởi tạo).
+Ảnh đầu vào là đường dẫn hoặc SheetImage (bytes upload gửi thẳng sang worker, không qua file tạm).
+"""
+import logging
+import os
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+import cv2
+
+from .detection import draw_scoring_overlay
+from .image_io import SheetImage
+from .main_pipeline import OMRAligner, process_single_image, iter_process_images_batched, _load_and_align
+from .model_registry import get_yolo_model, model_registry
+from .template import get_compiled_template
+
+logger = logging.getLogger(__name__)
+
+
+def init_worker(model_path, max_memory_mb=0):
+    """Initializer của worker: giới hạn bộ nhớ (address space) và preload model."""
+    if max_memory_mb:
+        try:
+            import resource
+            limit = int(max_memory_mb) * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            logger.warning(f"Could not set worker memory limit: {e}")
+    model_registry.preload(model_path)
+    logger.info(f"OMR worker {os.getpid()} ready")
+
+
+def _as_input(img):
+    return img if isinstance(img, SheetImage) else str(img)
+
+
+def _make_aligner(template_path):
+    template_dir = os.path.dirname(template_path)
+    ref_images = list(Path(template_dir).glob("*.png")) + list(Path(template_dir).glob("*.jpg"))
+    if not ref_images:
+        return None
+    return OMRAligner(ref_img_path=str(ref_images[0]))
+
+
+class EncodedSheet(NamedTuple):
+    """Ảnh căn chỉnh (và ảnh annotation nếu được yêu cầu) đã encode JPEG trong worker."""
+    aligned_jpeg: bytes
+    annotated_jpeg: Optional[bytes] = None
+
+
+def _encode_jpeg(image, jpeg_quality) -> Optional[bytes]:
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)])
+    return buffer.tobytes() if ok else None
+
+
+def encode_sheet(aligned, template, results, jpeg_quality, annotation_keys: Optional[Dict[str, Dict]] = None):
+    """
+    EncodedSheet của ảnh căn chỉnh; với `annotation_keys` ({mã đề: đáp án}) vẽ thêm annotation chấm điểm
+    theo đáp án của mã đề nhận diện được trên phiếu.
+    """
+    annotated = None
+    if annotation_keys is not None and "error" not in results:
+        ma_de = str(results.get("_metadata", {}).get("ma_de", ""))
+        try:
+            overlay = draw_scoring_overlay(aligned, template, results, annotation_keys.get(ma_de, {}), None)
+            annotated = _encode_jpeg(overlay, jpeg_quality)
+        except Exception as e:
+            logger.error(f"Annotation drawing failed: {e}")
+    return EncodedSheet(_encode_jpeg(aligned, jpeg_quality), annotated)
+
+
+def process_sheet_job(img_path, template_path, template_id=None, model_path=None, conf=0.4,
+                      auto_align=True, save_files=False, return_aligned=True, jpeg_quality=0,
+                      annotation_keys=None):
+    """
+    Xử lý một phiếu, trả về (fname, results, aligned_image hoặc None).
+
+    Với `jpeg_quality`, ảnh căn chỉnh được encode ngay trong worker và phần tử thứ ba là EncodedSheet:
+    chỉ vài trăm KB bytes JPEG đi qua IPC thay vì cả mảng ảnh ~18 MB mỗi frame.
+    """
+    template = get_compiled_template(template_path, template_id)
+    aligner = _make_aligner(template_path) if auto_align else None
+    fname, results, aligned = process_single_image(
+        _as_input(img_path), template, get_yolo_model(model_path), conf, aligner, save_files=save_files
+    )
+    if not return_aligned or aligned is None:
+        return fname, results, None
+    if jpeg_quality:
+        return fname, results, encode_sheet(aligned, template, results, jpeg_quality, annotation_keys)
+    return fname, results, aligned
+
+
+def process_batch_job(img_paths, template_path, template_id=None, model_path=None, conf=0.4,
+                      auto_align=True, save_files=False, inference_batch_size=1024, return_aligned=False):
+    """Xử lý nhiều phiếu với inference gộp, trả về list (fname, results, aligned_image hoặc None)."""
+    template = get_compiled_template(template_path, template_id)
+    aligner = _make_aligner(template_path) if auto_align else None
+    sheets = iter_process_images_batched(
+        [_as_input(p) for p in img_paths], template, get_yolo_model(model_path), conf, aligner,
+        save_files=save_files, inference_batch_size=inference_batch_size
+    )
+    return [(fname, results, aligned if return_aligned else None) for fname, results, aligned in sheets]
+
+
+def render_annotation_job(image_path, aligned_path, template_path, template_id=None, student_results=None,
+                          answer_key=None, max_width=0, jpeg_quality=85):
+    """
+    Vẽ annotation chấm điểm lên ảnh đã căn chỉnh và encode JPEG trong bộ nhớ, trả về bytes
+    (None nếu không đọc được ảnh). Chưa có ảnh căn chỉnh thì căn chỉnh lại từ ảnh gốc và lưu lại.
+    """
+    template = get_compiled_template(template_path, template_id)
+    image = cv2.imread(aligned_path) if aligned_path and os.path.exists(aligned_path) else None
+    if image is None:
+        if not image_path:
+            return None
+        _, image, _ = _load_and_align(image_path, _make_aligner(template_path), save_files=True, compiled=template)
+        if image is None:
+            return None
+
+    annotated = draw_scoring_overlay(image, template, student_results or {}, answer_key or {}, None)
+    height, width = annotated.shape[:2]
+    if max_width and width > max_width:
+        annotated = cv2.resize(annotated, (max_width, round(height * max_width / width)), interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode(".jpg", annotated, [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)])
+    return buffer.tobytes() if ok else None
@@ -7,8 +7,11 @@ import multiprocessing
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from ultralytics import YOLO
 import pandas as pd
-from .template import load_template, get_all_bubbles
-from .detection import classify_bubbles_batch, draw_selected_answers, draw_scoring_overlay
+from .template import load_template, compile_template
+from .detection import (
+    classify_bubbles_batch, draw_selected_answers, draw_scoring_overlay,
+    predict_filled, decode_bubble_results, prepare_bubbles, sharpen_regions
+)
 from .src.utils.extract_special_code import extract_special_code
 from .src.utils.group_answers import group_answers, group_scores
 import logging
@@ -18,6 +21,9 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 # 1. Import aligner gốc
 from .src.processors.AdvancedFeatureAlignment import AdvancedFeatureAlignment
+from .src.processors.CornerMarkerAlignment import CornerMarkerAlignment
+from .aligner_cache import get_reference_features
+from .image_io import image_name, image_path, image_stem, read_image
 
 # 2. MockConfig tối thiểu cho aligner
 class MockConfig:
@@ -35,8 +41,15 @@ class MockConfig:
         self.outputs.show_image_level = 3 if debug else 0
 
 class OMRAligner:
-    def __init__(self, ref_img_path, method='ORB', max_features=5000, good_match_percent=0.2, debug=False):
+    def __init__(self, ref_img_path, method='ORB', max_features=5000, good_match_percent=0.2, debug=False, mode=None,
+                 use_markers=None):
+        from app.core.config import settings
         self.config = MockConfig(width=2084, height=2947, debug=debug)
+        # "standard" (ORB full-resolution + BFMatcher, mặc định) hoặc "pyramid" (coarse-to-fine)
+        if mode is None:
+            mode = settings.OMR_ALIGNMENT_MODE
+        if use_markers is None:
+            use_markers = settings.OMR_MARKER_ALIGNMENT
         
         # Auto-find reference image in template directory
         if ref_img_path.endswith('.json'):
@@ -61,16 +74,52 @@ class OMRAligner:
             "featureType": method,
             "maxFeatures": max_features,
             "goodMatchPercent": good_match_percent,
-            "resizeTemplate": False
+            "resizeTemplate": False,
+            "alignmentMode": mode
         }
+        # Keypoints/descriptors của reference được cache theo (path, mtime, method, max_features)
+        reference_features = get_reference_features(
+            ref_img_path, method, max_features,
+            self.config.dimensions.processing_width, self.config.dimensions.processing_height
+        )
         self.aligner = AdvancedFeatureAlignment(
             options=options,
             tuning_config=self.config,
-            relative_dir=Path(".")
+            relative_dir=Path("."),
+            reference_features=reference_features
         )
 
+        # Fast-path: 4 marker góc; marker của reference được detect một lần và giữ cùng reference_features
+        self.marker_aligner = None
+        if use_markers:
+            self.marker_aligner = CornerMarkerAlignment(
+                options={"reference": ref_img_path, "minConfidence": settings.OMR_MARKER_MIN_CONFIDENCE},
+                tuning_config=self.config,
+                relative_dir=Path("."),
+                reference_image=reference_features.ref_img,
+                reference_markers=reference_features.corner_markers
+            )
+            reference_features.corner_markers = (self.marker_aligner.ref_markers, self.marker_aligner.ref_marker_area)
+            if not self.marker_aligner.available:
+                self.marker_aligner = None
+
+        # Đường căn chỉnh ("markers" / "features" / "none") và thống kê của lần align gần nhất
+        self.last_path = None
+        self.last_stats = {}
+
     def align(self, image):
+        marker_stats = {}
+        if self.marker_aligner is not None:
+            aligned = self.marker_aligner.apply_filter(image, "")
+            marker_stats = {"marker_confidence": self.marker_aligner.last_stats.get("confidence", 0.0)}
+            if aligned is not None:
+                self.last_path = "markers"
+                self.last_stats = {"path": self.last_path, **self.marker_aligner.last_stats, **marker_stats}
+                return aligned
+
         aligned = self.aligner.apply_filter(image, "")
+        self.last_path = "features" if aligned is not None else "none"
+        self.last_stats = {"path": self.last_path, **self.aligner.last_stats, **marker_stats}
         return aligned if aligned is not None else image
 
     def cleanup(self):
@@ -93,88 +142,202 @@ def scoring_by_key(student_results, answer_key, score_key):
 
 # -------------------------------------------------
 
+def _lean_default(lean):
+    if lean is None:
+        from app.core.config import settings
+        lean = settings.OMR_LEAN_PIPELINE
+    return lean
+
+def _cascade_band(compiled):
+    """Dải ngưỡng cascade của template nếu đã hiệu chỉnh và OMR_CASCADE_ENABLED bật."""
+    from app.core.config import settings
+    return compiled.cascade_band if settings.OMR_CASCADE_ENABLED else None
+
+def _sharpen_aligned(aligned_image, compiled=None):
+    """
+    Làm nét ảnh sau khi align, tại chỗ trên ảnh align. Biết template thì chỉ làm nét các vùng bubble
+    (kết quả trong vùng bubble giống hệt làm nét cả trang), không thì làm nét cả trang.
+    """
+    if compiled is not None and len(compiled.field_regions):
+        regions = compiled.field_regions
+    else:
+        regions = [(0, 0, aligned_image.shape[1], aligned_image.shape[0])]
+    return sharpen_regions(aligned_image, regions, strength=1.2)
+
+def _load_and_align(img_path, aligner=None, save_files=False, compiled=None, lean=None):
+    """
+    Đọc ảnh (đường dẫn hoặc SheetImage trong bộ nhớ), căn chỉnh và làm nét (nếu có aligner).
+    Trả về (processing_image, aligned_image_to_return, alignment_path) hoặc (None, None, None)
+    nếu không đọc được ảnh; alignment_path là "markers", "features", "none" hoặc None khi không align.
+
+    Hai ảnh trả về là cùng một mảng (view, không copy). Chế độ lean (OMR_LEAN_PIPELINE) decode thẳng
+    sang grayscale, bằng 1/3 bộ nhớ của ảnh màu; làm nét chỉ chạy trên vùng bubble của `compiled`.
+    """
+    image = read_image(img_path, cv2.IMREAD_GRAYSCALE if _lean_default(lean) else cv2.IMREAD_COLOR)
+    if image is None:
+        return None, None, None
+
+    if not aligner:
+        return image, image, None
+
+    logging.info(f"-> Aligning image: {image_name(img_path)}")
+    try:
+        aligned_image = aligner.align(image)
+        if aligned_image is None:
+            return image, image, "none"
+        source_path = image_path(img_path)
+        if save_files and source_path:
+            aligned_dir = os.path.join(os.path.dirname(source_path), "aligned_results")
+            os.makedirs(aligned_dir, exist_ok=True)
+            aligned_out_path = os.path.join(aligned_dir, f"{image_stem(img_path)}_aligned.jpg")
+            cv2.imwrite(aligned_out_path, aligned_image)
+
+        # Làm nét tại chỗ; mảng do caller truyền vào (SheetImage ndarray) thì không được sửa
+        if aligned_image is getattr(img_path, "data", None):
+            aligned_image = aligned_image.copy()
+        sharpened = _sharpen_aligned(aligned_image, compiled)
+        return sharpened, sharpened, getattr(aligner, "last_path", "features")
+    except Exception as e:
+        logging.warning(f"Alignment failed, using original image: {e}")
+        return image, image, "none"
+
+def _cascade_metadata(stats):
+    """Số bubble và tỉ lệ đã qua model của một phiếu, None khi không dùng cascade."""
+    if not stats or stats.get("band") is None:
+        return None
+    total = stats["bubbles"]
+    return {"bubbles": total, "model": stats["model"],
+            "model_fraction": round(stats["model"] / total, 4) if total else 0.0}
+
+def _attach_metadata(results, fname, alignment_path=None, cascade=None):
+    """Extract special codes (SBD, mã đề) và gắn `_metadata` vào kết quả"""
+    results["_metadata"] = {
+        "sbd": extract_special_code(results, "sbd"),
+        "ma_de": extract_special_code(results, "mdt"),
+        "filename": fname,
+        "total_questions": len([k for k in results.keys() if not k.startswith("_")]),
+        "alignment_path": alignment_path
+    }
+    if cascade is not None:
+        results["_metadata"]["cascade"] = cascade
+    return results
+
 def process_single_image(img_path, template, yolo_model, conf, aligner=None, answer_key_excel=None, save_files=False):
     """
     Xử lý một ảnh OMR với tối ưu hóa và loại bỏ các công việc thừa
     """
-    aligned_image_to_return = None
     try:
-        # 1. Kiểm tra file ảnh
-        if not os.path.exists(img_path):
-            logging.error(f"Image file not found: {img_path}")
-            return os.path.basename(img_path), {}, None
-        
-        # Bỏ qua kiểm tra header của file, tin tưởng vào cv2.imread
-        
-        # 2. Đọc ảnh
-        image = cv2.imread(img_path)
-        if image is None:
-            logging.warning(f"Could not read image {img_path}")
-            return os.path.basename(img_path), {}, None
+        compiled = compile_template(template)
+        processing_image, aligned_image, alignment_path = _load_and_align(img_path, aligner, save_files, compiled)
+        if processing_image is None:
+            return image_name(img_path), {}, None
 
-        processing_image = image.copy()
+        band = _cascade_band(compiled)
+        stats = {"band": band}
+        results = classify_bubbles_batch(processing_image, compiled, yolo_model, conf, band, stats)
+        fname = image_stem(img_path)
+        return fname, _attach_metadata(results, fname, alignment_path, _cascade_metadata(stats)), aligned_image
 
-        # 3. Alignment (nếu có)
-        if aligner:
-            logging.info(f"-> Aligning image: {os.path.basename(img_path)}")
-            try:
-                aligned_image = aligner.align(image)
-                if aligned_image is not None:
-                    if save_files:
-                        fname_base = os.path.splitext(os.path.basename(img_path))[0]
-                        input_dir = os.path.dirname(img_path)
-                        aligned_dir = os.path.join(input_dir, "aligned_results")
-                        os.makedirs(aligned_dir, exist_ok=True)
-                        aligned_out_path = os.path.join(aligned_dir, f"{fname_base}_aligned.jpg")
-                        cv2.imwrite(aligned_out_path, aligned_image)
+    except Exception as e:
+        logging.exception(f"FATAL ERROR processing {image_name(img_path)}: {e}")
+        # Luôn trả về 3 giá trị, giá trị cuối là None khi có lỗi
+        return image_name(img_path), {"error": str(e)}, None
 
-                    # Làm nét ảnh sau khi align
-                    blurred = cv2.GaussianBlur(aligned_image, (9, 9), 10.0)
-                    sharpened = cv2.addWeighted(aligned_image, 1.0 + 1.2, blurred, -1.2, 0)
-                    processing_image = sharpened
-                    aligned_image_to_return = sharpened.copy()
-                else:
-                    aligned_image_to_return = image.copy()
-            except Exception as e:
-                aligned_image_to_return = image.copy()
-        else:
-            aligned_image_to_return = image.copy()
+def iter_process_images_batched(img_paths, template, yolo_model, conf, aligner=None, save_files=False,
+                                inference_batch_size=1024):
+    """
+    Xử lý nhiều ảnh OMR, gộp ROI của nhiều phiếu vào các lần gọi model lớn
+    (tối đa `inference_batch_size` ROI mỗi lần) thay vì một lần gọi cho mỗi phiếu.
 
-        # 4. Xử lý OMR detection
-        bubbles = get_all_bubbles(template)
-        results = classify_bubbles_batch(processing_image, bubbles, yolo_model, conf)
+    Yield (fname, results, aligned_image) giống process_single_image, đúng thứ tự `img_paths`,
+    ngay khi mọi ROI của phiếu đó đã có kết quả. Chỉ giữ ảnh của các phiếu đang chờ trong bộ nhớ.
+    Template đã hiệu chỉnh cascade thì chỉ ROI của bubble không chắc chắn được đưa vào pool.
+    """
+    compiled = compile_template(template)
+    band = _cascade_band(compiled)
+    batch_size = max(1, int(inference_batch_size))
+    pending = []       # các phiếu đang chờ, theo đúng thứ tự đầu vào
+    pool = []          # ROI chưa chạy model (view trên tensor của từng phiếu)
 
-        fname = os.path.splitext(os.path.basename(img_path))[0]
-        
-        # 5. Extract special codes (SBD, mã đề)
-        sbd = extract_special_code(results, "sbd")
-        ma_de = extract_special_code(results, "mdt")
-        results["_metadata"] = {
-            "sbd": sbd,
-            "ma_de": ma_de,
-            "filename": fname,
-            "total_questions": len([k for k in results.keys() if not k.startswith("_")])
+    def run_model(count):
+        rois, pool[:count] = pool[:count], []
+        try:
+            filled = predict_filled(rois, yolo_model, conf)
+        except Exception as e:
+            logging.exception(f"Batched inference failed: {e}")
+            filled = None
+        # Phân phối kết quả theo thứ tự FIFO cho các phiếu đang chờ
+        pos = 0
+        for sheet in pending:
+            if pos >= len(rois):
+                break
+            take = min(sheet["remaining"], len(rois) - pos)
+            if take == 0:
+                continue
+            if filled is None:
+                sheet["error"] = "Batched inference failed"
+            else:
+                done = sheet["done"]
+                sheet["filled"][sheet["model_pos"][done:done + take]] = filled[pos:pos + take]
+            sheet["done"] += take
+            sheet["remaining"] -= take
+            pos += take
+
+    def finish(sheet):
+        fname = sheet["fname"]
+        if "error" in sheet:
+            return fname, {"error": sheet["error"]}, None
+        if sheet["valid_idx"] is None:
+            return image_name(sheet["img_path"]), {}, None
+        results = decode_bubble_results(sheet["filled"], sheet["valid_idx"], compiled.labels)
+        cascade = _cascade_metadata({"band": band, "bubbles": len(sheet["valid_idx"]), "model": len(sheet["model_pos"])})
+        return fname, _attach_metadata(results, fname, sheet["alignment_path"], cascade), sheet["aligned"]
+
+    def drain():
+        while pending and pending[0]["remaining"] == 0:
+            yield finish(pending.pop(0))
+
+    for img_path in img_paths:
+        sheet = {
+            "img_path": img_path,
+            "fname": image_stem(img_path),
+            "valid_idx": None,
+            "aligned": None,
+            "alignment_path": None,
+            "done": 0,
+            "remaining": 0,
         }
+        try:
+            processing_image, sheet["aligned"], sheet["alignment_path"] = _load_and_align(
+                img_path, aligner, save_files, compiled
+            )
+            if processing_image is not None:
+                sheet["filled"], sheet["valid_idx"], sheet["model_pos"], rois = prepare_bubbles(
+                    processing_image, compiled.bounds, band
+                )
+                sheet["remaining"] = len(rois)
+                pool.extend(rois)
+        except Exception as e:
+            logging.exception(f"FATAL ERROR processing {image_name(img_path)}: {e}")
+            sheet["fname"] = image_name(img_path)
+            sheet["error"] = str(e)
+            sheet["remaining"] = 0
+        pending.append(sheet)
 
-        # Đảm bảo aligned_image_to_return được khởi tạo
-        if 'sharpened' in locals():
-            aligned_image_to_return = sharpened
-        elif 'image' in locals():
-            aligned_image_to_return = image
+        while len(pool) >= batch_size:
+            run_model(batch_size)
+        yield from drain()
 
-        return fname, results, aligned_image_to_return
-        
-    except Exception as e:
-        logging.exception(f"FATAL ERROR processing {img_path}: {e}")
-        # Luôn trả về 3 giá trị, giá trị cuối là None khi có lỗi
-        return os.path.basename(img_path), {"error": str(e)}, None
+    if pool:
+        run_model(len(pool))
+    yield from drain()
 
 def process_single_image_with_aligned(img_path, template, yolo_model, conf, aligner=None, answer_key_excel=None, save_files=False, return_aligned_image=True):
     """
     Xử lý một ảnh OMR với tối ưu hóa và có thể trả về ảnh đã align
     
     Args:
-        img_path: Đường dẫn ảnh
+        img_path: Đường dẫn ảnh hoặc SheetImage (bytes / ndarray trong bộ nhớ)
         template: Template OMR
         yolo_model: YOLO model
         conf: Confidence threshold
@@ -188,75 +351,56 @@ def process_single_image_with_aligned(img_path, template, yolo_model, conf, alig
         Tuple(filename, results_dict) nếu return_aligned_image=False
     """
     try:
-        # 1. Kiểm tra file ảnh
-        if not os.path.exists(img_path):
-            logging.error(f"Image file not found: {img_path}")
-            result = (os.path.basename(img_path), {})
-            return result + (None,) if return_aligned_image else result
-            
-        # Kiểm tra magic bytes để đảm bảo là file ảnh hợp lệ
-        try:
-            with open(img_path, 'rb') as f:
-                header = f.read(8)
-                if not (header.startswith(b'\xff\xd8\xff') or  # JPEG
-                       header.startswith(b'\x89PNG\r\n\x1a\n') or  # PNG
-                       header.startswith(b'BM')):  # BMP
-                    logging.error(f"File {img_path} is not a valid image file")
-                    result = (os.path.basename(img_path), {})
-                    return result + (None,) if return_aligned_image else result
-        except Exception as e:
-            logging.error(f"Error checking image file format: {e}")
-            result = (os.path.basename(img_path), {})
-            return result + (None,) if return_aligned_image else result
-        
-        # 2. Đọc ảnh
-        image = cv2.imread(img_path)
+        # 1-2. Đọc ảnh một lần (đường dẫn hoặc SheetImage), magic bytes kiểm tra trên buffer
+        compiled = compile_template(template)
+        image = read_image(img_path, cv2.IMREAD_GRAYSCALE if _lean_default(None) else cv2.IMREAD_COLOR,
+                           check_format=True)
         if image is None:
-            logging.warning(f"Could not read image {img_path}")
-            result = (os.path.basename(img_path), {})
+            logging.error(f"{image_name(img_path)} is not a readable image file")
+            result = (image_name(img_path), {})
             return result + (None,) if return_aligned_image else result
 
-        # 3. Alignment (nếu có)
+        # 3. Alignment (nếu có); pipeline chỉ đọc ảnh nên không cần copy
         aligned_image = None
-        processing_image = image.copy()
+        processing_image = image
         
         if aligner:
-            logging.info(f"-> Aligning image: {os.path.basename(img_path)}")
+            logging.info(f"-> Aligning image: {image_name(img_path)}")
             try:
                 aligned_image = aligner.align(image)
                 if aligned_image is not None:
                     # Chỉ lưu aligned image nếu save_files=True
-                    if save_files:
-                        fname = os.path.splitext(os.path.basename(img_path))[0]
-                        input_dir = os.path.dirname(img_path)
-                        aligned_dir = os.path.join(input_dir, "aligned_results")
+                    source_path = image_path(img_path)
+                    if save_files and source_path:
+                        aligned_dir = os.path.join(os.path.dirname(source_path), "aligned_results")
                         os.makedirs(aligned_dir, exist_ok=True)
-                        aligned_out_path = os.path.join(aligned_dir, f"{fname}_aligned.jpg")
+                        aligned_out_path = os.path.join(aligned_dir, f"{image_stem(img_path)}_aligned.jpg")
                         cv2.imwrite(aligned_out_path, aligned_image)
                     
-                    # Apply sharpening
-                    blurred = cv2.GaussianBlur(aligned_image, (9, 9), 10.0)
-                    sharpened = cv2.addWeighted(aligned_image, 1.0 + 1.2, blurred, -1.2, 0)
+                    # Làm nét tại chỗ, chỉ trên vùng bubble
+                    if aligned_image is getattr(img_path, "data", None):
+                        aligned_image = aligned_image.copy()
+                    sharpened = _sharpen_aligned(aligned_image, compiled)
                     processing_image = sharpened
                     
-                    # Lưu aligned image để return nếu cần
-                    if return_aligned_image:
-                        aligned_image = sharpened.copy()
+                    # Trả về ảnh đã làm nét nếu cần
+                    aligned_image = sharpened if return_aligned_image else None
                 else:
-                    logging.warning(f"Alignment failed for {img_path}, using original image")
-                    aligned_image = image.copy() if return_aligned_image else None
+                    logging.warning(f"Alignment failed for {image_name(img_path)}, using original image")
+                    aligned_image = image if return_aligned_image else None
             except Exception as e:
                 logging.warning(f"Alignment failed, using original image: {e}")
-                aligned_image = image.copy() if return_aligned_image else None
+                aligned_image = image if return_aligned_image else None
         else:
             # No alignment requested
-            aligned_image = image.copy() if return_aligned_image else None
+            aligned_image = image if return_aligned_image else None
 
         # 4. Xử lý OMR detection trên processing_image
-        bubbles = get_all_bubbles(template)
-        results = classify_bubbles_batch(processing_image, bubbles, yolo_model, conf)
+        band = _cascade_band(compiled)
+        stats = {"band": band}
+        results = classify_bubbles_batch(processing_image, compiled, yolo_model, conf, band, stats)
 
-        fname = os.path.splitext(os.path.basename(img_path))[0]
+        fname = image_stem(img_path)
         
         # 5. Extract special codes (SBD, mã đề)
         sbd = extract_special_code(results, "sbd")
@@ -269,15 +413,18 @@ def process_single_image_with_aligned(img_path, template, yolo_model, conf, alig
             "filename": fname,
             "total_questions": len([k for k in results.keys() if not k.startswith("_")]),
             "alignment_performed": aligner is not None,
-            "alignment_success": aligned_image is not None and aligner is not None
+            "alignment_success": aligned_image is not None and aligner is not None,
+            "alignment_path": aligner.last_path if aligner is not None else None
         }
+        if (cascade := _cascade_metadata(stats)) is not None:
+            results["_metadata"]["cascade"] = cascade
 
         result = (fname, results)
         return result + (aligned_image,) if return_aligned_image else result
         
     except Exception as e:
-        logging.exception(f"FATAL ERROR processing {img_path}: {e}")
-        error_result = (os.path.basename(img_path), {"error": str(e)})
+        logging.exception(f"FATAL ERROR processing {image_name(img_path)}: {e}")
+        error_result = (image_name(img_path), {"error": str(e)})
         return error_result + (None,) if return_aligned_image else error_result
 
 def process_multiple_images_optimized(
@@ -0,0 +1,127 @@
+# model_registry.py
+"""
+Registry dùng chung trong một worker cho các model phân loại bubble.
+
+Mỗi file model chỉ được load một lần (theo đường dẫn + mtime), được warm-up
+bằng một batch ảnh 54x54 giả và tự reload khi file `.pt` trên đĩa thay đổi.
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BUBBLE_INPUT_SIZE = 54
+
+
+def _load_yolo(model_path):
+    from ultralytics import YOLO
+    return YOLO(model_path)
+
+
+def _load_model(model_path):
+    """Load model theo backend cấu hình trong `settings.OMR_INFERENCE_BACKEND`."""
+    from app.core.config import settings
+    if settings.OMR_INFERENCE_BACKEND == "onnx":
+        from .inference import load_onnx_classifier
+        return load_onnx_classifier(model_path, intra_op_threads=settings.OMR_ONNX_INTRA_OP_THREADS)
+    return _load_yolo(model_path)
+
+
+class ModelRegistry:
+    def __init__(self, loader=None, warmup_batch=4):
+        self._loader = loader or _load_model
+        self._warmup_batch = warmup_batch
+        self._models = {}  # abs_path -> (mtime, model)
+        self._load_seconds = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    @staticmethod
+    def _key(model_path):
+        path = os.path.abspath(model_path)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        return path, mtime
+
+    def get(self, model_path):
+        """Lấy model từ cache, load (hoặc reload nếu file đã thay đổi) khi cần."""
+        path, mtime = self._key(model_path)
+        with self._lock:
+            entry = self._models.get(path)
+            if entry is not None and entry[0] == mtime:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            if entry is not None:
+                self.reloads += 1
+                logger.info(f"Model file changed on disk, reloading: {path}")
+
+            model = self._load(path)
+            self._models[path] = (mtime, model)
+            return model
+
+    def preload(self, model_path):
+        """Load và warm-up model lúc khởi động worker, bỏ qua lỗi để không chặn startup."""
+        try:
+            self.get(model_path)
+            return True
+        except Exception as e:
+            logger.warning(f"Could not preload model {model_path}: {e}")
+            return False
+
+    def _load(self, path):
+        start = time.perf_counter()
+        model = self._loader(path)
+        self._warmup(model)
+        elapsed = time.perf_counter() - start
+        self._load_seconds[path] = elapsed
+        logger.info(f"Loaded model {path} in {elapsed:.2f}s")
+        return model
+
+    def _warmup(self, model):
+        dummy = [np.zeros((BUBBLE_INPUT_SIZE, BUBBLE_INPUT_SIZE, 3), dtype=np.uint8)] * self._warmup_batch
+        try:
+            model(dummy, verbose=False)
+        except Exception as e:
+            logger.warning(f"Model warm-up failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._load_seconds.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "models": [
+                    {
+                        "path": path,
+                        "mtime": mtime,
+                        "load_seconds": round(self._load_seconds.get(path, 0.0), 3),
+                    }
+                    for path, (mtime, _) in self._models.items()
+                ],
+            }
+
+
+# Singleton cho toàn bộ process
+model_registry = ModelRegistry()
+
+
+def get_yolo_model(model_path=None):
+    """Lấy model phân loại bubble dùng chung, mặc định là `settings.OMR_MODEL_PATH`."""
+    if model_path is None:
+        from app.core.config import settings
+        model_path = settings.OMR_MODEL_PATH
+    return model_registry.get(model_path)
@@ -0,0 +1,185 @@
+# quality.py
+"""
+Kiểm tra nhanh chất lượng frame trước pipeline OMR.
+
+Khi quét trực tiếp, phần lớn frame bị mờ, lệch khỏi phiếu hoặc không phải phiếu. Thay vì để mỗi frame
+trả giá căn chỉnh + inference rồi mới thất bại ở bước nhận diện SBD, frame được decode thẳng ở 1/4
+kích thước (grayscale) và kiểm tra trong vài ms:
+
+- độ nét: phương sai Laplacian
+- độ phủ của tờ phiếu: diện tích contour vùng sáng lớn nhất so với khung hình
+- phơi sáng: độ sáng trung bình và độ tương phản (phân vị 1%-99% của histogram)
+- 4 marker góc (cùng cách chọn marker với CornerMarkerAlignment)
+
+Ngưỡng có thể ghi đè cho từng template bằng mục "quality" trong template.json, ví dụ
+`"quality": {"minSharpness": 80, "requireMarkers": false}`.
+"""
+import logging
+from typing import Dict, List, NamedTuple, Optional
+
+import cv2
+import numpy as np
+
+from .image_io import decode_image
+from .src.processors.CornerMarkerAlignment import select_corner_markers
+
+logger = logging.getLogger(__name__)
+
+_REDUCED_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+# Gợi ý gửi về client theo từng lỗi
+QUALITY_HINTS = {
+    "blurry": "Ảnh bị mờ: giữ máy cố định và lấy nét vào phiếu",
+    "no_page": "Không thấy trọn tờ phiếu: đưa toàn bộ phiếu vào khung hình",
+    "too_dark": "Ảnh quá tối: tăng ánh sáng hoặc bật đèn",
+    "low_contrast": "Ảnh bị lóa hoặc thiếu tương phản: tránh ánh đèn chiếu thẳng vào phiếu",
+    "no_markers": "Không thấy đủ 4 ô vuông đen ở góc phiếu: đưa cả 4 góc vào khung hình",
+}
+
+
+def _parse_bool(value) -> bool:
+    """Boolean JSON, hoặc chuỗi / số "true"/"false"/"1"/"0"; giá trị khác là lỗi cấu hình."""
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("true", "1"):
+        return True
+    if text in ("false", "0"):
+        return False
+    raise ValueError(f"expected a boolean, got {value!r}")
+
+
+class QualityThresholds(NamedTuple):
+    """
+    Ngưỡng kiểm tra, tính trên ảnh đã thu nhỏ `1/reduce` lần (1, 2, 4 hoặc 8).
+    Trong template.json dùng khóa camelCase: reduce, minSharpness, minPageCoverage,
+    minBrightness, minContrast, requireMarkers.
+    """
+    reduce: int = 4
+    min_sharpness: float = 50.0
+    min_page_coverage: float = 0.4
+    min_brightness: float = 60.0
+    min_contrast: float = 80.0
+    require_markers: bool = True
+
+    @classmethod
+    def from_config(cls, config) -> "QualityThresholds":
+        if not config:
+            return cls()
+        defaults = cls()
+        try:
+            thresholds = cls(
+                reduce=int(config.get("reduce", defaults.reduce)),
+                min_sharpness=float(config.get("minSharpness", defaults.min_sharpness)),
+                min_page_coverage=float(config.get("minPageCoverage", defaults.min_page_coverage)),
+                min_brightness=float(config.get("minBrightness", defaults.min_brightness)),
+                min_contrast=float(config.get("minContrast", defaults.min_contrast)),
+                require_markers=_parse_bool(config.get("requireMarkers", defaults.require_markers))
+            )
+            if thresholds.reduce not in _REDUCED_FLAGS:
+                raise ValueError(f"reduce must be one of {sorted(_REDUCED_FLAGS)}")
+            return thresholds
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.warning(f"Ignoring invalid quality config {config}: {e}")
+            return defaults
+
+
+class QualityReport(NamedTuple):
+    """Kết quả kiểm tra: `issues` là mã lỗi (khóa của QUALITY_HINTS), `metrics` là số đo để debug/hiệu chỉnh."""
+    ok: bool
+    issues: List[str]
+    metrics: Dict[str, float]
+
+    @property
+    def hints(self) -> List[str]:
+        return [QUALITY_HINTS[issue] for issue in self.issues]
+
+
+def page_coverage(gray) -> float:
+    """Tỉ lệ khung hình bị chiếm bởi vùng sáng liền khối lớn nhất (tờ giấy)."""
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    # Lấp chữ và bubble in trên giấy để trang là một khối
+    binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return 0.0
+    area = max(cv2.contourArea(c) for c in contours)
+    return float(area / ((gray.shape[0] - 1) * (gray.shape[1] - 1)))
+
+
+def exposure(gray):
+    """(độ sáng trung bình, độ tương phản p99 - p1) từ histogram 256 bin."""
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    cdf = np.cumsum(hist) / hist.sum()
+    p1, p99 = int(np.searchsorted(cdf, 0.01)), int(np.searchsorted(cdf, 0.99))
+    return float(np.dot(hist, np.arange(256)) / hist.sum()), float(p99 - p1)
+
+
+def corner_markers_found(gray) -> bool:
+    """
+    Có đủ 4 marker góc tạo thành tứ giác lồi. Chỉ cần biết marker có mặt, nên thay vì đo từng blob như
+    `find_square_markers` (minAreaRect trong vòng lặp Python), ứng viên được lọc vector hóa trên
+    thống kê connected components: diện tích, tỉ lệ cạnh và độ đặc của khung bao.
+    """
+    frame_area = gray.shape[0] * gray.shape[1]
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(binary)
+    w, h, area = (stats[1:, i].astype(np.float32) for i in (cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT, cv2.CC_STAT_AREA))
+    squareness = np.minimum(w, h) / np.maximum(w, h)
+    fill = area / (w * h)
+    keep = (area >= frame_area * 2e-5) & (area <= frame_area * 5e-3) & (squareness >= 0.7) & (fill >= 0.8)
+    selected = select_corner_markers(
+        centroids[1:][keep].astype(np.float32), area[keep], (squareness * np.minimum(fill, 1.0))[keep]
+    )
+    return selected is not None and cv2.isContourConvex(selected[0].reshape(-1, 1, 2))
+
+
+def assess_gray(gray, thresholds: Optional[QualityThresholds] = None) -> QualityReport:
+    """Kiểm tra một ảnh grayscale đã thu nhỏ."""
+    thresholds = thresholds or QualityThresholds()
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    coverage = page_coverage(gray)
+    brightness, contrast = exposure(gray)
+
+    issues = []
+    if sharpness < thresholds.min_sharpness:
+        issues.append("blurry")
+    if coverage < thresholds.min_page_coverage:
+        issues.append("no_page")
+    if brightness < thresholds.min_brightness:
+        issues.append("too_dark")
+    if contrast < thresholds.min_contrast:
+        issues.append("low_contrast")
+    # Dò marker tốn nhất, bỏ qua khi frame đã bị loại
+    markers = None
+    if thresholds.require_markers and not issues:
+        markers = corner_markers_found(gray)
+        if not markers:
+            issues.append("no_markers")
+
+    metrics = {
+        "sharpness": round(sharpness, 1),
+        "page_coverage": round(coverage, 3),
+        "brightness": round(brightness, 1),
+        "contrast": contrast,
+        "markers": markers,
+        "size": [int(gray.shape[1]), int(gray.shape[0])],
+    }
+    return QualityReport(not issues, issues, metrics)
+
+
+def assess_frame(data, thresholds: Optional[QualityThresholds] = None) -> QualityReport:
+    """
+    Kiểm tra bytes ảnh JPEG/PNG: decode thẳng ở kích thước thu nhỏ (libjpeg bỏ qua phần lớn IDCT),
+    không bao giờ decode ảnh đầy đủ.
+    """
+    thresholds = thresholds or QualityThresholds()
+    gray = decode_image(data, _REDUCED_FLAGS[thresholds.reduce])
+    if gray is None or gray.size == 0:
+        return QualityReport(False, ["no_page"], {})
+    return assess_gray(gray, thresholds)
@@ -1,8 +1,15 @@
 """
 Advanced Feature-based alignment preprocessor for OMRChecker.
 Supports ORB, AKAZE, and SIFT feature detectors.
+
+Two alignment modes:
+- "standard": full-resolution detectAndCompute + brute-force cross-check matching.
+- "pyramid": coarse homography on a downscaled level (FLANN + ratio test), refined with
+  a few features detected in small full-resolution windows around reference keypoints.
 """
 
+import time
+
 import cv2
 import numpy as np
 from pathlib import Path
@@ -13,6 +20,68 @@ from ..utils.image import ImageUtils
 from ..utils.interaction import InteractionUtils
 from ..logger import logger
 
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+def create_feature_detector(feature_type: str, max_features: int):
+    """Create the feature detector and matching norm for a feature type."""
+    if feature_type == "ORB":
+        return cv2.ORB_create(max_features), cv2.NORM_HAMMING
+    if feature_type == "AKAZE":
+        return cv2.AKAZE_create(), cv2.NORM_HAMMING
+    if feature_type == "SIFT":
+        return cv2.SIFT_create(max_features), cv2.NORM_L2
+    raise ValueError(f"Unknown feature type: {feature_type}")
+
+def create_flann_matcher(norm_type):
+    """FLANN matcher: LSH index for binary descriptors, KD-tree for float descriptors."""
+    if norm_type == cv2.NORM_HAMMING:
+        index_params = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+    else:
+        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+    return cv2.FlannBasedMatcher(index_params, dict(checks=50))
+
+def keypoint_coords(keypoints) -> np.ndarray:
+    return np.float32([k.pt for k in keypoints]).reshape(-1, 2)
+
+def ratio_test(knn_matches, ratio: float):
+    """Lowe ratio test over knnMatch(k=2) output, returns (query_idx, train_idx) arrays."""
+    pairs = np.array(
+        [(m[0].queryIdx, m[0].trainIdx, m[0].distance, m[1].distance) for m in knn_matches if len(m) == 2],
+        dtype=np.float32,
+    ).reshape(-1, 4)
+    keep = pairs[:, 2] < ratio * pairs[:, 3]
+    return pairs[keep, 0].astype(np.intp), pairs[keep, 1].astype(np.intp)
+
+def pixel_scale_matrix(sx: float, sy: float) -> np.ndarray:
+    """Homography mapping pixel coordinates of an image to the same image resized by (sx, sy)."""
+    return np.array([[sx, 0, 0.5 * sx - 0.5], [0, sy, 0.5 * sy - 0.5], [0, 0, 1]], dtype=np.float64)
+
+class ReferenceFeatures:
+    """Reference image with its full-resolution keypoints/descriptors and lazily computed pyramid levels."""
+
+    def __init__(self, ref_img, keypoints, descriptors):
+        self.ref_img = ref_img
+        self.keypoints = keypoints
+        self.descriptors = descriptors
+        self.points = keypoint_coords(keypoints)
+        self.octaves = np.array([k.octave for k in keypoints], dtype=np.int32)
+        self._levels = {}
+        # (marker points, marker area) filled in by CornerMarkerAlignment users, see OMRAligner
+        self.corner_markers = None
+
+    def level(self, scale: float, feature_type: str, max_features: int):
+        """(scale_matrix, points, descriptors) of the reference resized by `scale`."""
+        key = (scale, feature_type, max_features)
+        if key not in self._levels:
+            h, w = self.ref_img.shape[:2]
+            small = cv2.resize(self.ref_img, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+            detector, _ = create_feature_detector(feature_type, max_features)
+            keypoints, descriptors = detector.detectAndCompute(small, None)
+            S = pixel_scale_matrix(small.shape[1] / w, small.shape[0] / h)
+            self._levels[key] = (S, keypoint_coords(keypoints), descriptors)
+        return self._levels[key]
+
 class AdvancedFeatureAlignment(BaseProcessor):
     def __init__(self, *args, **kwargs):
         """
@@ -20,6 +89,7 @@ class AdvancedFeatureAlignment(BaseProcessor):
             options (dict): config dict, must contain 'reference'
             tuning_config (object): tuning/config object, must have .dimensions.processing_width/height and .outputs.show_image_level
             relative_dir (Path): base dir for reference path
+            reference_features (ReferenceFeatures): optional precomputed reference features
         """
         super().__init__(*args, **kwargs)
         self.options = kwargs.get("options", {})
@@ -36,6 +106,31 @@ class AdvancedFeatureAlignment(BaseProcessor):
         self.good_match_percent = self.options.get("goodMatchPercent", 0.2)
         self.resize_template = self.options.get("resizeTemplate", False)
 
+        # Pyramid mode options
+        self.alignment_mode = self.options.get("alignmentMode", "standard")
+        self.pyramid_scale = float(self.options.get("pyramidScale", 0.25))
+        self.coarse_max_features = int(self.options.get("coarseMaxFeatures", 2000))
+        self.ratio = float(self.options.get("ratioTest", 0.75))
+        self.refine_grid = int(self.options.get("refineGrid", 6))
+        self.refine_window = int(self.options.get("refineWindow", 256))
+        self.refine_max_features = int(self.options.get("refineMaxFeatures", 500))
+        self.refine_radius = float(self.options.get("refineRadius", 8.0))
+        if self.alignment_mode not in ("standard", "pyramid"):
+            raise ValueError(f"Unknown alignment mode: {self.alignment_mode}")
+
+        # Homography, inlier ratio and per-stage timings of the last apply_filter call
+        self.last_homography = None
+        self.last_stats = {}
+
+        # Reference đã tính sẵn (xem app/omr/aligner_cache.py) thì dùng lại, không detect lại
+        reference_features = kwargs.get("reference_features", None)
+        if reference_features is not None:
+            self.reference = reference_features
+            self.ref_img = reference_features.ref_img
+            self._init_detector()
+            self.ref_kp, self.ref_des = reference_features.keypoints, reference_features.descriptors
+            return
+
         # Load and prepare reference image
         ref_img = cv2.imread(str(self.ref_path), cv2.IMREAD_GRAYSCALE)
         if ref_img is None:
@@ -53,83 +148,223 @@ class AdvancedFeatureAlignment(BaseProcessor):
         # Extract features from reference image
         self.ref_kp, self.ref_des = self.detector.detectAndCompute(self.ref_img, None)
         logger.info(f"Detected {len(self.ref_kp)} keypoints in reference image")
+        self.reference = ReferenceFeatures(self.ref_img, self.ref_kp, self.ref_des)
 
     def _init_detector(self) -> None:
         """Initialize the feature detector based on type."""
-        if self.feature_type == "ORB":
-            self.detector = cv2.ORB_create(self.max_features)
-            self.norm_type = cv2.NORM_HAMMING
-        elif self.feature_type == "AKAZE":
-            self.detector = cv2.AKAZE_create()
-            self.norm_type = cv2.NORM_HAMMING
-        elif self.feature_type == "SIFT":
-            self.detector = cv2.SIFT_create(self.max_features)
-            self.norm_type = cv2.NORM_L2
-        else:
-            raise ValueError(f"Unknown feature type: {self.feature_type}")
+        self.detector, self.norm_type = create_feature_detector(self.feature_type, self.max_features)
         logger.info(f"Initialized {self.feature_type} detector with max {self.max_features} features")
 
     def __str__(self):
-        return f"{self.ref_path.name} ({self.feature_type})"
+        return f"{self.ref_path.name} ({self.feature_type}, {self.alignment_mode})"
 
     def exclude_files(self):
         return [self.ref_path]
 
-    def apply_filter(self, image: np.ndarray, file_path: str) -> Optional[np.ndarray]:
-        """Aligns the input image to the reference template using feature matching."""
-        config = self.tuning_config
-
-        # Normalize image
-        image = cv2.normalize(image, None, 0, 255, norm_type=cv2.NORM_MINMAX)
-
-        # Detect features in input image
+    def _estimate_standard(self, image, file_path, stages):
+        """Full-resolution detection + brute-force cross-check matching."""
+        start = time.perf_counter()
         input_kp, input_des = self.detector.detectAndCompute(image, None)
+        stages["detect"] = time.perf_counter() - start
         logger.info(f"Detected {len(input_kp)} keypoints in input image")
 
         if input_des is None or len(input_kp) < 10:
             logger.error(f"Too few keypoints detected in {file_path}")
+            return None, None
+
+        start = time.perf_counter()
+        matcher = cv2.BFMatcher(self.norm_type, crossCheck=True)
+        matches = matcher.match(self.ref_des, input_des)
+        num_good_matches = max(10, int(len(matches) * self.good_match_percent))
+        distances = np.fromiter((m.distance for m in matches), dtype=np.float32, count=len(matches))
+        order = np.argsort(distances, kind="stable")[:num_good_matches]
+        good_matches = [matches[i] for i in order]
+        stages["match"] = time.perf_counter() - start
+
+        logger.info(f"Using {len(good_matches)} good matches out of {len(matches)} total")
+
+        ref_pts = np.float32([self.ref_kp[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+        input_pts = np.float32([input_kp[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+
+        start = time.perf_counter()
+        H, mask = cv2.findHomography(input_pts, ref_pts, cv2.RANSAC, 5.0)
+        stages["homography"] = time.perf_counter() - start
+        if H is not None:
+            self.last_stats["inlier_ratio"] = float(np.mean(mask)) if len(mask) else 0.0
+            self.last_stats["inliers"] = int(np.sum(mask))
+        return H, (input_kp, good_matches)
+
+    def _estimate_coarse(self, gray, stages):
+        """Homography input -> reference estimated on the downscaled pyramid level."""
+        start = time.perf_counter()
+        S_ref, ref_pts, ref_des = self.reference.level(self.pyramid_scale, self.feature_type, self.coarse_max_features)
+        ref_h, ref_w = self.ref_img.shape[:2]
+        scale = self.pyramid_scale * ref_w / gray.shape[1]
+        small = cv2.resize(gray, (round(gray.shape[1] * scale), round(gray.shape[0] * scale)),
+                           interpolation=cv2.INTER_AREA)
+        S_in = pixel_scale_matrix(small.shape[1] / gray.shape[1], small.shape[0] / gray.shape[0])
+        detector, _ = create_feature_detector(self.feature_type, self.coarse_max_features)
+        input_kp, input_des = detector.detectAndCompute(small, None)
+        stages["coarse_detect"] = time.perf_counter() - start
+
+        if input_des is None or ref_des is None or len(input_kp) < 10:
             return None
 
-        try:
-            matcher = cv2.BFMatcher(self.norm_type, crossCheck=True)
-            matches = matcher.match(self.ref_des, input_des)
-            matches = sorted(matches, key=lambda x: x.distance)
+        start = time.perf_counter()
+        knn = create_flann_matcher(self.norm_type).knnMatch(input_des, ref_des, k=2)
+        query_idx, train_idx = ratio_test(knn, self.ratio)
+        stages["coarse_match"] = time.perf_counter() - start
+        if len(query_idx) < 10:
+            return None
+
+        start = time.perf_counter()
+        input_pts = keypoint_coords(input_kp)[query_idx]
+        H_small, mask = cv2.findHomography(input_pts, ref_pts[train_idx], cv2.RANSAC, 3.0)
+        stages["coarse_homography"] = time.perf_counter() - start
+        if H_small is None:
+            return None
+
+        self.last_stats["coarse_inlier_ratio"] = float(np.mean(mask))
+        # input full -> input small -> reference small -> reference full
+        H = np.linalg.inv(S_ref) @ H_small @ S_in
+        return H / H[2, 2]
+
+    def _refine(self, gray, H_coarse, stages):
+        """
+        Re-estimate the homography from full-resolution features in small windows around
+        reference keypoints. Each window is warped into the reference frame with the coarse
+        homography, so matches only need to agree within `refine_radius` pixels.
+        """
+        start = time.perf_counter()
+        ref_pts, ref_des = self.reference.points, self.reference.descriptors
+        # Only base-level reference keypoints have full-resolution precision
+        base_level = self.reference.octaves == 0 if self.feature_type == "ORB" else np.ones(len(ref_pts), dtype=bool)
+        ref_h, ref_w = self.ref_img.shape[:2]
+        H_inv = np.linalg.inv(H_coarse)
+        if self.feature_type == "ORB":
+            # Window is already in the reference frame: a single pyramid level keeps keypoints precise
+            detector = cv2.ORB_create(self.refine_max_features, nlevels=1)
+        else:
+            detector, _ = create_feature_detector(self.feature_type, self.refine_max_features)
+        matcher = cv2.BFMatcher(self.norm_type)
+        half = self.refine_window // 2
+
+        input_matches, ref_matches = [], []
+        cell_w, cell_h = ref_w / self.refine_grid, ref_h / self.refine_grid
+        cell = np.floor(ref_pts / [cell_w, cell_h]).astype(np.intp).clip(0, self.refine_grid - 1)
+        for gx in range(self.refine_grid):
+            for gy in range(self.refine_grid):
+                in_cell = (cell[:, 0] == gx) & (cell[:, 1] == gy)
+                if np.count_nonzero(in_cell) < 10:
+                    continue
+                # Window centred on the median reference keypoint of the cell (text/bubbles, not blank paper)
+                cx, cy = np.median(ref_pts[in_cell], axis=0)
+                x0 = int(np.clip(cx - half, 0, max(0, ref_w - self.refine_window)))
+                y0 = int(np.clip(cy - half, 0, max(0, ref_h - self.refine_window)))
+
+                T = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64) @ H_coarse
+                window = cv2.warpPerspective(gray, T, (self.refine_window, self.refine_window))
+                window_kp, window_des = detector.detectAndCompute(window, None)
+                if window_des is None or len(window_kp) < 2:
+                    continue
+
+                margin = self.refine_radius
+                near = np.flatnonzero(
+                    base_level
+                    & (ref_pts[:, 0] >= x0 - margin) & (ref_pts[:, 0] < x0 + self.refine_window + margin)
+                    & (ref_pts[:, 1] >= y0 - margin) & (ref_pts[:, 1] < y0 + self.refine_window + margin)
+                )
+                if len(near) < 2:
+                    continue
+                query_idx, train_idx = ratio_test(matcher.knnMatch(window_des, ref_des[near], k=2), self.ratio)
+                if len(query_idx) == 0:
+                    continue
+
+                approx_ref = keypoint_coords(window_kp)[query_idx] + [x0, y0]
+                matched_ref = ref_pts[near[train_idx]]
+                close = np.linalg.norm(approx_ref - matched_ref, axis=1) < self.refine_radius
+                if not np.any(close):
+                    continue
+                input_matches.append(cv2.perspectiveTransform(approx_ref[close].reshape(-1, 1, 2), H_inv))
+                ref_matches.append(matched_ref[close])
+        stages["refine_match"] = time.perf_counter() - start
+
+        if not input_matches or sum(len(m) for m in ref_matches) < 12:
+            logger.warning("Too few refinement matches, using coarse homography")
+            return H_coarse
 
-            num_good_matches = max(10, int(len(matches) * self.good_match_percent))
-            good_matches = matches[:num_good_matches]
+        start = time.perf_counter()
+        input_pts = np.concatenate(input_matches).reshape(-1, 1, 2).astype(np.float32)
+        ref_pts_matched = np.concatenate(ref_matches).reshape(-1, 1, 2).astype(np.float32)
+        H, mask = cv2.findHomography(input_pts, ref_pts_matched, cv2.USAC_MAGSAC, 1.5)
+        stages["refine_homography"] = time.perf_counter() - start
+        if H is None:
+            return H_coarse
 
-            logger.info(f"Using {len(good_matches)} good matches out of {len(matches)} total")
+        self.last_stats["inlier_ratio"] = float(np.mean(mask))
+        self.last_stats["inliers"] = int(np.sum(mask))
+        return H
 
-            ref_pts = np.float32([self.ref_kp[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-            input_pts = np.float32([input_kp[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+    def _estimate_pyramid(self, image, file_path, stages):
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        H_coarse = self._estimate_coarse(gray, stages)
+        if H_coarse is None:
+            logger.error(f"Coarse alignment failed for {file_path}")
+            return None, None
+        return self._refine(gray, H_coarse, stages), None
 
-            H, mask = cv2.findHomography(input_pts, ref_pts, cv2.RANSAC, 5.0)
+    def apply_filter(self, image: np.ndarray, file_path: str) -> Optional[np.ndarray]:
+        """Aligns the input image to the reference template using feature matching."""
+        config = self.tuning_config
+        stages = {}
+        self.last_stats = {"mode": self.alignment_mode}
+        self.last_homography = None
+        total_start = time.perf_counter()
+
+        # Normalize image
+        start = time.perf_counter()
+        image = cv2.normalize(image, None, 0, 255, norm_type=cv2.NORM_MINMAX)
+        stages["normalize"] = time.perf_counter() - start
+
+        try:
+            if self.alignment_mode == "pyramid":
+                H, match_info = self._estimate_pyramid(image, file_path, stages)
+            else:
+                H, match_info = self._estimate_standard(image, file_path, stages)
 
             if H is None:
                 logger.error("Failed to compute homography")
                 return None
 
-            inliers = np.sum(mask)
-            inlier_ratio = inliers / len(mask) if len(mask) > 0 else 0
-            logger.info(f"Homography inlier ratio: {inlier_ratio:.2f} ({inliers}/{len(mask)})")
-
+            self.last_homography = H
+            start = time.perf_counter()
             h, w = self.ref_img.shape
             aligned = cv2.warpPerspective(image, H, (w, h))
+            stages["warp"] = time.perf_counter() - start
+
+            self.last_stats["stages_ms"] = {k: round(v * 1000, 1) for k, v in stages.items()}
+            self.last_stats["total_ms"] = round((time.perf_counter() - total_start) * 1000, 1)
+            logger.info(
+                f"Alignment ({self.alignment_mode}) inlier ratio: {self.last_stats.get('inlier_ratio', 0):.2f}, "
+                f"stages (ms): {self.last_stats['stages_ms']}"
+            )
 
             # Debug visualization
             if hasattr(config, "outputs") and getattr(config.outputs, "show_image_level", 0) >= 3:
-                match_img = cv2.drawMatches(
-                    self.ref_img, self.ref_kp,
-                    image, input_kp,
-                    good_matches[:50], None,
-                    flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS
-                )
-                InteractionUtils.show(
-                    f"Feature Matches ({self.feature_type})",
-                    match_img,
-                    resize=True,
-                    config=config
-                )
+                if match_info is not None:
+                    input_kp, good_matches = match_info
+                    match_img = cv2.drawMatches(
+                        self.ref_img, self.ref_kp,
+                        image, input_kp,
+                        good_matches[:50], None,
+                        flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS
+                    )
+                    InteractionUtils.show(
+                        f"Feature Matches ({self.feature_type})",
+                        match_img,
+                        resize=True,
+                        config=config
+                    )
 
                 before_after = np.hstack([
                     ImageUtils.resize_util_h(image, h),
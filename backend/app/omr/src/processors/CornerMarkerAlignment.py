@@ -0,0 +1,212 @@
+"""
+Corner-marker alignment preprocessor for OMRChecker.
+
+Detects the four large black corner fiducials on a downscaled copy of the sheet,
+refines their centres at full resolution and warps the sheet onto the reference
+marker positions with a four-point perspective transform. A confidence score is
+reported so callers can fall back to feature alignment when markers are unreliable.
+"""
+
+import time
+
+import cv2
+import numpy as np
+from pathlib import Path
+from typing import Optional
+
+from .interfaces.base_processor import BaseProcessor
+from ..utils.image import ImageUtils
+from ..logger import logger
+
+def find_square_markers(gray: np.ndarray, min_area: float, max_area: float):
+    """
+    Dark, solid, square blobs in a grayscale image.
+    Returns (centres (N, 2), areas (N,), scores (N,)) where score combines squareness and fill ratio.
+    """
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    # Connected components rather than external contours: sheets with a printed page frame
+    # would otherwise hide every marker inside one outer contour
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(binary)
+
+    centres, areas, scores = [], [], []
+    for i in range(1, n):
+        x, y, bw, bh, area = stats[i]
+        if area < min_area or area > max_area or min(bw, bh) < 0.6 * max(bw, bh):
+            continue
+        pixels = cv2.findNonZero((labels[y:y + bh, x:x + bw] == i).astype(np.uint8))
+        (cx, cy), (w, h), _ = cv2.minAreaRect(pixels)
+        w, h = w + 1, h + 1  # minAreaRect đo giữa tâm pixel
+        squareness = min(w, h) / max(w, h)
+        fill = area / (w * h)
+        if squareness < 0.7 or fill < 0.8:
+            continue
+        centres.append((cx + x, cy + y))
+        areas.append(area)
+        scores.append(squareness * min(1.0, fill))
+    return (np.float32(centres).reshape(-1, 2), np.float32(areas), np.float32(scores))
+
+def select_corner_markers(centres: np.ndarray, areas: np.ndarray, scores: np.ndarray):
+    """
+    Keep the largest marker-sized blobs (corner fiducials are the biggest squares on the sheet)
+    and pick the outermost one towards each corner, ordered tl, tr, br, bl.
+    Returns (points (4, 2), per-marker scores (4,), per-marker areas (4,)) or None.
+    """
+    if len(centres) < 4:
+        return None
+    big = areas >= 0.5 * np.sort(areas)[-4]
+    if np.count_nonzero(big) < 4:
+        return None
+    centres, areas, scores = centres[big], areas[big], scores[big]
+    ordered = ImageUtils.order_points(centres)
+    index = [int(np.flatnonzero((centres == point).all(axis=1))[0]) for point in ordered]
+    if len(set(index)) < 4:
+        return None
+    return ordered, scores[index], areas[index]
+
+def refine_centre(gray: np.ndarray, centre, radius: int):
+    """Sub-pixel centroid of the dark blob around `centre` in the full-resolution image."""
+    h, w = gray.shape[:2]
+    x0, y0 = max(0, int(centre[0] - radius)), max(0, int(centre[1] - radius))
+    x1, y1 = min(w, int(centre[0] + radius) + 1), min(h, int(centre[1] + radius) + 1)
+    patch = gray[y0:y1, x0:x1]
+    if patch.size == 0:
+        return centre
+    _, binary = cv2.threshold(patch, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(binary)
+    if n < 2:
+        return centre
+    # Component containing (or closest to) the coarse centre
+    local = np.array([centre[0] - x0, centre[1] - y0])
+    best = 1 + int(np.argmin(np.linalg.norm(centroids[1:] - local, axis=1) - 1e-6 * stats[1:, cv2.CC_STAT_AREA]))
+    return centroids[best] + [x0, y0]
+
+class CornerMarkerAlignment(BaseProcessor):
+    def __init__(self, *args, **kwargs):
+        """
+        Args:
+            options (dict): config dict, must contain 'reference'
+            tuning_config (object): tuning/config object, must have .dimensions.processing_width/height
+            relative_dir (Path): base dir for reference path
+            reference_image (np.ndarray): optional grayscale reference already resized to processing size
+            reference_markers (tuple): optional (marker points, mean marker area) detected earlier on the reference
+        """
+        super().__init__(*args, **kwargs)
+        self.options = kwargs.get("options", {})
+        self.tuning_config = kwargs.get("tuning_config", None)
+        self.relative_dir = kwargs.get("relative_dir", Path("."))
+
+        if not self.tuning_config:
+            raise ValueError("tuning_config is required for CornerMarkerAlignment.")
+
+        self.ref_path = self.relative_dir.joinpath(self.options["reference"])
+        self.detection_width = int(self.options.get("detectionWidth", 700))
+        self.min_confidence = float(self.options.get("minConfidence", 0.6))
+
+        ref_img = kwargs.get("reference_image", None)
+        if ref_img is None:
+            ref_img = cv2.imread(str(self.ref_path), cv2.IMREAD_GRAYSCALE)
+            if ref_img is None:
+                logger.error(f"Could not load reference image: {self.ref_path}")
+                raise FileNotFoundError(f"Reference image not found at {self.ref_path}")
+            ref_img = ImageUtils.resize_util(
+                ref_img,
+                self.tuning_config.dimensions.processing_width,
+                self.tuning_config.dimensions.processing_height,
+            )
+        self.ref_shape = ref_img.shape[:2]
+
+        # Confidence, marker positions and timing of the last apply_filter call
+        self.last_stats = {}
+        self.last_homography = None
+
+        reference_markers = kwargs.get("reference_markers", None)
+        if reference_markers is not None:
+            self.ref_markers, self.ref_marker_area = reference_markers
+            return
+
+        self.ref_markers = None
+        self.ref_marker_area = None
+        detected = self._detect(ref_img)
+        if detected is None:
+            logger.warning(f"No corner markers found in reference {self.ref_path}, marker alignment disabled")
+        else:
+            self.ref_markers, _, areas = detected
+            self.ref_marker_area = float(np.mean(areas))
+            logger.info(f"Reference corner markers: {self.ref_markers.round(1).tolist()}")
+
+    @property
+    def available(self) -> bool:
+        return self.ref_markers is not None
+
+    def __str__(self):
+        return f"{self.ref_path.name} (corner markers)"
+
+    def exclude_files(self):
+        return [self.ref_path]
+
+    def _detect(self, gray, expected_area=None):
+        """Detect the four corner markers, returns (points, scores, areas) at full resolution or None."""
+        scale = min(1.0, self.detection_width / gray.shape[1])
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+        small_area = small.shape[0] * small.shape[1]
+        if expected_area is None:
+            min_area, max_area = small_area * 2e-5, small_area * 5e-3
+        else:
+            expected = expected_area * scale * scale
+            min_area, max_area = expected * 0.25, expected * 4.0
+
+        selected = select_corner_markers(*find_square_markers(small, min_area, max_area))
+        if selected is None:
+            return None
+        points, scores, areas = selected
+        points = (points + 0.5) / scale - 0.5
+        radius = int(np.sqrt(np.max(areas)) / scale)
+        points = np.float32([refine_centre(gray, point, radius) for point in points])
+        return points, scores, areas / (scale * scale)
+
+    def _confidence(self, points, scores, areas):
+        """Marker quality x agreement of the detected quad with the reference quad shape."""
+        if not cv2.isContourConvex(points.reshape(-1, 1, 2)):
+            return 0.0
+        size_consistency = float(areas.min() / areas.max())
+
+        def side_ratios(quad):
+            sides = np.linalg.norm(quad - np.roll(quad, -1, axis=0), axis=1)
+            return np.array([sides[0] / sides[1], sides[2] / sides[3]])
+
+        ref_ratios, ratios = side_ratios(self.ref_markers), side_ratios(points)
+        shape_consistency = float(np.clip(1.0 - np.max(np.abs(ratios / ref_ratios - 1.0)) * 2.0, 0.0, 1.0))
+        return float(scores.min()) * size_consistency * shape_consistency
+
+    def apply_filter(self, image: np.ndarray, file_path: str) -> Optional[np.ndarray]:
+        """Aligns the input image to the reference using the four corner markers."""
+        start = time.perf_counter()
+        self.last_stats = {"mode": "markers", "confidence": 0.0}
+        self.last_homography = None
+        if not self.available:
+            return None
+
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # Expected marker area in the input, assuming the sheet fills the frame like the reference
+        area_scale = (gray.shape[0] * gray.shape[1]) / (self.ref_shape[0] * self.ref_shape[1])
+        detected = self._detect(gray, self.ref_marker_area * area_scale)
+        if detected is None:
+            logger.info(f"Corner markers not found in {file_path}")
+            return None
+
+        points, scores, areas = detected
+        confidence = self._confidence(points, scores, areas)
+        self.last_stats["confidence"] = round(confidence, 3)
+        self.last_stats["markers"] = points.round(1).tolist()
+        if confidence < self.min_confidence:
+            logger.info(f"Low corner marker confidence {confidence:.2f} for {file_path}")
+            return None
+
+        H = cv2.getPerspectiveTransform(points, self.ref_markers)
+        image = cv2.normalize(image, None, 0, 255, norm_type=cv2.NORM_MINMAX)
+        h, w = self.ref_shape
+        aligned = cv2.warpPerspective(image, H, (w, h))
+        self.last_homography = H
+        self.last_stats["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        logger.info(f"Corner marker alignment confidence {confidence:.2f} in {self.last_stats['total_ms']} ms")
+        return aligned
@@ -1,8 +1,14 @@
 # template.py
+from .cascade import CascadeBand, cascade_path_for, load_cascade_config
+from .quality import QualityThresholds
 from .src.constants import FIELD_TYPES
+from collections import OrderedDict
 import json
 import logging
 import os
+import threading
+
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
@@ -66,52 +72,63 @@ class TemplateOMR:
             'bubbleDimensions', [54, 54])
         self.field_blocks = [FieldBlock(n, d, self.bubble_dimensions) for n, d in
                              template_data.get('fieldBlocks', {}).items()]
+        # Dải ngưỡng của classifier hai tầng (xem cascade.py), None nếu chưa hiệu chỉnh
+        self.cascade = template_data.get('cascade')
+        # Ngưỡng kiểm tra chất lượng frame trước pipeline (xem quality.py), None = mặc định
+        self.quality = template_data.get('quality')
 
 def get_all_bubbles(template):
+    if isinstance(template, CompiledTemplate):
+        return template.bubbles
     return [dict(qid=pt.qid, choice=pt.choice, bounds=(int(pt.x), int(pt.y), int(pt.x + bw), int(pt.y + bh)))
             for blk in template.field_blocks
             for strip in blk.traverse_bubbles
             for pt in strip
             for bw, bh in [blk.bubble_dimensions]]
 
+def resolve_template_path(template_path):
+    """Tìm file template.json thực tế từ đường dẫn file JSON, file ảnh hoặc thư mục template"""
+    actual_template_path = template_path
+
+    # Nếu path không kết thúc bằng .json
+    if not template_path.lower().endswith('.json'):
+        # Nếu là file ảnh hoặc thư mục, tìm file template.json
+        if os.path.isfile(template_path):
+            # Nếu là file ảnh, tìm template.json trong cùng thư mục
+            template_dir = os.path.dirname(template_path)
+            potential_json = os.path.join(template_dir, "template.json")
+            if os.path.exists(potential_json):
+                actual_template_path = potential_json
+                logger.info(f"Auto-detected template.json: {actual_template_path}")
+            else:
+                raise FileNotFoundError(f"No template.json found in directory: {template_dir}")
+        elif os.path.isdir(template_path):
+            # Nếu là thư mục, tìm template.json bên trong
+            potential_json = os.path.join(template_path, "template.json")
+            if os.path.exists(potential_json):
+                actual_template_path = potential_json
+                logger.info(f"Auto-detected template.json: {actual_template_path}")
+            else:
+                raise FileNotFoundError(f"No template.json found in directory: {template_path}")
+        else:
+            # Thử append /template.json
+            potential_json = os.path.join(template_path, "template.json")
+            if os.path.exists(potential_json):
+                actual_template_path = potential_json
+                logger.info(f"Auto-detected template.json: {actual_template_path}")
+
+    # Kiểm tra file tồn tại
+    if not os.path.exists(actual_template_path):
+        raise FileNotFoundError(f"Template file not found: {actual_template_path}")
+    return actual_template_path
+
 def load_template(template_path):
     """Load template với error handling tốt hơn cho encoding và auto-detect file JSON"""
     try:
         logger.info(f"Loading template from: {template_path}")
         
         # Auto-detect file template.json nếu path không phải file JSON
-        actual_template_path = template_path
-        
-        # Nếu path không kết thúc bằng .json
-        if not template_path.lower().endswith('.json'):
-            # Nếu là file ảnh hoặc thư mục, tìm file template.json
-            if os.path.isfile(template_path):
-                # Nếu là file ảnh, tìm template.json trong cùng thư mục
-                template_dir = os.path.dirname(template_path)
-                potential_json = os.path.join(template_dir, "template.json")
-                if os.path.exists(potential_json):
-                    actual_template_path = potential_json
-                    logger.info(f"Auto-detected template.json: {actual_template_path}")
-                else:
-                    raise FileNotFoundError(f"No template.json found in directory: {template_dir}")
-            elif os.path.isdir(template_path):
-                # Nếu là thư mục, tìm template.json bên trong
-                potential_json = os.path.join(template_path, "template.json")
-                if os.path.exists(potential_json):
-                    actual_template_path = potential_json
-                    logger.info(f"Auto-detected template.json: {actual_template_path}")
-                else:
-                    raise FileNotFoundError(f"No template.json found in directory: {template_path}")
-            else:
-                # Thử append /template.json
-                potential_json = os.path.join(template_path, "template.json")
-                if os.path.exists(potential_json):
-                    actual_template_path = potential_json
-                    logger.info(f"Auto-detected template.json: {actual_template_path}")
-        
-        # Kiểm tra file tồn tại
-        if not os.path.exists(actual_template_path):
-            raise FileNotFoundError(f"Template file not found: {actual_template_path}")
+        actual_template_path = resolve_template_path(template_path)
         
         # Thử đọc với UTF-8 trước
         try:
@@ -126,8 +143,122 @@ def load_template(template_path):
             logger.error(f"Invalid JSON in template file: {e}")
             raise
         
+        # Kết quả hiệu chỉnh cascade.json cạnh template được ưu tiên hơn mục "cascade" trong template
+        template_data['cascade'] = load_cascade_config(actual_template_path) or template_data.get('cascade')
         return TemplateOMR(template_data)
         
     except Exception as e:
         logger.error(f"Error loading template {template_path}: {str(e)}")
         raise RuntimeError(f"Cannot load template: {str(e)}")
+
+class CompiledTemplate:
+    """
+    Template đã được "biên dịch" sẵn thành mảng NumPy để dùng lại cho mọi ảnh:
+    - bounds: (N, 4) int32 [x1, y1, x2, y2] của từng bubble
+    - qid_index / choice_codes: chỉ số vào `qids` / `choice_values`
+    - field_slices: nhóm bubble theo field block (slice trên các mảng)
+    Có thể truyền vào mọi chỗ đang dùng TemplateOMR.
+    """
+    def __init__(self, template, template_id=None, source_path=None, mtime=None):
+        self.template = template
+        self.template_id = template_id
+        self.source_path = source_path
+        self.mtime = mtime
+
+        bounds, qid_index, choice_codes = [], [], []
+        self.qids, self.choice_values = [], []
+        qid_pos, choice_pos = {}, {}
+        self.field_slices = {}
+        for blk in template.field_blocks:
+            start = len(bounds)
+            bw, bh = blk.bubble_dimensions
+            for strip in blk.traverse_bubbles:
+                for pt in strip:
+                    if pt.qid not in qid_pos:
+                        qid_pos[pt.qid] = len(self.qids)
+                        self.qids.append(pt.qid)
+                    if pt.choice not in choice_pos:
+                        choice_pos[pt.choice] = len(self.choice_values)
+                        self.choice_values.append(pt.choice)
+                    bounds.append((int(pt.x), int(pt.y), int(pt.x + bw), int(pt.y + bh)))
+                    qid_index.append(qid_pos[pt.qid])
+                    choice_codes.append(choice_pos[pt.choice])
+            self.field_slices[blk.name] = slice(start, len(bounds))
+
+        self.bounds = np.array(bounds, dtype=np.int32).reshape(-1, 4)
+        self.qid_index = np.array(qid_index, dtype=np.int32)
+        self.choice_codes = np.array(choice_codes, dtype=np.int16)
+        # (qid, choice) theo thứ tự bubble, dùng khi map kết quả model về câu hỏi
+        self.labels = [(self.qids[q], self.choice_values[c]) for q, c in zip(qid_index, choice_codes)]
+        self.bounds_lookup = {f"{q}_{c}": tuple(b) for (q, c), b in zip(self.labels, bounds)}
+        # Khung bao bubble của từng field block: chỉ các vùng này cần làm nét trước khi phân loại
+        self.field_regions = np.array([
+            (self.bounds[s, 0].min(), self.bounds[s, 1].min(), self.bounds[s, 2].max(), self.bounds[s, 3].max())
+            for s in self.field_slices.values() if s.stop > s.start
+        ], dtype=np.int32).reshape(-1, 4)
+        self.cascade_band = CascadeBand.from_config(getattr(template, "cascade", None))
+        self.quality_thresholds = QualityThresholds.from_config(getattr(template, "quality", None))
+        self._bubbles = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def page_dimensions(self):
+        return self.template.page_dimensions
+
+    @property
+    def bubble_dimensions(self):
+        return self.template.bubble_dimensions
+
+    @property
+    def field_blocks(self):
+        return self.template.field_blocks
+
+    @property
+    def bubbles(self):
+        """Danh sách dict như `get_all_bubbles`, chỉ tạo khi có code cũ cần tới"""
+        if self._bubbles is None:
+            self._bubbles = [dict(qid=q, choice=c, bounds=tuple(b))
+                             for (q, c), b in zip(self.labels, self.bounds.tolist())]
+        return self._bubbles
+
+def compile_template(template):
+    """Trả về CompiledTemplate cho một TemplateOMR (nhớ sẵn trên chính object template)"""
+    if isinstance(template, CompiledTemplate):
+        return template
+    compiled = getattr(template, "_compiled", None)
+    if compiled is None:
+        compiled = CompiledTemplate(template)
+        template._compiled = compiled
+    return compiled
+
+MAX_COMPILED_TEMPLATES = 32
+_compiled_templates = OrderedDict()
+_compiled_lock = threading.Lock()
+
+def get_compiled_template(template_path, template_id=None):
+    """
+    Lấy CompiledTemplate từ cache LRU theo template id (hoặc đường dẫn) và mtime của template.json
+    (cùng cascade.json nếu có). Template chỉ được đọc lại từ đĩa khi file thay đổi.
+    """
+    actual_path = os.path.abspath(resolve_template_path(template_path))
+    mtime = os.path.getmtime(actual_path)
+    cascade_path = cascade_path_for(actual_path)
+    if os.path.exists(cascade_path):
+        mtime = max(mtime, os.path.getmtime(cascade_path))
+    key = template_id if template_id is not None else actual_path
+
+    with _compiled_lock:
+        cached = _compiled_templates.get(key)
+        if cached is not None and cached.source_path == actual_path and cached.mtime == mtime:
+            _compiled_templates.move_to_end(key)
+            return cached
+
+    compiled = CompiledTemplate(load_template(actual_path), template_id=template_id, source_path=actual_path, mtime=mtime)
+    with _compiled_lock:
+        _compiled_templates[key] = compiled
+        _compiled_templates.move_to_end(key)
+        while len(_compiled_templates) > MAX_COMPILED_TEMPLATES:
+            _compiled_templates.popitem(last=False)
+    return compiled
@@ -1,12 +1,19 @@
+from datetime import datetime
+import copy
+import logging
+
 from fastapi import APIRouter, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db.session import get_async_db
 from app.models.user import User
 from app.utils.auth import get_current_active_user
-from app.services.dashboard_service import DashboardService
+from app.services.dashboard_service import DashboardService, ADMIN_STATS_FALLBACK
+from app.services.dashboard_cache import dashboard_cache
 from app.schemas.dashboard import AdminStats, ManagerStats, TeacherStats
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/stats", tags=["stats"])
 
 @router.get("/overview", response_model=dict)
@@ -43,11 +50,25 @@ async def get_admin_detailed_stats(
     if current_user.vaiTro.upper() != "ADMIN":
         return {"detail": "Chỉ admin mới có quyền truy cập"}
     
-    stats = await DashboardService.admin_stats(db)
-    activities = await DashboardService.get_recent_activities(db, 8)
-    
+    # Thống kê và hoạt động gần đây cùng nằm trong một snapshot (một lần truy vấn, hoặc không khi cache còn mới)
+    try:
+        snapshot = await DashboardService.admin_snapshot(db)
+    except Exception as e:
+        logger.error(f"Error in admin dashboard snapshot: {e}")
+        snapshot = {"stats": copy.deepcopy(ADMIN_STATS_FALLBACK), "recentActivities": [], "generatedAt": datetime.now().isoformat()}
+
     return {
-        "stats": stats,
-        "recentActivities": activities,
-        "timestamp": "2024-01-15T10:30:00Z"
-    }
\ No newline at end of file
+        "stats": snapshot["stats"],
+        "recentActivities": snapshot["recentActivities"][:8],
+        "timestamp": snapshot["generatedAt"]
+    }
+
+@router.get("/cache")
+async def get_dashboard_cache_stats(
+    current_user: User = Depends(get_current_active_user),
+):
+    """Tỉ lệ hit và thời gian truy vấn của snapshot cache dashboard (admin only)"""
+    if current_user.vaiTro.upper() != "ADMIN":
+        return {"detail": "Chỉ admin mới có quyền truy cập"}
+
+    return dashboard_cache.stats()
\ No newline at end of file
@@ -6,6 +6,7 @@ import io
 
 from app.db.session import get_async_db
 from app.services.exam_service import ExamService
+from app.services.item_analysis_service import ItemAnalysisService
 from app.schemas.exam import ExamCreate, ExamUpdate, ExamOut, ExamClassAssignment, ExamAnswersCreate, ExamAnswersOut
 from app.models.user import User
 from app.utils.auth import get_current_active_user, check_manager_permission, check_teacher_permission
@@ -208,6 +209,35 @@ async def get_exam_statistics(
     return stats
 
 
+@router.get("/{exam_id}/item-analysis")
+async def get_exam_item_analysis(
+    exam_id: int,
+    class_id: Optional[int] = None,
+    refresh: bool = False,
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Phân tích câu hỏi theo mã đề (độ khó, độ phân biệt, phương án nhiễu).
+    Theo lớp: đọc bản đã lưu trong thống kê bài thi, tự tính lại khi số kết quả thay đổi.
+    Cả bài thi: tính từ các phiếu đã lưu.
+    """
+    exam = await ExamService.get_exam(db, exam_id)
+    if current_user.vaiTro == "MANAGER" and exam.maToChuc != current_user.maToChuc:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Không có quyền truy cập bài kiểm tra này")
+    if current_user.vaiTro == "TEACHER" and exam.maNguoiTao != current_user.maNguoiDung:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Không có quyền truy cập bài kiểm tra này")
+
+    try:
+        if class_id is not None:
+            return await ItemAnalysisService.get_class_analysis(db, exam_id, class_id, refresh=refresh)
+        if refresh:
+            return (await ItemAnalysisService.refresh(db, exam_id))["exam"]
+        return (await ItemAnalysisService.analyze(db, exam_id))["exam"]
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+
 @router.get("/{exam_id}/results")
 async def get_exam_results(
     exam_id: int,
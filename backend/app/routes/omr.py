@@ -1,11 +1,11 @@
 """
 OMR Checker API Routes - Version 2: Ultra Simple File-Based Annotation
 """
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, Request
+from fastapi.responses import JSONResponse, FileResponse, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional, Dict
-import tempfile
+import asyncio
 import cv2
 import os
 import base64
@@ -18,12 +18,22 @@ from pydantic import BaseModel
 from app.db.session import get_async_db
 from app.models.user import User
 from app.utils.auth import get_current_user
-from app.omr.main_pipeline import process_single_image, OMRAligner
-from app.omr.template import load_template, get_all_bubbles
-from app.services.omr_service import OMRDatabaseService
+from app.omr.main_pipeline import OMRAligner
+from app.omr.image_io import SheetImage, decode_image, persist_image, sniff_image_format
+from app.omr.template import get_compiled_template
+from app.services.omr_service import OMRDatabaseService, storage_relative_path
 from app.models.student import Student
 from app.models.class_room import ClassRoom
-from ultralytics import YOLO
+from app.omr.model_registry import model_registry
+from app.services.omr_worker_pool import omr_worker_pool, OMRQueueFullError
+from app.services.omr_result_cache import omr_result_cache
+from app.services.omr_job_service import OMRJobService, omr_job_runner
+from app.services.student_roster_index import student_roster_index
+from app.services.answer_key_cache import answer_key_cache
+from app.services.annotation_service import (
+    AnnotationService, AnnotationSource, annotation_renderer, annotation_url, verify_annotation_signature
+)
+from app.models.omr_job import OMRJob
 from app.models.answer_sheet_template import AnswerSheetTemplate
 from app.models.exam import Exam
 from app.core.config import settings
@@ -79,7 +89,7 @@ async def process_omr_with_exam(
     exam_id: int = Form(...),
     image: UploadFile = File(...),
     template_id: int = Form(...),
-    yolo_model: str = Form(default="app/omr/models/best.pt"),
+    yolo_model: str = Form(default=settings.OMR_MODEL_PATH),
     auto_align: bool = Form(default=False),
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_async_db)
@@ -93,108 +103,68 @@ async def process_omr_with_exam(
         if current_user.vaiTro not in ["ADMIN", "MANAGER", "TEACHER"]:
             raise HTTPException(status_code=403, detail="Không có quyền sử dụng chức năng này")
         
-        # Kiểm tra file đầu vào
+        # Kiểm tra file đầu vào: đuôi file và magic bytes của nội dung upload
         if not image.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
             raise HTTPException(status_code=400, detail="File phải có định dạng PNG, JPG hoặc JPEG")
+        content = await image.read()
+        if sniff_image_format(content) is None:
+            raise HTTPException(status_code=400, detail="Nội dung file không phải ảnh PNG, JPG hoặc JPEG hợp lệ")
+        
+        # Căn chỉnh + nhận dạng chạy trong worker pool, không chặn event loop; ảnh đi thẳng
+        # từ bộ nhớ sang worker và chỉ được decode một lần ở đó; annotation được vẽ và encode JPEG trong worker.
+        # Ảnh đã xử lý trước đó lấy từ cache kết quả
+        fname, omr_results, encoded = await omr_result_cache.process_sheet(
+            SheetImage(content, image.filename),
+            template_path,
+            template_id=template_id,
+            model_path=yolo_model,
+            conf=0.4,
+            auto_align=auto_align,
+            return_aligned=True,
+            jpeg_quality=settings.OMR_ANNOTATION_JPEG_QUALITY,
+            annotation_keys={}
+        )
         
-        # Tạo file tạm và xử lý OMR
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmpf:
-            content = await image.read()
-            tmpf.write(content)
-            tmpf.flush()
+        # Lấy SBD từ metadata nếu có
+        metadata = omr_results.get("_metadata", {})
+        sbd = metadata.get("sbd", "")
+        ma_de = metadata.get("ma_de", "")
+        
+        # Fallback: Tìm SBD từ các key khác nếu không có trong metadata
+        if not sbd:
+            sbd_keys = ["sbd", "so_bao_danh", "student_id", "id"]
+            for key in sbd_keys:
+                if key in omr_results and omr_results[key]:
+                    sbd = str(omr_results[key])
+                    break
             
-            # Khởi tạo aligner nếu cần
-            aligner = None
-            if auto_align:
-                template_dir = os.path.dirname(template_path)
-                ref_images = list(Path(template_dir).glob("*.png")) + list(Path(template_dir).glob("*.jpg"))
-                if ref_images:
-                    ref_img_path = str(ref_images[0])
-                    aligner = OMRAligner(
-                        ref_img_path=ref_img_path,
-                        method='ORB',
-                        max_features=5000,
-                        good_match_percent=0.2,
-                        debug=False
-                    )
-            
-            # Xử lý ảnh OMR để lấy câu trả lời
-            fname, omr_results = process_single_image(
-                tmpf.name,
-                load_template(template_path),
-                YOLO(yolo_model),
-                conf=0.4,
-                aligner=aligner,
-                answer_key_excel=None,  # Không dùng Excel
-                save_files=False  # Không lưu file trung gian cho single image API
-            )
-            
-            # Lấy SBD từ metadata nếu có
-            metadata = omr_results.get("_metadata", {})
-            sbd = metadata.get("sbd", "")
-            ma_de = metadata.get("ma_de", "")
-            
-            # Fallback: Tìm SBD từ các key khác nếu không có trong metadata
+            # Thử tìm trong key có pattern số
             if not sbd:
-                sbd_keys = ["sbd", "so_bao_danh", "student_id", "id"]
-                for key in sbd_keys:
-                    if key in omr_results and omr_results[key]:
-                        sbd = str(omr_results[key])
-                        break
-                
-                # Thử tìm trong key có pattern số
-                if not sbd:
-                    for key, value in omr_results.items():
-                        if "sbd" in key.lower() or "id" in key.lower():
-                            if value and str(value).isdigit():
-                                sbd = str(value)
-                                break
-            
-            if not sbd:
-                raise HTTPException(
-                    status_code=400, 
-                    detail="Không thể tự động nhận diện số báo danh từ phiếu trả lời. Vui lòng kiểm tra template và ảnh."
-                )
-            
-            # Chấm điểm bằng database service
-            scoring_result = await OMRDatabaseService.score_omr_result(
+                for key, value in omr_results.items():
+                    if "sbd" in key.lower() or "id" in key.lower():
+                        if value and str(value).isdigit():
+                            sbd = str(value)
+                            break
+        
+        if not sbd:
+            raise HTTPException(
+                status_code=400, 
+                detail="Không thể tự động nhận diện số báo danh từ phiếu trả lời. Vui lòng kiểm tra template và ảnh."
+            )
+        
+        # Chấm điểm bằng database service
+        scoring_result = await OMRDatabaseService.score_omr_result(
             db=db,
             exam_id=exam_id,
-                student_answers=omr_results,
-                sbd=sbd,
-                image_path=tmpf.name,
-                scanner_user_id=current_user.maNguoiDung
-            )
-            
-            # Tạo annotated image cho response (không lưu file)
-            img_anno_b64 = ""
-            try:
-                # Tạo annotated image trong memory
-                with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as temp_anno:
-                    template_obj = load_template(template_path)
-                    bubbles = get_all_bubbles(template_obj)
-                    
-                    # Tạo ảnh annotation
-                    from app.omr.detection import draw_scoring_overlay
-                    image = cv2.imread(tmpf.name)
-                    if image is not None:
-                        draw_scoring_overlay(
-                            image, bubbles, omr_results, {}, temp_anno.name
-                        )
-                        
-                        # Đọc và encode
-                        if os.path.exists(temp_anno.name):
-                            with open(temp_anno.name, "rb") as f:
-                                img_anno_b64 = base64.b64encode(f.read()).decode()
-                            os.unlink(temp_anno.name)  # Cleanup
-            except Exception as e:
-                logging.warning(f"Failed to create annotated image: {e}")
+            student_answers=omr_results,
+            sbd=sbd,
+            scanner_user_id=current_user.maNguoiDung
+        )
         
-        # Dọn dẹp file tạm
-        try:
-            os.unlink(tmpf.name)
-        except:
-            pass
+        # Tạo annotated image cho response trong bộ nhớ (ảnh không được lưu nên không có URL annotation)
+        img_anno_b64 = ""
+        if encoded is not None and encoded.annotated_jpeg:
+            img_anno_b64 = base64.b64encode(encoded.annotated_jpeg).decode()
         
         return JSONResponse({
             "success": True,
@@ -205,6 +175,10 @@ async def process_omr_with_exam(
             "annotated_image": img_anno_b64
         })
         
+    except HTTPException:
+        raise
+    except OMRQueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Hệ thống OMR đang quá tải, vui lòng thử lại sau: {e}")
     except Exception as e:
         logging.error(f"OMR processing error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Lỗi xử lý OMR: {str(e)}")
@@ -214,11 +188,12 @@ async def batch_process_omr_with_exam(
     exam_id: int = Form(...),
     template_id: int = Form(...),
     images: List[UploadFile] = File(...),
-    yolo_model: str = Form(default="app/omr/models/best.pt"),
+    yolo_model: str = Form(default=settings.OMR_MODEL_PATH),
     confidence: float = Form(default=0.4),
     auto_align: bool = Form(default=True),
     create_annotations: bool = Form(default=True),
-    max_annotation_images: int = Form(default=10),
+    # Không còn tác dụng (annotation được render khi mở URL), chỉ giữ để client cũ không lỗi
+    max_annotation_images: Optional[int] = Form(default=None, deprecated=True),
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_async_db)
 ):
@@ -230,97 +205,68 @@ async def batch_process_omr_with_exam(
         logging.info(f"Starting FINAL batch processing with JSON answer key comparison")
         
         if len(images) > 50:
-            raise HTTPException(status_code=400, detail="Không thể xử lý quá 50 ảnh cùng lúc")
+            raise HTTPException(status_code=400, detail="Không thể xử lý quá 50 ảnh cùng lúc, hãy dùng /omr/jobs cho batch lớn")
         
         # 1. Tạo thư mục lưu trữ vĩnh viễn cho các ảnh gốc và ảnh đã xử lý
         # Đường dẫn vật lý trên server
         storage_root = Path(settings.STORAGE_PATH)
         exam_storage_dir = storage_root / "annotated_scans" / str(exam_id)
         exam_storage_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Đường dẫn web tương đối
-        relative_storage_path = Path("annotated_scans") / str(exam_id)
 
-        image_paths_to_process = []
-        
-        # Lưu ảnh gốc vào thư mục lưu trữ
+        # Ảnh upload giữ trong bộ nhớ và gửi thẳng sang worker; ảnh gốc được ghi xuống storage
+        # song song với xử lý thay vì ghi rồi đọc lại
+        sheet_images = []
         for i, image in enumerate(images):
             if not image.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
                 continue
+            content = await image.read()
+            if sniff_image_format(content) is None:
+                logging.warning(f"Skipping {image.filename}: content is not a valid image")
+                continue
                 
             # Tạo tên file an toàn
             safe_filename = f"original_{i}_{Path(image.filename).name}"
-            physical_path = exam_storage_dir / safe_filename
-            
-            with open(physical_path, 'wb') as f:
-                content = await image.read()
-                f.write(content)
-            image_paths_to_process.append(physical_path)
+            sheet_images.append(SheetImage(content, safe_filename, str(exam_storage_dir / safe_filename)))
         
-        if not image_paths_to_process:
+        if not sheet_images:
             raise HTTPException(status_code=400, detail="Không có ảnh hợp lệ để xử lý")
         
-        logging.info(f"Processing {len(image_paths_to_process)} images with JSON answer key comparison")
+        persist_originals = asyncio.create_task(
+            asyncio.to_thread(lambda: [persist_image(sheet_image) for sheet_image in sheet_images])
+        )
+        
+        logging.info(f"Processing {len(sheet_images)} images with JSON answer key comparison")
         
-        # Load components
-        template = load_template(template_path)
-        model = YOLO(yolo_model)
-        bubbles = get_all_bubbles(template)
+        # Annotation không vẽ ở đây: response chỉ mang URL, ảnh được render khi client mở lần đầu
+        # (GET /omr/annotations/exams/{exam_id}/files/{filename}) nên max_annotation_images không còn giới hạn gì
+        if max_annotation_images is not None:
+            logging.warning("max_annotation_images is deprecated and ignored: annotations are rendered on demand")
+        should_create_annotations = create_annotations
         
-        # Tạo aligner nếu cần
-        aligner = None
-        if auto_align:
-            template_dir = os.path.dirname(template_path)
-            ref_images = list(Path(template_dir).glob("*.png")) + list(Path(template_dir).glob("*.jpg"))
-            if ref_images:
-                aligner = OMRAligner(
-                    ref_img_path=str(ref_images[0]),
-                    method='ORB',
-                    max_features=5000,
-                    good_match_percent=0.2,
-                    debug=False
-                )
-                logging.info(f"Created aligner with reference: {ref_images[0]}")
-        
-        should_create_annotations = create_annotations and len(image_paths_to_process) <= max_annotation_images
-        
-        # Import draw function
-        try:
-            from app.omr.detection import draw_scoring_overlay
-            draw_function_available = True
-            logging.info("draw_scoring_overlay imported successfully")
-        except ImportError as e:
-            logging.error(f"Cannot import draw_scoring_overlay: {e}")
-            draw_function_available = False
-            should_create_annotations = False
-        
-        logging.info(f"Will create annotations with JSON answer key: {should_create_annotations}")
-        
-        # 🎯 LOAD JSON ANSWER KEYS từ exam trong database
-        exam_answer_keys = {}
-        try:
-            exam_answer_keys = await load_json_answer_keys_for_exam(db, exam_id)
-            logging.info(f"Loaded JSON answer keys for {len(exam_answer_keys)} mã đề: {list(exam_answer_keys.keys())}")
-        except Exception as e:
-            logging.warning(f"Could not load JSON answer keys: {e}")
-            exam_answer_keys = {}
+        # Roster SBD của bài thi: xây một lần cho cả batch, báo trước các SBD trùng nhau
+        roster = await student_roster_index.for_exam(db, exam_id)
         
         # Process images
         batch_results = []
         omr_results = {}
-        annotated_images = {}
+        annotation_urls = {}
+        
+        # Ảnh chưa có trong cache kết quả được chia cho các worker; mỗi worker gộp ROI của nhiều phiếu vào
+        # các lần gọi model lớn, kết quả trả về theo đúng thứ tự ảnh. Ảnh căn chỉnh được lưu cạnh ảnh gốc
+        # để vẽ annotation về sau.
+        processed_sheets = await omr_result_cache.process_batch(
+            sheet_images, template_path,
+            template_id=template_id, model_path=yolo_model, conf=confidence,
+            auto_align=auto_align, save_files=True,
+            inference_batch_size=settings.OMR_INFERENCE_BATCH_SIZE
+        )
+        # Sidecar và kết quả trỏ tới ảnh gốc nên ảnh phải nằm trên đĩa trước khi trả về
+        await persist_originals
         
-        for i, img_path in enumerate(image_paths_to_process):
+        for i, (sheet_image, (fname, results, _)) in enumerate(zip(sheet_images, processed_sheets)):
+            img_path = sheet_image.path
             try:
-                logging.info(f"Processing {i+1}/{len(image_paths_to_process)}: {os.path.basename(img_path)}")
-                
-                # Process để lấy kết quả và ảnh đã căn chỉnh
-                fname, results, aligned_img = process_single_image(
-                    img_path, template, model, confidence, aligner, 
-                    answer_key_excel=None, save_files=True
-                )
-                
-                logging.info(f"process_single_image completed for {fname}")
+                logging.info(f"Processed {i+1}/{len(sheet_images)}: {sheet_image.name}")
                 
                 if "error" not in results:
                     metadata = results.get("_metadata", {})
@@ -344,52 +290,21 @@ async def batch_process_omr_with_exam(
                     
                     logging.info(f"Detected SBD: {sbd}, mã đề: {ma_de}")
                     
+                    # Kết quả nhận dạng lưu cạnh ảnh căn chỉnh: dùng để render annotation
+                    # và để /save-results biết ảnh gốc của phiếu
+                    image_path = storage_relative_path(img_path)
+                    AnnotationService.write_batch_sidecar(exam_id, fname, image_path, template_id, results)
+                    if should_create_annotations:
+                        annotation_urls[fname] = annotation_url(f"/annotations/exams/{exam_id}/files/{fname}")
+                    
                     # Chuẩn bị cho database scoring
                     if sbd:
-                        # Đường dẫn tương đối của ảnh annotation để lưu vào DB
-                        relative_annotated_path = relative_storage_path / f"{sbd}_{fname}_annotated.jpg"
-                        
-                        # Thêm đường dẫn này vào dict để truyền đi
-                        batch_item = {
+                        batch_results.append({
                             "student_answers": results,
                             "sbd": sbd,
-                            "image_path": str(img_path), # Đường dẫn ảnh gốc vật lý
-                            "filename": fname,
-                            # Đường dẫn URL tương đối cho DB và response
-                            "annotated_image_path": str(relative_annotated_path) 
-                        }
-                        batch_results.append(batch_item)
-                    
-                    # 🎨 FINAL ANNOTATION
-                    if should_create_annotations and draw_function_available and aligned_img is not None:
-                        try:
-                            logging.info(f"Creating FINAL annotation for {fname} with mã đề {ma_de}")
-                            
-                            # Lấy đáp án
-                            answer_key_for_annotation = exam_answer_keys.get(str(ma_de), {})
-                            
-                            # Đường dẫn vật lý để lưu ảnh annotation
-                            physical_annotation_path = exam_storage_dir / f"{sbd}_{fname}_annotated.jpg"
-                            
-                            # Đảm bảo thư mục tồn tại TRƯỚC KHI gọi hàm vẽ
-                            os.makedirs(os.path.dirname(physical_annotation_path), exist_ok=True)
-
-                            # Vẽ và lưu file, đảm bảo các tham số được truyền đúng qua keyword
-                            draw_scoring_overlay(
-                                image=aligned_img,
-                                bubbles=bubbles,
-                                student_results=results,
-                                answer_key=answer_key_for_annotation,
-                                out_path=str(physical_annotation_path)
-                            )
-                            
-                            # Đọc lại file đã annotate để encode (vẫn giữ để trả về cho UI)
-                            if os.path.exists(physical_annotation_path):
-                                with open(physical_annotation_path, 'rb') as f:
-                                    annotated_images[fname] = base64.b64encode(f.read()).decode()
-                            
-                        except Exception as e:
-                            logging.error(f"Final annotation error for {fname}: {e}")
+                            "image_path": image_path,
+                            "filename": fname
+                        })
                 else:
                     logging.error(f"OMR processing failed for {fname}: {results.get('error', 'Unknown error')}")
                 
@@ -401,8 +316,6 @@ async def batch_process_omr_with_exam(
                 logging.error(f"Processing traceback: {traceback.format_exc()}")
                 omr_results[f"error_{i}"] = {"error": str(e), "original_path": img_path}
         
-        logging.info(f"OMR processing completed. Created {len(annotated_images)} FINAL annotated images: {list(annotated_images.keys())}")
-        
         # Database scoring
         scoring_result = await OMRDatabaseService.batch_score_omr_results(
             db=db,
@@ -415,17 +328,13 @@ async def batch_process_omr_with_exam(
         
         # Summary
         summary = {
-            "total_images": len(image_paths_to_process),
+            "total_images": len(sheet_images),
             "successful": len([r for r in omr_results.values() if "error" not in r]),
             "failed": len([r for r in omr_results.values() if "error" in r]),
-            "annotated_images_created": len(annotated_images),
+            "annotation_urls_created": len(annotation_urls),
             "alignment_enabled": auto_align,
             "annotations_enabled": should_create_annotations,
-            "max_annotation_limit": max_annotation_images,
-            "draw_function_available": draw_function_available,
-            "aligner_created": aligner is not None,
-            "json_answer_keys_loaded": len(exam_answer_keys),
-            "enhancement": "json_answer_key_comparison"
+            "aligner_created": auto_align
         }
         
         logging.info(f"FINAL batch processing summary: {summary}")
@@ -436,11 +345,13 @@ async def batch_process_omr_with_exam(
             "summary": summary,
             "omr_results": omr_results,
             "scoring_result": scoring_result,
-            "annotated_images": annotated_images,
+            "annotation_urls": annotation_urls,
             "storage_path": str(exam_storage_dir), # For debugging
-            "json_answer_keys_available": list(exam_answer_keys.keys())
+            "sbd_collisions": roster.collision_report()
         })
         
+    except OMRQueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Hệ thống OMR đang quá tải, vui lòng thử lại sau: {e}")
     except Exception as e:
         logging.error(f"FINAL batch processing error: {str(e)}")
         import traceback
@@ -454,45 +365,11 @@ async def load_json_answer_keys_for_exam(db: AsyncSession, exam_id: int):
     Format: {"123": {"q1":"A","q2":"B",...}, "777": {"q1":"A",...}}
     """
     try:
-        from app.models.exam import Answer
-        from sqlalchemy import select
-        
-        # Lấy exam record
-        stmt = select(Answer).where(Answer.maBaiKiemTra == exam_id)  # Điều chỉnh field name
-        result = await db.execute(stmt)
-        exam = result.scalar_one_or_none()
-        
-        if not exam:
-            logging.error(f"Exam not found: {exam_id}")
-            return {}
-        
-        # Lấy JSON answer keys từ field trong exam
-        # Điều chỉnh field name theo database thực tế
-        answer_keys_json = exam.dapAnJson  # Tùy theo tên field
-        
-        if not answer_keys_json:
+        compiled = await answer_key_cache.get(db, exam_id)
+        answer_keys = compiled.annotation_keys()
+        if not answer_keys:
             logging.warning(f"No answer keys found for exam {exam_id}")
-            return {}
-        
-        # Parse JSON
-        if isinstance(answer_keys_json, str):
-            answer_keys = json.loads(answer_keys_json)
-        else:
-            answer_keys = answer_keys_json  # Đã là dict
-        
-        # Validate format
-        if not isinstance(answer_keys, dict):
-            logging.error(f"Invalid answer keys format for exam {exam_id}")
-            return {}
-        
-        # Filter ra chỉ phần answer keys (loại bỏ scoring weights nếu có)
-        cleaned_answer_keys = {}
-        for ma_de, questions in answer_keys.items():
-            if isinstance(questions, dict) and all(isinstance(v, str) for v in questions.values()):
-                cleaned_answer_keys[str(ma_de)] = questions
-                logging.info(f"Loaded answer key for mã đề {ma_de}: {len(questions)} questions")
-        
-        return cleaned_answer_keys
+        return answer_keys
         
     except Exception as e:
         logging.error(f"Error loading JSON answer keys for exam {exam_id}: {e}")
@@ -500,6 +377,84 @@ async def load_json_answer_keys_for_exam(db: AsyncSession, exam_id: int):
         logging.error(f"Traceback: {traceback.format_exc()}")
         return {}
 
+@router.post("/jobs", status_code=202)
+async def create_omr_job(
+    exam_id: int = Form(...),
+    template_id: int = Form(...),
+    images: List[UploadFile] = File(...),
+    yolo_model: str = Form(default=settings.OMR_MODEL_PATH),
+    confidence: float = Form(default=0.4),
+    auto_align: bool = Form(default=True),
+    save_results: bool = Form(default=False),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Tạo công việc chấm OMR chạy nền cho batch lớn, trả về job_id ngay sau khi lưu ảnh.
+    Tiến trình được gửi qua WebSocket (omr_progress), kết quả lấy tại GET /omr/jobs/{job_id}.
+    """
+    if current_user.vaiTro not in ["ADMIN", "MANAGER", "TEACHER"]:
+        raise HTTPException(status_code=403, detail="Không có quyền sử dụng chức năng này")
+
+    valid_images = [image for image in images if image.filename.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    if not valid_images:
+        raise HTTPException(status_code=400, detail="Không có ảnh hợp lệ để xử lý")
+    if len(valid_images) > settings.OMR_JOB_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Không thể xử lý quá {settings.OMR_JOB_MAX_IMAGES} ảnh trong một công việc")
+
+    # Kiểm tra template trước khi nhận job
+    await get_template_path_from_id(template_id, db)
+
+    job = await OMRJobService.create_job(
+        db, exam_id, template_id, current_user.maNguoiDung, valid_images,
+        options={
+            "yolo_model": yolo_model,
+            "confidence": confidence,
+            "auto_align": auto_align,
+            "save_results": save_results,
+        }
+    )
+    omr_job_runner.enqueue(job.maCongViec)
+
+    return {
+        "success": True,
+        "job_id": job.maCongViec,
+        "status": job.trangThai,
+        "total_images": job.tongSoAnh,
+        "skipped_files": len(images) - len(valid_images)
+    }
+
+@router.get("/jobs/{job_id}")
+async def get_omr_job(
+    job_id: int,
+    include_results: bool = True,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Trạng thái, tiến trình và kết quả từng ảnh của một công việc OMR."""
+    job = await db.get(OMRJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy công việc OMR ID: {job_id}")
+    if current_user.vaiTro not in ["ADMIN", "MANAGER"] and job.maNguoiTao != current_user.maNguoiDung:
+        raise HTTPException(status_code=403, detail="Không có quyền xem công việc này")
+    return await OMRJobService.get_job(db, job_id, include_results=include_results)
+
+@router.get("/exams/{exam_id}/sbd-collisions")
+async def get_exam_sbd_collisions(
+    exam_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Các SBD (6 số cuối mã học sinh) bị trùng giữa nhiều học sinh của bài thi, cần kiểm tra trước khi quét."""
+    if current_user.vaiTro not in ["ADMIN", "MANAGER", "TEACHER"]:
+        raise HTTPException(status_code=403, detail="Không có quyền sử dụng chức năng này")
+    roster = await student_roster_index.for_exam(db, exam_id)
+    return {
+        "exam_id": exam_id,
+        "total_students": len(roster),
+        "collisions": roster.collision_report()
+    }
+
 @router.get("/exam-stats/{exam_id}")
 async def get_exam_omr_stats(
     exam_id: int,
@@ -546,80 +501,68 @@ async def omr_preview(
         if current_user.vaiTro not in ["ADMIN", "MANAGER", "TEACHER"]:
             raise HTTPException(status_code=403, detail="Không có quyền sử dụng chức năng này")
 
-        # 2. Lưu ảnh upload tạm thời
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmpf:
-            content = await image.read()
-            tmpf.write(content)
-            tmpf.flush()
-            
-            img_to_process = cv2.imread(tmpf.name)
-            if img_to_process is None:
-                os.unlink(tmpf.name)
-                raise HTTPException(status_code=400, detail="Không thể đọc file ảnh được upload.")
+        # 2. Decode ảnh upload trực tiếp từ bộ nhớ
+        content = await image.read()
+        img_to_process = decode_image(content)
+        if img_to_process is None:
+            raise HTTPException(status_code=400, detail="Không thể đọc file ảnh được upload.")
 
-            # 3. Thực hiện căn chỉnh ảnh nếu được yêu cầu
-            alignment_status = "Not Performed"
-            if auto_align:
-                try:
-                    # Tìm ảnh tham chiếu trong thư mục template
-                    ref_images = list(template_dir.glob("*.png")) + list(template_dir.glob("*.jpg"))
-                    if not ref_images:
-                        logging.warning(f"Không tìm thấy ảnh tham chiếu trong: {template_dir}. Bỏ qua bước căn chỉnh.")
-                        alignment_status = "Skipped (No reference image)"
+        # 3. Thực hiện căn chỉnh ảnh nếu được yêu cầu
+        alignment_status = "Not Performed"
+        if auto_align:
+            try:
+                # Tìm ảnh tham chiếu trong thư mục template
+                ref_images = list(template_dir.glob("*.png")) + list(template_dir.glob("*.jpg"))
+                if not ref_images:
+                    logging.warning(f"Không tìm thấy ảnh tham chiếu trong: {template_dir}. Bỏ qua bước căn chỉnh.")
+                    alignment_status = "Skipped (No reference image)"
+                else:
+                    ref_img_path = str(ref_images[0])
+                    aligner = OMRAligner(ref_img_path=ref_img_path)
+                    
+                    # Căn chỉnh ảnh
+                    aligned_img = aligner.align(img_to_process)
+                    
+                    if aligned_img is not None:
+                        img_to_process = aligned_img  # >> Sử dụng ảnh đã căn chỉnh
+                        alignment_status = "Success"
                     else:
-                        ref_img_path = str(ref_images[0])
-                        aligner = OMRAligner(ref_img_path=ref_img_path)
-                        
-                        # Căn chỉnh ảnh
-                        aligned_img = aligner.align(img_to_process)
-                        
-                        if aligned_img is not None:
-                            img_to_process = aligned_img  # >> Sử dụng ảnh đã căn chỉnh
-                            alignment_status = "Success"
-                        else:
-                            logging.warning(f"Căn chỉnh thất bại cho template {template_id}. Sử dụng ảnh gốc để preview.")
-                            alignment_status = "Failed (Using original image)"
+                        logging.warning(f"Căn chỉnh thất bại cho template {template_id}. Sử dụng ảnh gốc để preview.")
+                        alignment_status = "Failed (Using original image)"
 
-                except Exception as align_error:
-                    logging.error(f"Lỗi trong quá trình căn chỉnh ảnh preview: {align_error}")
-                    alignment_status = f"Error: {align_error}"
-            else:
-                alignment_status = "Disabled"
+            except Exception as align_error:
+                logging.error(f"Lỗi trong quá trình căn chỉnh ảnh preview: {align_error}")
+                alignment_status = f"Error: {align_error}"
+        else:
+            alignment_status = "Disabled"
 
-            # 4. Load template và vẽ các ô nhận dạng
-            template = load_template(str(template_path))
-            bubbles = get_all_bubbles(template)
-            
-            for bubble in bubbles:
-                x1, y1, x2, y2 = bubble['bounds']
-                cv2.rectangle(img_to_process, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                cv2.putText(img_to_process, f"{bubble.get('qid', '')}-{bubble.get('choice', '')}", 
-                           (x1, y1-5), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 0), 1)
-            
-            # 5. Encode ảnh preview để gửi về client
-            _, buffer = cv2.imencode('.jpg', img_to_process)
-            preview_b64 = base64.b64encode(buffer).decode()
-            
-            # 6. Dọn dẹp file tạm và trả về kết quả
-            os.unlink(tmpf.name)
-            
-            return JSONResponse({
-                "success": True,
-                "template_info": {
-                    "page_dimensions": template.page_dimensions,
-                    "bubble_dimensions": template.bubble_dimensions,
-                    "field_blocks": len(template.field_blocks),
-                    "total_bubbles": len(bubbles)
-                },
-                "alignment_status": alignment_status,
-                "alignment_enabled": auto_align,
-                "preview_image": preview_b64
-            })
+        # 4. Load template và vẽ các ô nhận dạng
+        template = get_compiled_template(str(template_path), template_id)
+        
+        for (qid, choice), (x1, y1, x2, y2) in zip(template.labels, template.bounds.tolist()):
+            cv2.rectangle(img_to_process, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            cv2.putText(img_to_process, f"{qid}-{choice}", 
+                       (x1, y1-5), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 0), 1)
+        
+        # 5. Encode ảnh preview để gửi về client
+        _, buffer = cv2.imencode('.jpg', img_to_process)
+        preview_b64 = base64.b64encode(buffer).decode()
+        
+        # 6. Trả về kết quả
+        return JSONResponse({
+            "success": True,
+            "template_info": {
+                "page_dimensions": template.page_dimensions,
+                "bubble_dimensions": template.bubble_dimensions,
+                "field_blocks": len(template.field_blocks),
+                "total_bubbles": len(template)
+            },
+            "alignment_status": alignment_status,
+            "alignment_enabled": auto_align,
+            "preview_image": preview_b64
+        })
         
     except Exception as e:
-        # Dọn dẹp nếu có lỗi xảy ra
-        if 'tmpf' in locals() and os.path.exists(tmpf.name):
-            os.unlink(tmpf.name)
         logging.error(f"OMR preview error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Lỗi preview OMR: {str(e)}")
 
@@ -947,7 +890,13 @@ async def get_omr_processing_stats(
                 "alignment_support": True,
                 "batch_processing_support": True,
                 "ultra_simple_approach": True
-            }
+            },
+            "model_registry": model_registry.stats(),
+            "worker_pool": omr_worker_pool.stats(),
+            "student_roster_index": student_roster_index.stats(),
+            "answer_key_cache": answer_key_cache.stats(),
+            "annotations": annotation_renderer.stats(),
+            "result_cache": omr_result_cache.stats()
         }
         
         return JSONResponse({
@@ -978,44 +927,37 @@ async def save_omr_results(
     """
     Lưu một batch kết quả OMR đã được chấm điểm vào database.
     """
-    saved_count = 0
-    errors = []
-    for result_item in request.results:
-        try:
-            # Gọi hàm service và nhận kết quả trả về
-            scoring_response = await OMRDatabaseService.score_omr_result(
-                db=db,
-                exam_id=request.exam_id,
-                student_answers=result_item.student_answers,
-                sbd=result_item.sbd,
-                scanner_user_id=current_user.maNguoiDung,
-                annotated_image_path=result_item.annotated_image_path,
-                save_to_db=True
-            )
-            
-            # Kiểm tra kết quả trả về từ service
-            if scoring_response.get("success"):
-                saved_count += 1
-            else:
-                errors.append({"filename": result_item.filename, "sbd": result_item.sbd, "error": scoring_response.get("error", "Lỗi không xác định từ service")})
+    items = [result_item.dict() for result_item in request.results]
+    for item in items:
+        # Ảnh gốc lấy từ kết quả batch lưu trên server, không tin đường dẫn do client gửi lên
+        sidecar = AnnotationService.read_batch_sidecar(request.exam_id, item["filename"])
+        if sidecar:
+            item["image_path"] = sidecar["image_path"]
 
-        except Exception as e:
-            # Bắt các lỗi không mong muốn từ chính hàm service
-            logging.error(f"Unhandled exception in save_omr_results for SBD {result_item.sbd}: {e}")
-            errors.append({"filename": result_item.filename, "sbd": result_item.sbd, "error": str(e)})
+    # Chấm và ghi cả batch trong một transaction
+    save_result = await OMRDatabaseService.save_scored_results(
+        db=db,
+        exam_id=request.exam_id,
+        items=items,
+        scanner_user_id=current_user.maNguoiDung
+    )
+    saved_count = len(save_result["saved"])
+    errors = save_result["errors"]
 
     # Trả về response chi tiết hơn
     if not errors and saved_count > 0:
         return JSONResponse({
             "success": True, 
             "message": f"Đã lưu thành công tất cả {saved_count} kết quả.",
-            "errors": []
+            "errors": [],
+            "results": save_result["saved"]
         })
     elif saved_count > 0:
         return JSONResponse({
             "success": False, # Coi là False nếu có lỗi để frontend biết
             "message": f"Đã lưu thành công {saved_count}/{len(request.results)} kết quả. Vui lòng kiểm tra các lỗi sau.",
-            "errors": errors
+            "errors": errors,
+            "results": save_result["saved"]
         }, status_code=207) # Multi-Status
     else:
         # Chỉ raise Exception khi không lưu được BẤT KỲ kết quả nào
@@ -1024,6 +966,66 @@ async def save_omr_results(
             detail={"message": "Không có kết quả nào được lưu thành công. Vui lòng kiểm tra lỗi.", "errors": errors}
         )
 
+async def _annotation_response(request: Request, db: AsyncSession, source: AnnotationSource, size: str):
+    """Trả ảnh annotation từ cache trên đĩa (render nếu chưa có), hỗ trợ ETag / If-None-Match."""
+    template_path = await get_template_path_from_id(source.template_id, db)
+    try:
+        etag = annotation_renderer.cache_key(source, template_path, size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Khóa phụ thuộc cả đáp án nên trình duyệt phải hỏi lại mỗi lần, đa số lượt chỉ nhận 304
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip().strip('"') for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        _, path = await annotation_renderer.get(source, template_path, size)
+    except OMRQueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Hệ thống OMR đang quá tải, vui lòng thử lại sau: {e}")
+    if path is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy ảnh phiếu để tạo annotation")
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
+
+@router.get("/annotations/{answer_sheet_id}")
+async def get_answer_sheet_annotation(
+    answer_sheet_id: int,
+    request: Request,
+    size: str = "full",
+    expires: int = 0,
+    sig: str = "",
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Ảnh annotation của một phiếu đã lưu, render lần đầu từ ảnh căn chỉnh và kết quả trong DB.
+    URL được ký sẵn (expires, sig) để dùng làm src của <img>; size là "full" hoặc "thumb".
+    """
+    if not verify_annotation_signature(f"/annotations/{answer_sheet_id}", expires, sig):
+        raise HTTPException(status_code=403, detail="URL annotation không hợp lệ hoặc đã hết hạn")
+    source = await AnnotationService.source_for_sheet(db, answer_sheet_id)
+    if source is None:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy ảnh của phiếu trả lời ID: {answer_sheet_id}")
+    return await _annotation_response(request, db, source, size)
+
+@router.get("/annotations/exams/{exam_id}/files/{filename}")
+async def get_batch_file_annotation(
+    exam_id: int,
+    filename: str,
+    request: Request,
+    size: str = "full",
+    expires: int = 0,
+    sig: str = "",
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Ảnh annotation của một ảnh trong batch-process-with-exam, kể cả khi kết quả chưa được lưu."""
+    if not verify_annotation_signature(f"/annotations/exams/{exam_id}/files/{filename}", expires, sig):
+        raise HTTPException(status_code=403, detail="URL annotation không hợp lệ hoặc đã hết hạn")
+    source = await AnnotationService.source_for_batch_file(db, exam_id, filename)
+    if source is None:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy kết quả OMR của ảnh {filename}")
+    return await _annotation_response(request, db, source, size)
+
 class BackfillRequest(BaseModel):
     exam_id: Optional[int] = None
     class_id: Optional[int] = None
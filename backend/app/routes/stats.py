@@ -1,14 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from typing import Optional
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, and_
+from sqlalchemy import select, and_
 
 from app.db.session import get_async_db
 from app.models.user import User
 from app.models.class_room import ClassRoom
-from app.models.student import Student
-from app.models.exam import Exam, Result
+from app.models.exam import Exam
 from app.utils.auth import get_current_active_user, check_manager_permission
+from app.services.dashboard_service import DashboardService
 
 router = APIRouter(
     prefix="/stats",
@@ -28,72 +28,9 @@ async def get_manager_dashboard_overview(
     org_filter = None
     if current_user.vaiTro == "MANAGER":
         org_filter = current_user.maToChuc
-    
-    # Count classes
-    classes_query = select(func.count(ClassRoom.maLopHoc)).where(ClassRoom.trangThai == True)
-    if org_filter:
-        classes_query = classes_query.where(ClassRoom.maToChuc == org_filter)
-    
-    classes_result = await db.execute(classes_query)
-    total_classes = classes_result.scalar() or 0
-    
-    # Count teachers
-    teachers_query = select(func.count(User.maNguoiDung)).where(
-        and_(
-            User.vaiTro == "TEACHER",
-            User.trangThai == True
-        )
-    )
-    if org_filter:
-        teachers_query = teachers_query.where(User.maToChuc == org_filter)
-    
-    teachers_result = await db.execute(teachers_query)
-    total_teachers = teachers_result.scalar() or 0
-    
-    # Count students
-    students_query = select(func.count(Student.maHocSinh)).where(Student.trangThai == True)
-    if org_filter:
-        students_query = students_query.join(ClassRoom, Student.maLopHoc == ClassRoom.maLopHoc).where(ClassRoom.maToChuc == org_filter)
-    
-    students_result = await db.execute(students_query)
-    total_students = students_result.scalar() or 0
-    
-    # Count exams
-    exams_query = select(func.count(Exam.maBaiKiemTra)).where(Exam.trangThai == 'published')
-    if org_filter:
-        # This join logic seems complex and might be incorrect if exams aren't directly linked to classes in a simple way
-        # For now, let's assume a simpler join through the creator (User)
-        exams_query = select(func.count(Exam.maBaiKiemTra)).join(
-            User, Exam.maNguoiTao == User.maNguoiDung
-        ).where(
-            and_(
-                Exam.trangThai == 'published',
-                User.maToChuc == org_filter
-            )
-        )
-    
-    exams_result = await db.execute(exams_query)
-    total_exams = exams_result.scalar() or 0
-    
-    # Calculate average score
-    avg_score_query = select(func.avg(Result.diem))
-    if org_filter:
-        avg_score_query = avg_score_query.join(
-            Student, Result.maHocSinh == Student.maHocSinh
-        ).join(
-            ClassRoom, Student.maLopHoc == ClassRoom.maLopHoc
-        ).where(ClassRoom.maToChuc == org_filter)
-    
-    avg_score_result = await db.execute(avg_score_query)
-    average_score = avg_score_result.scalar()
-    
-    return {
-        "classes": total_classes,
-        "teachers": total_teachers,
-        "students": total_students,
-        "exams": total_exams,
-        "averageScore": float(average_score) if average_score else None
-    }
+
+    # Một câu truy vấn tổng hợp, phục vụ từ snapshot cache theo tổ chức
+    return await DashboardService.manager_overview(db, org_filter)
 
 @router.get("/recent-activities")
 async def get_recent_activities(
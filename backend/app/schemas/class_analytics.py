@@ -20,8 +20,8 @@ class ClassAnalytics(BaseModel):
     inactiveStudents: int
     examTrend: List[ExamStatistic]
     overallAverage: str
-    bestExam: ExamStatistic
-    worstExam: ExamStatistic
+    bestExam: Optional[ExamStatistic] = None
+    worstExam: Optional[ExamStatistic] = None
     totalExams: int
     
     class Config:
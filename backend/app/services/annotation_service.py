@@ -0,0 +1,279 @@
+# Annotation Service
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.models.exam import AnswerSheet, Exam
+from app.services.answer_key_cache import answer_key_cache
+from app.services.omr_service import OMRDatabaseService
+from app.services.omr_worker_pool import omr_worker_pool
+
+logger = logging.getLogger(__name__)
+
+# Tăng khi đổi cách vẽ annotation để cache cũ không còn được dùng
+RENDER_VERSION = 1
+
+ANNOTATION_SIZES = ("full", "thumb")
+
+
+def storage_file(path: Optional[str]) -> Optional[Path]:
+    """Đường dẫn vật lý của ảnh lưu trong DB (tương đối so với STORAGE_PATH hoặc tuyệt đối)."""
+    if not path:
+        return None
+    candidate = Path(path)
+    if not candidate.is_absolute():
+        candidate = Path(settings.STORAGE_PATH) / candidate
+    return candidate
+
+
+def aligned_path_for(image_path: Path) -> Path:
+    """Ảnh căn chỉnh được pipeline lưu cạnh ảnh gốc (xem _load_and_align)."""
+    return image_path.parent / "aligned_results" / f"{image_path.stem}_aligned.jpg"
+
+
+def batch_sidecar_path(exam_id: int, filename: str) -> Path:
+    """Kết quả nhận dạng của một ảnh batch chưa lưu, đặt cạnh ảnh căn chỉnh."""
+    exam_storage_dir = Path(settings.STORAGE_PATH) / "annotated_scans" / str(exam_id)
+    return exam_storage_dir / "aligned_results" / f"{Path(filename).name}.json"
+
+
+def sign_annotation_path(path: str, expires: int) -> str:
+    message = f"{path}:{expires}".encode()
+    return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def annotation_url(path: str, size: str = "full", ttl: Optional[int] = None) -> str:
+    """
+    URL ký sẵn tới endpoint annotation, dùng trực tiếp làm src của <img> (không cần header Authorization).
+    `path` là phần sau prefix /omr, vd "/annotations/12", chưa escape: chữ ký tính trên path này
+    (đúng như endpoint nhận lại sau khi giải mã), còn URL thì escape tên file có '#', '?', '%'...
+    """
+    expires = int(time.time()) + (settings.OMR_ANNOTATION_URL_TTL if ttl is None else ttl)
+    return (f"{settings.API_PREFIX}/v1/omr{quote(path)}"
+            f"?size={size}&expires={expires}&sig={sign_annotation_path(path, expires)}")
+
+
+def verify_annotation_signature(path: str, expires: int, sig: str) -> bool:
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(sign_annotation_path(path, expires), sig or "")
+
+
+class AnnotationSource(NamedTuple):
+    """Mọi thứ cần để vẽ annotation của một phiếu; cũng là đầu vào của khóa cache"""
+    image_path: Optional[Path]
+    aligned_path: Optional[Path]
+    template_id: int
+    student_results: Dict[str, Any]
+    answer_key: Dict[str, str]
+
+
+def annotation_cache_key(source: AnnotationSource, template_path: str, max_width: int, quality: int) -> str:
+    """
+    Khóa nội dung (sha256) của ảnh annotation, cũng là ETag: đổi ảnh, câu trả lời, đáp án,
+    template, kích thước hoặc chất lượng đều sinh khóa mới nên entry cũ không bao giờ bị dùng sai.
+    """
+    image = source.image_path if source.image_path and source.image_path.exists() else source.aligned_path
+    image_stat = os.stat(image) if image and image.exists() else None
+    template_stat = os.stat(template_path) if os.path.exists(template_path) else None
+    payload = {
+        "v": RENDER_VERSION,
+        "image": str(image) if image else None,
+        "image_stat": [image_stat.st_size, image_stat.st_mtime_ns] if image_stat else None,
+        "template": [source.template_id, template_path, template_stat.st_mtime_ns if template_stat else None],
+        "answers": {k: v for k, v in source.student_results.items() if not str(k).startswith("_")},
+        "key": source.answer_key,
+        "size": [max_width, quality],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class AnnotationRenderer:
+    """
+    Render ảnh annotation theo yêu cầu trong worker pool và cache JPEG trên đĩa theo khóa nội dung.
+
+    Request trùng khóa trong lúc đang render dùng chung một lần render. Khi cache vượt
+    `max_bytes`, các file ít được đọc gần đây nhất bị xóa.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.cache_dir = Path(cache_dir or os.path.join(settings.STORAGE_PATH, "annotation_cache"))
+        self.max_bytes = settings.OMR_ANNOTATION_CACHE_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._writes_since_prune = 0
+        self.hits = 0
+        self.renders = 0
+
+    def cache_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.jpg"
+
+    @staticmethod
+    def size_params(size: str) -> Tuple[int, int]:
+        if size not in ANNOTATION_SIZES:
+            raise ValueError(f"Kích thước annotation không hợp lệ: {size}")
+        width = settings.OMR_ANNOTATION_THUMB_WIDTH if size == "thumb" else 0
+        return width, settings.OMR_ANNOTATION_JPEG_QUALITY
+
+    def cache_key(self, source: AnnotationSource, template_path: str, size: str = "full") -> str:
+        return annotation_cache_key(source, template_path, *self.size_params(size))
+
+    async def get(self, source: AnnotationSource, template_path: str, size: str = "full") -> Tuple[str, Optional[Path]]:
+        """(ETag, file JPEG trong cache); file là None khi không có ảnh để vẽ."""
+        max_width, quality = self.size_params(size)
+        key = annotation_cache_key(source, template_path, max_width, quality)
+        path = self.cache_path(key)
+        if path.exists():
+            self.hits += 1
+            return key, path
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._render(key, path, source, template_path, max_width, quality))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return key, await asyncio.shield(future)
+
+    async def _render(self, key, path: Path, source: AnnotationSource, template_path: str,
+                      max_width: int, quality: int) -> Optional[Path]:
+        from app.omr.jobs import render_annotation_job
+
+        data = await omr_worker_pool.run(
+            render_annotation_job,
+            str(source.image_path) if source.image_path else None,
+            str(source.aligned_path) if source.aligned_path else None,
+            template_path,
+            template_id=source.template_id,
+            student_results=source.student_results,
+            answer_key=source.answer_key,
+            max_width=max_width,
+            jpeg_quality=quality
+        )
+        if data is None:
+            return None
+        await asyncio.to_thread(self._write, path, data)
+        self.renders += 1
+        self._writes_since_prune += 1
+        if self._writes_since_prune >= 100:
+            self._writes_since_prune = 0
+            await asyncio.to_thread(self.prune)
+        return path
+
+    @staticmethod
+    def _write(path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def prune(self) -> int:
+        """Xóa file cũ nhất (theo thời gian đọc) cho tới khi cache dưới `max_bytes`, trả về số file đã xóa."""
+        if not self.max_bytes or not self.cache_dir.exists():
+            return 0
+        entries = []
+        for file in self.cache_dir.glob("*/*.jpg"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, file))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, file in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Pruned {removed} cached annotations")
+        return removed
+
+    def stats(self) -> Dict:
+        return {"hits": self.hits, "renders": self.renders, "rendering": len(self._inflight)}
+
+
+class AnnotationService:
+    """Tìm nguồn dữ liệu annotation cho phiếu đã lưu và ảnh batch chưa lưu"""
+
+    @staticmethod
+    async def annotation_answer_key(db: AsyncSession, exam_id: int, student_results: Dict[str, Any]) -> Dict[str, str]:
+        """Đáp án dùng để tô màu: cùng mã đề và fallback như khi chấm, rỗng nếu bài thi chưa có đáp án."""
+        try:
+            compiled = await answer_key_cache.get(db, exam_id)
+            ma_de = OMRDatabaseService.detect_ma_de_from_omr_results(student_results)
+            return compiled.resolve_detected(ma_de)[1]
+        except Exception as e:
+            logger.warning(f"No answer key for annotation of exam {exam_id}: {e}")
+            return {}
+
+    @staticmethod
+    async def source_for_sheet(db: AsyncSession, answer_sheet_id: int) -> Optional[AnnotationSource]:
+        sheet = await db.get(AnswerSheet, answer_sheet_id)
+        if not sheet or not sheet.urlHinhAnh:
+            return None
+        exam = await db.get(Exam, sheet.maBaiKiemTra)
+        if not exam or not exam.maMauPhieu:
+            return None
+        image_path = storage_file(sheet.urlHinhAnh)
+        student_results = sheet.cauTraLoiJson or {}
+        return AnnotationSource(
+            image_path=image_path,
+            aligned_path=aligned_path_for(image_path),
+            template_id=exam.maMauPhieu,
+            student_results=student_results,
+            answer_key=await AnnotationService.annotation_answer_key(db, sheet.maBaiKiemTra, student_results)
+        )
+
+    @staticmethod
+    def write_batch_sidecar(exam_id: int, filename: str, image_path: str, template_id: int, results: Dict[str, Any]):
+        """Ghi kết quả nhận dạng của ảnh batch để render annotation và lưu đường dẫn ảnh gốc về sau."""
+        path = batch_sidecar_path(exam_id, filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"image_path": image_path, "template_id": template_id, "results": results}, f, ensure_ascii=False)
+
+    @staticmethod
+    def read_batch_sidecar(exam_id: int, filename: str) -> Optional[Dict[str, Any]]:
+        path = batch_sidecar_path(exam_id, filename)
+        if not path.exists():
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot read batch sidecar {path}: {e}")
+            return None
+
+    @staticmethod
+    async def source_for_batch_file(db: AsyncSession, exam_id: int, filename: str) -> Optional[AnnotationSource]:
+        sidecar = AnnotationService.read_batch_sidecar(exam_id, filename)
+        if not sidecar:
+            return None
+        image_path = storage_file(sidecar["image_path"])
+        student_results = sidecar.get("results") or {}
+        return AnnotationSource(
+            image_path=image_path,
+            aligned_path=aligned_path_for(image_path),
+            template_id=sidecar["template_id"],
+            student_results=student_results,
+            answer_key=await AnnotationService.annotation_answer_key(db, exam_id, student_results)
+        )
+
+
+# Singleton cho toàn bộ process API
+annotation_renderer = AnnotationRenderer()
@@ -0,0 +1,237 @@
+# Answer Key Cache
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.exam import Answer, Exam
+
+logger = logging.getLogger(__name__)
+
+
+def _load_json(value):
+    """dapAnJson / diemMoiCauJson có thể là dict (JSONB) hoặc chuỗi JSON (dữ liệu cũ)."""
+    if isinstance(value, str):
+        return json.loads(value)
+    if isinstance(value, dict):
+        return value
+    return json.loads(str(value))
+
+
+def _normalise(answers: Dict) -> Dict[str, str]:
+    return {str(q_id): str(answer) for q_id, answer in answers.items()}
+
+
+def select_answer_key(dap_an_data: Any, ma_de: Optional[str]) -> Tuple[Dict[str, str], str]:
+    """
+    Chọn đáp án của một mã đề từ dapAnJson, hỗ trợ cả format theo mã đề
+    {"123": {"1": "A", ...}} và format cũ {"1": "A", ...}.
+    Trả về (answer_key, mô tả cách chọn để log).
+    """
+    if not isinstance(dap_an_data, dict):
+        return {}, "unsupported format"
+    if ma_de and ma_de in dap_an_data:
+        return _normalise(dap_an_data[ma_de]), f"mã đề {ma_de}"
+    if len(dap_an_data) == 1:
+        first_ma_de = next(iter(dap_an_data.keys()))
+        if first_ma_de.isdigit():
+            return _normalise(dap_an_data[first_ma_de]), f"auto-selected mã đề {first_ma_de} (only option)"
+        return _normalise(dap_an_data), "direct answer format"
+    if not ma_de and len(dap_an_data) > 1:
+        first_ma_de = next(iter(dap_an_data.keys()))
+        if all(k.isdigit() for k in dap_an_data.keys()):
+            return _normalise(dap_an_data[first_ma_de]), f"first available mã đề {first_ma_de}"
+        return _normalise(dap_an_data), "direct answer format (fallback)"
+    if all(isinstance(v, str) for v in dap_an_data.values()):
+        return _normalise(dap_an_data), "legacy direct format"
+    if dap_an_data:
+        first_key = next(iter(dap_an_data.keys()))
+        first_value = dap_an_data[first_key]
+        if isinstance(first_value, dict):
+            return _normalise(first_value), f"fallback format with key {first_key}"
+        raise ValueError(f"Cannot parse answer format. Available keys: {list(dap_an_data.keys())}")
+    return {}, "empty"
+
+
+class CompiledAnswerKey:
+    """
+    Đáp án của một bài thi đã parse sẵn: đáp án / điểm theo từng mã đề (câu hỏi dạng chuỗi)
+    và bộ đáp án dùng để vẽ annotation. Dùng chung cho mọi phiếu của bài thi.
+    """
+
+    def __init__(self, exam_id: int, dap_an_json: Any, diem_moi_cau_json: Any,
+                 equal_points: Optional[float] = None):
+        self.exam_id = exam_id
+        self.built_at = time.monotonic()
+
+        try:
+            self.answers = _load_json(dap_an_json) if dap_an_json else {}
+        except (json.JSONDecodeError, TypeError, UnicodeDecodeError) as e:
+            raise ValueError(f"Lỗi parse đáp án JSON: {str(e)}")
+
+        # Điểm riêng từng câu; lỗi parse giữa chừng thì giữ phần đã đọc được
+        self.scores: Dict[str, float] = {}
+        if diem_moi_cau_json:
+            try:
+                for q_id, score in _load_json(diem_moi_cau_json).items():
+                    self.scores[str(q_id)] = float(score)
+            except (json.JSONDecodeError, TypeError, ValueError, UnicodeDecodeError) as e:
+                logger.error(f"Error parsing diemMoiCauJson for exam {exam_id}: {e}")
+        self.equal_points = equal_points
+
+        self._forms: Dict[Optional[str], Tuple[Dict[str, str], Dict[str, float]]] = {}
+        self._annotation_keys: Optional[Dict[str, Dict[str, str]]] = None
+        self._version: Optional[str] = None
+
+    @property
+    def version(self) -> str:
+        """Hash của đáp án, điểm từng câu và điểm chia đều: đổi khi bất kỳ thứ gì ảnh hưởng việc chấm thay đổi."""
+        if self._version is None:
+            payload = json.dumps([self.answers, self.scores, self.equal_points], sort_keys=True, default=str)
+            self._version = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+        return self._version
+
+    @property
+    def codes(self):
+        """Các mã đề có trong dapAnJson (khi dapAnJson theo format mã đề)."""
+        return list(self.answers.keys()) if isinstance(self.answers, dict) else []
+
+    def resolve(self, ma_de: Optional[str] = None) -> Tuple[Dict[str, str], Dict[str, float]]:
+        """(answer_key, score_key) cho một mã đề, parse một lần rồi dùng lại."""
+        form = self._forms.get(ma_de)
+        if form is None:
+            answer_key, how = select_answer_key(self.answers, ma_de)
+            if not answer_key:
+                raise ValueError(f"Không thể lấy được đáp án cho exam_id={self.exam_id}, ma_de={ma_de}")
+            if self.scores:
+                score_key = self.scores
+            else:
+                points = self.equal_points if self.equal_points is not None else 1.0
+                score_key = {q_id: points for q_id in answer_key}
+            logger.info(f"Compiled answer key for exam {self.exam_id}, mã đề {ma_de} ({how}): {len(answer_key)} questions")
+            form = (answer_key, score_key)
+            self._forms[ma_de] = form
+        return form
+
+    def resolve_detected(self, ma_de: Optional[str]) -> Tuple[Optional[str], Dict[str, str], Dict[str, float]]:
+        """
+        (ma_de thực sự dùng, answer_key, score_key) cho mã đề nhận diện từ phiếu, cùng fallback
+        với OMRDatabaseService.resolve_answer_key khi không nhận diện được mã đề.
+        """
+        try:
+            return (ma_de,) + self.resolve(ma_de)
+        except Exception:
+            codes = self.codes
+            if ma_de is not None or not self.answers:
+                raise
+            if codes and all(code.isdigit() for code in codes):
+                return (codes[0],) + self.resolve(codes[0])
+            return (None,) + self.resolve(None)
+
+    def annotation_keys(self) -> Dict[str, Dict[str, str]]:
+        """Đáp án theo mã đề để vẽ annotation: {"123": {"q1": "A", ...}, ...}."""
+        if self._annotation_keys is None:
+            self._annotation_keys = {
+                str(ma_de): questions
+                for ma_de, questions in (self.answers.items() if isinstance(self.answers, dict) else [])
+                if isinstance(questions, dict) and all(isinstance(v, str) for v in questions.values())
+            }
+        return self._annotation_keys
+
+
+def exam_equal_points(exam: Optional[Exam]) -> Optional[float]:
+    """Điểm mỗi câu khi đáp án không có điểm riêng: chia đều tổng điểm của bài thi."""
+    if exam and exam.tongSoCau > 0:
+        return float(exam.tongDiem) / exam.tongSoCau
+    return None
+
+
+def diff_answer_keys(old: CompiledAnswerKey, new: CompiledAnswerKey) -> Dict[Optional[str], List[str]]:
+    """
+    Các câu thay đổi đáp án hoặc điểm theo từng mã đề giữa hai phiên bản đáp án của một bài thi.
+    Key None là bộ đáp án dùng khi phiếu không nhận diện được mã đề. Mã đề không đổi không có trong kết quả.
+    """
+    changes: Dict[Optional[str], List[str]] = {}
+    for ma_de in [None] + sorted(set(old.codes) | set(new.codes)):
+        try:
+            old_form = old.resolve_detected(ma_de)
+        except Exception:
+            old_form = (ma_de, {}, {})
+        try:
+            new_form = new.resolve_detected(ma_de)
+        except Exception:
+            new_form = (ma_de, {}, {})
+        _, old_answers, old_scores = old_form
+        _, new_answers, new_scores = new_form
+        changed = [
+            q_id for q_id in sorted(set(old_answers) | set(new_answers))
+            if old_answers.get(q_id) != new_answers.get(q_id)
+            or old_scores.get(q_id, 0.0) != new_scores.get(q_id, 0.0)
+        ]
+        if changed or old_form[0] != new_form[0]:
+            changes[ma_de] = changed
+    return changes
+
+
+class AnswerKeyCache:
+    """
+    LRU các CompiledAnswerKey theo bài thi.
+
+    Ghi đáp án qua ExamService.create_or_update_answers sẽ xóa entry tương ứng (write-through);
+    `ttl_seconds` giới hạn độ cũ khi đáp án được sửa bởi process khác.
+    """
+
+    def __init__(self, max_exams: int = 128, ttl_seconds: float = 60.0):
+        self.max_exams = max_exams
+        self.ttl_seconds = ttl_seconds
+        self._keys: "OrderedDict[int, CompiledAnswerKey]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, db: AsyncSession, exam_id: int) -> CompiledAnswerKey:
+        with self._lock:
+            compiled = self._keys.get(exam_id)
+            if compiled is not None and time.monotonic() - compiled.built_at < self.ttl_seconds:
+                self._keys.move_to_end(exam_id)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        answer_obj = (await db.execute(select(Answer).where(Answer.maBaiKiemTra == exam_id))).scalars().first()
+        if not answer_obj:
+            raise ValueError(f"Không tìm thấy đáp án cho bài kiểm tra ID: {exam_id}")
+
+        compiled = CompiledAnswerKey(exam_id, answer_obj.dapAnJson, answer_obj.diemMoiCauJson)
+        if not compiled.scores:
+            compiled.equal_points = exam_equal_points(await db.get(Exam, exam_id))
+
+        with self._lock:
+            self._keys[exam_id] = compiled
+            self._keys.move_to_end(exam_id)
+            while len(self._keys) > self.max_exams:
+                self._keys.popitem(last=False)
+        return compiled
+
+    def invalidate(self, exam_id: int):
+        with self._lock:
+            self._keys.pop(exam_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"exams": len(self._keys), "hits": self.hits, "misses": self.misses}
+
+
+# Singleton cho toàn bộ process API
+answer_key_cache = AnswerKeyCache()
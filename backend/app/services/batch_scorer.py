@@ -0,0 +1,165 @@
+# Batch Scorer
+
+from typing import Any, Dict, List, NamedTuple, Tuple, Union
+
+import numpy as np
+
+# Ký hiệu có thể tô trên phiếu: lựa chọn A-D, Đúng/Sai (T/F), chữ số và dấu của câu điền số (_colN).
+# Xếp theo thứ tự sort() của Python để chuỗi nhiều lựa chọn do pipeline ghép (vd "AC") luôn ở dạng chuẩn.
+CHOICE_ALPHABET = "".join(sorted(",-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+_CHOICE_BIT = {ch: 1 << i for i, ch in enumerate(CHOICE_ALPHABET)}
+_CHOICE_INDEX = {ch: i for i, ch in enumerate(CHOICE_ALPHABET)}
+
+
+class ScoreTally(NamedTuple):
+    """Kết quả chấm một phiếu theo một bộ đáp án"""
+    total_score: float
+    correct_count: int
+    wrong_count: int
+    blank_count: int
+    details: List[Dict[str, Any]]
+
+
+def score_answers(answer_key: Dict[str, str], score_key: Dict[str, float],
+                  student_answers: Dict[str, Any]) -> ScoreTally:
+    """Chấm một phiếu: so sánh từng câu không phân biệt hoa thường, câu để trống không tính sai."""
+    total_score = 0.0
+    correct_count = 0
+    wrong_count = 0
+    blank_count = 0
+    details = []
+
+    for q_id, correct_answer in answer_key.items():
+        student_answer = student_answers.get(q_id, "")
+        points = score_key.get(q_id, 0.0)
+        is_correct = student_answer.upper() == correct_answer.upper()
+
+        if not student_answer or student_answer.strip() == "":
+            blank_count += 1
+        elif is_correct:
+            correct_count += 1
+            total_score += points
+        else:
+            wrong_count += 1
+
+        details.append({
+            "question_id": q_id,
+            "student_answer": student_answer,
+            "correct_answer": correct_answer,
+            "is_correct": is_correct,
+            "points": points
+        })
+
+    return ScoreTally(total_score, correct_count, wrong_count, blank_count, details)
+
+
+class AnswerEncoder:
+    """
+    Mã hóa câu trả lời (đã upper) thành int64 sao cho hai câu trả lời bằng nhau khi và chỉ khi mã bằng nhau:
+    - chuỗi rỗng -> 0
+    - chuỗi các ký hiệu trong CHOICE_ALPHABET không lặp, đúng thứ tự (A, AC, T, 7, ...) -> bitmask > 0
+    - còn lại (câu điền số đã gộp "2,41", thứ tự khác "CA", ...) -> id âm theo từ điển
+    """
+
+    def __init__(self):
+        self._codes: Dict[str, Tuple[int, bool]] = {}
+        self._vocab: Dict[str, int] = {}
+
+    def _encode_upper(self, upper: str) -> int:
+        mask, last = 0, -1
+        for ch in upper:
+            idx = _CHOICE_INDEX.get(ch)
+            if idx is None or idx <= last:
+                break
+            mask |= _CHOICE_BIT[ch]
+            last = idx
+        else:
+            return mask
+        code = self._vocab.get(upper)
+        if code is None:
+            code = -(len(self._vocab) + 1)
+            self._vocab[upper] = code
+        return code
+
+    def encode(self, answer: str) -> Tuple[int, bool]:
+        """(mã, để trống) của một câu trả lời; ném lỗi như score_answers nếu không phải chuỗi."""
+        cached = self._codes.get(answer)
+        if cached is None:
+            cached = (self._encode_upper(answer.upper()), not answer or answer.strip() == "")
+            self._codes[answer] = cached
+        return cached
+
+
+def score_answers_batch(answer_key: Dict[str, str], score_key: Dict[str, float],
+                        sheets: List[Dict[str, Any]], with_details: bool = True
+                        ) -> List[Union[ScoreTally, Exception]]:
+    """
+    Chấm nhiều phiếu cùng một bộ đáp án trong một lượt NumPy, kết quả trùng khớp với score_answers.
+
+    Câu trả lời và đáp án được mã hóa thành ma trận (số phiếu x số câu) bằng AnswerEncoder, số câu
+    đúng/sai/trống và tổng điểm tính theo cột. Tổng điểm cộng dồn theo đúng thứ tự câu như bản tuần tự
+    nên giá trị float giống hệt. Phiếu không mã hóa được trả về Exception tại vị trí tương ứng.
+    """
+    encoder = AnswerEncoder()
+    q_ids = list(answer_key.keys())
+    correct_answers = [answer_key[q_id] for q_id in q_ids]
+    points_list = [score_key.get(q_id, 0.0) for q_id in q_ids]
+    key_codes = np.array([encoder._encode_upper(a.upper()) for a in correct_answers], dtype=np.int64)
+    points = np.array(points_list, dtype=np.float64)
+
+    n_sheets, n_questions = len(sheets), len(q_ids)
+    failed: Dict[int, Exception] = {}
+    blanks = [""] * n_questions
+    responses = [list(map(student_answers.get, q_ids, blanks)) for student_answers in sheets]
+    flat = [a for answers in responses for a in answers]
+    try:
+        # Mỗi giá trị khác nhau chỉ mã hóa một lần, phần còn lại là tra dict ở tầng C
+        encoded = {a: encoder.encode(a) for a in set(flat)}
+    except Exception:
+        # Có phiếu chứa giá trị không phải chuỗi: mã hóa lại từng phiếu để chỉ loại phiếu lỗi
+        encoded = {}
+        for row, answers in enumerate(responses):
+            try:
+                encoded.update((a, encoder.encode(a)) for a in answers)
+            except Exception as e:
+                failed[row] = e
+                flat[row * n_questions:(row + 1) * n_questions] = blanks
+        encoded[""] = encoder.encode("")
+    code_of = {a: code for a, (code, _) in encoded.items()}
+    blank_of = {a: is_blank for a, (_, is_blank) in encoded.items()}
+    codes = np.fromiter(map(code_of.__getitem__, flat), dtype=np.int64, count=len(flat)).reshape(n_sheets, n_questions)
+    blank = np.fromiter(map(blank_of.__getitem__, flat), dtype=bool, count=len(flat)).reshape(n_sheets, n_questions)
+
+    is_correct = codes == key_codes
+    correct = is_correct & ~blank
+    wrong = ~is_correct & ~blank
+    correct_counts = correct.sum(axis=1).tolist()
+    wrong_counts = wrong.sum(axis=1).tolist()
+    blank_counts = blank.sum(axis=1).tolist()
+    if n_questions:
+        # cumsum cộng tuần tự từ trái sang phải (np.sum cộng theo cặp sẽ lệch ở chữ số cuối)
+        totals = np.cumsum(np.where(correct, points, 0.0), axis=1)[:, -1].tolist()
+    else:
+        totals = [0.0] * n_sheets
+
+    is_correct_rows = is_correct.tolist() if with_details else []
+    tallies: List[Union[ScoreTally, Exception]] = []
+    for row in range(n_sheets):
+        if row in failed:
+            tallies.append(failed[row])
+            continue
+        details = []
+        if with_details:
+            details = [
+                {
+                    "question_id": q_id,
+                    "student_answer": student_answer,
+                    "correct_answer": correct_answer,
+                    "is_correct": ok,
+                    "points": pts
+                }
+                for q_id, student_answer, correct_answer, ok, pts
+                in zip(q_ids, responses[row], correct_answers, is_correct_rows[row], points_list)
+            ]
+        tallies.append(ScoreTally(totals[row], correct_counts[row], wrong_counts[row], blank_counts[row], details))
+    return tallies
@@ -7,7 +7,7 @@ from app.models.exam import Exam, ExamStatistic, Result
 from app.schemas.class_analytics import ClassAnalytics, ExamStatistic as ExamStatSchema, AnalyticsFilters
 from fastapi import HTTPException, status
 from typing import Optional
-import json
+from app.services.exam_rollup_service import ScoreRollup
 
 class ClassAnalyticsService:
     @staticmethod
@@ -38,7 +38,7 @@ class ClassAnalyticsService:
         
         # Get exam statistics for this class
         exam_stats_stmt = (
-            select(ExamStatistic, Exam.tieuDe, Exam.ngayThi)
+            select(ExamStatistic, Exam.tieuDe, Exam.ngayThi, Exam.tongDiem)
             .join(Exam, ExamStatistic.maBaiKiemTra == Exam.maBaiKiemTra)
             .where(ExamStatistic.maLopHoc == class_id)
             .order_by(Exam.ngayThi.desc())
@@ -49,16 +49,11 @@ class ClassAnalyticsService:
         
         # Transform exam statistics
         exam_trends = []
-        for stat, tieu_de, ngay_thi in exam_stats_rows:
-            # Calculate distribution from results if available
-            phan_phoi = {"gioi": 0, "kha": 0, "trungBinh": 0, "yeu": 0}
-            
-            if stat.phanBoDiemJson:
-                try:
-                    phan_phoi = json.loads(stat.phanBoDiemJson)
-                except:
-                    pass
-            
+        for stat, tieu_de, ngay_thi, tong_diem in exam_stats_rows:
+            # Phân loại và tỷ lệ đạt lấy từ rollup được cập nhật khi ghi kết quả
+            rollup = ScoreRollup.from_json(stat.phanBoDiemJson)
+            phan_phoi = rollup.grade_bands(float(tong_diem or 10))
+
             # Calculate trend
             trend = "stable"
             if stat.diemTrungBinh and stat.diemTrungBinh >= 8.0:
@@ -74,41 +69,12 @@ class ClassAnalyticsService:
                 diemTrungBinh=float(stat.diemTrungBinh) if stat.diemTrungBinh else 0.0,
                 diemCao=float(stat.diemCaoNhat) if stat.diemCaoNhat else 0.0,
                 diemThap=float(stat.diemThapNhat) if stat.diemThapNhat else 0.0,
-                tyLeDau=0.0,  # Calculate from individual results if needed
+                tyLeDau=round(rollup.pass_rate(float(tong_diem or 10)), 1),
                 phanPhoi=phan_phoi,
                 trend=trend
             )
             exam_trends.append(exam_stat)
         
-        # If no real exam data, create sample data for demo
-        if not exam_trends:
-            exam_trends = [
-                ExamStatSchema(
-                    maKyThi=1,
-                    tenKyThi="Kiểm tra giữa kỳ 1",
-                    ngayThi="2024-10-15",
-                    soLuongHocSinh=active_students,
-                    diemTrungBinh=7.8,
-                    diemCao=9.5,
-                    diemThap=4.2,
-                    tyLeDau=87.5,
-                    phanPhoi={"gioi": 8, "kha": 12, "trungBinh": 10, "yeu": 2},
-                    trend="up"
-                ),
-                ExamStatSchema(
-                    maKyThi=2,
-                    tenKyThi="Kiểm tra cuối kỳ 1",
-                    ngayThi="2024-12-20",
-                    soLuongHocSinh=active_students,
-                    diemTrungBinh=8.2,
-                    diemCao=9.8,
-                    diemThap=5.5,
-                    tyLeDau=93.3,
-                    phanPhoi={"gioi": 12, "kha": 15, "trungBinh": 3, "yeu": 0},
-                    trend="up"
-                )
-            ]
-        
         # Calculate overall statistics
         if exam_trends:
             overall_average = sum(exam.diemTrungBinh for exam in exam_trends) / len(exam_trends)
@@ -116,8 +82,8 @@ class ClassAnalyticsService:
             worst_exam = min(exam_trends, key=lambda x: x.diemTrungBinh)
         else:
             overall_average = 0.0
-            best_exam = exam_trends[0] if exam_trends else None
-            worst_exam = exam_trends[0] if exam_trends else None
+            best_exam = None
+            worst_exam = None
         
         return ClassAnalytics(
             totalStudents=total_students,
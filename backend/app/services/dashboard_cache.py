@@ -0,0 +1,162 @@
+# Dashboard Snapshot Cache
+
+import asyncio
+import copy
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, NamedTuple, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+SnapshotLoader = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class _Snapshot(NamedTuple):
+    built_at: float
+    value: Any
+
+
+class DashboardSnapshotCache:
+    """
+    Snapshot thống kê dashboard theo khóa (loại dashboard, vai trò, tổ chức / người dùng).
+
+    - Snapshot còn mới (< ttl_seconds): trả ngay, không chạm DB.
+    - Snapshot cũ nhưng còn trong `stale_seconds`: vẫn trả ngay và làm mới ở nền bằng session riêng
+      (stale-while-revalidate), mỗi khóa tối đa một lần làm mới cùng lúc.
+    - Không có snapshot dùng được: tải bằng session của request; các request cùng khóa chờ chung một lần tải.
+
+    Mỗi lần get trả về một bản sao, caller sửa kết quả không làm hỏng snapshot dùng chung.
+    """
+
+    def __init__(self, ttl_seconds: float = 30.0, stale_seconds: float = 300.0, max_entries: int = 256,
+                 session_factory: Optional[Callable[[], Any]] = None):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self._session_factory = session_factory
+        self._entries: "OrderedDict[Tuple, _Snapshot]" = OrderedDict()
+        self._loading: Dict[Tuple, asyncio.Future] = {}
+        self._refreshing: Dict[Tuple, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+        # Thời gian truy vấn theo loại dashboard (phần tử đầu của khóa)
+        self._timings: Dict[Hashable, Dict[str, float]] = {}
+
+    async def get(self, key: Tuple, loader: SnapshotLoader, db: AsyncSession) -> Any:
+        return copy.deepcopy(await self._get(key, loader, db))
+
+    async def _get(self, key: Tuple, loader: SnapshotLoader, db: AsyncSession) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.built_at
+            if age < self.ttl_seconds:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry.value
+            if age < self.ttl_seconds + self.stale_seconds:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._refresh_in_background(key, loader)
+                return entry.value
+
+        self.misses += 1
+        pending = self._loading.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        # Không ai chờ thì exception cũng không bị báo "never retrieved"
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._loading[key] = future
+        try:
+            value = await self._load(key, loader, db)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._loading.pop(key, None)
+
+    async def _load(self, key: Tuple, loader: SnapshotLoader, db: AsyncSession) -> Any:
+        start = time.perf_counter()
+        try:
+            value = await loader(db)
+        except Exception:
+            self.errors += 1
+            raise
+        self._record_timing(key[0], (time.perf_counter() - start) * 1000)
+
+        self._entries[key] = _Snapshot(time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def _refresh_in_background(self, key: Tuple, loader: SnapshotLoader):
+        task = self._refreshing.get(key)
+        if task is not None and not task.done():
+            return
+        self._refreshing[key] = asyncio.create_task(self._refresh(key, loader))
+
+    async def _refresh(self, key: Tuple, loader: SnapshotLoader):
+        try:
+            session_factory = self._session_factory
+            if session_factory is None:
+                from app.db.session import AsyncSessionLocal
+                session_factory = AsyncSessionLocal
+            async with session_factory() as db:
+                await self._load(key, loader, db)
+            self.refreshes += 1
+        except Exception as e:
+            logger.warning(f"Làm mới snapshot dashboard {key} thất bại, giữ snapshot cũ: {e}")
+        finally:
+            self._refreshing.pop(key, None)
+
+    def _record_timing(self, kind: Hashable, elapsed_ms: float):
+        timing = self._timings.setdefault(kind, {"count": 0, "total_ms": 0.0, "last_ms": 0.0, "max_ms": 0.0})
+        timing["count"] += 1
+        timing["total_ms"] += elapsed_ms
+        timing["last_ms"] = elapsed_ms
+        timing["max_ms"] = max(timing["max_ms"], elapsed_ms)
+
+    def invalidate(self, kind: Optional[Hashable] = None):
+        """Xóa snapshot của một loại dashboard (hoặc tất cả)."""
+        for key in [k for k in self._entries if kind is None or k[0] == kind]:
+            del self._entries[key]
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 3) if lookups else 0.0,
+            "queries": {
+                str(kind): {
+                    "count": t["count"],
+                    "avg_ms": round(t["total_ms"] / t["count"], 1),
+                    "last_ms": round(t["last_ms"], 1),
+                    "max_ms": round(t["max_ms"], 1),
+                }
+                for kind, t in self._timings.items()
+            },
+        }
+
+
+# Singleton cho toàn bộ process API
+dashboard_cache = DashboardSnapshotCache(
+    ttl_seconds=settings.DASHBOARD_CACHE_TTL,
+    stale_seconds=settings.DASHBOARD_CACHE_STALE_SECONDS,
+)
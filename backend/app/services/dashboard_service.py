@@ -1,233 +1,299 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, desc, and_, text
+from sqlalchemy import select, func, desc, literal, true, union_all, String
 from typing import Dict, List, Optional
 from datetime import datetime, timedelta
+import copy
+import logging
 
 from app.models.organization import Organization
 from app.models.class_room import ClassRoom
 from app.models.user import User
 from app.models.exam import Exam, AnswerSheet, Result, ExamStatistic
 from app.models.student import Student
+from app.services.dashboard_cache import dashboard_cache
+
+logger = logging.getLogger(__name__)
+
+# Số hoạt động gần đây lấy từ mỗi nguồn (bài thi, người dùng, tổ chức)
+RECENT_ACTIVITY_LIMITS = {"exam": 3, "user": 3, "organization": 2}
+
+ADMIN_STATS_FALLBACK = {
+    "totalUsers": 0, "totalExams": 0, "totalOrganizations": 0,
+    "totalManagers": 0, "totalTeachers": 0, "totalClasses": 0,
+    "totalStudents": 0, "totalAnswerSheets": 0, "processedSheets": 0,
+    "activeUsers": 0, "todayExams": 0, "todaySheets": 0,
+    "accuracy": 0, "averageScore": 0, "highestScore": 0, "lowestScore": 0,
+    "trends": {"users": 0, "exams": 0, "organizations": 0, "accuracy": 0}
+}
+
+
+def _relative_time(moment: datetime, now: datetime) -> str:
+    time_diff = now - moment
+    return f"{time_diff.days} ngày trước" if time_diff.days > 0 else f"{time_diff.seconds // 3600} giờ trước"
+
+
+def admin_snapshot_query(now: datetime):
+    """
+    Một câu SQL cho toàn bộ admin dashboard: mỗi bảng được quét một lần trong một CTE tổng hợp
+    (`count(*) FILTER (WHERE ...)` cho các số đếm có điều kiện), các CTE một dòng được ghép với nhau,
+    rồi LEFT JOIN với danh sách hoạt động gần đây (UNION ALL). Kết quả: mỗi hoạt động một dòng,
+    các cột tổng hợp lặp lại trên mọi dòng (ít nhất một dòng khi chưa có hoạt động nào).
+    """
+    thirty_days_ago = now - timedelta(days=30)
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    tomorrow_start = today_start + timedelta(days=1)
+
+    users = select(
+        func.count().label("total_users"),
+        func.count().filter(func.upper(User.vaiTro) == "MANAGER").label("total_managers"),
+        func.count().filter(func.upper(User.vaiTro) == "TEACHER").label("total_teachers"),
+        func.count().filter(User.thoiGianTao >= thirty_days_ago).label("recent_users"),
+        # Active users (logged in last 30 days)
+        func.count().filter(User.thoiGianDangNhapCuoi >= thirty_days_ago).label("active_users"),
+    ).select_from(User).cte("user_agg")
+    orgs = select(
+        func.count().label("total_orgs"),
+        func.count().filter(Organization.thoiGianTao >= thirty_days_ago).label("recent_orgs"),
+    ).select_from(Organization).cte("org_agg")
+    classes = select(func.count().label("total_classes")).select_from(ClassRoom).cte("class_agg")
+    students = select(func.count().label("total_students")).select_from(Student).cte("student_agg")
+    exams = select(
+        func.count().label("total_exams"),
+        func.count().filter(Exam.thoiGianTao >= thirty_days_ago).label("recent_exams"),
+        func.count().filter(Exam.thoiGianTao >= today_start, Exam.thoiGianTao < tomorrow_start).label("today_exams"),
+    ).select_from(Exam).cte("exam_agg")
+    sheets = select(
+        func.count().label("total_answer_sheets"),
+        func.count().filter(AnswerSheet.daXuLyHoanTat.is_(True)).label("processed_sheets"),
+        func.count().filter(
+            AnswerSheet.thoiGianQuet >= today_start, AnswerSheet.thoiGianQuet < tomorrow_start
+        ).label("today_sheets"),
+        # Processing accuracy (sheets với doTinCay >= 95%)
+        func.count().filter(AnswerSheet.doTinCay >= 95.0).label("high_confidence_sheets"),
+    ).select_from(AnswerSheet).cte("sheet_agg")
+    scores = select(
+        func.avg(Result.diem).label("avg_score"),
+        func.max(Result.diem).label("highest_score"),
+        func.min(Result.diem).label("lowest_score"),
+    ).cte("score_agg")
+
+    branches = [
+        select(
+            literal("exam").label("kind"), Exam.tieuDe.label("title"),
+            User.hoTen.label("actor"), Exam.thoiGianTao.label("created_at")
+        ).join(User, Exam.maNguoiTao == User.maNguoiDung)
+        .order_by(desc(Exam.thoiGianTao)).limit(RECENT_ACTIVITY_LIMITS["exam"]),
+        select(
+            literal("user").label("kind"), User.vaiTro.label("title"),
+            User.hoTen.label("actor"), User.thoiGianTao.label("created_at")
+        ).order_by(desc(User.thoiGianTao)).limit(RECENT_ACTIVITY_LIMITS["user"]),
+        select(
+            literal("organization").label("kind"), Organization.tenToChuc.label("title"),
+            literal(None, String).label("actor"), Organization.thoiGianTao.label("created_at")
+        ).order_by(desc(Organization.thoiGianTao)).limit(RECENT_ACTIVITY_LIMITS["organization"]),
+    ]
+    activities = union_all(*[select(branch.subquery()) for branch in branches]).subquery("recent_activity")
+
+    aggregates = [users, orgs, classes, students, exams, sheets, scores]
+    joined = aggregates[0]
+    for cte in aggregates[1:]:
+        joined = joined.join(cte, true())
+    joined = joined.outerjoin(activities, true())
+
+    columns = [c for cte in aggregates for c in cte.c]
+    return (
+        select(*columns, activities.c.kind, activities.c.title, activities.c.actor, activities.c.created_at)
+        .select_from(joined)
+        .order_by(activities.c.created_at.desc().nulls_last())
+    )
+
 
 class DashboardService:
+    @staticmethod
+    async def _load_admin_snapshot(db: AsyncSession) -> Dict:
+        """Thống kê admin + hoạt động gần đây trong một lần truy vấn"""
+        now = datetime.now()
+        rows = (await db.execute(admin_snapshot_query(now))).all()
+        agg = rows[0]
+
+        total_users = agg.total_users or 0
+        total_exams = agg.total_exams or 0
+        total_orgs = agg.total_orgs or 0
+        total_answer_sheets = agg.total_answer_sheets or 0
+        accuracy_rate = (agg.high_confidence_sheets / total_answer_sheets * 100) if total_answer_sheets > 0 else 0
+
+        stats = {
+            "totalUsers": total_users,
+            "totalExams": total_exams,
+            "totalOrganizations": total_orgs,
+            "totalManagers": agg.total_managers or 0,
+            "totalTeachers": agg.total_teachers or 0,
+            "totalClasses": agg.total_classes or 0,
+            "totalStudents": agg.total_students or 0,
+            "totalAnswerSheets": total_answer_sheets,
+            "processedSheets": agg.processed_sheets or 0,
+            "activeUsers": agg.active_users or 0,
+            "todayExams": agg.today_exams or 0,
+            "todaySheets": agg.today_sheets or 0,
+            "accuracy": round(accuracy_rate, 1),
+            "averageScore": round(float(agg.avg_score), 2) if agg.avg_score else 0,
+            "highestScore": float(agg.highest_score) if agg.highest_score else 0,
+            "lowestScore": float(agg.lowest_score) if agg.lowest_score else 0,
+            "trends": {
+                "users": round((agg.recent_users / max(total_users - agg.recent_users, 1)) * 100, 1),
+                "exams": round((agg.recent_exams / max(total_exams - agg.recent_exams, 1)) * 100, 1),
+                "organizations": round((agg.recent_orgs / max(total_orgs - agg.recent_orgs, 1)) * 100, 1),
+                "accuracy": round(accuracy_rate - 95.0, 1)  # Baseline 95%
+            }
+        }
+
+        activities = []
+        for row in rows:
+            if row.kind is None:
+                continue
+            activity = {
+                "id": f"{'org' if row.kind == 'organization' else row.kind}_{row.created_at.timestamp()}",
+                "type": row.kind,
+                "user": row.actor,
+                "timestamp": _relative_time(row.created_at, now),
+                "status": "success"
+            }
+            if row.kind == "exam":
+                activity["action"] = f"Tạo bài thi: '{row.title}'"
+            elif row.kind == "user":
+                activity["action"] = f"Đăng ký tài khoản {row.title.lower()}"
+            else:
+                activity["action"] = f"Đăng ký tổ chức: '{row.title}'"
+                activity["user"] = "Admin"
+            activities.append(activity)
+
+        return {"stats": stats, "recentActivities": activities, "generatedAt": now.isoformat()}
+
+    @staticmethod
+    async def admin_snapshot(db: AsyncSession) -> Dict:
+        """Snapshot admin dashboard dùng chung cho thống kê và hoạt động gần đây"""
+        return await dashboard_cache.get(("admin",), DashboardService._load_admin_snapshot, db)
+
     @staticmethod
     async def admin_stats(db: AsyncSession) -> Dict:
         """Lấy thống kê tổng quan cho admin"""
         try:
-            # Basic counts
-            total_orgs = await db.scalar(select(func.count()).select_from(Organization))
-            total_users = await db.scalar(select(func.count()).select_from(User))
-            total_managers = await db.scalar(select(func.count()).select_from(User).where(User.vaiTro == "manager"))
-            total_teachers = await db.scalar(select(func.count()).select_from(User).where(User.vaiTro == "teacher"))
-            total_classes = await db.scalar(select(func.count()).select_from(ClassRoom))
-            total_students = await db.scalar(select(func.count()).select_from(Student))
-            total_exams = await db.scalar(select(func.count()).select_from(Exam))
-            
-            # Answer sheets processing
-            total_answer_sheets = await db.scalar(select(func.count()).select_from(AnswerSheet))
-            processed_sheets = await db.scalar(
-                select(func.count()).select_from(AnswerSheet).where(AnswerSheet.daXuLyHoanTat == True)
-            )
-            
-            # Score statistics
-            avg_score = await db.scalar(select(func.avg(Result.diem)))
-            highest_score = await db.scalar(select(func.max(Result.diem)))
-            lowest_score = await db.scalar(select(func.min(Result.diem)))
-            
-            # Recent activity counts (last 30 days)
-            thirty_days_ago = datetime.now() - timedelta(days=30)
-            
-            recent_users = await db.scalar(
-                select(func.count()).select_from(User).where(User.thoiGianTao >= thirty_days_ago)
-            )
-            recent_exams = await db.scalar(
-                select(func.count()).select_from(Exam).where(Exam.thoiGianTao >= thirty_days_ago)
-            )
-            recent_orgs = await db.scalar(
-                select(func.count()).select_from(Organization).where(Organization.thoiGianTao >= thirty_days_ago)
-            )
-            
-            # Today's activities
-            today = datetime.now().date()
-            today_exams = await db.scalar(
-                select(func.count()).select_from(Exam).where(func.date(Exam.thoiGianTao) == today)
-            )
-            today_sheets = await db.scalar(
-                select(func.count()).select_from(AnswerSheet).where(func.date(AnswerSheet.thoiGianQuet) == today)
-            )
-            
-            # Active users (logged in last 30 days)
-            active_users = await db.scalar(
-                select(func.count()).select_from(User).where(
-                    User.thoiGianDangNhapCuoi >= thirty_days_ago
-                )
-            )
-            
-            # Processing accuracy (sheets với doTinCay >= 95%)
-            high_confidence_sheets = await db.scalar(
-                select(func.count()).select_from(AnswerSheet).where(AnswerSheet.doTinCay >= 95.0)
-            )
-            accuracy_rate = (high_confidence_sheets / total_answer_sheets * 100) if total_answer_sheets > 0 else 0
-            
-            return {
-                "totalUsers": total_users or 0,
-                "totalExams": total_exams or 0,
-                "totalOrganizations": total_orgs or 0,
-                "totalManagers": total_managers or 0,
-                "totalTeachers": total_teachers or 0,
-                "totalClasses": total_classes or 0,
-                "totalStudents": total_students or 0,
-                "totalAnswerSheets": total_answer_sheets or 0,
-                "processedSheets": processed_sheets or 0,
-                "activeUsers": active_users or 0,
-                "todayExams": today_exams or 0,
-                "todaySheets": today_sheets or 0,
-                "accuracy": round(accuracy_rate, 1),
-                "averageScore": round(float(avg_score), 2) if avg_score else 0,
-                "highestScore": float(highest_score) if highest_score else 0,
-                "lowestScore": float(lowest_score) if lowest_score else 0,
-                "trends": {
-                    "users": round((recent_users / max(total_users - recent_users, 1)) * 100, 1),
-                    "exams": round((recent_exams / max(total_exams - recent_exams, 1)) * 100, 1),
-                    "organizations": round((recent_orgs / max(total_orgs - recent_orgs, 1)) * 100, 1),
-                    "accuracy": round(accuracy_rate - 95.0, 1)  # Baseline 95%
-                }
-            }
+            return (await DashboardService.admin_snapshot(db))["stats"]
         except Exception as e:
-            print(f"Error in admin_stats: {e}")
-            # Fallback
-            return {
-                "totalUsers": 0, "totalExams": 0, "totalOrganizations": 0,
-                "totalManagers": 0, "totalTeachers": 0, "totalClasses": 0,
-                "totalStudents": 0, "totalAnswerSheets": 0, "processedSheets": 0,
-                "activeUsers": 0, "todayExams": 0, "todaySheets": 0,
-                "accuracy": 0, "averageScore": 0, "highestScore": 0, "lowestScore": 0,
-                "trends": {"users": 0, "exams": 0, "organizations": 0, "accuracy": 0}
-            }
+            logger.error(f"Error in admin_stats: {e}")
+            return copy.deepcopy(ADMIN_STATS_FALLBACK)
 
     @staticmethod
     async def get_recent_activities(db: AsyncSession, limit: int = 10) -> List[Dict]:
         """Lấy hoạt động gần đây của hệ thống"""
         try:
-            activities = []
-            
-            # Recent exams
-            recent_exams = await db.execute(
-                select(Exam.tieuDe, Exam.thoiGianTao, User.hoTen.label('nguoiTao'))
-                .join(User, Exam.maNguoiTao == User.maNguoiDung)
-                .order_by(desc(Exam.thoiGianTao))
-                .limit(3)
-            )
-            
-            for exam in recent_exams:
-                time_diff = datetime.now() - exam.thoiGianTao
-                if time_diff.days == 0:
-                    timestamp = f"{time_diff.seconds // 3600} giờ trước"
-                else:
-                    timestamp = f"{time_diff.days} ngày trước"
-                    
-                activities.append({
-                    "id": f"exam_{exam.thoiGianTao.timestamp()}",
-                    "type": "exam",
-                    "action": f"Tạo bài thi: '{exam.tieuDe}'",
-                    "user": exam.nguoiTao,
-                    "timestamp": timestamp,
-                    "status": "success"
-                })
-            
-            # Recent users
-            recent_users = await db.execute(
-                select(User.hoTen, User.vaiTro, User.thoiGianTao)
-                .order_by(desc(User.thoiGianTao))
-                .limit(3)
-            )
-            
-            for user in recent_users:
-                time_diff = datetime.now() - user.thoiGianTao
-                timestamp = f"{time_diff.days} ngày trước" if time_diff.days > 0 else f"{time_diff.seconds // 3600} giờ trước"
-                
-                activities.append({
-                    "id": f"user_{user.thoiGianTao.timestamp()}",
-                    "type": "user", 
-                    "action": f"Đăng ký tài khoản {user.vaiTro.lower()}",
-                    "user": user.hoTen,
-                    "timestamp": timestamp,
-                    "status": "success"
-                })
-            
-            # Recent organizations
-            recent_orgs = await db.execute(
-                select(Organization.tenToChuc, Organization.thoiGianTao)
-                .order_by(desc(Organization.thoiGianTao))
-                .limit(2)
-            )
-            
-            for org in recent_orgs:
-                time_diff = datetime.now() - org.thoiGianTao
-                timestamp = f"{time_diff.days} ngày trước" if time_diff.days > 0 else f"{time_diff.seconds // 3600} giờ trước"
-                
-                activities.append({
-                    "id": f"org_{org.thoiGianTao.timestamp()}",
-                    "type": "organization",
-                    "action": f"Đăng ký tổ chức: '{org.tenToChuc}'",
-                    "user": "Admin",
-                    "timestamp": timestamp,
-                    "status": "success"
-                })
-            
-            # Sort by timestamp and limit
-            activities.sort(key=lambda x: x["timestamp"])
-            return activities[:limit]
-            
+            return (await DashboardService.admin_snapshot(db))["recentActivities"][:limit]
         except Exception as e:
-            print(f"Error in get_recent_activities: {e}")
+            logger.error(f"Error in get_recent_activities: {e}")
             return []
 
     @staticmethod
     async def manager_stats(db: AsyncSession, org_id: int) -> Dict:
         """Enhanced manager stats với chi tiết hơn"""
-        try:
-            classes = await db.scalar(select(func.count()).select_from(ClassRoom).where(ClassRoom.maToChuc == org_id))
-            teachers = await db.scalar(select(func.count()).select_from(User).where(User.maToChuc == org_id, User.vaiTro == "teacher"))
-            exams = await db.scalar(select(func.count()).select_from(Exam).where(Exam.maToChuc == org_id))
-            students = await db.scalar(
-                select(func.count()).select_from(Student).join(ClassRoom, Student.maLopHoc == ClassRoom.maLopHoc).where(ClassRoom.maToChuc == org_id)
-            )
-            avg_score = await db.scalar(
-                select(func.avg(Result.diem)).join(Exam, Result.maBaiKiemTra == Exam.maBaiKiemTra).where(Exam.maToChuc == org_id)
-            )
-            
+        async def load(db: AsyncSession) -> Dict:
+            row = (await db.execute(select(
+                select(func.count()).select_from(ClassRoom).where(ClassRoom.maToChuc == org_id).scalar_subquery().label("classes"),
+                select(func.count()).select_from(User).where(
+                    User.maToChuc == org_id, func.upper(User.vaiTro) == "TEACHER"
+                ).scalar_subquery().label("teachers"),
+                select(func.count()).select_from(Exam).where(Exam.maToChuc == org_id).scalar_subquery().label("exams"),
+                (
+                    select(func.count()).select_from(Student)
+                    .join(ClassRoom, Student.maLopHoc == ClassRoom.maLopHoc).where(ClassRoom.maToChuc == org_id)
+                ).scalar_subquery().label("students"),
+                (
+                    select(func.avg(Result.diem))
+                    .join(Exam, Result.maBaiKiemTra == Exam.maBaiKiemTra).where(Exam.maToChuc == org_id)
+                ).scalar_subquery().label("avg_score"),
+            ))).one()
             return {
-                "classes": classes or 0,
-                "teachers": teachers or 0,
-                "exams": exams or 0,
-                "students": students or 0,
-                "averageScore": round(float(avg_score), 2) if avg_score else 0,
+                "classes": row.classes or 0,
+                "teachers": row.teachers or 0,
+                "exams": row.exams or 0,
+                "students": row.students or 0,
+                "averageScore": round(float(row.avg_score), 2) if row.avg_score else 0,
             }
+
+        try:
+            return await dashboard_cache.get(("manager", org_id), load, db)
         except Exception as e:
-            print(f"Error in manager_stats: {e}")
+            logger.error(f"Error in manager_stats: {e}")
             return {"classes": 0, "teachers": 0, "exams": 0, "students": 0, "averageScore": 0}
 
+    @staticmethod
+    async def manager_overview(db: AsyncSession, org_id: Optional[int] = None) -> Dict:
+        """
+        Thống kê manager dashboard (lớp, giáo viên, học sinh đang hoạt động, bài thi đã xuất bản, điểm TB).
+        org_id None = toàn hệ thống.
+        """
+        async def load(db: AsyncSession) -> Dict:
+            classes = select(func.count(ClassRoom.maLopHoc)).where(ClassRoom.trangThai == True)
+            teachers = select(func.count(User.maNguoiDung)).where(User.vaiTro == "TEACHER", User.trangThai == True)
+            students = select(func.count(Student.maHocSinh)).where(Student.trangThai == True)
+            exams = select(func.count(Exam.maBaiKiemTra)).where(Exam.trangThai == 'published')
+            avg_score = select(func.avg(Result.diem))
+            if org_id:
+                classes = classes.where(ClassRoom.maToChuc == org_id)
+                teachers = teachers.where(User.maToChuc == org_id)
+                students = students.join(ClassRoom, Student.maLopHoc == ClassRoom.maLopHoc).where(ClassRoom.maToChuc == org_id)
+                # Bài thi thuộc tổ chức theo người tạo
+                exams = exams.join(User, Exam.maNguoiTao == User.maNguoiDung).where(User.maToChuc == org_id)
+                avg_score = avg_score.join(
+                    Student, Result.maHocSinh == Student.maHocSinh
+                ).join(
+                    ClassRoom, Student.maLopHoc == ClassRoom.maLopHoc
+                ).where(ClassRoom.maToChuc == org_id)
+
+            row = (await db.execute(select(
+                classes.scalar_subquery().label("classes"),
+                teachers.scalar_subquery().label("teachers"),
+                students.scalar_subquery().label("students"),
+                exams.scalar_subquery().label("exams"),
+                avg_score.scalar_subquery().label("avg_score"),
+            ))).one()
+            return {
+                "classes": row.classes or 0,
+                "teachers": row.teachers or 0,
+                "students": row.students or 0,
+                "exams": row.exams or 0,
+                "averageScore": float(row.avg_score) if row.avg_score else None
+            }
+
+        return await dashboard_cache.get(("overview", org_id), load, db)
+
     @staticmethod
     async def teacher_stats(db: AsyncSession, teacher_id: int) -> Dict:
         """Enhanced teacher stats"""
-        try:
-            classes = await db.scalar(select(func.count()).select_from(ClassRoom).where(ClassRoom.maGiaoVienChuNhiem == teacher_id))
-            exams = await db.scalar(select(func.count()).select_from(Exam).where(Exam.maNguoiTao == teacher_id))
-            answer_sheets = await db.scalar(select(func.count()).select_from(Result).where(Result.maBaiKiemTra.in_(
-                select(Exam.maBaiKiemTra).where(Exam.maNguoiTao == teacher_id)
-            )))
-            avg_score = await db.scalar(
-                select(func.avg(Result.diem)).join(Exam, Result.maBaiKiemTra == Exam.maBaiKiemTra).where(Exam.maNguoiTao == teacher_id)
+        async def load(db: AsyncSession) -> Dict:
+            # Số phiếu và điểm trung bình cùng quét một lần bảng kết quả của các bài thi giáo viên tạo
+            results = (
+                select(func.count().label("answer_sheets"), func.avg(Result.diem).label("avg_score"))
+                .join(Exam, Result.maBaiKiemTra == Exam.maBaiKiemTra)
+                .where(Exam.maNguoiTao == teacher_id)
+                .cte("teacher_results")
             )
-            
+            row = (await db.execute(select(
+                select(func.count()).select_from(ClassRoom).where(
+                    ClassRoom.maGiaoVienChuNhiem == teacher_id
+                ).scalar_subquery().label("classes"),
+                select(func.count()).select_from(Exam).where(Exam.maNguoiTao == teacher_id).scalar_subquery().label("exams"),
+                results.c.answer_sheets,
+                results.c.avg_score,
+            ).select_from(results))).one()
             return {
-                "classes": classes or 0,
-                "exams": exams or 0,
-                "answerSheets": answer_sheets or 0,
-                "averageScore": round(float(avg_score), 2) if avg_score else 0,
+                "classes": row.classes or 0,
+                "exams": row.exams or 0,
+                "answerSheets": row.answer_sheets or 0,
+                "averageScore": round(float(row.avg_score), 2) if row.avg_score else 0,
             }
+
+        try:
+            return await dashboard_cache.get(("teacher", teacher_id), load, db)
         except Exception as e:
-            print(f"Error in teacher_stats: {e}")
+            logger.error(f"Error in teacher_stats: {e}")
             return {"classes": 0, "exams": 0, "answerSheets": 0, "averageScore": 0}
-
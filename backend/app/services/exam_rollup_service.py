@@ -0,0 +1,416 @@
+# Exam Statistic Rollups
+"""
+Thống kê điểm theo (bài thi, lớp) trong THONGKEKIEMTRA, được cập nhật tăng dần mỗi khi KETQUA được ghi.
+
+Trạng thái cộng dồn lưu trong phanBoDiemJson["rollup"]: số bài, tổng và tổng bình phương của điểm
+(đơn vị 1/100 điểm, số nguyên nên không trôi số khi cộng/trừ mãi) và histogram theo từng mức 0.01 điểm.
+Từ đó điểm TB, độ lệch chuẩn, cao nhất, thấp nhất, trung vị và phân loại đều tính chính xác mà không
+đọc lại KETQUA. Khi một kết quả được ghi lại, điểm cũ được trừ ra và điểm mới được cộng vào.
+
+Học sinh chuyển lớp được chuyển điểm giữa rollup của hai lớp (move_students). Dữ liệu có từ trước
+(hoặc bị lệch vì được sửa ngoài ứng dụng) được dựng lại bằng:
+
+    python -m app.services.exam_rollup_service rebuild [--exam-id 12]
+"""
+import argparse
+import asyncio
+import logging
+import math
+from collections import Counter
+from decimal import Decimal
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import Integer, cast, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.exam import Exam, ExamStatistic, Result
+from app.models.student import Student
+
+logger = logging.getLogger(__name__)
+
+# Điểm lưu trong histogram theo đơn vị 1/100 (Numeric(5, 2))
+CENTI = 100
+# Ngưỡng phân loại trên thang 10 (quy đổi theo tổng điểm của bài thi)
+GRADE_BANDS = (("gioi", 8.0), ("kha", 6.5), ("trungBinh", 5.0), ("yeu", 0.0))
+PASS_MARK = 5.0
+
+
+def to_centi(score) -> int:
+    return int(round(float(score) * CENTI))
+
+
+class ScoreRollup:
+    """Trạng thái cộng dồn của một tập điểm: đếm, tổng, tổng bình phương và histogram (đơn vị 1/100 điểm)."""
+
+    def __init__(self, count: int = 0, total: int = 0, total_sq: int = 0, histogram: Optional[Dict[int, int]] = None):
+        self.count = count
+        self.total = total
+        self.total_sq = total_sq
+        self.histogram: Counter = Counter(histogram or {})
+
+    @classmethod
+    def from_json(cls, data) -> "ScoreRollup":
+        rollup = (data or {}).get("rollup") if isinstance(data, dict) else None
+        if not rollup:
+            return cls()
+        return cls(
+            count=int(rollup.get("count", 0)),
+            total=int(rollup.get("sum", 0)),
+            total_sq=int(rollup.get("sumSq", 0)),
+            histogram={int(k): int(v) for k, v in rollup.get("histogram", {}).items()},
+        )
+
+    @classmethod
+    def from_scores(cls, scores: Iterable) -> "ScoreRollup":
+        rollup = cls()
+        for score in scores:
+            rollup.add(score)
+        return rollup
+
+    def to_json(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "sumSq": self.total_sq,
+            "histogram": {str(k): v for k, v in sorted(self.histogram.items())},
+        }
+
+    def add_centi(self, centi: int, weight: int = 1):
+        self.count += weight
+        self.total += weight * centi
+        self.total_sq += weight * centi * centi
+        self.histogram[centi] += weight
+        if self.histogram[centi] <= 0:
+            del self.histogram[centi]
+
+    def add(self, score, weight: int = 1):
+        self.add_centi(to_centi(score), weight)
+
+    def remove(self, score) -> bool:
+        """
+        Trừ một điểm đã được cộng trước đó. Điểm không có trong histogram nghĩa là rollup đã lệch
+        với KETQUA: không thay đổi gì và trả về False để caller dựng lại từ KETQUA.
+        """
+        centi = to_centi(score)
+        if self.histogram.get(centi, 0) <= 0:
+            return False
+        self.add_centi(centi, -1)
+        return True
+
+    def merge(self, other: "ScoreRollup"):
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.histogram.update(other.histogram)
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count / CENTI if self.count else None
+
+    @property
+    def std(self) -> Optional[float]:
+        """Độ lệch chuẩn tổng thể"""
+        if not self.count:
+            return None
+        variance = (self.total_sq * self.count - self.total * self.total) / (self.count * self.count)
+        return math.sqrt(max(variance, 0)) / CENTI
+
+    @property
+    def minimum(self) -> Optional[float]:
+        return min(self.histogram) / CENTI if self.histogram else None
+
+    @property
+    def maximum(self) -> Optional[float]:
+        return max(self.histogram) / CENTI if self.histogram else None
+
+    @property
+    def median(self) -> Optional[float]:
+        """Trung vị từ số đếm cộng dồn của histogram"""
+        if not self.count:
+            return None
+        lower_rank, upper_rank = (self.count - 1) // 2, self.count // 2
+        lower = upper = None
+        seen = 0
+        for centi in sorted(self.histogram):
+            seen += self.histogram[centi]
+            if lower is None and seen > lower_rank:
+                lower = centi
+            if seen > upper_rank:
+                upper = centi
+                break
+        return (lower + upper) / 2 / CENTI
+
+    def count_at_least(self, score) -> int:
+        threshold = to_centi(score)
+        return sum(n for centi, n in self.histogram.items() if centi >= threshold)
+
+    def grade_bands(self, max_score: float = 10.0) -> Dict[str, int]:
+        """Số học sinh giỏi / khá / trung bình / yếu theo thang 10"""
+        scale = (max_score or 10.0) / 10.0
+        bands = {name: 0 for name, _ in GRADE_BANDS}
+        for centi, n in self.histogram.items():
+            for name, threshold in GRADE_BANDS:
+                if centi >= to_centi(threshold * scale):
+                    bands[name] += n
+                    break
+        return bands
+
+    def pass_rate(self, max_score: float = 10.0) -> float:
+        if not self.count:
+            return 0.0
+        return self.count_at_least(PASS_MARK * (max_score or 10.0) / 10.0) / self.count * 100
+
+    def score_distribution(self) -> Dict[str, int]:
+        """Phân bố theo khoảng 2 điểm, cùng nhãn với ExamService._calculate_score_distribution"""
+        distribution = {"0-2": 0, "2-4": 0, "4-6": 0, "6-8": 0, "8-10": 0}
+        labels = list(distribution)
+        for centi, n in self.histogram.items():
+            distribution[labels[min(max(centi // (2 * CENTI), 0), 4)]] += n
+        return distribution
+
+
+def _decimal(value: Optional[float]) -> Optional[Decimal]:
+    return Decimal(str(round(value, 2))) if value is not None else None
+
+
+def write_rollup(stat: ExamStatistic, rollup: ScoreRollup, max_score: float = 10.0):
+    """Ghi các cột thống kê và trạng thái cộng dồn vào một dòng THONGKEKIEMTRA"""
+    stat.soLuongThamGia = rollup.count
+    stat.diemTrungBinh = _decimal(rollup.mean)
+    stat.diemCaoNhat = _decimal(rollup.maximum)
+    stat.diemThapNhat = _decimal(rollup.minimum)
+    stat.diemTrungVi = _decimal(rollup.median)
+    stat.doLechChuan = _decimal(rollup.std)
+    stat.phanBoDiemJson = {**rollup.grade_bands(max_score), "rollup": rollup.to_json()}
+
+
+class ScoreChange(NamedTuple):
+    """Một lần ghi KETQUA: old_score None nếu là kết quả mới, new_score None nếu kết quả bị xóa"""
+    exam_id: int
+    class_id: Optional[int]
+    old_score: Optional[Decimal]
+    new_score: Optional[Decimal]
+
+
+def _class_filter(class_id: Optional[int]):
+    return Student.maLopHoc.is_(None) if class_id is None else Student.maLopHoc == class_id
+
+
+class ExamRollupService:
+    @staticmethod
+    async def previous_scores(db: AsyncSession, exam_id: int, student_ids: List[int]) -> Dict[int, Tuple[Optional[int], Optional[Decimal]]]:
+        """{maHocSinh: (maLopHoc, điểm hiện tại hoặc None)} của các học sinh sắp được ghi kết quả"""
+        rows = (await db.execute(
+            select(Student.maHocSinh, Student.maLopHoc, Result.diem)
+            .outerjoin(Result, (Result.maHocSinh == Student.maHocSinh) & (Result.maBaiKiemTra == exam_id))
+            .where(Student.maHocSinh.in_(student_ids))
+        )).all()
+        return {student_id: (class_id, score) for student_id, class_id, score in rows}
+
+    @staticmethod
+    async def previous_scores_by_result(db: AsyncSession, result_ids: List[int]) -> Dict[int, Tuple[int, Optional[int], Decimal]]:
+        """{maKetQua: (maBaiKiemTra, maLopHoc, điểm hiện tại)} của các kết quả sắp được cập nhật"""
+        rows = (await db.execute(
+            select(Result.maKetQua, Result.maBaiKiemTra, Student.maLopHoc, Result.diem)
+            .join(Student, Result.maHocSinh == Student.maHocSinh)
+            .where(Result.maKetQua.in_(result_ids))
+        )).all()
+        return {result_id: (exam_id, class_id, score) for result_id, exam_id, class_id, score in rows}
+
+    @staticmethod
+    async def _aggregate(db: AsyncSession, exam_id: int, class_id: Optional[int] = None,
+                         all_classes: bool = False) -> Dict[Optional[int], ScoreRollup]:
+        """Dựng rollup từ KETQUA bằng một câu GROUP BY (lớp, mức điểm): histogram được đếm ngay trong DB"""
+        centi = cast(func.round(Result.diem * CENTI), Integer)
+        stmt = (
+            select(Student.maLopHoc, centi, func.count())
+            .join(Student, Result.maHocSinh == Student.maHocSinh)
+            .where(Result.maBaiKiemTra == exam_id)
+            .group_by(Student.maLopHoc, centi)
+        )
+        if not all_classes:
+            stmt = stmt.where(_class_filter(class_id))
+        rollups: Dict[Optional[int], ScoreRollup] = {}
+        for row_class_id, score_centi, n in (await db.execute(stmt)).all():
+            rollups.setdefault(row_class_id, ScoreRollup()).add_centi(score_centi, n)
+        return rollups
+
+    @staticmethod
+    async def _lock_statistic(db: AsyncSession, exam_id: int, class_id: Optional[int]) -> Tuple[ExamStatistic, bool]:
+        """Khóa (tạo nếu chưa có) dòng thống kê của (bài thi, lớp). Trả về (dòng, vừa được tạo)."""
+        stmt = pg_insert(ExamStatistic).values(maBaiKiemTra=exam_id, maLopHoc=class_id, soLuongThamGia=0)
+        if class_id is None:
+            stmt = stmt.on_conflict_do_nothing(
+                index_elements=[ExamStatistic.maBaiKiemTra], index_where=ExamStatistic.maLopHoc.is_(None)
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(constraint="uq_thongkekiemtra_mabkt_malop")
+        created = (await db.execute(stmt.returning(ExamStatistic.maThongKe))).first() is not None
+
+        class_match = ExamStatistic.maLopHoc.is_(None) if class_id is None else ExamStatistic.maLopHoc == class_id
+        stat = (await db.execute(
+            select(ExamStatistic)
+            .where(ExamStatistic.maBaiKiemTra == exam_id, class_match)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )).scalar_one()
+        return stat, created
+
+    @staticmethod
+    async def apply(db: AsyncSession, changes: List[ScoreChange]) -> int:
+        """
+        Cập nhật thống kê của các (bài thi, lớp) bị ảnh hưởng, trong transaction của caller và sau khi
+        KETQUA đã được ghi. Dòng thống kê chưa tồn tại được dựng đầy đủ từ KETQUA (đã gồm thay đổi mới)
+        thay vì cộng delta. Trả về số dòng thống kê được cập nhật.
+        """
+        groups: Dict[Tuple[int, Optional[int]], List[ScoreChange]] = {}
+        for change in changes:
+            if change.old_score is not None or change.new_score is not None:
+                groups.setdefault((change.exam_id, change.class_id), []).append(change)
+        if not groups:
+            return 0
+
+        exam_ids = {exam_id for exam_id, _ in groups}
+        max_scores = dict((await db.execute(
+            select(Exam.maBaiKiemTra, Exam.tongDiem).where(Exam.maBaiKiemTra.in_(exam_ids))
+        )).all())
+
+        # Khóa theo thứ tự cố định để hai batch đồng thời không deadlock
+        for exam_id, class_id in sorted(groups, key=lambda key: (key[0], key[1] is not None, key[1] or 0)):
+            stat, created = await ExamRollupService._lock_statistic(db, exam_id, class_id)
+            if created:
+                rollup = (await ExamRollupService._aggregate(db, exam_id, class_id)).get(class_id, ScoreRollup())
+            else:
+                rollup = ScoreRollup.from_json(stat.phanBoDiemJson)
+                for change in groups[(exam_id, class_id)]:
+                    if change.old_score is not None and not rollup.remove(change.old_score):
+                        logger.warning(f"Statistic rollup of exam {exam_id}, class {class_id} is out of sync, rebuilding")
+                        rollup = (await ExamRollupService._aggregate(db, exam_id, class_id)).get(class_id, ScoreRollup())
+                        break
+                    if change.new_score is not None:
+                        rollup.add(change.new_score)
+            write_rollup(stat, rollup, float(max_scores.get(exam_id) or 10))
+        await db.flush()
+        return len(groups)
+
+    @staticmethod
+    async def ensure_statistic(db: AsyncSession, exam_id: int, class_id: Optional[int]) -> ExamStatistic:
+        """Dòng thống kê (đã khóa) của một (bài thi, lớp); dòng mới được dựng rollup từ KETQUA. Không commit."""
+        stat, created = await ExamRollupService._lock_statistic(db, exam_id, class_id)
+        if created:
+            max_score = await db.scalar(select(Exam.tongDiem).where(Exam.maBaiKiemTra == exam_id))
+            rollup = (await ExamRollupService._aggregate(db, exam_id, class_id)).get(class_id, ScoreRollup())
+            write_rollup(stat, rollup, float(max_score or 10))
+            await db.flush()
+        return stat
+
+    @staticmethod
+    async def move_students(db: AsyncSession, moves: Dict[int, Tuple[Optional[int], Optional[int]]]) -> int:
+        """
+        Chuyển điểm của các học sinh đổi lớp {maHocSinh: (lớp cũ, lớp mới)} từ rollup lớp cũ sang lớp mới.
+        Gọi trong transaction của caller, sau khi maLopHoc mới đã được flush. Trả về số dòng thống kê được cập nhật.
+        """
+        moves = {student_id: classes for student_id, classes in moves.items() if classes[0] != classes[1]}
+        if not moves:
+            return 0
+        rows = (await db.execute(
+            select(Result.maBaiKiemTra, Result.maHocSinh, Result.diem)
+            .where(Result.maHocSinh.in_(list(moves)), Result.diem.is_not(None))
+        )).all()
+        changes = []
+        for exam_id, student_id, score in rows:
+            old_class_id, new_class_id = moves[student_id]
+            changes.append(ScoreChange(exam_id, old_class_id, score, None))
+            changes.append(ScoreChange(exam_id, new_class_id, None, score))
+        return await ExamRollupService.apply(db, changes)
+
+    @staticmethod
+    async def rebuild(db: AsyncSession, exam_id: int) -> int:
+        """Dựng lại toàn bộ thống kê của một bài thi từ KETQUA (không commit). Trả về số lớp có kết quả."""
+        exam = await db.get(Exam, exam_id)
+        if exam is None:
+            return 0
+        rollups = await ExamRollupService._aggregate(db, exam_id, all_classes=True)
+        existing = (await db.execute(
+            select(ExamStatistic).where(ExamStatistic.maBaiKiemTra == exam_id).with_for_update()
+        )).scalars().all()
+
+        by_class = {}
+        for stat in existing:
+            # Dòng trùng (lớp NULL trước khi có unique index) bị gộp vào dòng đầu tiên
+            if stat.maLopHoc in by_class:
+                await db.delete(stat)
+            else:
+                by_class[stat.maLopHoc] = stat
+        for class_id in set(by_class) | set(rollups):
+            stat = by_class.get(class_id)
+            if stat is None:
+                stat = ExamStatistic(maBaiKiemTra=exam_id, maLopHoc=class_id)
+                db.add(stat)
+            write_rollup(stat, rollups.get(class_id, ScoreRollup()), float(exam.tongDiem or 10))
+        await db.flush()
+        return len(rollups)
+
+    @staticmethod
+    async def get_rollup(db: AsyncSession, exam_id: int, class_id: Optional[int] = None) -> Tuple[ScoreRollup, float]:
+        """
+        Rollup của một bài thi (gộp mọi lớp) hoặc một lớp, đọc từ THONGKEKIEMTRA.
+        Khi các dòng thống kê không phủ hết KETQUA (chưa backfill, hoặc có lớp có kết quả mà chưa có dòng
+        thống kê) rollup được tính bằng GROUP BY trên KETQUA, không ghi lại.
+        """
+        stmt = select(ExamStatistic.phanBoDiemJson).where(ExamStatistic.maBaiKiemTra == exam_id)
+        count_stmt = (
+            select(func.count(Result.maKetQua))
+            .join(Student, Result.maHocSinh == Student.maHocSinh)
+            .where(Result.maBaiKiemTra == exam_id)
+        )
+        if class_id is not None:
+            stmt = stmt.where(ExamStatistic.maLopHoc == class_id)
+            count_stmt = count_stmt.where(_class_filter(class_id))
+        rows = (await db.execute(stmt)).scalars().all()
+        max_score = float((await db.scalar(select(Exam.tongDiem).where(Exam.maBaiKiemTra == exam_id))) or 10)
+
+        rollup = ScoreRollup()
+        for data in rows:
+            rollup.merge(ScoreRollup.from_json(data))
+        if rows and rollup.count == (await db.scalar(count_stmt)):
+            return rollup, max_score
+
+        rollup = ScoreRollup()
+
+        aggregated = await ExamRollupService._aggregate(db, exam_id, class_id, all_classes=class_id is None)
+        for part in aggregated.values():
+            rollup.merge(part)
+        return rollup, max_score
+
+
+async def _rebuild_command(exam_id: Optional[int] = None):
+    from app.db.session import AsyncSessionLocal
+
+    async with AsyncSessionLocal() as db:
+        if exam_id is not None:
+            exam_ids = [exam_id]
+        else:
+            exam_ids = (await db.execute(select(Exam.maBaiKiemTra).order_by(Exam.maBaiKiemTra))).scalars().all()
+        for current in exam_ids:
+            classes = await ExamRollupService.rebuild(db, current)
+            await db.commit()
+            logger.info(f"Rebuilt statistics for exam {current}: {classes} class(es)")
+    logger.info(f"Rebuilt statistics for {len(exam_ids)} exam(s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dựng lại thống kê bài thi (THONGKEKIEMTRA) từ KETQUA")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("rebuild", help="backfill / sửa thống kê của một hoặc tất cả bài thi")
+    rebuild.add_argument("--exam-id", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "rebuild":
+        asyncio.run(_rebuild_command(args.exam_id))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,10 @@ from app.models.exam import Exam, ExamClassRoom, Answer, Result, ExamStatistic
 from app.models.class_room import ClassRoom
 from app.models.student import Student
 from app.schemas.exam import ExamCreate, ExamUpdate, ExamOut
+from app.services.student_roster_index import student_roster_index
+from app.services.answer_key_cache import CompiledAnswerKey, answer_key_cache, diff_answer_keys, exam_equal_points
+from app.services.regrade_service import answer_key_regrader
+from app.services.exam_rollup_service import ExamRollupService
 
 class ExamService:
     @staticmethod
@@ -61,6 +65,8 @@ class ExamService:
             setattr(exam, attr, value)
         exam.thoiGianCapNhat = datetime.utcnow()
         await db.commit()
+        # Tổng điểm / số câu thay đổi thì điểm chia đều của đáp án cũng thay đổi
+        answer_key_cache.invalidate(exam_id)
         await db.refresh(exam)
         return exam
 
@@ -69,6 +75,7 @@ class ExamService:
         exam = await ExamService.get_exam(db, exam_id)
         await db.delete(exam)
         await db.commit()
+        answer_key_cache.invalidate(exam_id)
 
     # ========== NEW METHODS ==========
     
@@ -103,6 +110,7 @@ class ExamService:
             })
         
         await db.commit()
+        student_roster_index.invalidate_exam(exam_id)
         return assigned_classes
 
     @staticmethod
@@ -128,19 +136,36 @@ class ExamService:
     async def create_or_update_answers(db: AsyncSession, exam_id: int, answers_data: Dict) -> Answer:
         """Tạo hoặc cập nhật đáp án cho bài kiểm tra"""
         # Kiểm tra exam tồn tại
-        await ExamService.get_exam(db, exam_id)
+        exam = await ExamService.get_exam(db, exam_id)
         
         # Kiểm tra đáp án đã tồn tại chưa
         result = await db.execute(select(Answer).where(Answer.maBaiKiemTra == exam_id))
         existing_answer = result.scalars().first()
         
         if existing_answer:
+            try:
+                previous = CompiledAnswerKey(
+                    exam_id, existing_answer.dapAnJson, existing_answer.diemMoiCauJson,
+                    equal_points=exam_equal_points(exam)
+                )
+            except ValueError:
+                # Đáp án cũ hỏng: coi như mọi mã đề đều thay đổi
+                previous = CompiledAnswerKey(exam_id, {}, None)
             # Cập nhật đáp án hiện có
             existing_answer.dapAnJson = answers_data.get("answers", {})
             existing_answer.diemMoiCauJson = answers_data.get("scores", {})
             existing_answer.thoiGianCapNhat = datetime.utcnow()
             await db.commit()
+            answer_key_cache.invalidate(exam_id)
             await db.refresh(existing_answer)
+            
+            # Chấm lại nền các phiếu thuộc mã đề có câu bị sửa đáp án / điểm
+            changes = diff_answer_keys(previous, CompiledAnswerKey(
+                exam_id, existing_answer.dapAnJson, existing_answer.diemMoiCauJson,
+                equal_points=exam_equal_points(exam)
+            ))
+            if changes:
+                answer_key_regrader.enqueue(exam_id, previous, changes)
             return existing_answer
         else:
             # Tạo đáp án mới
@@ -151,6 +176,7 @@ class ExamService:
             )
             db.add(new_answer)
             await db.commit()
+            answer_key_cache.invalidate(exam_id)
             await db.refresh(new_answer)
             return new_answer
 
@@ -162,16 +188,9 @@ class ExamService:
 
     @staticmethod
     async def get_exam_statistics(db: AsyncSession, exam_id: int, class_id: Optional[int] = None) -> Dict[str, Any]:
-        """Lấy thống kê kết quả bài kiểm tra"""
-        # Base query cho results
-        stmt = select(Result).where(Result.maBaiKiemTra == exam_id)
-        if class_id:
-            stmt = stmt.join(Student).where(Student.maLopHoc == class_id)
-        
-        result = await db.execute(stmt)
-        results = result.scalars().all()
-        
-        if not results:
+        """Lấy thống kê kết quả bài kiểm tra (đọc từ rollup THONGKEKIEMTRA, không quét KETQUA)"""
+        rollup, _ = await ExamRollupService.get_rollup(db, exam_id, class_id)
+        if not rollup.count:
             return {
                 "total_students": 0,
                 "average_score": 0,
@@ -180,16 +199,14 @@ class ExamService:
                 "pass_rate": 0,
                 "score_distribution": {}
             }
-        
-        scores = [r.diem for r in results]
-        
+
         return {
-            "total_students": len(results),
-            "average_score": sum(scores) / len(scores),
-            "highest_score": max(scores),
-            "lowest_score": min(scores),
-            "pass_rate": len([s for s in scores if s >= 5.0]) / len(scores) * 100,
-            "score_distribution": ExamService._calculate_score_distribution(scores)
+            "total_students": rollup.count,
+            "average_score": rollup.mean,
+            "highest_score": rollup.maximum,
+            "lowest_score": rollup.minimum,
+            "pass_rate": rollup.count_at_least(5.0) / rollup.count * 100,
+            "score_distribution": rollup.score_distribution()
         }
 
     @staticmethod
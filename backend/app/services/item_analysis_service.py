@@ -0,0 +1,335 @@
+# Item Analysis Service
+"""
+Phân tích câu hỏi (item analysis) của một bài thi theo từng mã đề: độ khó (p-value), độ phân biệt
+(nhóm 27% cao / thấp), hệ số tương quan điểm-câu (point-biserial) và phân bố phương án nhiễu.
+
+Phiếu được đọc theo chunk (keyset trên maPhieuTraLoi), mỗi chunk mã hóa thành ma trận (phiếu x câu)
+id phương án rồi cộng dồn vào các thống kê đủ (tổng, tổng tích với điểm, bincount phương án). Chỉ ma trận
+đúng/sai (nén bit) và điểm của từng phiếu được giữ lại để chia nhóm cao / thấp ở cuối, nên bộ nhớ
+khoảng số phiếu x số câu / 8 byte. Kết quả của từng lớp được lưu vào THONGKEKIEMTRA.thongKeCauHoiJson.
+"""
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.models.exam import AnswerSheet, ExamStatistic, Result
+from app.models.student import Student
+from app.services.answer_key_cache import answer_key_cache
+from app.services.exam_rollup_service import ExamRollupService
+from app.services.omr_service import OMRDatabaseService
+
+logger = logging.getLogger(__name__)
+
+# Tỷ lệ phiếu trong mỗi nhóm cao / thấp khi tính độ phân biệt (Kelley)
+GROUP_FRACTION = 0.27
+# Nhãn độ khó theo p-value và mức độ phân biệt theo Ebel
+DIFFICULTY_LEVELS = (("de", 0.8), ("trungBinh", 0.3), ("kho", 0.0))
+DISCRIMINATION_LEVELS = (("tot", 0.4), ("kha", 0.3), ("canXemLai", 0.2), ("loai", float("-inf")))
+# Khóa của mã đề khi bài thi chỉ có một bộ đáp án
+DEFAULT_FORM = "default"
+EXAM_SCOPE = "exam"
+
+
+def _level(value: Optional[float], levels) -> Optional[str]:
+    if value is None:
+        return None
+    for name, threshold in levels:
+        if value >= threshold:
+            return name
+    return None
+
+
+def _round(value, digits: int = 4) -> Optional[float]:
+    return None if value is None or not np.isfinite(value) else round(float(value), digits)
+
+
+class AnswerVocabulary:
+    """Id nhỏ (int32) cho từng câu trả lời đã chuẩn hóa, dùng chung cho mọi chunk của một lượt phân tích"""
+
+    def __init__(self):
+        self.values: List[str] = [""]
+        self._ids: Dict[str, int] = {"": 0}
+        self._raw: Dict[Any, int] = {}
+
+    @property
+    def blank_id(self) -> int:
+        return 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def id_of(self, raw) -> int:
+        cached = self._raw.get(raw)
+        if cached is None:
+            # Cùng quy tắc với batch_scorer: so sánh không phân biệt hoa thường, chuỗi toàn khoảng trắng là để trống
+            text = raw if isinstance(raw, str) else ("" if raw is None else str(raw))
+            text = "" if text.strip() == "" else text.upper()
+            cached = self._ids.get(text)
+            if cached is None:
+                cached = len(self.values)
+                self._ids[text] = cached
+                self.values.append(text)
+            self._raw[raw] = cached
+        return cached
+
+    def encode(self, q_ids: List[str], sheets: List[Dict[str, Any]]) -> np.ndarray:
+        """Ma trận (số phiếu x số câu) id câu trả lời"""
+        blanks = [""] * len(q_ids)
+        flat = [a for answers in sheets for a in map(answers.get, q_ids, blanks)]
+        try:
+            id_of = {a: self.id_of(a) for a in set(flat)}
+            ids = map(id_of.__getitem__, flat)
+        except TypeError:
+            # Giá trị không hash được (list, dict) trong cauTraLoiJson
+            ids = (self.id_of(a if isinstance(a, str) else str(a)) for a in flat)
+        return np.fromiter(ids, dtype=np.int32, count=len(flat)).reshape(len(sheets), len(q_ids))
+
+
+class ItemAccumulator:
+    """Thống kê đủ của một mã đề trong một phạm vi (cả bài thi hoặc một lớp), cộng dồn theo chunk"""
+
+    def __init__(self, q_ids: List[str], key_ids: np.ndarray):
+        self.q_ids = q_ids
+        self.key_ids = key_ids
+        n_questions = len(q_ids)
+        self.count = 0
+        self.correct_sum = np.zeros(n_questions, dtype=np.int64)
+        self.correct_total_sum = np.zeros(n_questions, dtype=np.float64)
+        self.total_sum = 0.0
+        self.total_sq_sum = 0.0
+        self.option_counts = np.zeros((n_questions, 0), dtype=np.int64)
+        self.option_totals = np.zeros((n_questions, 0), dtype=np.float64)
+        self._packed: List[np.ndarray] = []
+        self._totals: List[np.ndarray] = []
+
+    def add(self, ids: np.ndarray, correct: np.ndarray, totals: np.ndarray, n_options: int):
+        n_sheets, n_questions = ids.shape
+        if not n_sheets:
+            return
+        if self.option_counts.shape[1] < n_options:
+            grow = n_options - self.option_counts.shape[1]
+            self.option_counts = np.pad(self.option_counts, ((0, 0), (0, grow)))
+            self.option_totals = np.pad(self.option_totals, ((0, 0), (0, grow)))
+
+        width = self.option_counts.shape[1]
+        cells = (ids + np.arange(n_questions, dtype=np.int64) * width).ravel()
+        size = n_questions * width
+        self.option_counts += np.bincount(cells, minlength=size).reshape(n_questions, width)
+        self.option_totals += np.bincount(
+            cells, weights=np.repeat(totals, n_questions), minlength=size
+        ).reshape(n_questions, width)
+
+        self.count += n_sheets
+        self.correct_sum += correct.sum(axis=0)
+        self.correct_total_sum += totals @ correct
+        self.total_sum += float(totals.sum())
+        self.total_sq_sum += float(totals @ totals)
+        self._packed.append(np.packbits(correct, axis=1))
+        self._totals.append(totals)
+
+    def discrimination(self) -> np.ndarray:
+        """Độ phân biệt D = p(nhóm cao) - p(nhóm thấp), nhóm theo điểm bài thi"""
+        n_questions = len(self.q_ids)
+        if self.count < 2:
+            return np.full(n_questions, np.nan)
+        totals = np.concatenate(self._totals)
+        correct = np.unpackbits(np.concatenate(self._packed), axis=1, count=n_questions).astype(bool)
+        order = np.argsort(-totals, kind="stable")
+        group = max(1, int(round(self.count * GROUP_FRACTION)))
+        return correct[order[:group]].mean(axis=0) - correct[order[-group:]].mean(axis=0)
+
+    def result(self, vocabulary: AnswerVocabulary) -> Dict[str, Any]:
+        n = self.count
+        if not n:
+            return {"sheetCount": 0, "questions": []}
+        p_values = self.correct_sum / n
+        mean_total = self.total_sum / n
+        var_total = max(self.total_sq_sum / n - mean_total * mean_total, 0.0)
+        covariance = self.correct_total_sum / n - p_values * mean_total
+        with np.errstate(divide="ignore", invalid="ignore"):
+            point_biserial = covariance / np.sqrt(var_total * p_values * (1 - p_values))
+        discrimination = self.discrimination()
+
+        questions = []
+        for q, q_id in enumerate(self.q_ids):
+            counts = self.option_counts[q]
+            options = []
+            for option in np.argsort(-counts, kind="stable")[:np.count_nonzero(counts)]:
+                chosen = int(counts[option])
+                options.append({
+                    "answer": vocabulary.values[option],
+                    "isKey": bool(option == self.key_ids[q]),
+                    "isBlank": bool(option == vocabulary.blank_id),
+                    "count": chosen,
+                    "share": _round(chosen / n),
+                    "meanScore": _round(self.option_totals[q, option] / chosen, 2),
+                })
+            p_value = _round(p_values[q])
+            d_index = _round(discrimination[q])
+            questions.append({
+                "questionId": q_id,
+                "correctAnswer": vocabulary.values[self.key_ids[q]],
+                "pValue": p_value,
+                "discrimination": d_index,
+                "pointBiserial": _round(point_biserial[q]),
+                "blankRate": _round(counts[vocabulary.blank_id] / n) if counts.size else 0.0,
+                "difficulty": _level(p_value, DIFFICULTY_LEVELS),
+                "discriminationLevel": _level(d_index, DISCRIMINATION_LEVELS),
+                "options": options,
+            })
+        return {"sheetCount": n, "meanScore": _round(mean_total, 2), "questions": questions}
+
+
+def difficulty_summary(analysis: Dict[str, Any]) -> Dict[str, int]:
+    """Số câu hỏi theo từng mức độ khó, gộp mọi mã đề (phanLoaiDoKhoJson)"""
+    summary = {name: 0 for name, _ in DIFFICULTY_LEVELS}
+    for form in analysis.get("forms", {}).values():
+        for question in form["questions"]:
+            if question["difficulty"] in summary:
+                summary[question["difficulty"]] += 1
+    return summary
+
+
+class ItemAnalysisService:
+    @staticmethod
+    async def analyze(db: AsyncSession, exam_id: int, class_id: Optional[int] = None,
+                      chunk_size: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Phân tích câu hỏi từ cauTraLoiJson đã lưu (theo đáp án hiện tại) và điểm KETQUA.
+        Trả về {"exam": phân tích cả bài thi, "classes": {maLopHoc: phân tích của lớp}};
+        với class_id chỉ phiếu của lớp đó được đọc và "exam" là None.
+        """
+        chunk_size = chunk_size or settings.ITEM_ANALYSIS_CHUNK_SIZE
+        compiled = await answer_key_cache.get(db, exam_id)
+        vocabulary = AnswerVocabulary()
+        forms: Dict[Optional[str], Any] = {}
+        # (phạm vi, mã đề) -> accumulator; phạm vi là EXAM_SCOPE (cả bài thi) hoặc maLopHoc
+        accumulators: Dict[Tuple[Any, str], ItemAccumulator] = {}
+        result_counts: Dict[Any, int] = {}
+        skipped = 0
+
+        stmt = (
+            select(AnswerSheet.maPhieuTraLoi, AnswerSheet.cauTraLoiJson, Result.diem, Student.maLopHoc)
+            .join(Result, Result.maPhieuTraLoi == AnswerSheet.maPhieuTraLoi)
+            .join(Student, Result.maHocSinh == Student.maHocSinh)
+            .where(AnswerSheet.maBaiKiemTra == exam_id)
+            .order_by(AnswerSheet.maPhieuTraLoi)
+            .limit(chunk_size)
+        )
+        if class_id is not None:
+            stmt = stmt.where(Student.maLopHoc == class_id)
+
+        last_sheet_id = 0
+        while True:
+            rows = (await db.execute(stmt.where(AnswerSheet.maPhieuTraLoi > last_sheet_id))).all()
+            if not rows:
+                break
+            last_sheet_id = rows[-1][0]
+
+            # Gom phiếu theo mã đề đã resolve
+            groups: Dict[str, Tuple[Dict[str, str], List[Tuple[Dict, float, Optional[int]]]]] = {}
+            for _, student_answers, score, row_class_id in rows:
+                result_counts[row_class_id] = result_counts.get(row_class_id, 0) + 1
+                if not student_answers or not isinstance(student_answers, dict):
+                    skipped += 1
+                    continue
+                ma_de = OMRDatabaseService.detect_ma_de_from_omr_results(student_answers)
+                if ma_de not in forms:
+                    try:
+                        forms[ma_de] = compiled.resolve_detected(ma_de)
+                    except Exception as e:
+                        logger.warning(f"Item analysis exam {exam_id}: no answer key for mã đề {ma_de}: {e}")
+                        forms[ma_de] = None
+                form = forms[ma_de]
+                if form is None:
+                    skipped += 1
+                    continue
+                form_key = DEFAULT_FORM if form[0] is None else str(form[0])
+                groups.setdefault(form_key, (form[1], []))[1].append((student_answers, float(score), row_class_id))
+
+            for form_key, (answer_key, items) in groups.items():
+                q_ids = list(answer_key.keys())
+                key_ids = np.array([vocabulary.id_of(answer_key[q_id]) for q_id in q_ids], dtype=np.int32)
+                ids = vocabulary.encode(q_ids, [answers for answers, _, _ in items])
+                correct = (ids == key_ids) & (ids != vocabulary.blank_id)
+                totals = np.fromiter((score for _, score, _ in items), dtype=np.float64, count=len(items))
+                # Học sinh chưa có lớp mang mã -1 trong mảng, khóa None trong kết quả
+                item_classes = np.fromiter((-1 if c is None else c for _, _, c in items), dtype=np.int64, count=len(items))
+
+                targets = [] if class_id is not None else [(EXAM_SCOPE, None)]
+                for code in np.unique(item_classes).tolist():
+                    targets.append((None if code == -1 else code, item_classes == code))
+                for scope, mask in targets:
+                    accumulator = accumulators.get((scope, form_key))
+                    if accumulator is None:
+                        accumulator = accumulators[(scope, form_key)] = ItemAccumulator(q_ids, key_ids)
+                    if mask is None:
+                        accumulator.add(ids, correct, totals, len(vocabulary))
+                    else:
+                        accumulator.add(ids[mask], correct[mask], totals[mask], len(vocabulary))
+
+        generated_at = datetime.utcnow().isoformat()
+
+        def build(scope) -> Dict[str, Any]:
+            scope_forms = {
+                form_key: accumulator.result(vocabulary)
+                for (acc_scope, form_key), accumulator in sorted(accumulators.items(), key=lambda item: item[0][1])
+                if acc_scope == scope
+            }
+            counted = sum(result_counts.values()) if scope == EXAM_SCOPE else result_counts.get(scope, 0)
+            return {
+                "generatedAt": generated_at,
+                "answerKeyVersion": compiled.version,
+                "resultCount": counted,
+                "sheetCount": sum(form["sheetCount"] for form in scope_forms.values()),
+                "forms": scope_forms,
+            }
+
+        analysis = {
+            "exam": build(EXAM_SCOPE) if class_id is None else None,
+            "classes": {scope: build(scope) for scope in result_counts},
+        }
+        logger.info(
+            f"Item analysis exam {exam_id}: {sum(result_counts.values())} results, {skipped} skipped, "
+            f"{len(accumulators)} (scope, mã đề) groups"
+        )
+        return analysis
+
+    @staticmethod
+    async def refresh(db: AsyncSession, exam_id: int, class_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Tính lại và lưu phân tích câu hỏi vào THONGKEKIEMTRA (commit): của lớp `class_id`, hoặc của
+        mọi lớp có kết quả. Chỉ dòng thống kê của các lớp đó được chạm tới; dòng chưa có thì được tạo.
+        """
+        analysis = await ItemAnalysisService.analyze(db, exam_id, class_id)
+        # Khóa theo cùng thứ tự với ExamRollupService.apply để không deadlock với batch đang ghi điểm
+        for scope in sorted(analysis["classes"], key=lambda key: (key is not None, key or 0)):
+            class_analysis = analysis["classes"][scope]
+            stat = await ExamRollupService.ensure_statistic(db, exam_id, scope)
+            stat.thongKeCauHoiJson = class_analysis
+            stat.phanLoaiDoKhoJson = difficulty_summary(class_analysis)
+        await db.commit()
+        return analysis
+
+    @staticmethod
+    async def get_class_analysis(db: AsyncSession, exam_id: int, class_id: int, refresh: bool = False) -> Dict[str, Any]:
+        """
+        Phân tích câu hỏi của một lớp: đọc bản đã lưu, chỉ tính lại khi chưa có, khi số kết quả
+        của lớp hoặc đáp án đã thay đổi, hoặc khi được yêu cầu.
+        """
+        stat = (await db.execute(
+            select(ExamStatistic).where(ExamStatistic.maBaiKiemTra == exam_id, ExamStatistic.maLopHoc == class_id)
+        )).scalars().first()
+        stored = stat.thongKeCauHoiJson if stat is not None else None
+        if (not refresh and stored and stored.get("resultCount") == stat.soLuongThamGia
+                and stored.get("answerKeyVersion") == (await answer_key_cache.get(db, exam_id)).version):
+            return stored
+        analysis = await ItemAnalysisService.refresh(db, exam_id, class_id)
+        return analysis["classes"].get(class_id) or {
+            "generatedAt": datetime.utcnow().isoformat(), "resultCount": 0, "sheetCount": 0, "forms": {},
+        }
@@ -0,0 +1,322 @@
+# OMR Job Service
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select, update, or_, and_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.models.omr_job import OMRJob, OMRJobItem
+from app.services.omr_result_cache import omr_result_cache
+from app.services.omr_service import OMRDatabaseService
+from app.services.omr_worker_pool import OMRQueueFullError
+from app.services.student_roster_index import student_roster_index
+from app.services.websocket_service import WebSocketService
+
+logger = logging.getLogger(__name__)
+
+JOB_PENDING = "choXuLy"
+JOB_RUNNING = "dangXuLy"
+JOB_DONE = "hoanTat"
+JOB_FAILED = "loi"
+
+
+def extract_sbd(results: Dict[str, Any]) -> str:
+    """SBD từ metadata, fallback sang các key có chứa 'sbd' (giống batch-process-with-exam)."""
+    sbd = results.get("_metadata", {}).get("sbd", "")
+    if not sbd:
+        for key, value in results.items():
+            if "sbd" in key.lower() and value and str(value).isdigit():
+                return str(value)
+    return sbd
+
+
+class OMRJobService:
+    """Tạo và truy vấn công việc chấm OMR lưu trong bảng CONGVIECOMR / ANHCONGVIECOMR"""
+
+    @staticmethod
+    def job_storage_dir(job_id: int) -> Path:
+        return Path(settings.STORAGE_PATH) / "omr_jobs" / str(job_id)
+
+    @staticmethod
+    async def create_job(
+        db: AsyncSession,
+        exam_id: int,
+        template_id: int,
+        user_id: int,
+        images: List[Any],
+        options: Dict[str, Any]
+    ) -> OMRJob:
+        """
+        Lưu ảnh upload vào thư mục của job và tạo một dòng ANHCONGVIECOMR cho mỗi ảnh.
+        `images` là danh sách UploadFile đã được lọc định dạng.
+        """
+        job = OMRJob(
+            maBaiKiemTra=exam_id, maMauPhieu=template_id, maNguoiTao=user_id,
+            trangThai=JOB_PENDING, tuyChonJson=options, tongSoAnh=len(images),
+            soAnhDaXuLy=0, soAnhLoi=0
+        )
+        db.add(job)
+        await db.flush()
+
+        storage_dir = OMRJobService.job_storage_dir(job.maCongViec)
+        storage_dir.mkdir(parents=True, exist_ok=True)
+        for i, image in enumerate(images):
+            physical_path = storage_dir / f"{i:05d}_{Path(image.filename).name}"
+            with open(physical_path, "wb") as f:
+                f.write(await image.read())
+            db.add(OMRJobItem(
+                maCongViec=job.maCongViec, thuTu=i, tenTapTin=image.filename,
+                duongDanAnh=str(physical_path), trangThai=JOB_PENDING
+            ))
+
+        await db.commit()
+        return job
+
+    @staticmethod
+    async def get_job(db: AsyncSession, job_id: int, include_results: bool = True) -> Optional[Dict[str, Any]]:
+        job = await db.get(OMRJob, job_id)
+        if not job:
+            return None
+
+        data = {
+            "job_id": job.maCongViec,
+            "exam_id": job.maBaiKiemTra,
+            "template_id": job.maMauPhieu,
+            "status": job.trangThai,
+            "total_images": job.tongSoAnh,
+            "processed": job.soAnhDaXuLy,
+            "failed": job.soAnhLoi,
+            "progress": round(job.soAnhDaXuLy * 100 / job.tongSoAnh) if job.tongSoAnh else 100,
+            "error": job.thongBaoLoi,
+            "created_at": job.thoiGianTao.isoformat() if job.thoiGianTao else None,
+            "completed_at": job.thoiGianHoanTat.isoformat() if job.thoiGianHoanTat else None,
+        }
+        if include_results:
+            items = (await db.execute(
+                select(OMRJobItem).where(OMRJobItem.maCongViec == job_id).order_by(OMRJobItem.thuTu)
+            )).scalars().all()
+            data["images"] = [{
+                "filename": item.tenTapTin,
+                "status": item.trangThai,
+                "error": item.thongBaoLoi,
+                "result": item.ketQuaJson,
+            } for item in items]
+        return data
+
+
+class OMRJobRunner:
+    """
+    Chạy nền các công việc OMR trong event loop của API, phần xử lý ảnh nằm trong omr_worker_pool.
+
+    Trạng thái bền vững nằm trong database: mỗi ảnh được commit ngay sau khi chấm (checkpoint),
+    nên khi server khởi động lại, job đang dở được chạy tiếp từ ảnh chưa xử lý đầu tiên.
+    Job được "nhận" bằng một câu UPDATE có điều kiện để nhiều process API không chạy trùng;
+    job `dangXuLy` chỉ được nhận lại khi heartbeat (thoiGianCapNhat) quá `stale_seconds`.
+    """
+
+    def __init__(self, concurrency: Optional[int] = None, chunk_size: Optional[int] = None,
+                 stale_seconds: Optional[int] = None):
+        self.concurrency = settings.OMR_JOB_CONCURRENCY if concurrency is None else concurrency
+        self.chunk_size = settings.OMR_JOB_CHUNK_SIZE if chunk_size is None else chunk_size
+        self.stale_seconds = settings.OMR_JOB_STALE_SECONDS if stale_seconds is None else stale_seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._consumers: List[asyncio.Task] = []
+
+    async def start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._consumers = [asyncio.create_task(self._consume()) for _ in range(max(1, self.concurrency))]
+        await self.resume_interrupted()
+
+    async def stop(self):
+        for task in self._consumers:
+            task.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._consumers = []
+        self._queue = None
+
+    def enqueue(self, job_id: int):
+        if self._queue is None:
+            logger.warning(f"OMR job runner not started, job {job_id} will run after restart")
+            return
+        self._queue.put_nowait(job_id)
+
+    async def resume_interrupted(self):
+        """Đưa lại vào hàng đợi các job chưa xong (đang chờ hoặc bị ngắt giữa chừng)."""
+        try:
+            async with AsyncSessionLocal() as db:
+                job_ids = (await db.execute(
+                    select(OMRJob.maCongViec)
+                    .where(OMRJob.trangThai.in_([JOB_PENDING, JOB_RUNNING]))
+                    .order_by(OMRJob.maCongViec)
+                )).scalars().all()
+        except Exception as e:
+            logger.error(f"Could not load unfinished OMR jobs: {e}")
+            return
+        for job_id in job_ids:
+            self.enqueue(job_id)
+        if job_ids:
+            logger.info(f"Resuming {len(job_ids)} unfinished OMR jobs: {list(job_ids)}")
+
+    async def _consume(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run_job(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"OMR job {job_id} failed: {e}", exc_info=True)
+                await self._mark_failed(job_id, str(e))
+            finally:
+                self._queue.task_done()
+
+    async def _claim(self, db: AsyncSession, job_id: int) -> bool:
+        # So sánh bằng giờ của database vì heartbeat được ghi bằng CURRENT_TIMESTAMP
+        stale_before = func.current_timestamp() - timedelta(seconds=self.stale_seconds)
+        claimed = await db.execute(
+            update(OMRJob)
+            .where(and_(
+                OMRJob.maCongViec == job_id,
+                or_(
+                    OMRJob.trangThai == JOB_PENDING,
+                    and_(OMRJob.trangThai == JOB_RUNNING, OMRJob.thoiGianCapNhat < stale_before),
+                ),
+            ))
+            .values(trangThai=JOB_RUNNING, thoiGianCapNhat=func.current_timestamp())
+            .returning(OMRJob.maCongViec)
+        )
+        await db.commit()
+        return claimed.scalar_one_or_none() is not None
+
+    async def _mark_failed(self, job_id: int, error: str):
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(OMRJob).where(OMRJob.maCongViec == job_id)
+                    .values(trangThai=JOB_FAILED, thongBaoLoi=error, thoiGianHoanTat=func.current_timestamp())
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Could not mark OMR job {job_id} as failed: {e}")
+
+    async def _run_job(self, job_id: int):
+        async with AsyncSessionLocal() as db:
+            if not await self._claim(db, job_id):
+                job = await db.get(OMRJob, job_id)
+                if job and job.trangThai == JOB_RUNNING:
+                    # Đang chạy ở process khác, hoặc process cũ vừa chết nhưng heartbeat chưa hết hạn:
+                    # kiểm tra lại khi heartbeat hết hạn
+                    logger.info(f"OMR job {job_id} is running elsewhere, re-checking in {self.stale_seconds}s")
+                    asyncio.get_running_loop().call_later(self.stale_seconds, self.enqueue, job_id)
+                return
+
+            job = await db.get(OMRJob, job_id)
+            options = job.tuyChonJson or {}
+            user_id = job.maNguoiTao
+
+            from app.websocket.omr_socket import get_template_path_from_id
+            template_path = await get_template_path_from_id(job.maMauPhieu, db)
+
+            # Roster SBD được xây một lần cho cả job; SBD trùng được báo trước khi chấm
+            roster = await student_roster_index.for_exam(db, job.maBaiKiemTra)
+            if roster.collisions and user_id:
+                await WebSocketService.send_omr_progress_update(
+                    user_id=user_id,
+                    status="warning",
+                    message=f"Có {len(roster.collisions)} SBD trùng nhau giữa nhiều học sinh, cần kiểm tra thủ công",
+                    details={"job_id": job_id, "sbd_collisions": roster.collision_report()}
+                )
+
+            logger.info(f"Running OMR job {job_id}: {job.soAnhDaXuLy}/{job.tongSoAnh} images already processed")
+            while True:
+                items = (await db.execute(
+                    select(OMRJobItem)
+                    .where(and_(OMRJobItem.maCongViec == job_id, OMRJobItem.trangThai == JOB_PENDING))
+                    .order_by(OMRJobItem.thuTu)
+                    .limit(self.chunk_size)
+                )).scalars().all()
+                if not items:
+                    break
+
+                try:
+                    sheets = await self._process_chunk(items, template_path, job.maMauPhieu, options)
+                except OMRQueueFullError:
+                    # Pool đang bận với request trực tiếp: chờ rồi thử lại chunk này
+                    await asyncio.sleep(1.0)
+                    continue
+                for item, (fname, results, _) in zip(items, sheets):
+                    await self._checkpoint(db, job, item, results, options)
+                    if user_id:
+                        await WebSocketService.send_omr_progress_update(
+                            user_id=user_id,
+                            status="processing",
+                            message=f"Đã xử lý {job.soAnhDaXuLy}/{job.tongSoAnh} ảnh",
+                            progress=round(job.soAnhDaXuLy * 100 / job.tongSoAnh),
+                            details={"job_id": job_id, "filename": item.tenTapTin, "item_status": item.trangThai}
+                        )
+
+            job.trangThai = JOB_DONE
+            job.thoiGianHoanTat = datetime.utcnow()
+            await db.commit()
+            logger.info(f"OMR job {job_id} completed: {job.soAnhDaXuLy} images, {job.soAnhLoi} failed")
+            if user_id:
+                await WebSocketService.send_omr_progress_update(
+                    user_id=user_id,
+                    status="complete",
+                    message=f"Hoàn tất công việc OMR: {job.soAnhDaXuLy - job.soAnhLoi}/{job.tongSoAnh} ảnh thành công",
+                    progress=100,
+                    details={"job_id": job_id, "failed": job.soAnhLoi}
+                )
+
+    async def _process_chunk(self, items, template_path, template_id, options):
+        """Chia chunk cho các worker, trả về (fname, results, None) theo đúng thứ tự items."""
+        # Ảnh đã có trong cache kết quả (vd job chạy lại sau lỗi) không được gửi sang worker
+        return await omr_result_cache.process_batch(
+            [item.duongDanAnh for item in items], template_path,
+            template_id=template_id,
+            model_path=options.get("yolo_model") or settings.OMR_MODEL_PATH,
+            conf=options.get("confidence", 0.4),
+            auto_align=options.get("auto_align", True),
+            inference_batch_size=settings.OMR_INFERENCE_BATCH_SIZE
+        )
+
+    async def _checkpoint(self, db: AsyncSession, job: OMRJob, item: OMRJobItem, results: Dict[str, Any], options):
+        """Chấm một ảnh và commit trạng thái của ảnh cùng bộ đếm của job."""
+        error = results.get("error")
+        scoring_result = None
+        sbd = ""
+        if not error:
+            sbd = extract_sbd(results)
+            if not sbd:
+                error = "Không xác định được SBD"
+            else:
+                scoring_result = await OMRDatabaseService.score_omr_result(
+                    db, job.maBaiKiemTra, results, sbd, item.duongDanAnh,
+                    save_to_db=bool(options.get("save_results", False))
+                )
+                if not scoring_result.get("success"):
+                    error = scoring_result.get("error")
+
+        # score_omr_result có thể rollback/commit session, nạp lại trạng thái trước khi ghi
+        await db.refresh(job)
+        await db.refresh(item)
+        item.trangThai = JOB_FAILED if error else JOB_DONE
+        item.thongBaoLoi = error
+        item.ketQuaJson = {"sbd": sbd, "omr_results": results, "scoring_result": scoring_result}
+        item.thoiGianXuLy = datetime.utcnow()
+        job.soAnhDaXuLy += 1
+        if error:
+            job.soAnhLoi += 1
+        await db.commit()
+
+
+# Singleton cho toàn bộ process API
+omr_job_runner = OMRJobRunner()
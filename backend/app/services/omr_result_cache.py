@@ -0,0 +1,414 @@
+# OMR Result Cache
+
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from app.core.config import settings
+from app.omr.image_io import (
+    SheetImage, fingerprint_distance, image_name, image_path, image_stem, sheet_fingerprint
+)
+from app.omr.template import get_compiled_template
+from app.services.annotation_service import aligned_path_for
+from app.services.omr_worker_pool import omr_worker_pool
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(img) -> str:
+    """sha256 của bytes ảnh (SheetImage bytes / ndarray hoặc file trên đĩa)."""
+    data = img.data if isinstance(img, SheetImage) else None
+    if data is None:
+        digest = hashlib.sha256()
+        with open(img, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    if isinstance(data, np.ndarray):
+        return hashlib.sha256(str(data.shape).encode() + np.ascontiguousarray(data).tobytes()).hexdigest()
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read_image_data(img):
+    """Bytes / ndarray của ảnh để tính fingerprint."""
+    if isinstance(img, SheetImage):
+        return img.data
+    with open(img, "rb") as f:
+        return f.read()
+
+
+class CachedSheet(NamedTuple):
+    """Kết quả nhận dạng lấy từ cache: `aligned_path` là ảnh căn chỉnh đã lưu kèm (nếu có)."""
+    results: Dict[str, Any]
+    aligned_path: Optional[Path]
+    match: str
+
+
+class OMRResultCache:
+    """
+    Cache kết quả nhận dạng OMR trên đĩa, khóa theo sha256 của bytes ảnh cùng template (id, mtime),
+    checksum model, confidence và các cấu hình pipeline ảnh hưởng tới kết quả.
+
+    Ảnh trùng (upload lại sau lỗi, scanner gửi lại cùng phiếu) trả về ngay kết quả thô và ảnh căn chỉnh
+    đã lưu, không qua worker pool. Bật `perceptual` thì ảnh đã bị encode lại / đổi kích thước cũng khớp:
+    perceptual hash chọn ứng viên, rồi ảnh thu nhỏ được so từng vùng để một bubble tô khác cũng bị phát hiện.
+    Khi cache vượt `max_bytes`, các entry ít được dùng gần đây nhất bị xóa.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None,
+                 enabled: Optional[bool] = None, perceptual: Optional[bool] = None):
+        self.cache_dir = Path(cache_dir or os.path.join(settings.STORAGE_PATH, "omr_result_cache"))
+        self.max_bytes = settings.OMR_RESULT_CACHE_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+        self.enabled = settings.OMR_RESULT_CACHE_ENABLED if enabled is None else enabled
+        self.perceptual = settings.OMR_RESULT_CACHE_PERCEPTUAL if perceptual is None else perceptual
+        self._model_checksums: Dict[Tuple, str] = {}
+        self._phash_index: Dict[str, List[Tuple[int, str]]] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._writes_since_prune = 0
+        self.hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+
+    # --- Khóa ---
+
+    def _model_checksum(self, model_path: Optional[str]) -> str:
+        path = model_path or settings.OMR_MODEL_PATH
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return f"missing:{path}"
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self._model_checksums:
+            with open(path, "rb") as f:
+                self._model_checksums[key] = hashlib.sha256(f.read()).hexdigest()
+        return self._model_checksums[key]
+
+    def _context_key(self, template_path: str, template_id, model_path, conf: float, auto_align: bool) -> str:
+        template = get_compiled_template(template_path, template_id)
+        payload = {
+            "template": [template_id, template.source_path, template.mtime],
+            "model": self._model_checksum(model_path),
+            "conf": round(float(conf), 4),
+            "auto_align": bool(auto_align),
+            # Backend suy luận đổi kết quả (letterbox, làm tròn khác nhau); số thread ONNX thì không
+            "pipeline": [settings.OMR_LEAN_PIPELINE, settings.OMR_CASCADE_ENABLED, settings.OMR_ALIGNMENT_MODE,
+                         settings.OMR_MARKER_ALIGNMENT, settings.OMR_MARKER_MIN_CONFIDENCE,
+                         settings.OMR_INFERENCE_BACKEND],
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+    async def context_key(self, template_path: str, template_id=None, model_path=None, conf: float = 0.4,
+                          auto_align: bool = True) -> str:
+        """Khóa của mọi tham số ngoài ảnh; checksum model chỉ tính lại khi file model thay đổi."""
+        return await asyncio.to_thread(self._context_key, template_path, template_id, model_path, conf, auto_align)
+
+    def _entry_path(self, key: str, suffix: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}{suffix}"
+
+    # --- Đọc ---
+
+    def _phash_entries(self, context: str) -> List[Tuple[int, str]]:
+        entries = self._phash_index.get(context)
+        if entries is None:
+            entries = []
+            index_path = self.cache_dir / "phash" / f"{context}.txt"
+            if index_path.exists():
+                for line in index_path.read_text().splitlines():
+                    phash, _, key = line.partition(" ")
+                    if key:
+                        entries.append((int(phash, 16), key))
+            self._phash_index[context] = entries
+        return entries
+
+    def _load(self, key: str, match: str) -> Optional[CachedSheet]:
+        entry_path = self._entry_path(key, ".json")
+        try:
+            with open(entry_path, encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(entry_path)  # đánh dấu vừa dùng cho LRU
+        except (OSError, ValueError):
+            return None
+        aligned_path = self._entry_path(key, ".jpg")
+        return CachedSheet(entry["results"], aligned_path if aligned_path.exists() else None, match)
+
+    def _lookup(self, context: str, digest: str, img) -> Tuple[Optional[CachedSheet], Optional[tuple]]:
+        """(entry nếu có, fingerprint đã tính để dùng lại khi lưu)."""
+        cached = self._load(f"{context}{digest}", "exact")
+        if cached is not None or not self.perceptual:
+            return cached, None
+        try:
+            fingerprint = sheet_fingerprint(_read_image_data(img))
+        except (OSError, ValueError, cv2.error) as e:
+            logger.warning(f"Không tính được perceptual hash của {image_name(img)}, bỏ qua cache: {e}")
+            return None, None
+        if fingerprint is None:
+            return None, None
+        phash, thumb = fingerprint
+        for candidate_hash, key in self._phash_entries(context):
+            if bin(candidate_hash ^ phash).count("1") > settings.OMR_RESULT_CACHE_PHASH_DISTANCE:
+                continue
+            candidate_thumb = cv2.imread(str(self._entry_path(key, ".png")), cv2.IMREAD_GRAYSCALE)
+            if candidate_thumb is None or fingerprint_distance(thumb, candidate_thumb) > settings.OMR_RESULT_CACHE_MAX_DIFF:
+                continue
+            cached = self._load(key, "perceptual")
+            if cached is not None:
+                return cached, fingerprint
+        return None, fingerprint
+
+    def _try_lookup(self, context: str, img) -> Tuple[Optional[str], Optional[CachedSheet], Optional[tuple]]:
+        """
+        (digest, entry, fingerprint) của một ảnh; ảnh không đọc được (file đã bị xóa, không decode được)
+        là cache miss với digest None, để worker trả lỗi của riêng ảnh đó như khi không có cache.
+        """
+        try:
+            digest = content_hash(img)
+        except OSError as e:
+            logger.warning(f"Không đọc được ảnh {image_name(img)}, bỏ qua cache: {e}")
+            return None, None, None
+        cached, fingerprint = self._lookup(context, digest, img)
+        return digest, cached, fingerprint
+
+    # --- Ghi ---
+
+    def _store(self, context: str, digest: str, img, results: Dict[str, Any], aligned=None, fingerprint=None):
+        key = f"{context}{digest}"
+        entry_path = self._entry_path(key, ".json")
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(aligned, np.ndarray):
+            cv2.imwrite(str(self._entry_path(key, ".jpg")), aligned,
+                        [cv2.IMWRITE_JPEG_QUALITY, settings.OMR_ANNOTATION_JPEG_QUALITY])
+        elif isinstance(aligned, bytes):
+            self._entry_path(key, ".jpg").write_bytes(aligned)
+        elif aligned is not None and os.path.exists(aligned):
+            shutil.copyfile(aligned, self._entry_path(key, ".jpg"))
+        if self.perceptual:
+            fingerprint = fingerprint or sheet_fingerprint(_read_image_data(img))
+            if fingerprint is not None:
+                cv2.imwrite(str(self._entry_path(key, ".png")), fingerprint[1])
+                index_dir = self.cache_dir / "phash"
+                index_dir.mkdir(parents=True, exist_ok=True)
+                with open(index_dir / f"{context}.txt", "a") as f:
+                    f.write(f"{fingerprint[0]:016x} {key}\n")
+                self._phash_entries(context).append((fingerprint[0], key))
+        tmp_path = entry_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"results": results}, f, ensure_ascii=False)
+        os.replace(tmp_path, entry_path)
+
+        self._writes_since_prune += 1
+        if self._writes_since_prune >= 100:
+            self._writes_since_prune = 0
+            self.prune()
+
+    def prune(self) -> int:
+        """Xóa entry dùng lâu nhất cho tới khi cache dưới `max_bytes`, trả về số entry đã xóa."""
+        if not self.max_bytes or not self.cache_dir.exists():
+            return 0
+        entries = []
+        total = 0
+        for entry_path in self.cache_dir.glob("*/*.json"):
+            files = [entry_path.with_suffix(suffix) for suffix in (".json", ".jpg", ".png")]
+            try:
+                last_used = entry_path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            size = sum(f.stat().st_size for f in files if f.exists())
+            entries.append((last_used, size, files))
+            total += size
+        removed = 0
+        for _, size, files in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            for f in files:
+                try:
+                    f.unlink()
+                except FileNotFoundError:
+                    pass
+            total -= size
+            removed += 1
+        if removed:
+            # Entry bị xóa vẫn có thể còn trong index perceptual hash; _load bỏ qua các entry đó
+            logger.info(f"Pruned {removed} cached OMR results")
+        return removed
+
+    # --- Xử lý phiếu qua cache ---
+
+    @staticmethod
+    def _as_hit(img, cached: CachedSheet) -> Tuple[str, Dict[str, Any]]:
+        fname = image_stem(img)
+        results = copy.deepcopy(cached.results)
+        metadata = results.setdefault("_metadata", {})
+        metadata["filename"] = fname
+        metadata["cache_hit"] = cached.match
+        return fname, results
+
+    def _count(self, cached: Optional[CachedSheet]):
+        if cached is None:
+            self.misses += 1
+        elif cached.match == "perceptual":
+            self.perceptual_hits += 1
+        else:
+            self.hits += 1
+
+    async def process_sheet(self, img: SheetImage, template_path: str, template_id=None, model_path=None,
+                            conf: float = 0.4, auto_align: bool = True, return_aligned: bool = True,
+                            jpeg_quality: int = 0, annotation_keys: Optional[Dict[str, Dict]] = None):
+        """
+        Như process_sheet_job chạy qua worker pool (save_files=False), trả về (fname, results, aligned_image).
+        Ảnh đã có trong cache thì không gửi sang worker; request trùng đang xử lý dùng chung một lần chạy.
+        Với `jpeg_quality`, phần tử thứ ba là EncodedSheet (JPEG ảnh căn chỉnh, kèm annotation theo
+        `annotation_keys`) thay vì mảng ảnh, kể cả khi lấy từ cache.
+        """
+        from app.omr.jobs import process_sheet_job
+
+        def run():
+            return omr_worker_pool.run(
+                process_sheet_job, img, template_path, template_id=template_id, model_path=model_path,
+                conf=conf, auto_align=auto_align, save_files=False, return_aligned=True,
+                jpeg_quality=jpeg_quality, annotation_keys=annotation_keys
+            )
+
+        if not self.enabled:
+            fname, results, aligned = await run()
+            return fname, results, aligned if return_aligned else None
+
+        context = await self.context_key(template_path, template_id, model_path, conf, auto_align)
+        try:
+            digest = await asyncio.to_thread(content_hash, img)
+        except OSError as e:
+            logger.warning(f"Không đọc được ảnh {image_name(img)}, bỏ qua cache: {e}")
+            self.misses += 1
+            fname, results, aligned = await run()
+            return fname, results, aligned if return_aligned else None
+        # Request trùng chỉ dùng chung kết quả khi cùng dạng ảnh trả về
+        output = json.dumps([jpeg_quality, annotation_keys], sort_keys=True, default=str)
+        key = f"{context}{digest}:{hashlib.sha256(output.encode()).hexdigest()[:16]}"
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._process_one(
+                context, digest, img, run, template_path, template_id, jpeg_quality, annotation_keys
+            ))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        results, aligned = await asyncio.shield(future)
+        fname = image_stem(img) if "error" not in results else image_name(img)
+        if "_metadata" in results:
+            results = copy.deepcopy(results)
+            results["_metadata"]["filename"] = fname
+        return fname, results, aligned if return_aligned else None
+
+    async def _process_one(self, context: str, digest: str, img, run, template_path: str, template_id=None,
+                           jpeg_quality: int = 0, annotation_keys: Optional[Dict[str, Dict]] = None):
+        cached, fingerprint = await asyncio.to_thread(self._lookup, context, digest, img)
+        self._count(cached)
+        if cached is not None:
+            _, results = self._as_hit(img, cached)
+            if not cached.aligned_path:
+                return results, None
+            if jpeg_quality:
+                return results, await self._encoded_hit(cached, results, template_path, template_id,
+                                                        jpeg_quality, annotation_keys)
+            return results, await asyncio.to_thread(cv2.imread, str(cached.aligned_path))
+        _, results, aligned = await run()
+        if results and "error" not in results:
+            stored = aligned.aligned_jpeg if jpeg_quality and aligned is not None else aligned
+            try:
+                await asyncio.to_thread(self._store, context, digest, img, results, stored, fingerprint)
+            except (OSError, cv2.error) as e:
+                logger.warning(f"Không lưu được kết quả của {image_name(img)} vào cache: {e}")
+        return results, aligned
+
+    @staticmethod
+    async def _encoded_hit(cached: CachedSheet, results: Dict[str, Any], template_path: str, template_id,
+                           jpeg_quality: int, annotation_keys: Optional[Dict[str, Dict]]):
+        """EncodedSheet cho phiếu lấy từ cache: JPEG đã lưu dùng nguyên, annotation vẽ trong worker."""
+        from app.omr.jobs import EncodedSheet, render_annotation_job
+
+        aligned_jpeg = await asyncio.to_thread(cached.aligned_path.read_bytes)
+        annotated = None
+        if annotation_keys is not None:
+            ma_de = str(results.get("_metadata", {}).get("ma_de", ""))
+            annotated = await omr_worker_pool.run(
+                render_annotation_job, None, str(cached.aligned_path), template_path, template_id,
+                student_results=results, answer_key=annotation_keys.get(ma_de, {}), jpeg_quality=jpeg_quality
+            )
+        return EncodedSheet(aligned_jpeg, annotated)
+
+    async def process_batch(self, imgs: List[Any], template_path: str, template_id=None, model_path=None,
+                            conf: float = 0.4, auto_align: bool = True, save_files: bool = False,
+                            inference_batch_size: Optional[int] = None):
+        """
+        Như process_batch_job chia cho các worker, trả về list (fname, results, None) đúng thứ tự `imgs`.
+        Chỉ ảnh chưa có trong cache được gửi sang worker; với save_files, ảnh căn chỉnh của phiếu lấy từ
+        cache được chép về aligned_results cạnh ảnh gốc như khi pipeline tự lưu.
+        """
+        from app.omr.jobs import process_batch_job
+
+        batch_size = inference_batch_size or settings.OMR_INFERENCE_BATCH_SIZE
+        sheets: List[Optional[tuple]] = [None] * len(imgs)
+        misses = list(range(len(imgs)))
+        lookups = {}
+        if self.enabled:
+            context = await self.context_key(template_path, template_id, model_path, conf, auto_align)
+            misses = []
+            for i, img in enumerate(imgs):
+                digest, cached, fingerprint = await asyncio.to_thread(self._try_lookup, context, img)
+                self._count(cached)
+                if cached is None:
+                    misses.append(i)
+                    if digest is not None:
+                        lookups[i] = (digest, fingerprint)
+                    continue
+                fname, results = self._as_hit(img, cached)
+                source_path = image_path(img)
+                if save_files and source_path and cached.aligned_path:
+                    target = aligned_path_for(Path(source_path))
+                    await asyncio.to_thread(lambda: (target.parent.mkdir(parents=True, exist_ok=True),
+                                                     shutil.copyfile(cached.aligned_path, target)))
+                sheets[i] = (fname, results, None)
+
+        if misses:
+            parts = max(1, min(omr_worker_pool.workers, len(misses)))
+            size = -(-len(misses) // parts)
+            chunks = [misses[start:start + size] for start in range(0, len(misses), size)]
+            chunk_results = await asyncio.gather(*[
+                omr_worker_pool.run(
+                    process_batch_job, [imgs[i] for i in chunk], template_path,
+                    template_id=template_id, model_path=model_path, conf=conf, auto_align=auto_align,
+                    save_files=save_files, inference_batch_size=batch_size, return_aligned=False
+                )
+                for chunk in chunks
+            ])
+            for chunk, results_list in zip(chunks, chunk_results):
+                for i, sheet in zip(chunk, results_list):
+                    sheets[i] = sheet
+
+            for i in lookups:
+                _, results, _ = sheets[i]
+                if not results or "error" in results:
+                    continue
+                digest, fingerprint = lookups[i]
+                source_path = image_path(imgs[i])
+                aligned = aligned_path_for(Path(source_path)) if save_files and source_path else None
+                try:
+                    await asyncio.to_thread(self._store, context, digest, imgs[i], results, aligned, fingerprint)
+                except (OSError, cv2.error) as e:
+                    logger.warning(f"Không lưu được kết quả của {image_name(imgs[i])} vào cache: {e}")
+        return sheets
+
+    def stats(self) -> Dict:
+        return {"enabled": self.enabled, "perceptual": self.perceptual, "hits": self.hits,
+                "perceptual_hits": self.perceptual_hits, "misses": self.misses}
+
+
+# Singleton cho toàn bộ process API
+omr_result_cache = OMRResultCache()
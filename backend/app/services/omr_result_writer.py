@@ -0,0 +1,196 @@
+# OMR Result Writer
+
+import logging
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, literal_column, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.exam import AnswerSheet, Result
+from app.services.exam_rollup_service import ExamRollupService, ScoreChange
+
+logger = logging.getLogger(__name__)
+
+# Số dòng mỗi câu INSERT, giữ số tham số bind dưới giới hạn 32767 của PostgreSQL
+UPSERT_CHUNK_SIZE = 500
+
+OUTCOME_INSERTED = "inserted"
+OUTCOME_UPDATED = "updated"
+# Cùng học sinh xuất hiện nhiều lần trong batch: dòng sau ghi đè, dòng trước không được ghi
+OUTCOME_SUPERSEDED = "superseded"
+
+
+class SheetResultRow(NamedTuple):
+    """Phiếu đã chấm của một học sinh, sẵn sàng ghi vào PHIEUTRALOI và KETQUA"""
+    exam_id: int
+    student_id: int
+    student_answers: Dict[str, Any]
+    total_score: float
+    correct_count: int
+    wrong_count: int
+    blank_count: int
+    details: List[Dict[str, Any]]
+    image_path: Optional[str] = None
+    annotated_image_path: Optional[str] = None
+    scanner_user_id: Optional[int] = None
+
+
+def _chunks(items: List, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def upsert_sheet_results(db: AsyncSession, rows: List[SheetResultRow],
+                               update_statistics: bool = True) -> List[Dict[str, Any]]:
+    """
+    Ghi phiếu trả lời và kết quả của cả batch bằng INSERT ... ON CONFLICT (maBaiKiemTra, maHocSinh).
+
+    Không commit: caller quyết định transaction. Trả về kết quả từng dòng theo thứ tự đầu vào
+    gồm answer_sheet_id, result_id và status (inserted / updated / superseded).
+    Với update_statistics, thống kê THONGKEKIEMTRA của các (bài thi, lớp) bị ảnh hưởng được cập nhật
+    tăng dần trong cùng transaction.
+    """
+    # Dòng cuối cùng của mỗi học sinh thắng, giống như ghi tuần tự từng phiếu
+    latest: Dict[Tuple[int, int], int] = {}
+    for index, row in enumerate(rows):
+        latest[(row.exam_id, row.student_id)] = index
+    unique_rows = [rows[index] for index in sorted(latest.values())]
+
+    sheet_ids: Dict[Tuple[int, int], Tuple[int, bool]] = {}
+    for chunk in _chunks(unique_rows, UPSERT_CHUNK_SIZE):
+        stmt = pg_insert(AnswerSheet).values([
+            {
+                "maBaiKiemTra": row.exam_id,
+                "maHocSinh": row.student_id,
+                "maNguoiQuet": row.scanner_user_id,
+                "urlHinhAnh": row.image_path,
+                "urlHinhAnhXuLy": row.annotated_image_path,
+                "cauTraLoiJson": row.student_answers,
+                "daXuLyHoanTat": True,
+                "doTinCay": 95.0,
+            }
+            for row in chunk
+        ])
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_phieutraloi_mabkt_mahs",
+            set_={
+                "cauTraLoiJson": stmt.excluded.cauTraLoiJson,
+                "daXuLyHoanTat": True,
+                "urlHinhAnh": stmt.excluded.urlHinhAnh,
+                "urlHinhAnhXuLy": stmt.excluded.urlHinhAnhXuLy,
+                # Chỉ đổi người quét khi batch có người quét
+                "maNguoiQuet": func.coalesce(stmt.excluded.maNguoiQuet, AnswerSheet.maNguoiQuet),
+                "thoiGianCapNhat": func.current_timestamp(),
+            }
+        ).returning(
+            AnswerSheet.maBaiKiemTra, AnswerSheet.maHocSinh, AnswerSheet.maPhieuTraLoi,
+            # xmax = 0 chỉ đúng với dòng vừa được INSERT
+            literal_column("(xmax = 0)").label("inserted")
+        )
+        for exam_id, student_id, sheet_id, inserted in (await db.execute(stmt)).all():
+            sheet_ids[(exam_id, student_id)] = (sheet_id, inserted)
+
+    # Điểm cũ phải được đọc trước khi KETQUA bị ghi đè
+    previous: Dict[Tuple[int, int], Tuple[Optional[int], Optional[Decimal]]] = {}
+    if update_statistics:
+        students_by_exam: Dict[int, List[int]] = {}
+        for row in unique_rows:
+            students_by_exam.setdefault(row.exam_id, []).append(row.student_id)
+        for exam_id, student_ids in students_by_exam.items():
+            for chunk in _chunks(student_ids, UPSERT_CHUNK_SIZE):
+                for student_id, value in (await ExamRollupService.previous_scores(db, exam_id, chunk)).items():
+                    previous[(exam_id, student_id)] = value
+
+    result_ids: Dict[Tuple[int, int], int] = {}
+    for chunk in _chunks(unique_rows, UPSERT_CHUNK_SIZE):
+        stmt = pg_insert(Result).values([
+            {
+                "maPhieuTraLoi": sheet_ids[(row.exam_id, row.student_id)][0],
+                "maBaiKiemTra": row.exam_id,
+                "maHocSinh": row.student_id,
+                "diem": Decimal(str(round(row.total_score, 2))),
+                "soCauDung": row.correct_count,
+                "soCauSai": row.wrong_count,
+                "soCauChuaTraLoi": row.blank_count,
+                "chiTietJson": row.details,
+            }
+            for row in chunk
+        ])
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_ketqua_mabkt_mahs",
+            set_={
+                "maPhieuTraLoi": stmt.excluded.maPhieuTraLoi,
+                "diem": stmt.excluded.diem,
+                "soCauDung": stmt.excluded.soCauDung,
+                "soCauSai": stmt.excluded.soCauSai,
+                "soCauChuaTraLoi": stmt.excluded.soCauChuaTraLoi,
+                "chiTietJson": stmt.excluded.chiTietJson,
+                "thoiGianCapNhat": func.current_timestamp(),
+            }
+        ).returning(Result.maBaiKiemTra, Result.maHocSinh, Result.maKetQua)
+        for exam_id, student_id, result_id in (await db.execute(stmt)).all():
+            result_ids[(exam_id, student_id)] = result_id
+
+    if update_statistics:
+        changes = []
+        for row in unique_rows:
+            class_id, old_score = previous.get((row.exam_id, row.student_id), (None, None))
+            changes.append(ScoreChange(row.exam_id, class_id, old_score, Decimal(str(round(row.total_score, 2)))))
+        await ExamRollupService.apply(db, changes)
+
+    outcomes = []
+    for index, row in enumerate(rows):
+        key = (row.exam_id, row.student_id)
+        sheet_id, inserted = sheet_ids[key]
+        if latest[key] != index:
+            status = OUTCOME_SUPERSEDED
+        else:
+            status = OUTCOME_INSERTED if inserted else OUTCOME_UPDATED
+        outcomes.append({
+            "student_id": row.student_id,
+            "answer_sheet_id": sheet_id,
+            "result_id": result_ids.get(key),
+            "status": status,
+        })
+    logger.info(
+        f"Upserted {len(unique_rows)} answer sheets/results "
+        f"({sum(1 for o in outcomes if o['status'] == OUTCOME_INSERTED)} new, {len(rows) - len(unique_rows)} superseded)"
+    )
+    return outcomes
+
+
+async def update_result_scores(db: AsyncSession, scores: List[Dict[str, Any]],
+                               update_statistics: bool = True) -> int:
+    """
+    Cập nhật điểm của các KETQUA đã có theo khóa chính (executemany một câu UPDATE), không commit.
+    Mỗi phần tử gồm maKetQua, total_score, correct_count, wrong_count, blank_count, details.
+    """
+    if not scores:
+        return 0
+    previous = {}
+    if update_statistics:
+        previous = await ExamRollupService.previous_scores_by_result(db, [score["maKetQua"] for score in scores])
+    now = datetime.utcnow()
+    await db.execute(update(Result), [
+        {
+            "maKetQua": score["maKetQua"],
+            "diem": Decimal(str(round(score["total_score"], 2))),
+            "soCauDung": score["correct_count"],
+            "soCauSai": score["wrong_count"],
+            "soCauChuaTraLoi": score["blank_count"],
+            "chiTietJson": score["details"],
+            "thoiGianCapNhat": now,
+        }
+        for score in scores
+    ])
+    if update_statistics:
+        changes = []
+        for score in scores:
+            if score["maKetQua"] in previous:
+                exam_id, class_id, old_score = previous[score["maKetQua"]]
+                changes.append(ScoreChange(exam_id, class_id, old_score, Decimal(str(round(score["total_score"], 2)))))
+        await ExamRollupService.apply(db, changes)
+    return len(scores)
@@ -21,18 +21,30 @@ from app.models.exam import Exam, Result, AnswerSheet
 from app.models.class_room import ClassRoom
 import re
 from sqlalchemy import func
-from decimal import Decimal
 from app.models.user import User
 from app.models import Student, ClassRoom, ExamClassRoom, AnswerSheet, Result, Exam, Answer, User
 from sqlalchemy import select, func, and_, desc, asc
 from sqlalchemy.orm import aliased, joinedload
 from sqlalchemy.ext.asyncio import AsyncSession
-from datetime import datetime
 
 from app.services.websocket_service import WebSocketService
+from app.services.student_roster_index import student_roster_index, normalize_sbd, RosterStudent
+from app.services.answer_key_cache import answer_key_cache
+from app.services.batch_scorer import score_answers, score_answers_batch
+from app.services.omr_result_writer import SheetResultRow, upsert_sheet_results
 
 logger = logging.getLogger(__name__)
 
+
+def storage_relative_path(physical_path: Optional[str]) -> Optional[str]:
+    """Đường dẫn ảnh lưu trong DB: tương đối so với STORAGE_PATH nếu nằm trong đó."""
+    if not physical_path:
+        return None
+    try:
+        return str(Path(physical_path).relative_to(Path(settings.STORAGE_PATH)))
+    except ValueError:
+        return physical_path
+
 class OMRService:
     """Service để tích hợp với OMRChecker"""
     
@@ -310,30 +322,15 @@ class OMRService:
             return numbers_only[-6:]
         return numbers_only if numbers_only else None
     
-    async def match_student_by_sbd(self, db: AsyncSession, sbd: str, class_id: Optional[int] = None) -> Optional[Student]:
+    async def match_student_by_sbd(self, db: AsyncSession, sbd: str, class_id: Optional[int] = None) -> Optional[RosterStudent]:
         """
         Match học sinh dựa trên 6 số cuối của mã học sinh (maHocSinhTruong).
         """
         if not sbd:
             return None
-            
-        stmt = select(Student)
         if class_id:
-            stmt = stmt.where(Student.maLopHoc == class_id)
-            
-        # Tối ưu hóa query bằng cách chỉ tìm các mã có độ dài >= 6
-        stmt = stmt.where(func.length(Student.maHocSinhTruong) >= 6)
-
-        result = await db.execute(stmt)
-        students = result.scalars().all()
-        
-        for student in students:
-            # Lấy 6 ký tự cuối của maHocSinhTruong
-            student_code_suffix = student.maHocSinhTruong[-6:]
-            if student_code_suffix == sbd:
-                return student
-                
-        return None
+            return (await student_roster_index.for_class(db, class_id)).lookup(sbd)
+        return await student_roster_index.query_by_sbd(db, sbd)
     
     async def process_and_match_batch(
         self,
@@ -665,123 +662,9 @@ class OMRDatabaseService:
             score_key: Dict[question_id, score_points]
         """
         try:
-            # Lấy đáp án từ bảng DAPAN
-            stmt = select(Answer).where(Answer.maBaiKiemTra == exam_id)
-            result = await db.execute(stmt)
-            answer_obj = result.scalars().first()
-            
-            if not answer_obj:
-                raise ValueError(f"Không tìm thấy đáp án cho bài kiểm tra ID: {exam_id}")
-            
-            # Parse JSON data với error handling
-            answer_key = {}
-            score_key = {}
-            
-            if answer_obj.dapAnJson:
-                try:
-                    # Đảm bảo dapAnJson là dict, không phải string
-                    if isinstance(answer_obj.dapAnJson, str):
-                        # Nếu là string, parse JSON
-                        dap_an_data = json.loads(answer_obj.dapAnJson)
-                    elif isinstance(answer_obj.dapAnJson, dict):
-                        # Nếu đã là dict, sử dụng trực tiếp
-                        dap_an_data = answer_obj.dapAnJson
-                    else:
-                        # Nếu là type khác, convert sang string rồi parse
-                        dap_an_data = json.loads(str(answer_obj.dapAnJson))
-                    
-                    # Kiểm tra format đáp án
-                    if isinstance(dap_an_data, dict):
-                        if ma_de and ma_de in dap_an_data:
-                            answers_for_ma_de = dap_an_data[ma_de]
-                            for q_id, answer in answers_for_ma_de.items():
-                                answer_key[str(q_id)] = str(answer)
-                            logging.info(f"Using answer key for mã đề: {ma_de}")
-                        elif len(dap_an_data) == 1:
-                            first_ma_de = next(iter(dap_an_data.keys()))
-                            if first_ma_de.isdigit():
-                                answers_for_ma_de = dap_an_data[first_ma_de]
-                                for q_id, answer in answers_for_ma_de.items():
-                                    answer_key[str(q_id)] = str(answer)
-                                logging.info(f"Auto-selected mã đề: {first_ma_de} (only option)")
-                            else:
-                                for q_id, answer in dap_an_data.items():
-                                    answer_key[str(q_id)] = str(answer)
-                                logging.info("Using direct answer format")
-                        elif not ma_de and len(dap_an_data) > 1:
-                            first_ma_de = next(iter(dap_an_data.keys()))
-                            if all(k.isdigit() for k in dap_an_data.keys()):
-                                # Tất cả key đều là số - format theo mã đề
-                                answers_for_ma_de = dap_an_data[first_ma_de]
-                                for q_id, answer in answers_for_ma_de.items():
-                                    answer_key[str(q_id)] = str(answer)
-                                logging.warning(f"Cannot detect mã đề, using first available: {first_ma_de}")
-                            else:
-                                # Format cũ
-                                for q_id, answer in dap_an_data.items():
-                                    answer_key[str(q_id)] = str(answer)
-                                logging.info("Using direct answer format (fallback)")
-                        else:
-                            # Format cũ: {"1": "A", "2": "B", ...} - trực tiếp
-                            if all(isinstance(v, str) for v in dap_an_data.values()):
-                                for q_id, answer in dap_an_data.items():
-                                    answer_key[str(q_id)] = str(answer)
-                                logging.info("Using legacy direct format")
-                            else:
-                                # Thử lấy đề đầu tiên nếu có thể
-                                if dap_an_data:
-                                    first_key = next(iter(dap_an_data.keys()))
-                                    first_value = dap_an_data[first_key]
-                                    if isinstance(first_value, dict):
-                                        for q_id, answer in first_value.items():
-                                            answer_key[str(q_id)] = str(answer)
-                                        logging.warning(f"Using fallback format with key: {first_key}")
-                                    else:
-                                        raise ValueError(f"Cannot parse answer format. Available keys: {list(dap_an_data.keys())}")
-                    
-                except (json.JSONDecodeError, TypeError, UnicodeDecodeError) as e:
-                    logging.error(f"Error parsing dapAnJson: {e}")
-                    raise ValueError(f"Lỗi parse đáp án JSON: {str(e)}")
-            
-            if answer_obj.diemMoiCauJson:
-                try:
-                    # Đảm bảo diemMoiCauJson là dict
-                    if isinstance(answer_obj.diemMoiCauJson, str):
-                        diem_data = json.loads(answer_obj.diemMoiCauJson)
-                    elif isinstance(answer_obj.diemMoiCauJson, dict):
-                        diem_data = answer_obj.diemMoiCauJson
-                    else:
-                        diem_data = json.loads(str(answer_obj.diemMoiCauJson))
-                    
-                    for q_id, score in diem_data.items():
-                        score_key[str(q_id)] = float(score)
-                        
-                except (json.JSONDecodeError, TypeError, ValueError, UnicodeDecodeError) as e:
-                    logging.error(f"Error parsing diemMoiCauJson: {e}")
-                    # Fallback: tính điểm đều
-                    pass
-            
-            # Nếu không có điểm riêng hoặc lỗi parse, tính điểm đều cho tất cả câu
-            if not score_key:
-                exam_stmt = select(Exam).where(Exam.maBaiKiemTra == exam_id)
-                exam_result = await db.execute(exam_stmt)
-                exam_obj = exam_result.scalars().first()
-                
-                if exam_obj and exam_obj.tongSoCau > 0:
-                    points_per_question = float(exam_obj.tongDiem) / exam_obj.tongSoCau
-                    for q_id in answer_key.keys():
-                        score_key[q_id] = points_per_question
-                else:
-                    # Default scoring nếu không có thông tin
-                    for q_id in answer_key.keys():
-                        score_key[q_id] = 1.0
-            
-            if not answer_key:
-                raise ValueError(f"Không thể lấy được đáp án cho exam_id={exam_id}, ma_de={ma_de}")
-            
-            logging.info(f"Loaded answer key for exam {exam_id}, mã đề {ma_de}: {len(answer_key)} questions")
-            return answer_key, score_key
-            
+            # Đáp án đã parse được cache theo bài thi (xem answer_key_cache)
+            compiled = await answer_key_cache.get(db, exam_id)
+            return compiled.resolve(ma_de)
         except Exception as e:
             logging.error(f"Error loading answer key for exam {exam_id}, mã đề {ma_de}: {str(e)}")
             raise ValueError(f"Lỗi khi lấy đáp án từ database: {str(e)}")
@@ -791,68 +674,24 @@ class OMRDatabaseService:
         db: AsyncSession,
         exam_id: int,
         sbd: str
-    ) -> Optional[Student]:
+    ) -> Optional[RosterStudent]:
         """
         Tìm học sinh theo số báo danh (6 số cuối của mã học sinh trường).
-        Hàm này sẽ tự động trích xuất và làm sạch SBD để chỉ lấy 6 số cuối.
+        Tra trong roster của bài thi (chỉ query database một lần cho mỗi batch / phiên quét).
         """
         try:
-            # --- START FIX: Làm sạch SBD đầu vào ---
-            if not sbd or not isinstance(sbd, str):
-                return None
-            
-            import re
-            sbd_cleaned = re.sub(r'[^\d]', '', sbd)
-            
-            # Nếu SBD nhận dạng được dài hơn 6 số, chỉ lấy 6 số cuối
-            if len(sbd_cleaned) > 6:
-                sbd_to_find = sbd_cleaned[-6:]
-            else:
-                sbd_to_find = sbd_cleaned
-                
-            if not sbd_to_find:
+            if not normalize_sbd(sbd):
                 logging.warning(f"SBD '{sbd}' sau khi làm sạch không còn ký tự số.")
                 return None
-            # --- END FIX ---
-            
-            logging.info(f"🔍 DEBUGGING: Searching for SBD '{sbd_to_find}' (original: '{sbd}') in exam {exam_id}")
-            
-            # Lấy danh sách lớp tham gia bài kiểm tra
-            from app.models.exam import ExamClassRoom
-            
-            stmt = select(Student).join(
-                ClassRoom, Student.maLopHoc == ClassRoom.maLopHoc
-            ).join(
-                ExamClassRoom, ClassRoom.maLopHoc == ExamClassRoom.maLopHoc
-            ).where(
-                and_(
-                    ExamClassRoom.maBaiKiemTra == exam_id,
-                    Student.maHocSinhTruong.like(f"%{sbd_to_find}"),  # Tìm SBD đã được làm sạch
-                    Student.trangThai == True
-                )
-            )
-            
-            result = await db.execute(stmt)
-            students = result.scalars().all()
-            
-            # Lọc chính xác 6 số cuối
-            matching_students = []
-            for student in students:
-                if student.maHocSinhTruong and len(student.maHocSinhTruong) >= 6:
-                    last_6_digits = student.maHocSinhTruong[-6:]
-                    if last_6_digits == sbd_to_find: # So sánh với SBD đã được làm sạch
-                        matching_students.append(student)
-            
-            if len(matching_students) == 1:
-                logging.info(f"Found student {matching_students[0].hoTen} for SBD {sbd_to_find}")
-                return matching_students[0]
-            elif len(matching_students) > 1:
-                logging.warning(f"Multiple students found for SBD {sbd_to_find}")
-                return matching_students[0]  # Return first match
+
+            roster = await student_roster_index.for_exam(db, exam_id)
+            student = roster.lookup(sbd)
+            if student:
+                logging.info(f"Found student {student.hoTen} for SBD {sbd}")
             else:
-                logging.warning(f"No student found for SBD {sbd_to_find}")
-                return None
-                
+                logging.warning(f"No student found for SBD {sbd} in exam {exam_id}")
+            return student
+
         except Exception as e:
             logging.error(f"Error finding student by SBD {sbd}: {str(e)}")
             return None
@@ -873,6 +712,47 @@ class OMRDatabaseService:
         
         return ma_hoc_sinh_truong[-6:]
     
+    @staticmethod
+    async def resolve_answer_key(
+        db: AsyncSession,
+        exam_id: int,
+        ma_de: Optional[str]
+    ) -> Tuple[Optional[str], Dict[str, str], Dict[str, float]]:
+        """
+        Lấy đáp án cho mã đề nhận diện được, nếu không có thì dùng mã đề đầu tiên của bài thi
+        
+        Returns:
+            Tuple of (ma_de thực sự dùng, answer_key, score_key)
+        """
+        try:
+            answer_key, score_key = await OMRDatabaseService.get_answer_key_from_db(db, exam_id, ma_de)
+        except ValueError as e:
+            if "không tìm thấy mã đề" in str(e) or ma_de is None:
+                # Fallback: thử lấy đáp án với mã đề đầu tiên có sẵn
+                logging.warning(f"Fallback: trying to get any available answer key for exam {exam_id}")
+                
+                # Lấy thông tin đáp án để xem có mã đề nào
+                compiled = await answer_key_cache.get(db, exam_id)
+                
+                if compiled.answers:
+                    available_codes = compiled.codes
+                    logging.info(f"Available answer codes: {available_codes}")
+                    
+                    if available_codes and all(code.isdigit() for code in available_codes):
+                        # Thử với mã đề đầu tiên
+                        fallback_ma_de = available_codes[0]
+                        logging.warning(f"Using fallback mã đề: {fallback_ma_de}")
+                        answer_key, score_key = await OMRDatabaseService.get_answer_key_from_db(db, exam_id, fallback_ma_de)
+                        ma_de = fallback_ma_de  # Update ma_de
+                    else:
+                        # Thử với None để get format cũ
+                        answer_key, score_key = await OMRDatabaseService.get_answer_key_from_db(db, exam_id, None)
+                else:
+                    raise e
+            else:
+                raise e
+        return ma_de, answer_key, score_key
+    
     @staticmethod
     async def score_omr_result(
         db: AsyncSession,
@@ -911,69 +791,11 @@ class OMRDatabaseService:
                 )
             
             # 2. Lấy đáp án chuẩn từ database (với fallback handling)
-            try:
-                answer_key, score_key = await OMRDatabaseService.get_answer_key_from_db(db, exam_id, ma_de)
-            except ValueError as e:
-                if "không tìm thấy mã đề" in str(e) or ma_de is None:
-                    # Fallback: thử lấy đáp án với mã đề đầu tiên có sẵn
-                    logging.warning(f"Fallback: trying to get any available answer key for exam {exam_id}")
-                    
-                    # Lấy thông tin đáp án để xem có mã đề nào
-                    stmt = select(Answer).where(Answer.maBaiKiemTra == exam_id)
-                    result = await db.execute(stmt)
-                    answer_obj = result.scalars().first()
-                    
-                    if answer_obj and answer_obj.dapAnJson:
-                        available_codes = list(answer_obj.dapAnJson.keys()) if isinstance(answer_obj.dapAnJson, dict) else []
-                        logging.info(f"Available answer codes: {available_codes}")
-                        
-                        if available_codes and all(code.isdigit() for code in available_codes):
-                            # Thử với mã đề đầu tiên
-                            fallback_ma_de = available_codes[0]
-                            logging.warning(f"Using fallback mã đề: {fallback_ma_de}")
-                            answer_key, score_key = await OMRDatabaseService.get_answer_key_from_db(db, exam_id, fallback_ma_de)
-                            ma_de = fallback_ma_de  # Update ma_de
-                        else:
-                            # Thử với None để get format cũ
-                            answer_key, score_key = await OMRDatabaseService.get_answer_key_from_db(db, exam_id, None)
-                    else:
-                        raise e
-                else:
-                    raise e
+            ma_de, answer_key, score_key = await OMRDatabaseService.resolve_answer_key(db, exam_id, ma_de)
             
             # 3. Chấm điểm (Thực hiện trước khi tìm học sinh)
-            total_score = 0.0
-            correct_count = 0
-            wrong_count = 0
-            blank_count = 0
-            details = []
-            
             logging.info(f"Scoring: {len(answer_key)} questions from answer key, {len(student_answers)} student answers")
-
-            # --- LOGIC CHẤM ĐIỂM GIỮ NGUYÊN ---
-            # (Phần code tính điểm, so sánh đáp án, xử lý câu hỏi nhóm...)
-            # ... (giữ nguyên phần lặp qua answer_key để tính điểm) ...
-            # --- KẾT THÚC LOGIC CHẤM ĐIỂM ---
-            for q_id, correct_answer in answer_key.items():
-                student_answer = student_answers.get(q_id, "")
-                points = score_key.get(q_id, 0.0)
-                is_correct = student_answer.upper() == correct_answer.upper()
-                
-                if not student_answer or student_answer.strip() == "":
-                    blank_count += 1
-                elif is_correct:
-                    correct_count += 1
-                    total_score += points
-                else:
-                    wrong_count += 1
-                
-                details.append({
-                    "question_id": q_id,
-                    "student_answer": student_answer,
-                    "correct_answer": correct_answer,
-                    "is_correct": is_correct,
-                    "points": points
-                })
+            total_score, correct_count, wrong_count, blank_count, details = score_answers(answer_key, score_key, student_answers)
             
             logging.info(f"🔍 PRE-SAVE SCORE: {total_score} (Correct: {correct_count}, Wrong: {wrong_count}, Blank: {blank_count})")
 
@@ -989,67 +811,19 @@ class OMRDatabaseService:
                 )
 
             # Nếu tìm thấy học sinh VÀ được yêu cầu lưu, thì mới thực hiện ghi vào DB
+            answer_sheet_id = None
             if student and save_to_db:
-                # 4. Lưu/cập nhật AnswerSheet
-                answer_sheet_stmt = select(AnswerSheet).where(
-                    and_(
-                        AnswerSheet.maBaiKiemTra == exam_id,
-                        AnswerSheet.maHocSinh == student.maHocSinh
-                    )
-                )
-                answer_sheet_result = await db.execute(answer_sheet_stmt)
-                answer_sheet = answer_sheet_result.scalars().first()
-                
-                # Lấy đường dẫn tương đối từ đường dẫn vật lý
-                def get_relative_path(physical_path):
-                    if not physical_path: return None
-                    try:
-                        return str(Path(physical_path).relative_to(Path(settings.STORAGE_PATH)))
-                    except ValueError:
-                        return physical_path
-
-                relative_original_path = get_relative_path(image_path)
-                relative_annotated_path = annotated_image_path
-            
-                if not answer_sheet:
-                    answer_sheet = AnswerSheet(
-                            maBaiKiemTra=exam_id, maHocSinh=student.maHocSinh, maNguoiQuet=scanner_user_id,
-                            urlHinhAnh=relative_original_path, urlHinhAnhXuLy=relative_annotated_path,
-                            cauTraLoiJson=student_answers, daXuLyHoanTat=True, doTinCay=95.0
-                    )
-                    db.add(answer_sheet)
-                else:
-                    answer_sheet.cauTraLoiJson = student_answers
-                    answer_sheet.daXuLyHoanTat = True
-                    answer_sheet.urlHinhAnh = relative_original_path
-                    answer_sheet.urlHinhAnhXuLy = relative_annotated_path
-                    answer_sheet.thoiGianCapNhat = datetime.utcnow()
-                    if scanner_user_id:
-                        answer_sheet.maNguoiQuet = scanner_user_id
-            
-                await db.flush()
-            
-                # 5. Lưu/cập nhật Result
-                result_stmt = select(Result).where(and_(Result.maBaiKiemTra == exam_id, Result.maHocSinh == student.maHocSinh))
-                exam_result = (await db.execute(result_stmt)).scalars().first()
-            
-                if not exam_result:
-                    exam_result = Result(
-                            maPhieuTraLoi=answer_sheet.maPhieuTraLoi, maBaiKiemTra=exam_id, maHocSinh=student.maHocSinh,
-                            diem=Decimal(str(round(total_score, 2))), soCauDung=correct_count,
-                            soCauSai=wrong_count, soCauChuaTraLoi=blank_count, chiTietJson=details
-                    )
-                    db.add(exam_result)
-                else:
-                    exam_result.diem = Decimal(str(round(total_score, 2)))
-                    exam_result.soCauDung = correct_count
-                    exam_result.soCauSai = wrong_count
-                    exam_result.soCauChuaTraLoi = blank_count
-                    exam_result.chiTietJson = details
-                    exam_result.maPhieuTraLoi = answer_sheet.maPhieuTraLoi
-                    exam_result.thoiGianCapNhat = datetime.utcnow()
-            
+                # 4. Lưu/cập nhật AnswerSheet và Result (upsert theo bài thi + học sinh)
+                written = await upsert_sheet_results(db, [SheetResultRow(
+                    exam_id=exam_id, student_id=student.maHocSinh, student_answers=student_answers,
+                    total_score=total_score, correct_count=correct_count, wrong_count=wrong_count,
+                    blank_count=blank_count, details=details,
+                    image_path=storage_relative_path(image_path),
+                    annotated_image_path=annotated_image_path,
+                    scanner_user_id=scanner_user_id
+                )])
                 await db.commit()
+                answer_sheet_id = written[0]["answer_sheet_id"]
                 logging.info(f"Result for SBD {sbd} saved to database.")
             
             # 6. Trả về kết quả (luôn trả về, dù có tìm thấy học sinh hay không)
@@ -1066,6 +840,7 @@ class OMRDatabaseService:
                 "blank_answers": blank_count,
                 "total_questions": len(answer_key),
                 "details": details,
+                "answer_sheet_id": answer_sheet_id,
             }
             
             if scanner_user_id:
@@ -1096,6 +871,103 @@ class OMRDatabaseService:
                 "student_answers": student_answers
             }
     
+    @staticmethod
+    async def tally_batch(
+        db: AsyncSession,
+        exam_id: int,
+        answers_list: List[Dict[str, Any]]
+    ) -> List[Any]:
+        """
+        Chấm nhiều bộ câu trả lời của cùng một bài thi. Mỗi mã đề chỉ resolve đáp án một lần và các
+        phiếu cùng bộ đáp án được chấm chung một lượt bằng score_answers_batch.
+        
+        Returns:
+            List theo thứ tự đầu vào, mỗi phần tử là (ma_de, answer_key, ScoreTally) hoặc Exception
+        """
+        tallies: List[Any] = [None] * len(answers_list)
+        resolved: Dict[Optional[str], Any] = {}
+        groups: Dict[int, Dict[str, Any]] = {}
+        
+        for i, student_answers in enumerate(answers_list):
+            detected_ma_de = OMRDatabaseService.detect_ma_de_from_omr_results(student_answers)
+            if detected_ma_de not in resolved:
+                try:
+                    resolved[detected_ma_de] = await OMRDatabaseService.resolve_answer_key(db, exam_id, detected_ma_de)
+                except Exception as e:
+                    logging.error(f"Error resolving answer key for exam {exam_id}, mã đề {detected_ma_de}: {str(e)}")
+                    resolved[detected_ma_de] = e
+            form = resolved[detected_ma_de]
+            if isinstance(form, Exception):
+                tallies[i] = form
+                continue
+            
+            ma_de, answer_key, score_key = form
+            group = groups.setdefault(id(answer_key), {"answer_key": answer_key, "score_key": score_key, "rows": []})
+            group["rows"].append((i, ma_de))
+        
+        for group in groups.values():
+            rows = group["rows"]
+            scored = score_answers_batch(group["answer_key"], group["score_key"], [answers_list[i] for i, _ in rows])
+            for (i, ma_de), tally in zip(rows, scored):
+                tallies[i] = tally if isinstance(tally, Exception) else (ma_de, group["answer_key"], tally)
+        
+        logging.info(f"Scored {len(answers_list)} sheets for exam {exam_id} against {len(groups)} answer key(s)")
+        return tallies
+    
+    @staticmethod
+    async def score_batch_outcomes(
+        db: AsyncSession,
+        exam_id: int,
+        batch_results: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Chấm các phiếu của batch, trả về kết quả theo đúng thứ tự đầu vào: dict kết quả có
+        "success": True giống score_omr_result(save_to_db=False), hoặc dict lỗi filename/sbd/error.
+        """
+        outcomes: List[Optional[Dict[str, Any]]] = [None] * len(batch_results)
+        scorable = []
+        for i, omr_result in enumerate(batch_results):
+            filename = omr_result.get("filename", f"image_{i}")
+            sbd = omr_result.get("sbd", "")
+            if not sbd:
+                outcomes[i] = {"filename": filename, "sbd": sbd, "error": f"Không xác định được SBD cho ảnh: {filename}"}
+            else:
+                scorable.append(i)
+        
+        tallies = await OMRDatabaseService.tally_batch(
+            db, exam_id, [batch_results[i].get("student_answers", {}) for i in scorable]
+        )
+        for i, scored in zip(scorable, tallies):
+            omr_result = batch_results[i]
+            filename = omr_result.get("filename", f"image_{i}")
+            sbd = omr_result["sbd"]
+            try:
+                if isinstance(scored, Exception):
+                    raise scored
+                ma_de, answer_key, tally = scored
+                student = await OMRDatabaseService.find_student_by_sbd(db, exam_id, sbd)
+            except Exception as e:
+                outcomes[i] = {"filename": filename, "sbd": sbd, "error": f"Lỗi khi chấm điểm: {str(e)}"}
+                continue
+            
+            outcomes[i] = {
+                "success": True,
+                "student_id": student.maHocSinh if student else None,
+                "student_name": student.hoTen if student else None,
+                "student_code": student.maHocSinhTruong if student else None,
+                "sbd": sbd,
+                "ma_de": ma_de,
+                "total_score": round(tally.total_score, 2),
+                "correct_answers": tally.correct_count,
+                "wrong_answers": tally.wrong_count,
+                "blank_answers": tally.blank_count,
+                "total_questions": len(answer_key),
+                "details": tally.details,
+                "filename": filename,
+                "annotated_image_path": omr_result.get("annotated_image_path"),
+            }
+        return outcomes
+    
     @staticmethod
     async def batch_score_omr_results(
         db: AsyncSession,
@@ -1106,53 +978,41 @@ class OMRDatabaseService:
         """
         Chấm điểm batch, KHÔNG lưu vào database.
         Chỉ trả về kết quả đã chấm.
+        
+        Các phiếu cùng bộ đáp án được chấm chung một lượt (xem score_batch_outcomes),
+        kết quả từng phiếu giống hệt score_omr_result(save_to_db=False).
         """
         try:
             total_processed = len(batch_results)
-            successful = 0
-            failed = 0
+            outcomes = await OMRDatabaseService.score_batch_outcomes(db, exam_id, batch_results)
+            
+            # Gom kết quả theo thứ tự ảnh ban đầu
             results = []
             errors = []
-            
-            for i, omr_result in enumerate(batch_results):
-                filename = omr_result.get("filename", f"image_{i}")
-                sbd = omr_result.get("sbd", "")
+            for outcome in outcomes:
+                if outcome.get("success"):
+                    results.append(outcome)
+                else:
+                    errors.append(outcome)
                 
-                try:
-                    student_answers = omr_result.get("student_answers", {})
-                    image_path = omr_result.get("image_path")
-                    annotated_image_path = omr_result.get("annotated_image_path")
-                    
-                    if not sbd:
-                        raise ValueError(f"Không xác định được SBD cho ảnh: {filename}")
-                    
-                    result = await OMRDatabaseService.score_omr_result(
-                        db, exam_id, student_answers, sbd, image_path, scanner_user_id,
-                        annotated_image_path=annotated_image_path,
-                        save_to_db=False
-                    )
-                    
-                    if result.get("success"):
-                        successful += 1
-                        # Thêm filename và annotated_image_path vào kết quả thành công
-                        result["filename"] = filename
-                        result["annotated_image_path"] = annotated_image_path
-                        results.append(result)
+                if scanner_user_id:
+                    if outcome.get("success"):
+                        await WebSocketService.send_omr_progress_update(
+                            user_id=scanner_user_id,
+                            status="complete",
+                            message=f"Hoàn tất chấm điểm cho SBD {outcome['sbd']}. Điểm: {outcome['total_score']}",
+                            details=outcome
+                        )
                     else:
-                        failed += 1
-                        errors.append({
-                            "filename": filename,
-                            "sbd": sbd,
-                            "error": result.get('error', 'Lỗi không xác định')
-                        })
-                        
-                except Exception as e:
-                    failed += 1
-                    errors.append({
-                        "filename": filename,
-                        "sbd": sbd,
-                        "error": str(e)
-                    })
+                        await WebSocketService.send_omr_progress_update(
+                            user_id=scanner_user_id,
+                            status="error",
+                            message=f"Lỗi khi xử lý SBD {outcome['sbd']}: {outcome['error']}",
+                            details={"sbd": outcome["sbd"]}
+                        )
+            successful = len(results)
+            failed = len(errors)
+            logging.info(f"Batch scoring for exam {exam_id}: {successful} scored, {failed} failed")
             
             return {
                 "success": True,
@@ -1173,6 +1033,74 @@ class OMRDatabaseService:
                 "failed": len(batch_results)
             }
     
+    @staticmethod
+    async def save_scored_results(
+        db: AsyncSession,
+        exam_id: int,
+        items: List[Dict[str, Any]],
+        scanner_user_id: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Chấm và lưu cả batch vào PHIEUTRALOI/KETQUA trong một transaction (upsert theo học sinh).
+        
+        Args:
+            items: mỗi phần tử gồm student_answers, sbd, filename và tùy chọn image_path, annotated_image_path
+            
+        Returns:
+            {"saved": [...], "errors": [...]}: kết quả từng phiếu đã ghi (answer_sheet_id, result_id,
+            status inserted/updated/superseded) và các phiếu không lưu được
+        """
+        outcomes = await OMRDatabaseService.score_batch_outcomes(db, exam_id, items)
+        
+        rows, scored, errors = [], [], []
+        for item, outcome in zip(items, outcomes):
+            if not outcome.get("success"):
+                errors.append(outcome)
+            elif not outcome["student_id"]:
+                errors.append({
+                    "filename": outcome["filename"],
+                    "sbd": outcome["sbd"],
+                    "error": f"Không tìm thấy học sinh với SBD {outcome['sbd']} trong các lớp của bài thi"
+                })
+            else:
+                rows.append(SheetResultRow(
+                    exam_id=exam_id, student_id=outcome["student_id"], student_answers=item.get("student_answers", {}),
+                    total_score=outcome["total_score"], correct_count=outcome["correct_answers"],
+                    wrong_count=outcome["wrong_answers"], blank_count=outcome["blank_answers"],
+                    details=outcome["details"],
+                    image_path=storage_relative_path(item.get("image_path")),
+                    annotated_image_path=item.get("annotated_image_path"),
+                    scanner_user_id=scanner_user_id
+                ))
+                scored.append(outcome)
+        
+        saved = []
+        if rows:
+            try:
+                written = await upsert_sheet_results(db, rows)
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"Error saving OMR results for exam {exam_id}: {str(e)}", exc_info=True)
+                errors.extend(
+                    {"filename": o["filename"], "sbd": o["sbd"], "error": f"Lỗi khi lưu kết quả: {str(e)}"}
+                    for o in scored
+                )
+            else:
+                saved = [
+                    {
+                        "filename": o["filename"],
+                        "sbd": o["sbd"],
+                        "student_name": o["student_name"],
+                        "total_score": o["total_score"],
+                        **w
+                    }
+                    for o, w in zip(scored, written)
+                ]
+        
+        logging.info(f"Saved {len(saved)}/{len(items)} OMR results for exam {exam_id}")
+        return {"saved": saved, "errors": errors}
+    
     @staticmethod
     async def get_exam_omr_stats(
         db: AsyncSession,
@@ -1252,6 +1180,8 @@ class OMRDatabaseService:
         Lấy danh sách kết quả chi tiết của tất cả học sinh cho một bài thi.
         Bao gồm cả những học sinh chưa được chấm.
         """
+        from app.services.annotation_service import annotation_url
+
         try:
             # Lấy thông tin cơ bản của bài thi
             exam_info_stmt = select(Exam).where(Exam.maBaiKiemTra == exam_id)
@@ -1285,7 +1215,9 @@ class OMRDatabaseService:
                     Result.soCauDung,
                     Result.soCauSai,
                     AnswerSheet.thoiGianTao.label("ngayCham"),
-                    AnswerSheet.urlHinhAnhXuLy
+                    AnswerSheet.urlHinhAnhXuLy,
+                    AnswerSheet.maPhieuTraLoi,
+                    AnswerSheet.urlHinhAnh
                 )
                 .join(AnswerSheet, Result.maPhieuTraLoi == AnswerSheet.maPhieuTraLoi)
                 .where(Result.maBaiKiemTra == exam_id)
@@ -1315,6 +1247,9 @@ class OMRDatabaseService:
                         "soCauSai": result_info['soCauSai'],
                         "ngayCham": result_info['ngayCham'].isoformat() if result_info['ngayCham'] else None,
                         "urlHinhAnhXuLy": result_info['urlHinhAnhXuLy'],
+                        # Ảnh annotation render khi được mở lần đầu, cần ảnh gốc đã lưu
+                        "annotationUrl": annotation_url(f"/annotations/{result_info['maPhieuTraLoi']}")
+                            if result_info['urlHinhAnh'] else None,
                         "trangThai": "dacom"
                     })
                 else:
@@ -1327,6 +1262,7 @@ class OMRDatabaseService:
                         "soCauSai": None,
                         "ngayCham": None,
                         "urlHinhAnhXuLy": None,
+                        "annotationUrl": None,
                         "trangThai": "chuacham"
                     })
             
@@ -1365,10 +1301,8 @@ class OMRDatabaseService:
         scanner_user_id: int
     ):
         """
-        Xử lý một ảnh duy nhất từ WebSocket, lưu ảnh và tạo annotation như batch-process-with-exam.
+        Xử lý một ảnh duy nhất từ WebSocket, lưu ảnh gốc và ảnh căn chỉnh, gửi URL annotation như batch-process-with-exam.
         """
-        import tempfile
-        import os
         from pathlib import Path
         import base64
         
@@ -1394,197 +1328,170 @@ class OMRDatabaseService:
             # Đường dẫn web tương đối
             relative_storage_path = Path("ws_scans") / str(exam_id)
 
-            # 4. Lưu ảnh gốc vào file tạm thời để xử lý
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_file:
-                tmp_file.write(image_data)
-                tmp_image_path = tmp_file.name
-
-            try:
-                # 5. Load OMR components (giống batch-process-with-exam)
-                from app.websocket.omr_socket import get_template_path_from_id
-                template_path = await get_template_path_from_id(exam.maMauPhieu, db)
-                
-                from app.omr.main_pipeline import process_single_image, OMRAligner
-                from app.omr.template import load_template, get_all_bubbles
-                from ultralytics import YOLO
-                
-                template = load_template(template_path)
-                yolo_model = YOLO("app/omr/models/best.pt")
-                bubbles = get_all_bubbles(template)
-                
-                # Tạo aligner
-                aligner = None
-                template_dir = os.path.dirname(template_path)
-                ref_images = list(Path(template_dir).glob("*.png")) + list(Path(template_dir).glob("*.jpg"))
-                if ref_images:
-                    aligner = OMRAligner(
-                        ref_img_path=str(ref_images[0]),
-                        method='ORB',
-                        max_features=5000,
-                        good_match_percent=0.2,
-                        debug=False
-                    )
-
-                # 6. Load JSON answer keys (giống batch-process-with-exam)
-                exam_answer_keys = {}
-                try:
-                    from app.routes.omr import load_json_answer_keys_for_exam
-                    exam_answer_keys = await load_json_answer_keys_for_exam(db, exam_id)
-                    logging.info(f"WebSocket: Loaded {len(exam_answer_keys)} JSON answer keys")
-                except Exception as e:
-                    logging.warning(f"WebSocket: Could not load JSON answer keys: {e}")
+            # 4. Kiểm tra magic bytes trên buffer, ảnh không được ghi ra file tạm
+            from app.omr.image_io import SheetImage, persist_image, sniff_image_format
+            if sniff_image_format(image_data) is None:
+                raise ValueError("Dữ liệu nhận được không phải ảnh JPEG/PNG hợp lệ.")
 
-                # 7. Process image
-                fname, omr_results, aligned_img = process_single_image(
-                    tmp_image_path, template, yolo_model, conf=0.4, 
-                    aligner=aligner, save_files=False
-                )
+            # 5. Load OMR components (giống batch-process-with-exam)
+            from app.websocket.omr_socket import get_template_path_from_id
+            template_path = await get_template_path_from_id(exam.maMauPhieu, db)
 
-                if "error" in omr_results:
-                    raise Exception(omr_results["error"])
+            # 5b. Kiểm tra nhanh trên ảnh thu nhỏ 1/4: frame mờ, lệch phiếu, thiếu sáng hoặc thiếu marker
+            # bị loại trong vài ms kèm gợi ý, không phải trả giá căn chỉnh + inference
+            if settings.OMR_QUALITY_GATE_ENABLED:
+                from app.omr.quality import assess_frame
+                from app.omr.template import get_compiled_template
 
-                # Tạo base64 cho aligned image ngay để có thể hiển thị khi cần
-                annotated_image_base64 = None
-                if aligned_img is not None:
-                    import cv2
-                    _, buffer = cv2.imencode('.jpg', aligned_img)
-                    annotated_image_base64 = base64.b64encode(buffer).decode('utf-8')
+                def check_quality():
+                    compiled = get_compiled_template(template_path, exam.maMauPhieu)
+                    return assess_frame(image_data, compiled.quality_thresholds)
 
-                # 8. Extract SBD và mã đề với validation nghiêm ngặt
-                metadata = omr_results.get("_metadata", {})
-                sbd = metadata.get("sbd", "")
-                ma_de = metadata.get("ma_de", "")
-                
-                # Fallback SBD detection
-                if not sbd or sbd == "unknown" or not str(sbd).isdigit():
-                    for key, value in omr_results.items():
-                        if "sbd" in key.lower() and value and str(value).isdigit() and str(value) != "unknown":
-                            sbd = str(value)
-                            break
-                
-                # ❌ DỪNG XỬ LÝ NẾU KHÔNG NHẬN DIỆN ĐƯỢC SBD
-                if not sbd or sbd == "unknown" or not str(sbd).isdigit() or len(str(sbd)) < 4:
-                    # DEBUG: In ra tất cả keys của OMR result để debug
-                    omr_keys_info = []
-                    for key, value in omr_results.items():
-                        if not key.startswith('_'):
-                            omr_keys_info.append(f"{key}: {value}")
-                    
+                report = await asyncio.to_thread(check_quality)
+                if not report.ok:
                     await WebSocketService.send_omr_progress_update(
                         user_id=scanner_user_id,
                         status="recognition_failed",
-                        message="❌ Không nhận diện được SBD từ phiếu trả lời",
+                        message="⚠️ Ảnh chưa đạt chất lượng, chưa nhận diện phiếu",
                         details={
                             "recognition_result": "failed",
-                            "detected_sbd": sbd if sbd else "Không phát hiện",
-                            "metadata": metadata,
-                            "all_omr_fields": omr_keys_info[:10],  # Chỉ hiển thị 10 fields đầu
-                            "reason": "SBD không hợp lệ hoặc không rõ ràng",
-                            "suggestion": "Vui lòng chụp lại ảnh rõ nét hơn, đảm bảo vùng SBD không bị che khuất",
-                            "help_text": "Tìm hiểu SBD hợp lệ bằng cách gọi API /api/v1/omr/generate-sbd",
-                            "aligned_image": f"data:image/jpeg;base64,{annotated_image_base64}" if aligned_img is not None else None
+                            "stage": "quality_gate",
+                            "detected_sbd": "Không phát hiện",
+                            "reason": "Ảnh không đạt kiểm tra chất lượng",
+                            "suggestion": "; ".join(report.hints),
+                            "issues": report.issues,
+                            "hints": report.hints,
+                            "quality": report.metrics
                         }
                     )
-                    return  # DỪNG XỬ LÝ NGAY TẠI ĐÂY
+                    return
+
+            from app.services.omr_result_cache import omr_result_cache
+
+            # 6. Process image: bytes đi thẳng sang worker, chỉ decode một lần ở đó; ảnh căn chỉnh được
+            # encode JPEG trong worker nên chỉ bytes JPEG quay về. Phiếu gửi lại thì lấy kết quả từ cache
+            fname, omr_results, encoded = await omr_result_cache.process_sheet(
+                SheetImage(image_data, f"ws_{scanner_user_id}.jpg"), template_path,
+                template_id=exam.maMauPhieu, conf=0.4, jpeg_quality=settings.OMR_ANNOTATION_JPEG_QUALITY
+            )
+
+            if "error" in omr_results:
+                raise Exception(omr_results["error"])
+            aligned_jpeg = encoded.aligned_jpeg if encoded is not None else None
+
+            def aligned_preview():
+                """Ảnh căn chỉnh dạng data URL, chỉ khi phiếu không có URL annotation để xem lại."""
+                if not aligned_jpeg:
+                    return None
+                return f"data:image/jpeg;base64,{base64.b64encode(aligned_jpeg).decode('utf-8')}"
+
+            # 7. Extract SBD và mã đề với validation nghiêm ngặt
+            metadata = omr_results.get("_metadata", {})
+            sbd = metadata.get("sbd", "")
+            ma_de = metadata.get("ma_de", "")
+            
+            # Fallback SBD detection
+            if not sbd or sbd == "unknown" or not str(sbd).isdigit():
+                for key, value in omr_results.items():
+                    if "sbd" in key.lower() and value and str(value).isdigit() and str(value) != "unknown":
+                        sbd = str(value)
+                        break
+            
+            # ❌ DỪNG XỬ LÝ NẾU KHÔNG NHẬN DIỆN ĐƯỢC SBD
+            if not sbd or sbd == "unknown" or not str(sbd).isdigit() or len(str(sbd)) < 4:
+                # DEBUG: In ra tất cả keys của OMR result để debug
+                omr_keys_info = []
+                for key, value in omr_results.items():
+                    if not key.startswith('_'):
+                        omr_keys_info.append(f"{key}: {value}")
                 
-                # ✅ SBD hợp lệ, tiếp tục xử lý
-                logging.info(f"WebSocket: ✅ Nhận diện thành công SBD: {sbd}")
                 await WebSocketService.send_omr_progress_update(
                     user_id=scanner_user_id,
-                    status="recognition_success",
-                    message=f"✅ Nhận diện thành công SBD: {sbd}",
+                    status="recognition_failed",
+                    message="❌ Không nhận diện được SBD từ phiếu trả lời",
                     details={
-                        "recognition_result": "success",
-                        "detected_sbd": sbd,
-                        "detected_ma_de": ma_de if ma_de else "Chưa xác định"
+                        "recognition_result": "failed",
+                        "detected_sbd": sbd if sbd else "Không phát hiện",
+                        "metadata": metadata,
+                        "all_omr_fields": omr_keys_info[:10],  # Chỉ hiển thị 10 fields đầu
+                        "reason": "SBD không hợp lệ hoặc không rõ ràng",
+                        "suggestion": "Vui lòng chụp lại ảnh rõ nét hơn, đảm bảo vùng SBD không bị che khuất",
+                        "help_text": "Tìm hiểu SBD hợp lệ bằng cách gọi API /api/v1/omr/generate-sbd",
+                        "aligned_image": aligned_preview()
                     }
                 )
+                return  # DỪNG XỬ LÝ NGAY TẠI ĐÂY
+            
+            # ✅ SBD hợp lệ, tiếp tục xử lý
+            logging.info(f"WebSocket: ✅ Nhận diện thành công SBD: {sbd}")
+            await WebSocketService.send_omr_progress_update(
+                user_id=scanner_user_id,
+                status="recognition_success",
+                message=f"✅ Nhận diện thành công SBD: {sbd}",
+                details={
+                    "recognition_result": "success",
+                    "detected_sbd": sbd,
+                    "detected_ma_de": ma_de if ma_de else "Chưa xác định"
+                }
+            )
 
-                # 9. Lưu ảnh gốc vào storage (giống batch-process-with-exam)
-                safe_filename = f"ws_{sbd}_{scanner_user_id}_original.jpg"
-                original_physical_path = exam_storage_dir / safe_filename
-                relative_original_path = relative_storage_path / safe_filename
-                
-                with open(original_physical_path, 'wb') as f:
-                    f.write(image_data)
+            # 8. Lưu ảnh gốc vào storage, kèm ảnh căn chỉnh để render annotation khi được xem
+            from app.services.annotation_service import aligned_path_for, annotation_url
+            safe_filename = f"ws_{sbd}_{scanner_user_id}_original.jpg"
+            original_physical_path = exam_storage_dir / safe_filename
+            relative_original_path = relative_storage_path / safe_filename
+            
+            def persist_images():
+                persist_image(SheetImage(image_data, safe_filename, str(original_physical_path)))
+                if aligned_jpeg:
+                    persist_image(SheetImage(aligned_jpeg, safe_filename, str(aligned_path_for(original_physical_path))))
 
-                # 10. Tạo annotation nâng cao (giống batch-process-with-exam)
-                relative_annotated_path = None
-                
-                if aligned_img is not None:
-                    try:
-                        from app.omr.detection import draw_scoring_overlay
-                        
-                        # Lấy đáp án cho mã đề
-                        answer_key_for_annotation = exam_answer_keys.get(str(ma_de), {})
-                        
-                        # Đường dẫn vật lý để lưu ảnh annotation
-                        annotated_filename = f"ws_{sbd}_{scanner_user_id}_annotated.jpg"
-                        physical_annotation_path = exam_storage_dir / annotated_filename
-                        relative_annotated_path = relative_storage_path / annotated_filename
-                        
-                        # Vẽ và lưu annotation
-                        draw_scoring_overlay(
-                            image=aligned_img.copy(),
-                            bubbles=bubbles,
-                            student_results=omr_results,
-                            answer_key=answer_key_for_annotation,
-                            out_path=str(physical_annotation_path)
-                        )
-                        
-                        # Đọc lại để encode base64
-                        if os.path.exists(physical_annotation_path):
-                            with open(physical_annotation_path, 'rb') as f:
-                                annotated_image_base64 = base64.b64encode(f.read()).decode('utf-8')
-                        
-                        logging.info(f"WebSocket: Created annotation for SBD {sbd}")
-                        
-                    except Exception as e:
-                        logging.error(f"WebSocket: Annotation creation failed: {e}")
-                        # Sử dụng ảnh đã có base64 từ trước
+            # Ghi ảnh xuống đĩa trong thread, song song với chấm điểm
+            persist_task = asyncio.create_task(asyncio.to_thread(persist_images))
 
-                # 11. Chấm điểm và lưu vào database
-                score_result = await OMRDatabaseService.score_omr_result(
-                    db=db,
-                    exam_id=exam_id,
-                    student_answers=omr_results,
-                    sbd=sbd,
-                    image_path=str(relative_original_path),  # Lưu đường dẫn tương đối
-                    scanner_user_id=scanner_user_id,
-                    annotated_image_path=str(relative_annotated_path) if relative_annotated_path else None,
-                    save_to_db=True
-                )
+            # 9. Chấm điểm và lưu vào database
+            score_result = await OMRDatabaseService.score_omr_result(
+                db=db,
+                exam_id=exam_id,
+                student_answers=omr_results,
+                sbd=sbd,
+                image_path=str(relative_original_path),  # Lưu đường dẫn tương đối
+                scanner_user_id=scanner_user_id,
+                save_to_db=True
+            )
 
-                # 12. Gửi kết quả thành công qua WebSocket
-                if score_result.get("success"):
-                    await WebSocketService.send_omr_progress_update(
-                        user_id=scanner_user_id,
-                        status="complete",
-                        message=f"Hoàn tất chấm điểm cho SBD {sbd}. Điểm: {score_result.get('total_score', 0)}",
-                        details={
-                            **score_result,
-                            "aligned_image": f"data:image/jpeg;base64,{annotated_image_base64}" if annotated_image_base64 else None,
-                            "original_image_path": str(relative_original_path),
-                            "annotated_image_path": str(relative_annotated_path) if relative_annotated_path else None
-                        }
-                    )
-                else:
-                    await WebSocketService.send_omr_progress_update(
-                        user_id=scanner_user_id,
-                        status="warning",
-                        message=f"Xử lý OMR thành công nhưng chấm điểm gặp vấn đề cho SBD {sbd}",
-                        details={
-                            "sbd": sbd,
-                            "ma_de": ma_de,
-                            "error": score_result.get('error', 'Lỗi không xác định'),
-                            "aligned_image": f"data:image/jpeg;base64,{annotated_image_base64}" if annotated_image_base64 else None
-                        }
-                    )
+            # 10. Annotation được vẽ lần đầu khi client mở URL (xem /omr/annotations/{answer_sheet_id})
+            await persist_task
+            sheet_annotation_url = None
+            if score_result.get("answer_sheet_id"):
+                sheet_annotation_url = annotation_url(f"/annotations/{score_result['answer_sheet_id']}")
+            preview_image = sheet_annotation_url or aligned_preview()
 
-            finally:
-                # Cleanup temp file
-                if os.path.exists(tmp_image_path):
-                    os.unlink(tmp_image_path)
+            # 11. Gửi kết quả thành công qua WebSocket
+            if score_result.get("success"):
+                await WebSocketService.send_omr_progress_update(
+                    user_id=scanner_user_id,
+                    status="complete",
+                    message=f"Hoàn tất chấm điểm cho SBD {sbd}. Điểm: {score_result.get('total_score', 0)}",
+                    details={
+                        **score_result,
+                        "aligned_image": preview_image,
+                        "annotation_url": sheet_annotation_url,
+                        "original_image_path": str(relative_original_path)
+                    }
+                )
+            else:
+                await WebSocketService.send_omr_progress_update(
+                    user_id=scanner_user_id,
+                    status="warning",
+                    message=f"Xử lý OMR thành công nhưng chấm điểm gặp vấn đề cho SBD {sbd}",
+                    details={
+                        "sbd": sbd,
+                        "ma_de": ma_de,
+                        "error": score_result.get('error', 'Lỗi không xác định'),
+                        "aligned_image": preview_image
+                    }
+                )
 
         except Exception as e:
             logging.error(f"Lỗi trong process_single_image_ws: {e}", exc_info=True)
@@ -1667,31 +1574,38 @@ class OMRDatabaseService:
         
         answer_sheets = (await db.execute(stmt)).scalars().all()
         
-        updated_count = 0
         errors = []
-        
+        rows = []
+        sheets_by_exam: Dict[int, List[AnswerSheet]] = {}
         for sheet in answer_sheets:
-            try:
-                if not sheet.cauTraLoiJson:
-                    errors.append({"answer_sheet_id": sheet.maPhieuTraLoi, "error": "Thiếu dữ liệu câu trả lời."})
+            if not sheet.cauTraLoiJson:
+                errors.append({"answer_sheet_id": sheet.maPhieuTraLoi, "error": "Thiếu dữ liệu câu trả lời."})
+            elif not sheet.maHocSinh:
+                errors.append({"answer_sheet_id": sheet.maPhieuTraLoi, "error": "Phiếu chưa gắn với học sinh."})
+            else:
+                sheets_by_exam.setdefault(sheet.maBaiKiemTra, []).append(sheet)
+        
+        # Chấm lại theo từng bài thi, phiếu đã gắn học sinh nên không cần tra SBD
+        for sheet_exam_id, sheets in sheets_by_exam.items():
+            tallies = await OMRDatabaseService.tally_batch(db, sheet_exam_id, [sheet.cauTraLoiJson for sheet in sheets])
+            for sheet, scored in zip(sheets, tallies):
+                if isinstance(scored, Exception):
+                    errors.append({"answer_sheet_id": sheet.maPhieuTraLoi, "error": str(scored)})
                     continue
-
-                # Gọi lại hàm chấm điểm, nhưng chỉ lưu nếu dry_run=False
-                await OMRDatabaseService.score_omr_result(
-                    db=db,
-                    exam_id=sheet.maBaiKiemTra,
-                    student_answers=sheet.cauTraLoiJson,
-                    sbd="000000", # Tạm thời placeholder
-                    image_path=sheet.urlHinhAnh,
-                    scanner_user_id=scanner_user_id,
-                    annotated_image_path=sheet.urlHinhAnhXuLy, # Giả sử đây là ảnh đã xử lý
-                    save_to_db=not dry_run
-                )
-                updated_count += 1
-            except Exception as e:
-                errors.append({"answer_sheet_id": sheet.maPhieuTraLoi, "error": str(e)})
-
+                _, _, tally = scored
+                rows.append(SheetResultRow(
+                    exam_id=sheet_exam_id, student_id=sheet.maHocSinh, student_answers=sheet.cauTraLoiJson,
+                    total_score=tally.total_score, correct_count=tally.correct_count,
+                    wrong_count=tally.wrong_count, blank_count=tally.blank_count, details=tally.details,
+                    image_path=sheet.urlHinhAnh, annotated_image_path=sheet.urlHinhAnhXuLy,
+                    scanner_user_id=scanner_user_id
+                ))
+        
+        updated_count = len(rows)
         if dry_run:
-            await db.rollback() # Hoàn tác tất cả thay đổi nếu là dry run
+            await db.rollback() # Không ghi gì nếu là dry run
+        elif rows:
+            await upsert_sheet_results(db, rows)
+            await db.commit()
         
         return updated_count, errors 
\ No newline at end of file
@@ -0,0 +1,126 @@
+# OMR Worker Pool Service
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class OMRQueueFullError(Exception):
+    """Hàng đợi OMR đã đầy, client nên thử lại sau"""
+
+
+class OMRWorkerPool:
+    """
+    Pool process riêng cho alignment / sharpen / inference, tách khỏi event loop của FastAPI.
+
+    - Mỗi worker preload model lúc khởi động, template/aligner được cache trong process.
+    - `run()` là API async: submit job rồi await kết quả, không chặn event loop.
+    - Admission control: tối đa `max_queue` job đang chờ/chạy, vượt quá thì raise OMRQueueFullError.
+    - Worker bị giới hạn bộ nhớ (RLIMIT_AS) và cả pool được thay mới sau
+      `max_jobs_per_worker * workers` job để trả lại bộ nhớ bị phân mảnh.
+    - `workers = 0`: không tạo process, job chạy trong thread (asyncio.to_thread).
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_queue: Optional[int] = None,
+                 max_jobs_per_worker: Optional[int] = None, max_memory_mb: Optional[int] = None,
+                 model_path: Optional[str] = None):
+        self.workers = settings.OMR_WORKERS if workers is None else workers
+        self.max_queue = settings.OMR_MAX_QUEUE if max_queue is None else max_queue
+        self.max_jobs_per_worker = settings.OMR_WORKER_MAX_JOBS if max_jobs_per_worker is None else max_jobs_per_worker
+        self.max_memory_mb = settings.OMR_WORKER_MAX_MEMORY_MB if max_memory_mb is None else max_memory_mb
+        self.model_path = model_path or settings.OMR_MODEL_PATH
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._jobs_in_generation = 0
+        self._pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.recycles = 0
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        from app.omr.jobs import init_worker
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            # spawn: không fork process đang có thread của OpenCV/PyTorch/uvicorn
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(self.model_path, self.max_memory_mb),
+        )
+
+    def start(self):
+        if self.workers <= 0 or self._executor is not None:
+            return
+        self._executor = self._create_executor()
+        self._jobs_in_generation = 0
+        logger.info(f"Started OMR worker pool with {self.workers} workers (max queue {self.max_queue})")
+
+    def _recycle(self, reason: str):
+        """Thay pool mới; job đang chạy trên pool cũ vẫn hoàn thành bình thường."""
+        old, self._executor = self._executor, self._create_executor()
+        self._jobs_in_generation = 0
+        self.recycles += 1
+        logger.info(f"Recycling OMR worker pool: {reason}")
+        if old is not None:
+            old.shutdown(wait=False)
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Chạy `fn(*args, **kwargs)` trong worker và trả về kết quả."""
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            raise OMRQueueFullError(f"OMR queue is full ({self._pending} jobs pending)")
+
+        self._pending += 1
+        self.submitted += 1
+        call = functools.partial(fn, *args, **kwargs)
+        try:
+            if self._executor is None:
+                result = await asyncio.to_thread(call)
+            else:
+                if self.max_jobs_per_worker and self._jobs_in_generation >= self.max_jobs_per_worker * self.workers:
+                    self._recycle(f"{self._jobs_in_generation} jobs processed")
+                self._jobs_in_generation += 1
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(self._executor, call)
+                except BrokenProcessPool:
+                    # Worker chết (vd vượt giới hạn bộ nhớ): thay pool để các job sau vẫn chạy được
+                    self._recycle("worker process died")
+                    raise
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "mode": "process" if self._executor is not None else "thread",
+            "pending": self._pending,
+            "max_queue": self.max_queue,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "recycles": self.recycles,
+        }
+
+
+# Singleton cho toàn bộ process API
+omr_worker_pool = OMRWorkerPool()
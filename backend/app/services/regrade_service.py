@@ -0,0 +1,186 @@
+# Regrade Service
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select, func, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.models.exam import AnswerSheet, ExamStatistic, Result
+from app.services.answer_key_cache import CompiledAnswerKey, answer_key_cache
+from app.services.batch_scorer import score_answers_batch
+from app.services.omr_result_writer import update_result_scores
+from app.services.omr_service import OMRDatabaseService
+from app.services.websocket_service import WebSocketService
+
+logger = logging.getLogger(__name__)
+
+
+def changed_form(previous: CompiledAnswerKey, current: CompiledAnswerKey, ma_de: Optional[str]):
+    """
+    Bộ đáp án mới cho các phiếu nhận diện mã đề `ma_de`, None nếu đáp án/điểm của mã đề này không đổi
+    (phiếu không cần chấm lại), hoặc Exception nếu đáp án mới không dùng được cho mã đề này.
+    """
+    try:
+        new_form = current.resolve_detected(ma_de)
+    except Exception as e:
+        return e
+    try:
+        old_form = previous.resolve_detected(ma_de)
+    except Exception:
+        old_form = None
+    return None if old_form == new_form else new_form
+
+
+def merge_changes(first: Dict[Optional[str], List[str]],
+                  second: Dict[Optional[str], List[str]]) -> Dict[Optional[str], List[str]]:
+    """Gộp hai kết quả diff_answer_keys: các câu thay đổi theo từng mã đề của cả hai lần sửa."""
+    merged = {ma_de: list(questions) for ma_de, questions in first.items()}
+    for ma_de, questions in second.items():
+        merged[ma_de] = sorted(set(merged.get(ma_de, [])) | set(questions))
+    return merged
+
+
+class AnswerKeyRegrader:
+    """
+    Chấm lại nền các KETQUA đã lưu khi đáp án của bài thi thay đổi.
+
+    Mỗi bài thi có tối đa một lượt đang chạy. Thay đổi đến khi lượt trước còn chờ được gộp lại (giữ
+    phiên bản đáp án cũ nhất), đến khi đang chạy thì thành lượt tiếp theo so với phiên bản lượt đó dùng.
+    Chỉ phiếu thuộc mã đề có đáp án hoặc điểm thay đổi được chấm lại, từ cauTraLoiJson đã lưu.
+    """
+
+    def __init__(self, chunk_size: Optional[int] = None):
+        self.chunk_size = settings.OMR_REGRADE_CHUNK_SIZE if chunk_size is None else chunk_size
+        self._pending: Dict[int, Tuple[CompiledAnswerKey, Dict[Optional[str], List[str]]]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def enqueue(self, exam_id: int, previous: CompiledAnswerKey, changes: Dict[Optional[str], List[str]]):
+        """Lên lịch chấm lại; `previous` là đáp án trước khi sửa, `changes` từ diff_answer_keys (để báo cáo)."""
+        if exam_id in self._pending:
+            previous, pending_changes = self._pending[exam_id]
+            changes = merge_changes(pending_changes, changes)
+        self._pending[exam_id] = (previous, changes)
+        logger.info(f"Regrade queued for exam {exam_id}: changed questions by mã đề {changes}")
+        if exam_id not in self._tasks:
+            self._tasks[exam_id] = asyncio.create_task(self._drain(exam_id))
+
+    def is_running(self, exam_id: int) -> bool:
+        return exam_id in self._tasks
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._pending.clear()
+
+    async def _drain(self, exam_id: int):
+        try:
+            while exam_id in self._pending:
+                previous, changes = self._pending.pop(exam_id)
+                await WebSocketService.send_exam_regrade_update(
+                    exam_id=exam_id,
+                    status="queued",
+                    message="Đáp án đã thay đổi, đang chấm lại các phiếu bị ảnh hưởng",
+                    details={"changed_questions": {str(k): v for k, v in changes.items()}}
+                )
+                try:
+                    async with AsyncSessionLocal() as db:
+                        await self.regrade(db, exam_id, previous)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Regrade for exam {exam_id} failed: {e}", exc_info=True)
+                    await WebSocketService.send_exam_regrade_update(
+                        exam_id=exam_id,
+                        status="error",
+                        message=f"Lỗi khi chấm lại bài thi: {str(e)}"
+                    )
+        finally:
+            self._tasks.pop(exam_id, None)
+
+    async def regrade(self, db: AsyncSession, exam_id: int, previous: CompiledAnswerKey) -> Dict[str, int]:
+        """Chấm lại các phiếu có kết quả của bài thi theo đáp án hiện tại, commit sau mỗi chunk."""
+        current = await answer_key_cache.get(db, exam_id)
+        total = (await db.execute(
+            select(func.count(Result.maKetQua)).where(Result.maBaiKiemTra == exam_id)
+        )).scalar_one()
+
+        forms: Dict[Optional[str], Any] = {}
+        processed = updated = failed = 0
+        last_sheet_id = 0
+        while True:
+            rows = (await db.execute(
+                select(AnswerSheet.maPhieuTraLoi, AnswerSheet.cauTraLoiJson, Result.maKetQua)
+                .join(Result, Result.maPhieuTraLoi == AnswerSheet.maPhieuTraLoi)
+                .where(AnswerSheet.maBaiKiemTra == exam_id, AnswerSheet.maPhieuTraLoi > last_sheet_id)
+                .order_by(AnswerSheet.maPhieuTraLoi)
+                .limit(self.chunk_size)
+            )).all()
+            if not rows:
+                break
+            last_sheet_id = rows[-1][0]
+
+            # Gom phiếu bị ảnh hưởng theo bộ đáp án mới
+            groups: Dict[int, Tuple[Tuple, List[Tuple[int, Dict]]]] = {}
+            for _, student_answers, result_id in rows:
+                if not student_answers:
+                    continue
+                ma_de = OMRDatabaseService.detect_ma_de_from_omr_results(student_answers)
+                if ma_de not in forms:
+                    forms[ma_de] = changed_form(previous, current, ma_de)
+                form = forms[ma_de]
+                if form is None:
+                    continue
+                if isinstance(form, Exception):
+                    failed += 1
+                    continue
+                groups.setdefault(id(form[1]), (form, []))[1].append((result_id, student_answers))
+
+            scores = []
+            for (_, answer_key, score_key), items in groups.values():
+                tallies = score_answers_batch(answer_key, score_key, [answers for _, answers in items])
+                for (result_id, _), tally in zip(items, tallies):
+                    if isinstance(tally, Exception):
+                        failed += 1
+                    else:
+                        scores.append({"maKetQua": result_id, **tally._asdict()})
+
+            updated += await update_result_scores(db, scores)
+            await db.commit()
+            processed += len(rows)
+            await WebSocketService.send_exam_regrade_update(
+                exam_id=exam_id,
+                status="processing",
+                message=f"Đã kiểm tra {processed}/{total} phiếu, cập nhật {updated} kết quả",
+                progress=round(processed * 100 / total) if total else 100,
+                details={"processed": processed, "updated": updated, "failed": failed}
+            )
+
+        if updated:
+            # Phân tích câu hỏi đã lưu dùng điểm cũ: xóa để lần xem tiếp theo tính lại
+            await db.execute(
+                update(ExamStatistic).where(ExamStatistic.maBaiKiemTra == exam_id)
+                .values(thongKeCauHoiJson=None, phanLoaiDoKhoJson=None)
+            )
+            await db.commit()
+
+        summary = {"processed": processed, "updated": updated, "failed": failed}
+        logger.info(f"Regrade for exam {exam_id} completed: {summary}")
+        await WebSocketService.send_exam_regrade_update(
+            exam_id=exam_id,
+            status="complete",
+            message=f"Hoàn tất chấm lại: cập nhật {updated}/{processed} kết quả",
+            progress=100,
+            details=summary
+        )
+        return summary
+
+
+# Singleton cho toàn bộ process API
+answer_key_regrader = AnswerKeyRegrader()
@@ -0,0 +1,178 @@
+# Student Roster Index
+
+import logging
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select, func, and_, literal_column
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.exam import ExamClassRoom
+from app.models.student import Student
+
+logger = logging.getLogger(__name__)
+
+# SBD trên phiếu là 6 số cuối của mã học sinh trường
+SBD_LENGTH = 6
+
+
+def normalize_sbd(sbd) -> Optional[str]:
+    """Chỉ giữ chữ số, lấy 6 số cuối; None nếu không còn chữ số nào."""
+    if not sbd or not isinstance(sbd, str):
+        return None
+    digits = re.sub(r'[^\d]', '', sbd)
+    return digits[-SBD_LENGTH:] or None
+
+
+class RosterStudent(NamedTuple):
+    """Bản sao chỉ đọc của học sinh, không gắn với session nên dùng chung được giữa các request"""
+    maHocSinh: int
+    maHocSinhTruong: str
+    hoTen: str
+    maLopHoc: int
+
+
+class SBDRoster:
+    """Danh sách học sinh của một bài thi (hoặc một lớp) đánh chỉ mục theo 6 số cuối mã học sinh"""
+
+    def __init__(self, students: Iterable[RosterStudent], class_ids: Iterable[int] = ()):
+        self.by_suffix: Dict[str, List[RosterStudent]] = {}
+        for student in sorted(students, key=lambda s: s.maHocSinh):
+            code = student.maHocSinhTruong or ""
+            if len(code) >= SBD_LENGTH:
+                self.by_suffix.setdefault(code[-SBD_LENGTH:], []).append(student)
+        # Lớp được gán cho bài thi kể cả lớp chưa có học sinh, dùng để invalidate
+        self.class_ids = set(class_ids) | {s.maLopHoc for students in self.by_suffix.values() for s in students}
+        self.built_at = time.monotonic()
+
+    @property
+    def collisions(self) -> Dict[str, List[RosterStudent]]:
+        """Các SBD bị trùng giữa nhiều học sinh, phiếu mang SBD này không thể khớp chắc chắn"""
+        return {suffix: students for suffix, students in self.by_suffix.items() if len(students) > 1}
+
+    def __len__(self):
+        return sum(len(students) for students in self.by_suffix.values())
+
+    def lookup(self, sbd: str) -> Optional[RosterStudent]:
+        matches = self.by_suffix.get(normalize_sbd(sbd) or "")
+        if not matches:
+            return None
+        if len(matches) > 1:
+            logger.warning(f"SBD {sbd} matches {len(matches)} students, using maHocSinh {matches[0].maHocSinh}")
+        return matches[0]
+
+    def collision_report(self) -> List[Dict]:
+        return [
+            {"sbd": suffix, "students": [s._asdict() for s in students]}
+            for suffix, students in sorted(self.collisions.items())
+        ]
+
+
+class StudentRosterIndex:
+    """
+    Cache SBD -> học sinh theo bài thi / lớp, xây bằng một query cho mỗi batch hoặc phiên quét.
+
+    Bị xóa khi StudentService thêm, sửa, chuyển lớp hoặc ngừng kích hoạt học sinh và khi
+    ExamService gán lại lớp cho bài thi. `ttl_seconds` giới hạn độ cũ khi thay đổi đến từ process khác.
+    """
+
+    def __init__(self, ttl_seconds: float = 300.0, max_rosters: int = 256):
+        self.ttl_seconds = ttl_seconds
+        self.max_rosters = max_rosters
+        self._rosters: Dict[Tuple[str, int], SBDRoster] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, key) -> Optional[SBDRoster]:
+        with self._lock:
+            roster = self._rosters.get(key)
+            if roster is not None and time.monotonic() - roster.built_at < self.ttl_seconds:
+                self.hits += 1
+                return roster
+            self.misses += 1
+            return None
+
+    def _store(self, key, roster: SBDRoster) -> SBDRoster:
+        with self._lock:
+            if len(self._rosters) >= self.max_rosters:
+                oldest = min(self._rosters, key=lambda k: self._rosters[k].built_at)
+                del self._rosters[oldest]
+            self._rosters[key] = roster
+        if roster.collisions:
+            logger.warning(
+                f"Roster {key}: {len(roster.collisions)} SBD collisions "
+                f"({', '.join(sorted(roster.collisions))}), sheets with these SBDs need manual review"
+            )
+        return roster
+
+    async def for_exam(self, db: AsyncSession, exam_id: int) -> SBDRoster:
+        """Học sinh đang hoạt động thuộc các lớp được gán bài thi."""
+        key = ("exam", exam_id)
+        roster = self._cached(key)
+        if roster is None:
+            rows = (await db.execute(
+                select(ExamClassRoom.maLopHoc, Student.maHocSinh, Student.maHocSinhTruong, Student.hoTen, Student.maLopHoc)
+                .outerjoin(Student, and_(Student.maLopHoc == ExamClassRoom.maLopHoc, Student.trangThai == True))
+                .where(ExamClassRoom.maBaiKiemTra == exam_id)
+            )).all()
+            roster = self._store(key, SBDRoster(
+                (RosterStudent(*row[1:]) for row in rows if row[1] is not None),
+                class_ids=(row[0] for row in rows)
+            ))
+        return roster
+
+    async def for_class(self, db: AsyncSession, class_id: int) -> SBDRoster:
+        """Học sinh của một lớp."""
+        key = ("class", class_id)
+        roster = self._cached(key)
+        if roster is None:
+            rows = (await db.execute(
+                select(Student.maHocSinh, Student.maHocSinhTruong, Student.hoTen, Student.maLopHoc)
+                .where(Student.maLopHoc == class_id)
+            )).all()
+            roster = self._store(key, SBDRoster((RosterStudent(*row) for row in rows), class_ids=[class_id]))
+        return roster
+
+    @staticmethod
+    async def query_by_sbd(db: AsyncSession, sbd: str) -> Optional[RosterStudent]:
+        """Tra cứu một SBD không giới hạn lớp, dùng functional index right("maHocSinhTruong", 6)."""
+        suffix = normalize_sbd(sbd)
+        if not suffix or len(suffix) < SBD_LENGTH:
+            return None
+        row = (await db.execute(
+            select(Student.maHocSinh, Student.maHocSinhTruong, Student.hoTen, Student.maLopHoc)
+            # Độ dài viết literal để biểu thức trùng khớp với index (tham số bind sẽ không dùng được index)
+            .where(func.right(Student.maHocSinhTruong, literal_column(str(SBD_LENGTH))) == suffix)
+            .order_by(Student.maHocSinh)
+            .limit(1)
+        )).first()
+        return RosterStudent(*row) if row else None
+
+    def invalidate_exam(self, exam_id: int):
+        with self._lock:
+            self._rosters.pop(("exam", exam_id), None)
+
+    def invalidate_classes(self, class_ids: Iterable[Optional[int]]):
+        """Xóa roster của các lớp và của mọi bài thi có học sinh (hoặc được gán) các lớp đó."""
+        class_ids = {c for c in class_ids if c is not None}
+        if not class_ids:
+            return
+        with self._lock:
+            for key in [k for k, roster in self._rosters.items()
+                        if (k[0] == "class" and k[1] in class_ids) or (k[0] == "exam" and roster.class_ids & class_ids)]:
+                del self._rosters[key]
+
+    def invalidate_all(self):
+        with self._lock:
+            self._rosters.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"rosters": len(self._rosters), "hits": self.hits, "misses": self.misses}
+
+
+# Singleton cho toàn bộ process API
+student_roster_index = StudentRosterIndex()
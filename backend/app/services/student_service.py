@@ -8,6 +8,8 @@ from datetime import datetime
 from app.models.student import Student
 from app.models.class_room import ClassRoom
 from app.schemas.class_student import StudentCreate, StudentUpdate, StudentBatchCreate, StudentTransfer
+from app.services.exam_rollup_service import ExamRollupService
+from app.services.student_roster_index import student_roster_index
 
 class StudentService:
     @staticmethod
@@ -70,6 +72,7 @@ class StudentService:
                 detail=f"Mã học sinh {student_create.maHocSinhTruong} đã tồn tại trong lớp này"
             )
         
+        student_roster_index.invalidate_classes([db_student.maLopHoc])
         return db_student
     
     @staticmethod
@@ -154,6 +157,7 @@ class StudentService:
                 detail=f"Lỗi khi thêm học sinh, có thể do mã học sinh trùng lặp: {str(e)}"
             )
         
+        student_roster_index.invalidate_classes(class_ids)
         return created_students
     
     @staticmethod
@@ -216,6 +220,7 @@ class StudentService:
                 )
         
         # Cập nhật thông tin
+        old_class_id = db_student.maLopHoc
         update_data = student_update.dict(exclude_unset=True)
         
         for key, value in update_data.items():
@@ -225,6 +230,9 @@ class StudentService:
         db_student.thoiGianCapNhat = datetime.now()
         
         try:
+            # Đổi lớp: chuyển điểm của học sinh sang thống kê của lớp mới trong cùng transaction
+            await db.flush()
+            await ExamRollupService.move_students(db, {student_id: (old_class_id, db_student.maLopHoc)})
             await db.commit()
             await db.refresh(db_student)
         except IntegrityError:
@@ -234,6 +242,7 @@ class StudentService:
                 detail=f"Lỗi khi cập nhật học sinh"
             )
         
+        student_roster_index.invalidate_classes([old_class_id, db_student.maLopHoc])
         return db_student
     
     @staticmethod
@@ -251,6 +260,7 @@ class StudentService:
         db_student.thoiGianCapNhat = datetime.now()
         
         await db.commit()
+        student_roster_index.invalidate_classes([db_student.maLopHoc])
         return True
     
     @staticmethod
@@ -273,14 +283,21 @@ class StudentService:
             )
         
         # Cập nhật lớp học cho từng học sinh
+        affected_class_ids = {transfer_data.maLopHocMoi}
+        moves = {}
         for student_id in transfer_data.maHocSinhList:
             db_student = await StudentService.get_student_by_id(db, student_id)
             if db_student:
+                affected_class_ids.add(db_student.maLopHoc)
+                moves[student_id] = (moves.get(student_id, (db_student.maLopHoc,))[0], transfer_data.maLopHocMoi)
                 db_student.maLopHoc = transfer_data.maLopHocMoi
                 db_student.thoiGianCapNhat = datetime.now()
                 transferred_students.append(db_student)
         
+        await db.flush()
+        await ExamRollupService.move_students(db, moves)
         await db.commit()
+        student_roster_index.invalidate_classes(affected_class_ids)
         
         for student in transferred_students:        
                 await db.refresh(student)
@@ -549,6 +566,8 @@ class StudentService:
         successful = 0
         failed = 0
         errors = []
+        affected_class_ids = set()
+        moves = {}
         
         for student_id in student_ids:
             try:
@@ -569,9 +588,11 @@ class StudentService:
                     continue
                 
                 # Perform operation
+                affected_class_ids.update([student.maLopHoc, target_class_id])
                 if operation == "delete":
                     await StudentService.delete_student(db, student_id)
                 elif operation == "move_class" and target_class_id:
+                    moves[student_id] = (moves.get(student_id, (student.maLopHoc,))[0], target_class_id)
                     student.maLopHoc = target_class_id
                 elif operation == "update_status" and new_status is not None:
                     student.trangThai = new_status
@@ -586,7 +607,11 @@ class StudentService:
                 errors.append(f"Học sinh ID {student_id}: {str(e)}")
                 failed += 1
         
+        if moves:
+            await db.flush()
+            await ExamRollupService.move_students(db, moves)
         await db.commit()
+        student_roster_index.invalidate_classes(affected_class_ids)
         
         return {
             "processed": processed,
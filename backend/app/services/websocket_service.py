@@ -174,6 +174,27 @@ class WebSocketService:
             for monitor_ws in manager.exam_monitors[exam_id]:
                 await manager.send_personal_message(status_message, monitor_ws)
 
+    @staticmethod
+    async def send_exam_regrade_update(
+        exam_id: int,
+        message: str,
+        status: str,
+        progress: Optional[int] = None,
+        details: Optional[dict] = None
+    ):
+        """Gửi tiến trình chấm lại bài thi (khi đáp án thay đổi) cho các exam monitor"""
+        regrade_message = {
+            "type": "exam_regrade",
+            "exam_id": exam_id,
+            "status": status, # e.g., "queued", "processing", "complete", "error"
+            "message": message,
+            "progress": progress,
+            "details": details or {},
+            "timestamp": datetime.now().isoformat()
+        }
+        for monitor_ws in list(manager.exam_monitors.get(exam_id, set())):
+            await manager.send_personal_message(regrade_message, monitor_ws)
+
     @staticmethod
     async def send_omr_progress_update(
         user_id: int, 
@@ -0,0 +1,38 @@
+import os
+import shutil
+
+import numpy as np
+
+from app.omr.aligner_cache import clear_reference_cache, get_reference_features, sidecar_path
+
+REFERENCE_PATH = os.path.join(os.path.dirname(__file__), "..", "omr", "templates", "12-4-6", "12-4-6.png")
+
+
+def test_reference_features_cached_and_persisted(tmp_path):
+    ref_path = str(tmp_path / "12-4-6.png")
+    shutil.copy(REFERENCE_PATH, ref_path)
+    clear_reference_cache()
+
+    first = get_reference_features(ref_path, "ORB", 1000)
+    assert get_reference_features(ref_path, "ORB", 1000) is first
+    assert os.path.exists(sidecar_path(os.path.abspath(ref_path), "ORB", 1000, 2084, 2947))
+
+    # Worker mới: không có cache bộ nhớ, đọc lại từ sidecar
+    clear_reference_cache()
+    reloaded = get_reference_features(ref_path, "ORB", 1000)
+    assert reloaded is not first
+    assert np.array_equal(reloaded.descriptors, first.descriptors)
+    assert [k.pt for k in reloaded.keypoints] == [k.pt for k in first.keypoints]
+    assert [k.octave for k in reloaded.keypoints] == [k.octave for k in first.keypoints]
+
+
+def test_reference_features_recomputed_when_image_changes(tmp_path):
+    ref_path = str(tmp_path / "12-4-6.png")
+    shutil.copy(REFERENCE_PATH, ref_path)
+    clear_reference_cache()
+
+    first = get_reference_features(ref_path, "ORB", 1000)
+    mtime = os.path.getmtime(ref_path)
+    os.utime(ref_path, (mtime + 10, mtime + 10))
+    clear_reference_cache()
+    assert get_reference_features(ref_path, "ORB", 1000) is not first
@@ -0,0 +1,62 @@
+import os
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.services.annotation_service import (
+    AnnotationRenderer, AnnotationSource, annotation_cache_key, annotation_url, sign_annotation_path,
+    verify_annotation_signature
+)
+
+
+def test_signature_rejects_other_paths_and_expired_urls():
+    expires = int(time.time()) + 60
+    sig = sign_annotation_path("/annotations/12", expires)
+    assert verify_annotation_signature("/annotations/12", expires, sig)
+    assert not verify_annotation_signature("/annotations/13", expires, sig)
+    assert not verify_annotation_signature("/annotations/12", expires + 1, sig)
+    expired = int(time.time()) - 1
+    assert not verify_annotation_signature("/annotations/12", expired, sign_annotation_path("/annotations/12", expired))
+
+
+def test_url_escapes_filename_and_signs_the_unescaped_path():
+    path = "/annotations/exams/3/files/original_0_a#1?b%.jpg"
+    url = urlsplit(annotation_url(path))
+    assert "#" not in url.path and url.fragment == ""
+    # Endpoint nhận lại path đã giải mã và kiểm tra chữ ký trên path đó
+    received = unquote(url.path).split("/v1/omr", 1)[1]
+    query = parse_qs(url.query)
+    assert received == path
+    assert verify_annotation_signature(received, int(query["expires"][0]), query["sig"][0])
+
+
+def test_cache_key_follows_content(tmp_path):
+    image = tmp_path / "sheet.jpg"
+    image.write_bytes(b"jpeg")
+    template = tmp_path / "template.json"
+    template.write_text("{}")
+    source = AnnotationSource(image, None, 1, {"q1": "A", "_metadata": {"sbd": "1"}}, {"q1": "A"})
+
+    key = annotation_cache_key(source, str(template), 0, 85)
+    assert key == annotation_cache_key(source._replace(student_results={"q1": "A"}), str(template), 0, 85)
+    assert key != annotation_cache_key(source._replace(answer_key={"q1": "B"}), str(template), 0, 85)
+    assert key != annotation_cache_key(source, str(template), 480, 85)
+
+    image.write_bytes(b"new jpeg")
+    assert key != annotation_cache_key(source, str(template), 0, 85)
+
+
+def test_prune_removes_least_recently_read(tmp_path):
+    renderer = AnnotationRenderer(cache_dir=str(tmp_path), max_bytes=250)
+    for index, key in enumerate(["aa01", "bb02", "cc03"]):
+        path = renderer.cache_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (1000 + index, 1000 + index))
+
+    assert renderer.prune() == 1
+    assert not renderer.cache_path("aa01").exists()
+    assert renderer.cache_path("cc03").exists()
@@ -0,0 +1,62 @@
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.services.answer_key_cache import AnswerKeyCache, CompiledAnswerKey, diff_answer_keys, select_answer_key
+
+
+def test_select_answer_key_formats():
+    by_code = {"123": {"1": "A", "2": "B"}, "456": {"1": "C", "2": "D"}}
+    assert select_answer_key(by_code, "456")[0] == {"1": "C", "2": "D"}
+    # Không nhận diện được mã đề: lấy mã đề đầu tiên
+    assert select_answer_key(by_code, None)[0] == {"1": "A", "2": "B"}
+    assert select_answer_key({"123": {"1": "A"}}, "999")[0] == {"1": "A"}
+    assert select_answer_key({"1": "A", "2": "B"}, "123")[0] == {"1": "A", "2": "B"}
+    assert select_answer_key([], "123")[0] == {}
+
+
+def test_resolve_is_memoized_and_uses_scores():
+    compiled = CompiledAnswerKey(1, '{"123": {"1": "A", "2": "B"}}', {"1": "0.5", "2": 1})
+    answer_key, score_key = compiled.resolve("123")
+    assert answer_key == {"1": "A", "2": "B"}
+    assert score_key == {"1": 0.5, "2": 1.0}
+    assert compiled.resolve("123")[0] is answer_key
+    assert compiled.codes == ["123"]
+
+
+def test_equal_points_and_missing_key():
+    compiled = CompiledAnswerKey(1, {"q1": "A", "q2": "B"}, None, equal_points=5.0)
+    assert compiled.resolve(None)[1] == {"q1": 5.0, "q2": 5.0}
+    with pytest.raises(ValueError):
+        CompiledAnswerKey(2, {}, None).resolve("123")
+
+
+def test_annotation_keys_skip_non_answer_entries():
+    compiled = CompiledAnswerKey(1, {"123": {"q1": "A"}, "meta": {"weight": 2}}, None)
+    assert compiled.annotation_keys() == {"123": {"q1": "A"}}
+
+
+def test_invalidate():
+    cache = AnswerKeyCache()
+    cache._keys[1] = CompiledAnswerKey(1, {"1": "A"}, None)
+    cache.invalidate(1)
+    cache.invalidate(2)
+    assert cache.stats()["exams"] == 0
+
+
+def test_diff_answer_keys_reports_changed_questions_by_ma_de():
+    old = CompiledAnswerKey(1, {"123": {"1": "A", "2": "B"}, "456": {"1": "C", "2": "D"}}, {"1": 1, "2": 1})
+    new = CompiledAnswerKey(1, {"123": {"1": "A", "2": "C"}, "456": {"1": "C", "2": "D"}}, {"1": 1, "2": 1})
+    # Phiếu không nhận diện được mã đề dùng mã đề đầu tiên (123) nên cũng bị ảnh hưởng
+    assert diff_answer_keys(old, new) == {None: ["2"], "123": ["2"]}
+
+    rescored = CompiledAnswerKey(1, {"123": {"1": "A", "2": "B"}, "456": {"1": "C", "2": "D"}}, {"1": 1, "2": 2})
+    assert set(diff_answer_keys(old, rescored)) == {None, "123", "456"}
+    assert diff_answer_keys(old, old) == {}
+
+
+def test_version_changes_with_answers_or_scores():
+    key = CompiledAnswerKey(1, '{"123": {"1": "A"}}', {"1": 1})
+    assert key.version == CompiledAnswerKey(1, {"123": {"1": "A"}}, {"1": "1"}).version
+    assert key.version != CompiledAnswerKey(1, {"123": {"1": "B"}}, {"1": 1}).version
+    assert key.version != CompiledAnswerKey(1, {"123": {"1": "A"}}, {"1": 2}).version
@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from app.services.batch_scorer import AnswerEncoder, score_answers, score_answers_batch
+
+CHOICES = ["A", "B", "C", "D", "a", "AB", "BA", "ACD", "", " ", "T", "F", "t", "2", ",", "-", "2,41", "10,0"]
+
+
+def make_key(rng):
+    key, scores = {}, {}
+    for i in range(1, rng.randint(0, 12) + 1):
+        key[f"q{i}"] = rng.choice(["A", "B", "C", "D", "AC"])
+    for q in range(12, 12 + rng.randint(0, 3)):
+        for sub in "abcd":
+            key[f"{q}_{sub}"] = rng.choice("TF")
+    for q in range(17, 17 + rng.randint(0, 2)):
+        for col, digit in enumerate("2,41", start=1):
+            key[f"{q}_col{col}"] = digit
+    if rng.random() < 0.5:
+        key["18"] = "2,41"
+    for q_id in key:
+        if rng.random() < 0.9:
+            scores[q_id] = rng.choice([0.1, 0.25, 1 / 3, 0.5, 1.0, 2])
+    return key, scores
+
+
+def make_sheet(rng, key):
+    sheet = {q_id: rng.choice(CHOICES + [answer]) for q_id, answer in key.items() if rng.random() < 0.95}
+    sheet["_metadata"] = {"ma_de": "123"}
+    return sheet
+
+
+def test_batch_matches_scalar_scorer():
+    rng = random.Random(2024)
+    for _ in range(200):
+        key, scores = make_key(rng)
+        sheets = [make_sheet(rng, key) for _ in range(rng.randint(0, 8))]
+        expected = [score_answers(key, scores, sheet) for sheet in sheets]
+        assert score_answers_batch(key, scores, sheets) == expected
+
+
+def test_invalid_sheet_is_reported_in_place():
+    key = {"q1": "A", "q2": "B"}
+    tallies = score_answers_batch(key, {}, [{"q1": "A"}, {"q1": 3}, {"q2": "b"}])
+    assert tallies[0].correct_count == 1 and tallies[0].blank_count == 1
+    assert isinstance(tallies[1], Exception)
+    assert tallies[2].correct_count == 1
+
+
+def test_encoder_is_case_insensitive_and_order_sensitive():
+    encoder = AnswerEncoder()
+    assert encoder.encode("ac")[0] == encoder.encode("AC")[0] > 0
+    assert encoder.encode("CA")[0] < 0
+    assert encoder.encode("CA")[0] != encoder.encode("AC")[0]
+    assert encoder.encode(" ") == (encoder.encode(" ")[0], True)
+    assert encoder.encode("")[0] == 0
@@ -0,0 +1,71 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from app.omr.cascade import CascadeBand, calibrate_band, cascade_decisions, fill_ratios
+from app.omr.detection import classify_bubbles_batch, prepare_bubbles
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..", "..")
+MODEL_PATH = os.getenv("OMR_MODEL_PATH", os.path.join(BACKEND_DIR, "app", "omr", "models", "best.pt"))
+DATASET_DIR = os.path.join(BACKEND_DIR, "..", "AI", "dataset")
+
+
+def _sheet():
+    """Trang trắng có 3 bubble: trống, tô kín, tô một nửa"""
+    page = np.full((200, 300), 255, dtype=np.uint8)
+    bounds = np.array([(10, 10, 60, 60), (110, 10, 160, 60), (210, 10, 260, 60)], dtype=np.int32)
+    for x1, y1, x2, y2 in bounds.tolist():
+        cv2.rectangle(page, (x1, y1), (x2 - 1, y2 - 1), 0, 2)
+    page[10:60, 110:160] = 0
+    page[10:35, 210:260] = 0
+    return page, bounds
+
+
+def test_fill_ratios_match_direct_count():
+    page, bounds = _sheet()
+    ratios = fill_ratios(page, bounds, inset=0.2, dark_threshold=128)
+    expected = [np.mean(page[y1 + 10:y2 - 10, x1 + 10:x2 - 10] < 128) for x1, y1, x2, y2 in bounds.tolist()]
+    np.testing.assert_allclose(ratios, expected, atol=1e-6)
+    np.testing.assert_allclose(fill_ratios(page, bounds), expected, atol=1e-6)
+
+
+def test_only_uncertain_bubbles_reach_the_model():
+    page, bounds = _sheet()
+    band = CascadeBand(empty_below=0.1, filled_above=0.9)
+    filled, valid_idx, model_pos, rois = prepare_bubbles(page, bounds, band)
+    assert filled.tolist() == [False, True, False]
+    assert model_pos.tolist() == [2] and len(rois) == 1
+
+    class Model:
+        def predict_filled(self, rois, conf):
+            return np.ones(len(rois), dtype=bool)
+
+    stats = {}
+    labels = [("q1", "A"), ("q1", "B"), ("q1", "C")]
+    bubbles = [dict(qid=q, choice=c, bounds=tuple(b)) for (q, c), b in zip(labels, bounds.tolist())]
+    assert classify_bubbles_batch(page, bubbles, Model(), 0.4, band, stats) == {"q1": "BC"}
+    assert stats == {"bubbles": 3, "model": 1}
+
+
+def test_calibrated_band_agrees_with_model_outside_band():
+    rng = np.random.default_rng(0)
+    ratios = np.concatenate([rng.uniform(0.0, 0.3, 500), rng.uniform(0.5, 1.0, 200)])
+    model_filled = ratios > 0.4
+    band = calibrate_band(ratios, model_filled, margin=0.02)
+    decided, uncertain = cascade_decisions(ratios, band)
+    assert np.array_equal(decided[~uncertain], model_filled[~uncertain])
+    assert uncertain.mean() < 0.5
+
+    with pytest.raises(ValueError):
+        calibrate_band(ratios, np.zeros(len(ratios), dtype=bool))
+
+
+@pytest.mark.skipif(not os.path.exists(MODEL_PATH), reason="bubble model weights not available")
+def test_cascade_does_not_regress_on_dataset():
+    YOLO = pytest.importorskip("ultralytics").YOLO
+    from app.omr.cascade import evaluate_dataset
+
+    report = evaluate_dataset(DATASET_DIR, YOLO(MODEL_PATH), conf=0.4)
+    assert report["cascade_accuracy"] >= report["model_accuracy"], report
@@ -0,0 +1,43 @@
+import os
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from app.omr.src.processors.CornerMarkerAlignment import CornerMarkerAlignment
+
+REFERENCE_PATH = os.path.join(os.path.dirname(__file__), "..", "omr", "templates", "12-4-6", "12-4-6.png")
+CONFIG = SimpleNamespace(
+    dimensions=SimpleNamespace(processing_width=2084, processing_height=2947),
+    outputs=SimpleNamespace(show_image_level=0),
+)
+
+
+def _aligner():
+    return CornerMarkerAlignment(options={"reference": REFERENCE_PATH}, tuning_config=CONFIG)
+
+
+def test_markers_recover_known_perspective():
+    aligner = _aligner()
+    assert aligner.available
+
+    ref = cv2.resize(cv2.imread(REFERENCE_PATH), (2084, 2947))
+    src = np.float32([[0, 0], [2084, 0], [2084, 2947], [0, 2947]])
+    dst = (src + np.float32([[30, -20], [-25, 15], [20, 35], [-30, -10]])) * 1.3 + 60
+    M = cv2.getPerspectiveTransform(src, dst)
+    scan = cv2.warpPerspective(ref, M, (2900, 4000), borderValue=(200, 200, 200))
+
+    aligned = aligner.apply_filter(scan, "scan.jpg")
+
+    assert aligned is not None and aligned.shape[:2] == (2947, 2084)
+    assert aligner.last_stats["confidence"] >= aligner.min_confidence
+    grid = np.float32([[x, y] for x in range(300, 1800, 300) for y in range(600, 2800, 400)]).reshape(-1, 1, 2)
+    mapped = cv2.perspectiveTransform(cv2.perspectiveTransform(grid, M), aligner.last_homography)
+    assert np.abs(mapped - grid).max() < 1.5
+
+
+def test_no_markers_means_fallback():
+    aligner = _aligner()
+    blank = np.full((3000, 2100, 3), 220, dtype=np.uint8)
+    assert aligner.apply_filter(blank, "blank.jpg") is None
+    assert aligner.last_stats["confidence"] == 0.0
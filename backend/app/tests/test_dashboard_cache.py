@@ -0,0 +1,74 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy.dialects import postgresql
+
+from app.services.dashboard_cache import DashboardSnapshotCache
+from app.services.dashboard_service import admin_snapshot_query
+
+
+class _Session:
+    async def __aenter__(self):
+        return "background-session"
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def test_fresh_stale_and_expired_snapshots():
+    async def scenario():
+        cache = DashboardSnapshotCache(ttl_seconds=0.05, stale_seconds=0.1, session_factory=_Session)
+        calls = []
+
+        async def loader(db):
+            calls.append(db)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        # Hai request đồng thời khi chưa có snapshot chỉ tải một lần
+        assert await asyncio.gather(cache.get(("admin",), loader, "req"), cache.get(("admin",), loader, "req")) == [1, 1]
+        assert await cache.get(("admin",), loader, "req") == 1
+
+        # Hết TTL: trả snapshot cũ ngay, làm mới ở nền bằng session riêng
+        await asyncio.sleep(0.06)
+        assert await cache.get(("admin",), loader, "req") == 1
+        await asyncio.sleep(0.02)
+        assert calls == ["req", "background-session"]
+        assert await cache.get(("admin",), loader, "req") == 2
+
+        # Quá cả thời gian stale: tải lại đồng bộ
+        await asyncio.sleep(0.2)
+        assert await cache.get(("admin",), loader, "req") == 3
+
+        stats = cache.stats()
+        assert (stats["hits"], stats["stale_hits"], stats["misses"], stats["refreshes"]) == (2, 1, 3, 1)
+        assert stats["queries"]["admin"]["count"] == 3
+
+    asyncio.run(scenario())
+
+
+def test_admin_dashboard_is_a_single_statement():
+    sql = str(admin_snapshot_query(datetime(2026, 1, 1, 10)).compile(dialect=postgresql.dialect()))
+    assert sql.count("FILTER (WHERE") == 10
+    assert sql.count("UNION ALL") == 2
+    for table in ('"NGUOIDUNG"', '"TOCHUC"', '"LOPHOC"', '"HOCSINH"', '"BAIKIEMTRA"', '"PHIEUTRALOI"', '"KETQUA"'):
+        assert table in sql
+
+
+def test_callers_get_a_copy_of_the_snapshot():
+    async def scenario():
+        cache = DashboardSnapshotCache(ttl_seconds=60, stale_seconds=60, session_factory=_Session)
+
+        async def loader(db):
+            return {"stats": {"totalUsers": 3}, "recentActivities": [{"title": "a"}]}
+
+        first = await cache.get(("admin",), loader, "req")
+        first["stats"]["totalUsers"] = 0
+        first["recentActivities"].clear()
+        return await cache.get(("admin",), loader, "req")
+
+    assert asyncio.run(scenario()) == {"stats": {"totalUsers": 3}, "recentActivities": [{"title": "a"}]}
@@ -0,0 +1,163 @@
+import asyncio
+import random
+import statistics
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy.sql.dml import Insert
+
+from app.models.exam import Exam, ExamStatistic
+from app.services.exam_rollup_service import ExamRollupService, ScoreChange, ScoreRollup, write_rollup
+
+
+def test_incremental_rollup_matches_full_recompute():
+    rng = random.Random(7)
+    scores = {student: round(rng.uniform(0, 10), 2) for student in range(40)}
+    rollup = ScoreRollup.from_scores(scores.values())
+
+    # Ghi lại điểm của một phần học sinh: trừ điểm cũ, cộng điểm mới, qua JSON như khi lưu DB
+    for student in range(0, 40, 3):
+        rollup = ScoreRollup.from_json({"rollup": rollup.to_json()})
+        new_score = round(rng.uniform(0, 10), 2)
+        rollup.remove(scores[student])
+        rollup.add(new_score)
+        scores[student] = new_score
+
+    values = list(scores.values())
+    assert rollup.count == len(values)
+    assert rollup.mean == pytest.approx(statistics.fmean(values))
+    assert rollup.std == pytest.approx(statistics.pstdev(values))
+    assert rollup.median == pytest.approx(statistics.median(values))
+    assert (rollup.minimum, rollup.maximum) == (min(values), max(values))
+    assert sum(rollup.histogram.values()) == len(values)
+
+
+def test_bands_pass_rate_and_distribution():
+    rollup = ScoreRollup.from_scores([10, 8, 7.5, 6.5, 5, 4.99, 2, 0])
+    assert rollup.grade_bands() == {"gioi": 2, "kha": 2, "trungBinh": 1, "yeu": 3}
+    assert rollup.pass_rate() == pytest.approx(62.5)
+    assert rollup.score_distribution() == {"0-2": 1, "2-4": 1, "4-6": 2, "6-8": 2, "8-10": 2}
+    # Thang 20 điểm: ngưỡng được quy đổi
+    assert ScoreRollup.from_scores([16, 12]).grade_bands(20) == {"gioi": 1, "kha": 0, "trungBinh": 1, "yeu": 0}
+    assert ScoreRollup().median is None
+
+
+class _Rows:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+    def scalar_one(self):
+        return self.rows[0]
+
+    def scalars(self):
+        return self
+
+
+class FakeRollupSession:
+    """THONGKEKIEMTRA theo (bài thi, lớp) trong bộ nhớ; GROUP BY trên KETQUA trả `results` {lớp: [điểm]}"""
+
+    def __init__(self, stats, results, max_score=10):
+        self.stats = stats
+        self.results = results
+        self.max_score = max_score
+        self.aggregated = []
+        self._locked = None
+
+    async def execute(self, stmt):
+        entity = stmt.column_descriptions[0].get("entity") if hasattr(stmt, "column_descriptions") else None
+        if isinstance(stmt, Insert):
+            params = stmt.compile().params
+            self._locked = (params["maBaiKiemTra"], params["maLopHoc"])
+            if self._locked in self.stats:
+                return _Rows([])
+            self.stats[self._locked] = ExamStatistic(maBaiKiemTra=self._locked[0], maLopHoc=self._locked[1])
+            return _Rows([(1,)])
+        if entity is Exam:
+            return _Rows([(1, self.max_score)])
+        if entity is ExamStatistic:
+            if stmt.column_descriptions[0]["name"] == "phanBoDiemJson":
+                return _Rows([stat.phanBoDiemJson for stat in self.stats.values()])
+            return _Rows([self.stats[self._locked]])
+        # GROUP BY (lớp, mức điểm) của _aggregate
+        self.aggregated.append(stmt)
+        return _Rows([
+            (class_id, centi, n)
+            for class_id, scores in self.results.items()
+            for centi, n in ScoreRollup.from_scores(scores).histogram.items()
+        ])
+
+    async def scalar(self, stmt):
+        if stmt.column_descriptions[0].get("entity") is Exam:
+            return self.max_score
+        return sum(len(scores) for scores in self.results.values())
+
+    async def flush(self):
+        pass
+
+
+def _stat(class_id, scores):
+    stat = ExamStatistic(maBaiKiemTra=1, maLopHoc=class_id)
+    write_rollup(stat, ScoreRollup.from_scores(scores))
+    return stat
+
+
+def test_apply_updates_existing_rows_and_rebuilds_missing_or_desynced_ones():
+    stats = {(1, 10): _stat(10, [5, 7]), (1, 20): _stat(20, [4])}
+    # Lớp 10 đổi 5 -> 9; KETQUA lớp 20 có điểm 6 nhưng rollup còn giữ 4 (lệch)
+    db = FakeRollupSession(stats, {20: [6, 8]})
+    changes = [
+        ScoreChange(1, 10, Decimal("5"), Decimal("9")),
+        ScoreChange(1, 20, Decimal("6"), Decimal("8")),
+    ]
+    assert asyncio.run(ExamRollupService.apply(db, changes)) == 2
+
+    assert ScoreRollup.from_json(stats[(1, 10)].phanBoDiemJson).histogram == {700: 1, 900: 1}
+    assert stats[(1, 10)].diemTrungBinh == Decimal("8.0")
+    # Điểm cũ 6 không có trong histogram: dựng lại lớp 20 từ KETQUA thay vì trừ count/sum
+    assert ScoreRollup.from_json(stats[(1, 20)].phanBoDiemJson).histogram == {600: 1, 800: 1}
+    assert len(db.aggregated) == 1
+
+    # Lớp 30 chưa có dòng thống kê: dựng từ KETQUA
+    db = FakeRollupSession(stats, {30: [3]})
+    asyncio.run(ExamRollupService.apply(db, [ScoreChange(1, 30, None, Decimal("3"))]))
+    assert stats[(1, 30)].soLuongThamGia == 1 and len(db.aggregated) == 1
+
+
+def test_get_rollup_falls_back_when_a_class_has_no_statistic_row():
+    stats = {(1, 10): _stat(10, [5, 7])}
+    db = FakeRollupSession(stats, {10: [5, 7]})
+    rollup, _ = asyncio.run(ExamRollupService.get_rollup(db, 1))
+    assert rollup.count == 2 and db.aggregated == []
+
+    # Lớp 20 có kết quả nhưng chưa có dòng thống kê: tính từ KETQUA
+    db = FakeRollupSession(stats, {10: [5, 7], 20: [9]})
+    rollup, _ = asyncio.run(ExamRollupService.get_rollup(db, 1))
+    assert (rollup.count, rollup.maximum) == (3, 9.0) and len(db.aggregated) == 1
+
+
+def test_move_students_moves_scores_between_class_rollups(monkeypatch):
+    applied = []
+
+    async def apply(db, changes):
+        applied.extend(changes)
+        return len(changes)
+
+    class _Session:
+        async def execute(self, stmt):
+            return _Rows([(1, 5, Decimal("7.5")), (2, 5, Decimal("4"))])
+
+    monkeypatch.setattr(ExamRollupService, "apply", staticmethod(apply))
+    asyncio.run(ExamRollupService.move_students(_Session(), {5: (10, 20), 6: (10, 10)}))
+    assert applied == [
+        ScoreChange(1, 10, Decimal("7.5"), None), ScoreChange(1, 20, None, Decimal("7.5")),
+        ScoreChange(2, 10, Decimal("4"), None), ScoreChange(2, 20, None, Decimal("4")),
+    ]
@@ -0,0 +1,33 @@
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+np = pytest.importorskip("numpy")
+
+from app.omr.image_io import SheetImage, decode_image, persist_image, read_image, sniff_image_format
+
+
+def _encoded(ext=".jpg"):
+    image = np.full((20, 30, 3), 200, dtype=np.uint8)
+    return cv2.imencode(ext, image)[1].tobytes()
+
+
+def test_sniff_and_decode_in_memory():
+    assert sniff_image_format(_encoded(".jpg")) == "jpeg"
+    assert sniff_image_format(_encoded(".png")) == "png"
+    assert sniff_image_format(b"%PDF-1.4") is None
+    assert decode_image(b"not an image") is None
+
+    image = read_image(SheetImage(_encoded(".png"), "sheet.png"))
+    assert image.shape == (20, 30, 3)
+    assert decode_image(_encoded(".png"), cv2.IMREAD_GRAYSCALE).shape == (20, 30)
+
+
+def test_persist_then_read_from_disk(tmp_path):
+    data = _encoded(".jpg")
+    sheet = SheetImage(data, "sheet.jpg", str(tmp_path / "scans" / "sheet.jpg"))
+    assert persist_image(sheet) == sheet.path
+    assert (tmp_path / "scans" / "sheet.jpg").read_bytes() == data
+    assert read_image(sheet.path, check_format=True).shape == (20, 30, 3)
+
+    (tmp_path / "fake.jpg").write_bytes(b"plain text")
+    assert read_image(str(tmp_path / "fake.jpg"), check_format=True) is None
@@ -0,0 +1,113 @@
+import glob
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+from app.omr.detection import predict_filled
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..", "..")
+MODEL_PATH = os.getenv("OMR_MODEL_PATH", os.path.join(BACKEND_DIR, "app", "omr", "models", "best.pt"))
+DATASET_DIR = os.path.join(BACKEND_DIR, "..", "AI", "dataset")
+
+
+def _dataset_rois():
+    paths = sorted(glob.glob(os.path.join(DATASET_DIR, "valid", "images", "*.jpg")) +
+                   glob.glob(os.path.join(DATASET_DIR, "test", "images", "*.jpg")))
+    return [cv2.imread(p) for p in paths]
+
+
+@pytest.mark.skipif(not os.path.exists(MODEL_PATH), reason="bubble model weights not available")
+def test_onnx_backend_matches_ultralytics(tmp_path):
+    YOLO = pytest.importorskip("ultralytics").YOLO
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    from app.omr.inference import load_onnx_classifier
+
+    rois = _dataset_rois()
+    assert rois, "no images found under AI/dataset"
+
+    model_path = tmp_path / "best.pt"
+    shutil.copy(MODEL_PATH, model_path)
+    torch_filled = predict_filled(rois, YOLO(str(model_path)), conf=0.4)
+    onnx_filled = predict_filled(rois, load_onnx_classifier(str(model_path)), conf=0.4)
+
+    mismatches = np.flatnonzero(torch_filled != onnx_filled)
+    assert len(mismatches) == 0, f"{len(mismatches)}/{len(rois)} fill decisions differ"
+
+
+def _fixture_model(path, imgsz=(64, 64), stride=32):
+    """
+    Model ONNX nhỏ có cùng giao diện với bubble classifier export từ ultralytics: đầu vào (B, 3, H, W) động,
+    đầu ra (B, 4 + 2 class, 1 anchor), metadata imgsz / stride. Điểm class 0 = 1 - độ sáng trung bình.
+    """
+    onnx = pytest.importorskip("onnx")
+    from onnx import TensorProto, helper
+
+    nodes = [
+        helper.make_node("ReduceMean", ["images"], ["mean"], axes=[1, 2, 3], keepdims=1),
+        helper.make_node("Reshape", ["mean", "shape"], ["brightness"]),
+        helper.make_node("Sub", ["one", "brightness"], ["darkness"]),
+        helper.make_node("Mul", ["brightness", "zero"], ["box"]),
+        helper.make_node("Concat", ["box", "box", "box", "box", "darkness", "brightness"], ["output0"], axis=1),
+    ]
+    graph = helper.make_graph(
+        nodes, "bubble_fixture",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT, ["batch", 3, "height", "width"])],
+        [helper.make_tensor_value_info("output0", TensorProto.FLOAT, ["batch", 6, 1])],
+        initializer=[
+            helper.make_tensor("shape", TensorProto.INT64, [3], [-1, 1, 1]),
+            helper.make_tensor("one", TensorProto.FLOAT, [], [1.0]),
+            helper.make_tensor("zero", TensorProto.FLOAT, [], [0.0]),
+        ],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    for key, value in {"imgsz": str(list(imgsz)), "stride": str(stride)}.items():
+        entry = model.metadata_props.add()
+        entry.key, entry.value = key, value
+    onnx.save(model, str(path))
+    return str(path)
+
+
+def test_letterbox_matches_ultralytics_geometry():
+    from app.omr.inference import letterbox
+
+    wide = np.zeros((30, 60, 3), dtype=np.uint8)
+    # Cùng kích thước (auto): chỉ pad tới bội của stride, 30x60 -> 32x64 không viền
+    assert letterbox(wide, (64, 64), auto=True).shape == (32, 64, 3)
+    # Khác kích thước: pad đủ imgsz, viền 114 chia đều trên / dưới
+    boxed = letterbox(wide, (64, 64), auto=False)
+    assert boxed.shape == (64, 64, 3)
+    assert (boxed[:16] == 114).all() and (boxed[16:48] == 0).all() and (boxed[48:] == 114).all()
+
+
+def test_letterbox_matches_ultralytics_transform():
+    augment = pytest.importorskip("ultralytics.data.augment")
+    from app.omr.inference import letterbox
+
+    rng = np.random.default_rng(0)
+    for shape in [(54, 54, 3), (30, 60, 3), (41, 23, 3)]:
+        img = rng.integers(0, 255, shape, dtype=np.uint8)
+        for auto in (True, False):
+            expected = augment.LetterBox((64, 64), auto=auto, stride=32)(image=img)
+            np.testing.assert_array_equal(letterbox(img, (64, 64), auto=auto), expected)
+
+
+def test_onnx_classifier_runs_fixture_model_with_letterbox(tmp_path):
+    pytest.importorskip("onnxruntime")
+    from app.omr.inference import OnnxBubbleClassifier
+
+    classifier = OnnxBubbleClassifier(_fixture_model(tmp_path / "bubble.onnx"))
+    assert (classifier.imgsz, classifier.stride) == ((64, 64), 32)
+
+    dark, light = np.zeros((54, 54, 3), np.uint8), np.full((54, 54, 3), 255, np.uint8)
+    assert predict_filled(np.stack([dark, light, dark]), classifier, conf=0.5).tolist() == [True, False, True]
+
+    # ROI rộng lẫn kích thước: viền 114 chiếm nửa ảnh letterbox nên điểm class 0 chỉ còn ~0.78,
+    # trong khi resize thẳng về 64x64 sẽ cho 1.0
+    wide_dark = np.zeros((27, 54, 3), np.uint8)
+    assert predict_filled([wide_dark, dark], classifier, conf=0.85).tolist() == [False, True]
+    assert predict_filled([wide_dark, wide_dark], classifier, conf=0.85).tolist() == [True, True]
@@ -0,0 +1,128 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.models.exam import ExamStatistic
+from app.services import item_analysis_service as module
+from app.services.answer_key_cache import CompiledAnswerKey
+from app.services.item_analysis_service import AnswerVocabulary, ItemAccumulator, ItemAnalysisService
+
+
+def _analyze(answer_key, sheets, totals, chunk):
+    vocabulary = AnswerVocabulary()
+    q_ids = list(answer_key)
+    key_ids = np.array([vocabulary.id_of(answer_key[q]) for q in q_ids], dtype=np.int32)
+    accumulator = ItemAccumulator(q_ids, key_ids)
+    for start in range(0, len(sheets), chunk):
+        ids = vocabulary.encode(q_ids, sheets[start:start + chunk])
+        correct = (ids == key_ids) & (ids != vocabulary.blank_id)
+        accumulator.add(ids, correct, np.asarray(totals[start:start + chunk], dtype=np.float64), len(vocabulary))
+    return accumulator.result(vocabulary)
+
+
+def test_chunked_item_statistics_match_direct_computation():
+    rng = np.random.default_rng(3)
+    answer_key = {"1": "A", "2": "C", "3": "B"}
+    choices = np.array(["A", "B", "C", "D", ""])
+    sheets = [{q: str(rng.choice(choices)).lower() for q in answer_key} for _ in range(200)]
+    correct = np.array([[s[q].upper() == answer_key[q] for q in answer_key] for s in sheets])
+    totals = correct.sum(axis=1) + rng.random(200)
+
+    result = _analyze(answer_key, sheets, totals.tolist(), chunk=37)
+    assert result["sheetCount"] == 200
+
+    order = np.argsort(-totals, kind="stable")
+    group = round(200 * 0.27)
+    for q, question in enumerate(result["questions"]):
+        p = correct[:, q].mean()
+        assert question["pValue"] == pytest.approx(p, abs=1e-4)
+        assert question["discrimination"] == pytest.approx(
+            correct[order[:group], q].mean() - correct[order[-group:], q].mean(), abs=1e-4
+        )
+        assert question["pointBiserial"] == pytest.approx(np.corrcoef(correct[:, q], totals)[0, 1], abs=1e-4)
+        # Phương án được chuẩn hóa chữ hoa, đáp án đúng được đánh dấu, tổng số lượt chọn bằng số phiếu
+        options = {o["answer"]: o for o in question["options"]}
+        assert sum(o["count"] for o in options.values()) == 200
+        assert options[answer_key[question["questionId"]]]["isKey"]
+        assert options[""]["isBlank"] and question["blankRate"] == options[""]["share"]
+
+
+def test_constant_item_has_no_correlation():
+    result = _analyze({"1": "A"}, [{"1": "A"}, {"1": "a"}], [1.0, 2.0], chunk=10)
+    question = result["questions"][0]
+    assert question["pValue"] == 1.0 and question["difficulty"] == "de"
+    assert question["pointBiserial"] is None
+    assert question["options"] == [{"answer": "A", "isKey": True, "isBlank": False, "count": 2, "share": 1.0, "meanScore": 1.5}]
+
+
+class _Scalars:
+    def __init__(self, value):
+        self.value = value
+
+    def scalars(self):
+        return self
+
+    def first(self):
+        return self.value
+
+
+class _StatSession:
+    def __init__(self, stat):
+        self.stat = stat
+        self.commits = 0
+
+    async def execute(self, stmt):
+        return _Scalars(self.stat)
+
+    async def commit(self):
+        self.commits += 1
+
+
+def test_stored_class_analysis_is_stale_after_answer_key_change(monkeypatch):
+    key = CompiledAnswerKey(1, {"123": {"1": "A"}}, None)
+    stored = {"resultCount": 2, "answerKeyVersion": key.version, "forms": {}}
+    stat = ExamStatistic(maBaiKiemTra=1, maLopHoc=10, soLuongThamGia=2, thongKeCauHoiJson=stored)
+    refreshed = []
+
+    async def current_key(db, exam_id):
+        return key
+
+    async def refresh(db, exam_id, class_id=None):
+        refreshed.append(class_id)
+        return {"classes": {class_id: {"resultCount": 2, "answerKeyVersion": key.version}}}
+
+    monkeypatch.setattr(module.answer_key_cache, "get", current_key)
+    monkeypatch.setattr(ItemAnalysisService, "refresh", staticmethod(refresh))
+
+    assert asyncio.run(ItemAnalysisService.get_class_analysis(_StatSession(stat), 1, 10)) is stored
+    # Cùng số kết quả nhưng đáp án đã sửa: tính lại, chỉ cho lớp được hỏi
+    key = CompiledAnswerKey(1, {"123": {"1": "B"}}, None)
+    asyncio.run(ItemAnalysisService.get_class_analysis(_StatSession(stat), 1, 10))
+    assert refreshed == [10]
+
+
+def test_refresh_of_one_class_only_touches_that_class(monkeypatch):
+    ensured = []
+    stat = ExamStatistic(maBaiKiemTra=1, maLopHoc=10)
+
+    async def analyze(db, exam_id, class_id=None):
+        return {"exam": None, "classes": {10: {"forms": {}}}}
+
+    async def ensure_statistic(db, exam_id, class_id):
+        ensured.append((exam_id, class_id))
+        return stat
+
+    async def rebuild(db, exam_id):
+        raise AssertionError("refresh must not rebuild the whole exam")
+
+    monkeypatch.setattr(ItemAnalysisService, "analyze", staticmethod(analyze))
+    monkeypatch.setattr(module.ExamRollupService, "ensure_statistic", staticmethod(ensure_statistic))
+    monkeypatch.setattr(module.ExamRollupService, "rebuild", staticmethod(rebuild))
+
+    db = _StatSession(None)
+    asyncio.run(ItemAnalysisService.refresh(db, 1, 10))
+    assert ensured == [(1, 10)] and db.commits == 1
+    assert stat.thongKeCauHoiJson == {"forms": {}}
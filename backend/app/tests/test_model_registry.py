@@ -0,0 +1,48 @@
+import os
+
+from app.omr.model_registry import ModelRegistry
+
+
+class FakeModel:
+    def __init__(self, path):
+        self.path = path
+        self.calls = 0
+
+    def __call__(self, images, **kwargs):
+        self.calls += 1
+        return []
+
+
+def test_model_loaded_once_and_warmed_up(tmp_path):
+    model_file = tmp_path / "best.pt"
+    model_file.write_bytes(b"weights")
+    loads = []
+
+    def loader(path):
+        loads.append(path)
+        return FakeModel(path)
+
+    registry = ModelRegistry(loader=loader)
+    first = registry.get(str(model_file))
+    second = registry.get(str(model_file))
+
+    assert first is second
+    assert len(loads) == 1
+    assert first.calls == 1  # warm-up batch
+    stats = registry.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+
+def test_model_reloaded_when_file_changes(tmp_path):
+    model_file = tmp_path / "best.pt"
+    model_file.write_bytes(b"weights")
+    registry = ModelRegistry(loader=FakeModel)
+
+    first = registry.get(str(model_file))
+    mtime = os.path.getmtime(model_file)
+    os.utime(model_file, (mtime + 10, mtime + 10))
+    second = registry.get(str(model_file))
+
+    assert first is not second
+    assert registry.stats()["reloads"] == 1
@@ -0,0 +1,178 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy.sql.dml import Update
+
+import app.models  # noqa: F401  (đăng ký mọi model cho relationship của OMRJob)
+from app.models.omr_job import OMRJob, OMRJobItem
+from app.services import omr_job_service as module
+from app.services import omr_result_cache as cache_module
+from app.services.omr_job_service import JOB_DONE, JOB_FAILED, JOB_PENDING, JOB_RUNNING, OMRJobRunner
+from app.services.omr_result_cache import OMRResultCache
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "..", "omr", "templates", "12-4-6", "template.json")
+
+
+class _Rows:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def scalar_one_or_none(self):
+        return self.rows[0] if self.rows else None
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self.rows
+
+
+class FakeStore:
+    """Một job và các ảnh của nó, giữ qua các session như database"""
+
+    def __init__(self, job, items, stale=False):
+        self.job = job
+        self.items = items
+        self.stale = stale
+        self.commits = []
+
+    def snapshot(self):
+        return [(item.thuTu, item.trangThai) for item in self.items], (self.job.soAnhDaXuLy, self.job.soAnhLoi)
+
+
+class FakeSession:
+    def __init__(self, store):
+        self.store = store
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        job = self.store.job
+        if isinstance(stmt, Update):
+            # Câu UPDATE nhận job: chỉ job đang chờ, hoặc đang chạy nhưng heartbeat đã hết hạn
+            if job.trangThai == JOB_PENDING or (job.trangThai == JOB_RUNNING and self.store.stale):
+                job.trangThai = JOB_RUNNING
+                return _Rows([job.maCongViec])
+            return _Rows([])
+        pending = sorted((i for i in self.store.items if i.trangThai == JOB_PENDING), key=lambda i: i.thuTu)
+        return _Rows(pending[:stmt._limit])
+
+    async def get(self, model, key):
+        return self.store.job
+
+    async def refresh(self, obj):
+        pass
+
+    async def commit(self):
+        self.store.commits.append(self.store.snapshot())
+
+
+@pytest.fixture
+def runner_env(tmp_path, monkeypatch):
+    sent_batches = []
+    fail_on_batch = {}
+
+    async def fake_pool_run(fn, imgs, *args, **kwargs):
+        sent_batches.append([os.path.basename(p) for p in imgs])
+        if len(sent_batches) in fail_on_batch:
+            raise RuntimeError(fail_on_batch[len(sent_batches)])
+        return [
+            (os.path.basename(p), {"error": f"Không đọc được ảnh: {p}"} if not os.path.exists(p)
+             else {"_metadata": {"sbd": "1000" + os.path.basename(p)[0]}}, None)
+            for p in imgs
+        ]
+
+    async def score(db, exam_id, results, sbd, image_path, save_to_db=False):
+        return {"success": True, "total_score": 10.0}
+
+    async def template_path(template_id, db):
+        return TEMPLATE_PATH
+
+    async def roster(db, exam_id):
+        return types.SimpleNamespace(collisions={})
+
+    async def notify(**kwargs):
+        pass
+
+    monkeypatch.setitem(sys.modules, "app.omr.jobs", types.SimpleNamespace(process_batch_job=object()))
+    monkeypatch.setitem(sys.modules, "app.websocket.omr_socket",
+                        types.SimpleNamespace(get_template_path_from_id=template_path))
+    monkeypatch.setattr(cache_module.omr_worker_pool, "run", fake_pool_run)
+    # Một worker: mỗi chunk của job là đúng một lần gọi pool
+    monkeypatch.setattr(cache_module.omr_worker_pool, "workers", 1, raising=False)
+    monkeypatch.setattr(module, "omr_result_cache",
+                        OMRResultCache(cache_dir=str(tmp_path / "cache"), max_bytes=0, enabled=True, perceptual=False))
+    monkeypatch.setattr(module.OMRDatabaseService, "score_omr_result", staticmethod(score))
+    monkeypatch.setattr(module.student_roster_index, "for_exam", roster)
+    monkeypatch.setattr(module.WebSocketService, "send_omr_progress_update", staticmethod(notify))
+
+    def make_store(done=(), failed=(), missing=(), stale=False):
+        job = OMRJob(maCongViec=7, maBaiKiemTra=1, maMauPhieu=1, maNguoiTao=3, trangThai=JOB_RUNNING,
+                     tuyChonJson={}, tongSoAnh=5, soAnhDaXuLy=len(done) + len(failed), soAnhLoi=len(failed))
+        items = []
+        for i in range(5):
+            path = tmp_path / f"{i}.jpg"
+            if i not in missing:
+                path.write_bytes(f"sheet {i}".encode())
+            status = JOB_DONE if i in done else JOB_FAILED if i in failed else JOB_PENDING
+            items.append(OMRJobItem(maCongViec=7, thuTu=i, tenTapTin=f"{i}.jpg", duongDanAnh=str(path), trangThai=status))
+        store = FakeStore(job, items, stale=stale)
+        monkeypatch.setattr(module, "AsyncSessionLocal", lambda: FakeSession(store))
+        return store
+
+    return make_store, sent_batches, fail_on_batch
+
+
+def test_interrupted_job_resumes_from_pending_items(runner_env):
+    make_store, sent_batches, _ = runner_env
+    # Ảnh 0 đã xong, ảnh 1 đã lỗi trước khi process cũ chết; ảnh 3 đã bị dọn khỏi đĩa
+    store = make_store(done={0}, failed={1}, missing={3}, stale=True)
+
+    asyncio.run(OMRJobRunner(concurrency=1, chunk_size=2, stale_seconds=60)._run_job(7))
+
+    assert sent_batches == [["2.jpg", "3.jpg"], ["4.jpg"]]
+    assert [item.trangThai for item in store.items] == [JOB_DONE, JOB_FAILED, JOB_DONE, JOB_FAILED, JOB_DONE]
+    assert "Không đọc được ảnh" in store.items[3].thongBaoLoi
+    assert (store.job.trangThai, store.job.soAnhDaXuLy, store.job.soAnhLoi) == (JOB_DONE, 5, 2)
+
+
+def test_job_running_elsewhere_is_not_claimed(runner_env):
+    make_store, sent_batches, _ = runner_env
+    store = make_store(stale=False)
+
+    async def scenario():
+        await OMRJobRunner(concurrency=1, chunk_size=2, stale_seconds=3600)._run_job(7)
+
+    asyncio.run(scenario())
+    assert sent_batches == [] and store.job.soAnhDaXuLy == 0
+
+
+def test_each_item_is_checkpointed_before_a_crash(runner_env):
+    make_store, sent_batches, fail_on_batch = runner_env
+    store = make_store()
+    store.job.trangThai = JOB_PENDING
+    fail_on_batch[2] = "worker died"
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(OMRJobRunner(concurrency=1, chunk_size=2, stale_seconds=60)._run_job(7))
+
+    # Mỗi ảnh của chunk đầu được commit riêng cùng bộ đếm của job
+    statuses = [status for _, status in store.commits[-1][0]]
+    assert statuses == [JOB_DONE, JOB_DONE, JOB_PENDING, JOB_PENDING, JOB_PENDING]
+    assert [counters for _, counters in store.commits[-2:]] == [(1, 0), (2, 0)]
+
+    # Lần chạy lại (heartbeat đã hết hạn) chỉ xử lý các ảnh còn chờ
+    store.stale = True
+    asyncio.run(OMRJobRunner(concurrency=1, chunk_size=2, stale_seconds=60)._run_job(7))
+    assert sent_batches[2:] == [["2.jpg", "3.jpg"], ["4.jpg"]]
+    assert (store.job.trangThai, store.job.soAnhDaXuLy, store.job.soAnhLoi) == (JOB_DONE, 5, 0)
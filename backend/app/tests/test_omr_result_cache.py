@@ -0,0 +1,157 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.omr.image_io import SheetImage
+from app.services import omr_result_cache as module
+from app.services.omr_result_cache import OMRResultCache, content_hash
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "..", "omr", "templates", "12-4-6", "template.json")
+
+
+def _sheet(filled=()):
+    page = np.full((1400, 1000, 3), 235, dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    for x, y in rng.integers(60, 940, (150, 2)).tolist():
+        cv2.circle(page, (x, y), 11, (40, 40, 40), 2)
+    for x, y in filled:
+        cv2.circle(page, (x, y), 9, (20, 20, 20), -1)
+    return page
+
+
+def _jpeg(page, quality=95):
+    return cv2.imencode(".jpg", page, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def test_exact_hit_returns_results_and_aligned_image(tmp_path):
+    cache = OMRResultCache(cache_dir=str(tmp_path), max_bytes=0, enabled=True, perceptual=False)
+    context = cache._context_key(TEMPLATE_PATH, 1, "missing.pt", 0.4, True)
+    assert context != cache._context_key(TEMPLATE_PATH, 1, "missing.pt", 0.5, True)
+
+    first = SheetImage(_jpeg(_sheet()), "a.jpg")
+    results = {"q1": "A", "_metadata": {"sbd": "123456", "filename": "a"}}
+    cache._store(context, content_hash(first), first, results, aligned=_sheet())
+
+    again = SheetImage(first.data, "b.jpg")
+    cached, _ = cache._lookup(context, content_hash(again), again)
+    assert cached.results == results and cached.match == "exact"
+    assert cv2.imread(str(cached.aligned_path)).shape == (1400, 1000, 3)
+    assert cache._as_hit(again, cached)[1]["_metadata"]["filename"] == "b"
+
+    other = SheetImage(_jpeg(_sheet(), 80), "c.jpg")
+    assert cache._lookup(context, content_hash(other), other)[0] is None
+
+
+def test_context_separates_inference_backends(tmp_path, monkeypatch):
+    cache = OMRResultCache(cache_dir=str(tmp_path), max_bytes=0, enabled=True, perceptual=False)
+    monkeypatch.setattr(module.settings, "OMR_INFERENCE_BACKEND", "ultralytics")
+    ultralytics_context = cache._context_key(TEMPLATE_PATH, 1, "missing.pt", 0.4, True)
+    monkeypatch.setattr(module.settings, "OMR_INFERENCE_BACKEND", "onnx")
+    assert cache._context_key(TEMPLATE_PATH, 1, "missing.pt", 0.4, True) != ultralytics_context
+
+
+def test_perceptual_match_ignores_reencoding_but_not_new_marks(tmp_path):
+    cache = OMRResultCache(cache_dir=str(tmp_path), max_bytes=0, enabled=True, perceptual=True)
+    context = "ctx"
+    original = SheetImage(_jpeg(_sheet()), "a.jpg")
+    cache._store(context, content_hash(original), original, {"q1": "A"})
+
+    reencoded = SheetImage(_jpeg(cv2.resize(_sheet(), (500, 700), interpolation=cv2.INTER_AREA), 70), "b.jpg")
+    cached, _ = cache._lookup(context, content_hash(reencoded), reencoded)
+    assert cached is not None and cached.match == "perceptual"
+
+    marked = SheetImage(_jpeg(_sheet(filled=[(500, 700)])), "c.jpg")
+    assert cache._lookup(context, content_hash(marked), marked)[0] is None
+
+
+def test_prune_evicts_least_recently_used_entries(tmp_path):
+    cache = OMRResultCache(cache_dir=str(tmp_path), max_bytes=0, enabled=True, perceptual=False)
+    sheets = [SheetImage(f"sheet {i}".encode(), f"{i}.jpg") for i in range(3)]
+    for index, sheet in enumerate(sheets):
+        cache._store("ctx", content_hash(sheet), sheet, {"q1": "A" * 100})
+        path = cache._entry_path("ctx" + content_hash(sheet), ".json")
+        os.utime(path, (1000 + index, 1000 + index))
+    cache._lookup("ctx", content_hash(sheets[0]), sheets[0])
+
+    cache.max_bytes = 2 * os.path.getsize(path)
+    assert cache.prune() == 1
+    assert cache._lookup("ctx", content_hash(sheets[0]), sheets[0])[0] is not None
+    assert cache._lookup("ctx", content_hash(sheets[1]), sheets[1])[0] is None
+
+
+def test_unreadable_path_is_a_miss_and_gets_the_workers_error(tmp_path, monkeypatch):
+    import asyncio
+    import sys
+    import types
+
+    from app.services import omr_result_cache as module
+
+    # Chỉ cần tên hàm job; worker pool được thay bằng fake nên pipeline (ultralytics) không được import
+    monkeypatch.setitem(sys.modules, "app.omr.jobs", types.SimpleNamespace(process_batch_job=object()))
+
+    cache = OMRResultCache(cache_dir=str(tmp_path), max_bytes=0, enabled=True, perceptual=True)
+    good = SheetImage(_jpeg(_sheet()), "good.jpg")
+    sent = []
+
+    async def fake_run(fn, imgs, *args, **kwargs):
+        sent.extend(imgs)
+        return [
+            (os.path.basename(str(img)), {"error": "Không đọc được ảnh"}, None) if isinstance(img, str)
+            else ("good", {"q1": "A"}, None)
+            for img in imgs
+        ]
+
+    monkeypatch.setattr(module.omr_worker_pool, "run", fake_run)
+    missing = str(tmp_path / "deleted" / "x.jpg")
+    sheets = asyncio.run(cache.process_batch([missing, good], TEMPLATE_PATH, 1, model_path="missing.pt"))
+
+    # Ảnh mất vẫn được gửi sang worker và nhận lỗi riêng, ảnh còn lại được xử lý và lưu cache bình thường
+    assert sent == [missing, good]
+    assert sheets[0][1] == {"error": "Không đọc được ảnh"}
+    assert sheets[1][1] == {"q1": "A"}
+    assert cache.misses == 2
+
+
+def test_encoded_output_is_cached_as_jpeg_bytes(tmp_path, monkeypatch):
+    import asyncio
+    import sys
+    import types
+    from typing import NamedTuple, Optional
+
+    from app.services import omr_result_cache as module
+
+    class EncodedSheet(NamedTuple):
+        aligned_jpeg: bytes
+        annotated_jpeg: Optional[bytes] = None
+
+    jobs = types.SimpleNamespace(EncodedSheet=EncodedSheet, process_sheet_job=object(), render_annotation_job=object())
+    monkeypatch.setitem(sys.modules, "app.omr.jobs", jobs)
+    aligned_jpeg = _jpeg(_sheet())
+    calls = []
+
+    async def fake_run(fn, *args, **kwargs):
+        calls.append((fn, kwargs))
+        if fn is jobs.process_sheet_job:
+            return "a", {"q1": "A", "_metadata": {"ma_de": "101"}}, EncodedSheet(aligned_jpeg, b"annotated")
+        return b"annotated from cache"
+
+    monkeypatch.setattr(module.omr_worker_pool, "run", fake_run)
+    cache = OMRResultCache(cache_dir=str(tmp_path), max_bytes=0, enabled=True, perceptual=False)
+    sheet = SheetImage(_jpeg(_sheet(filled=[(300, 300)])), "a.jpg")
+    keys = {"101": {"q1": "A"}}
+
+    _, _, first = asyncio.run(cache.process_sheet(sheet, TEMPLATE_PATH, 1, model_path="missing.pt",
+                                                  jpeg_quality=85, annotation_keys=keys))
+    assert first == EncodedSheet(aligned_jpeg, b"annotated")
+    assert calls[0][1]["jpeg_quality"] == 85 and calls[0][1]["annotation_keys"] == keys
+
+    # Lần sau: JPEG đã lưu được trả nguyên, annotation vẽ trong worker từ ảnh cache theo đáp án mã đề 101
+    _, _, again = asyncio.run(cache.process_sheet(sheet, TEMPLATE_PATH, 1, model_path="missing.pt",
+                                                  jpeg_quality=85, annotation_keys=keys))
+    assert again == EncodedSheet(aligned_jpeg, b"annotated from cache")
+    assert calls[1][0] is jobs.render_annotation_job and calls[1][1]["answer_key"] == {"q1": "A"}
+    assert (cache.hits, cache.misses) == (1, 1)
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy.dialects import postgresql
+
+from app.services.omr_result_writer import SheetResultRow, upsert_sheet_results
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+
+class FakeSession:
+    """Ghi lại câu SQL và trả về RETURNING giả lập"""
+
+    def __init__(self):
+        self.statements = []
+
+    async def execute(self, stmt):
+        sql = str(stmt.compile(dialect=postgresql.dialect()))
+        self.statements.append(sql)
+        if sql.startswith('INSERT INTO "PHIEUTRALOI"'):
+            return FakeResult([(1, 10, 100, True), (1, 11, 101, False)])
+        return FakeResult([(1, 11, 501), (1, 10, 500)])
+
+
+def test_upsert_links_sheets_and_reports_outcomes():
+    rows = [
+        SheetResultRow(1, 10, {"q1": "A"}, 1.0, 1, 0, 0, []),
+        SheetResultRow(1, 11, {}, 0.0, 0, 0, 1, []),
+        SheetResultRow(1, 10, {"q1": "B"}, 0.0, 0, 1, 0, []),
+    ]
+    db = FakeSession()
+    outcomes = asyncio.run(upsert_sheet_results(db, rows, update_statistics=False))
+
+    assert len(db.statements) == 2
+    assert "ON CONFLICT ON CONSTRAINT uq_phieutraloi_mabkt_mahs" in db.statements[0]
+    assert "ON CONFLICT ON CONSTRAINT uq_ketqua_mabkt_mahs" in db.statements[1]
+    # Học sinh 10 xuất hiện hai lần: chỉ dòng sau được ghi
+    assert db.statements[0].count("%(maHocSinh_m") == 2
+    assert [o["status"] for o in outcomes] == ["superseded", "updated", "inserted"]
+    assert [(o["answer_sheet_id"], o["result_id"]) for o in outcomes] == [(100, 500), (101, 501), (100, 500)]
@@ -0,0 +1,28 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("pydantic_settings")
+
+from app.services.omr_worker_pool import OMRWorkerPool, OMRQueueFullError
+
+
+def test_queue_full_rejects_and_recovers():
+    release = threading.Event()
+    pool = OMRWorkerPool(workers=0, max_queue=2)
+
+    async def scenario():
+        jobs = [asyncio.create_task(pool.run(release.wait, 5)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        with pytest.raises(OMRQueueFullError):
+            await pool.run(sum, [1, 2])
+        release.set()
+        assert await asyncio.gather(*jobs) == [True, True]
+        return await pool.run(sum, [1, 2])
+
+    assert asyncio.run(scenario()) == 3
+    stats = pool.stats()
+    assert stats["rejected"] == 1
+    assert stats["completed"] == 3
+    assert stats["pending"] == 0
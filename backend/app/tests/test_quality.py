@@ -0,0 +1,50 @@
+import os
+
+import cv2
+import numpy as np
+
+from app.omr.quality import QualityThresholds, assess_frame
+from app.omr.template import get_compiled_template
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "..", "omr", "templates")
+
+
+def _jpeg(image):
+    return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+
+
+def test_good_sheet_passes_and_bad_frames_get_hints():
+    sheet = cv2.imread(os.path.join(TEMPLATES_DIR, "12-4-6", "12-4-6.png"))
+    h, w = sheet.shape[:2]
+    desk = np.full((h + 800, w + 800, 3), 50, dtype=np.uint8)
+    desk[400:400 + h, 400:400 + w] = sheet
+    assert assess_frame(_jpeg(sheet)).ok
+    assert assess_frame(_jpeg(desk)).ok
+
+    blurry = assess_frame(_jpeg(cv2.GaussianBlur(sheet, (0, 0), 6)))
+    assert blurry.issues == ["blurry"] and blurry.hints
+
+    dark = assess_frame(_jpeg((sheet * 0.2).astype(np.uint8)))
+    assert "too_dark" in dark.issues
+
+    # Tờ phiếu lệch sang phải, mất 2 marker góc trái
+    shifted = np.full_like(desk, 50)
+    shifted[400:400 + h, 1200:] = sheet[:, :w - 400]
+    assert assess_frame(_jpeg(shifted)).issues == ["no_markers"]
+
+    assert assess_frame(b"not an image").issues == ["no_page"]
+
+
+def test_thresholds_come_from_template_config():
+    compiled = get_compiled_template(os.path.join(TEMPLATES_DIR, "40-8-0", "template.json"))
+    assert compiled.quality_thresholds.require_markers is False
+    assert get_compiled_template(os.path.join(TEMPLATES_DIR, "12-4-6", "template.json")).quality_thresholds == QualityThresholds()
+
+    custom = QualityThresholds.from_config({"minSharpness": 80, "reduce": 2})
+    assert custom.min_sharpness == 80.0 and custom.reduce == 2
+    assert QualityThresholds.from_config({"reduce": 3}) == QualityThresholds()
+    # Chuỗi "false" không được hiểu là True; giá trị không phải boolean thì bỏ cả cấu hình
+    assert QualityThresholds.from_config({"requireMarkers": "false"}).require_markers is False
+    assert QualityThresholds.from_config({"requireMarkers": "1"}).require_markers is True
+    assert QualityThresholds.from_config({"requireMarkers": False}).require_markers is False
+    assert QualityThresholds.from_config({"requireMarkers": "no", "minSharpness": 80}) == QualityThresholds()
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.services import regrade_service as module
+from app.services.answer_key_cache import CompiledAnswerKey
+from app.services.regrade_service import AnswerKeyRegrader, merge_changes
+
+OLD_KEY = {"123": {"1": "A", "2": "B"}, "456": {"1": "C", "2": "D"}}
+NEW_KEY = {"123": {"1": "A", "2": "C"}, "456": {"1": "C", "2": "D"}}
+
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+    def scalar_one(self):
+        return self.value
+
+    def all(self):
+        return self.value
+
+
+class FakeSession:
+    """Trả lần lượt: số kết quả của bài thi, rồi các chunk (maPhieuTraLoi, cauTraLoiJson, maKetQua), sau đó kết quả rỗng"""
+
+    def __init__(self, total, *chunks):
+        self.responses = [_Result(total)] + [_Result(chunk) for chunk in chunks] + [_Result([])]
+        self.commits = 0
+        self.statements = []
+
+    async def execute(self, stmt):
+        self.statements.append(stmt)
+        return self.responses.pop(0) if self.responses else _Result(None)
+
+    async def commit(self):
+        self.commits += 1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    sent = []
+
+    async def notify(**kwargs):
+        sent.append(kwargs)
+
+    monkeypatch.setattr(module.WebSocketService, "send_exam_regrade_update", staticmethod(notify))
+    return sent
+
+
+def _sheet(ma_de, **answers):
+    return {"_metadata": {"ma_de": ma_de}, **answers}
+
+
+def test_regrade_rescores_only_sheets_of_changed_ma_de(monkeypatch, updates):
+    written = []
+
+    async def current_key(db, exam_id):
+        return CompiledAnswerKey(exam_id, NEW_KEY, {"1": 1, "2": 1})
+
+    async def update_scores(db, scores):
+        written.extend(scores)
+        return len(scores)
+
+    monkeypatch.setattr(module.answer_key_cache, "get", current_key)
+    monkeypatch.setattr(module, "update_result_scores", update_scores)
+
+    db = FakeSession(3, [
+        (1, _sheet("123", **{"1": "A", "2": "C"}), 11),
+        (2, _sheet("456", **{"1": "C", "2": "D"}), 12),
+        (3, _sheet("123", **{"1": "B", "2": "B"}), 13),
+    ])
+    previous = CompiledAnswerKey(1, OLD_KEY, {"1": 1, "2": 1})
+    summary = asyncio.run(AnswerKeyRegrader(chunk_size=10).regrade(db, 1, previous))
+
+    # Mã đề 456 không đổi đáp án: phiếu 12 không được chấm lại
+    assert [(row["maKetQua"], row["total_score"], row["correct_count"]) for row in written] == [(11, 2.0, 2), (13, 0.0, 0)]
+    assert summary == {"processed": 3, "updated": 2, "failed": 0}
+    # Một commit cho chunk, một cho việc xóa phân tích câu hỏi đã lưu (dùng điểm cũ)
+    assert db.commits == 2
+    assert "thongKeCauHoiJson" in str(db.statements[-1])
+    assert updates[-1]["status"] == "complete"
+
+
+def test_merge_changes_unions_questions_per_ma_de():
+    assert merge_changes({"123": ["2"], None: ["2"]}, {"123": ["1"], "456": ["3"]}) == {
+        "123": ["1", "2"], None: ["2"], "456": ["3"]
+    }
+
+
+def test_pending_enqueues_are_merged(monkeypatch, updates):
+    v1 = CompiledAnswerKey(1, OLD_KEY, None)
+    v2 = CompiledAnswerKey(1, NEW_KEY, None)
+    v3 = CompiledAnswerKey(1, {"123": {"1": "B"}}, None)
+    regrader = AnswerKeyRegrader(chunk_size=10)
+    rounds = []
+
+    async def regrade(db, exam_id, previous):
+        rounds.append(previous)
+        if len(rounds) == 1:
+            # Sửa đáp án khi lượt đầu đang chạy: thành lượt tiếp theo
+            regrader.enqueue(1, v3, {"123": ["1"]})
+
+    monkeypatch.setattr(regrader, "regrade", regrade)
+    monkeypatch.setattr(module, "AsyncSessionLocal", lambda: FakeSession(0))
+
+    async def scenario():
+        regrader.enqueue(1, v1, {None: ["2"], "123": ["2"]})
+        regrader.enqueue(1, v2, {"456": ["1"]})
+        await regrader._tasks[1]
+
+    asyncio.run(scenario())
+
+    # Hai lần sửa trước khi lượt đầu bắt đầu: một lượt, so với đáp án cũ nhất, báo đủ câu của cả hai
+    assert rounds == [v1, v3]
+    queued = [u["details"]["changed_questions"] for u in updates if u["status"] == "queued"]
+    assert queued == [{"None": ["2"], "123": ["2"], "456": ["1"]}, {"123": ["1"]}]
+    assert not regrader.is_running(1)
@@ -0,0 +1,55 @@
+import asyncio
+
+from app.websocket.scan_session import ScanSessionRegistry
+
+
+def test_latest_frame_wins_with_single_worker():
+    async def scenario():
+        registry = ScanSessionRegistry(max_fps=0)
+        session = registry.open("sid", user=object())
+        session.start(exam_id=1, template_id=1)
+
+        processed, running = [], []
+
+        async def process(sess, frame):
+            running.append(frame)
+            assert len(running) == 1
+            await asyncio.sleep(0.01)
+            processed.append(frame)
+            running.remove(frame)
+
+        assert session.submit(b"1", process) == "queued"
+        await asyncio.sleep(0)
+        # Frame 1 đang chạy: frame 2 chờ, frame 3 thay frame 2
+        assert session.submit(b"2", process) == "queued"
+        assert session.submit(b"3", process) == "replaced"
+        await asyncio.sleep(0.05)
+
+        assert processed == [b"1", b"3"]
+        assert session.stats()["frames_replaced"] == 1
+        assert registry.stats()["frames_processed"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_rate_limit_and_close():
+    async def scenario():
+        registry = ScanSessionRegistry(max_fps=10)
+        session = registry.open("sid", user=object())
+        processed = []
+
+        async def process(sess, frame):
+            processed.append(asyncio.get_running_loop().time())
+
+        session.submit(b"1", process)
+        await asyncio.sleep(0)
+        session.submit(b"2", process)
+        await asyncio.sleep(0.15)
+        assert len(processed) == 2 and processed[1] - processed[0] >= 0.09
+
+        session.submit(b"3", process)
+        registry.close("sid")
+        await asyncio.sleep(0.15)
+        assert len(processed) == 2 and "sid" not in registry
+
+    asyncio.run(scenario())
@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.services.student_roster_index import RosterStudent, SBDRoster, StudentRosterIndex, normalize_sbd
+
+
+def make_roster():
+    return SBDRoster([
+        RosterStudent(3, "HS2024001234", "Trần B", 10),
+        RosterStudent(1, "HS2023001234", "Nguyễn A", 11),
+        RosterStudent(2, "HS2024005678", "Lê C", 10),
+        RosterStudent(4, "12345", "Mã quá ngắn", 10),
+    ], class_ids=[10, 11, 12])
+
+
+def test_normalize_sbd():
+    assert normalize_sbd("SBD: 2024-001234") == "001234"
+    assert normalize_sbd("1234") == "1234"
+    assert normalize_sbd("abc") is None
+    assert normalize_sbd(None) is None
+
+
+def test_lookup_and_collisions():
+    roster = make_roster()
+    assert roster.lookup("005678").hoTen == "Lê C"
+    assert roster.lookup("HS2024005678").maHocSinh == 2
+    # SBD trùng: lấy học sinh có maHocSinh nhỏ nhất, và được báo trong collision report
+    assert roster.lookup("001234").maHocSinh == 1
+    assert [c["sbd"] for c in roster.collision_report()] == ["001234"]
+    assert roster.lookup("12345") is None
+    assert roster.lookup("999999") is None
+    assert len(roster) == 3
+
+
+def test_invalidate_classes_drops_affected_rosters():
+    index = StudentRosterIndex()
+    index._store(("exam", 1), make_roster())
+    index._store(("exam", 2), SBDRoster([], class_ids=[20]))
+    index._store(("class", 12), SBDRoster([], class_ids=[12]))
+
+    # Lớp 12 được gán cho bài thi 1 nhưng chưa có học sinh
+    index.invalidate_classes([12])
+    assert index._cached(("exam", 1)) is None
+    assert index._cached(("class", 12)) is None
+    assert index._cached(("exam", 2)) is not None
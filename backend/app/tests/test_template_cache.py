@@ -0,0 +1,51 @@
+import os
+import shutil
+
+from app.omr.template import load_template, get_all_bubbles, get_compiled_template
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "..", "omr", "templates", "12-4-6", "template.json")
+
+
+def test_compiled_template_matches_get_all_bubbles():
+    template = load_template(TEMPLATE_PATH)
+    bubbles = get_all_bubbles(template)
+    compiled = get_compiled_template(TEMPLATE_PATH)
+
+    assert len(compiled) == len(bubbles)
+    assert compiled.bounds.shape == (len(bubbles), 4)
+    for i, bubble in enumerate(bubbles):
+        assert compiled.labels[i] == (bubble["qid"], bubble["choice"])
+        assert tuple(compiled.bounds[i]) == bubble["bounds"]
+    assert sum(s.stop - s.start for s in compiled.field_slices.values()) == len(bubbles)
+
+
+def test_compiled_template_cached_until_file_changes(tmp_path):
+    path = tmp_path / "template.json"
+    shutil.copy(TEMPLATE_PATH, path)
+
+    first = get_compiled_template(str(path), template_id="tmp")
+    assert get_compiled_template(str(path), template_id="tmp") is first
+
+    mtime = os.path.getmtime(path)
+    os.utime(path, (mtime + 10, mtime + 10))
+    assert get_compiled_template(str(path), template_id="tmp") is not first
+
+
+def test_region_sharpening_matches_full_page_inside_bubbles():
+    import cv2
+    import numpy as np
+    from app.omr.detection import sharpen_image_cv, sharpen_regions
+
+    compiled = get_compiled_template(TEMPLATE_PATH)
+    width, height = compiled.page_dimensions
+    page = np.random.default_rng(0).integers(0, 256, (height, width), dtype=np.uint8)
+
+    expected = sharpen_image_cv(page, 1.2)
+    lean = sharpen_regions(page.copy(), compiled.field_regions, strength=1.2)
+    for x1, y1, x2, y2 in compiled.bounds.tolist():
+        assert np.array_equal(lean[y1:y2, x1:x2], expected[y1:y2, x1:x2])
+    # Ngoài vùng bubble ảnh giữ nguyên
+    x1, y1, _, _ = compiled.field_regions.min(axis=0).tolist()
+    if x1 > 0 and y1 > 0:
+        assert np.array_equal(lean[:y1, :x1], page[:y1, :x1])
+    assert cv2.countNonZero(cv2.absdiff(lean, page)) > 0
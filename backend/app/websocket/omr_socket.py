@@ -1,31 +1,24 @@
 """WebSocket handler for real-time OMR processing"""
 
 import socketio
-import asyncio
 import base64
-import io
 import json
 import logging
-import os
-import tempfile
 from typing import Dict, Any, Optional
 from datetime import datetime
-import numpy as np
-from PIL import Image
-import cv2
 from sqlalchemy import select
 from pathlib import Path
 
 from app.core.config import settings
 from app.db.session import AsyncSessionLocal
 from app.services.omr_service import OMRDatabaseService
-from app.omr.main_pipeline import process_single_image, OMRAligner
-from app.omr.template import load_template, get_all_bubbles
+from app.omr.image_io import SheetImage, sniff_image_format
 from app.models.user import User
 from app.models.answer_sheet_template import AnswerSheetTemplate
 from app.core.security import verify_token
-from ultralytics import YOLO
+from app.services.omr_result_cache import omr_result_cache
 from app.services.websocket_service import WebSocketService
+from app.websocket.scan_session import ScanSession, ScanSessionRegistry
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -44,10 +37,12 @@ sio = socketio.AsyncServer(
     ],
     logger=False,
     engineio_logger=False, 
+    # Frame được gửi dạng attachment nhị phân, có thể lớn hơn giới hạn mặc định 1MB
+    max_http_buffer_size=settings.OMR_WS_MAX_FRAME_MB * 1024 * 1024,
 )
 
-# Store active sessions
-active_sessions: Dict[str, Dict[str, Any]] = {}
+# Singleton cho toàn bộ process API
+scan_sessions = ScanSessionRegistry(max_fps=settings.OMR_WS_MAX_FPS)
 
 async def get_template_path_from_id(template_id: int, db) -> str:
     """
@@ -120,17 +115,14 @@ class OMRWebSocketHandler:
             logger.error(f"Authentication error: {e}", exc_info=True)
             return None
     
-    async def process_and_score(self, sid: str, exam_id: int, image_data: bytes):
+    async def process_and_score(self, session: ScanSession, image_data: bytes):
         """
         Quy trình xử lý đầy đủ: gọi OMR-Checker, chấm điểm và gửi cập nhật WS.
+        Được gọi bởi worker của phiên, tối đa một lần chạy đồng thời cho mỗi sid.
         """
-        session_info = active_sessions.get(sid)
-        if not session_info or not session_info.get('user'):
-            logger.error(f"Không tìm thấy session hoặc user cho sid {sid}")
-            return
-
-        user = session_info['user']
-        scanner_user_id = user.maNguoiDung
+        sid = session.sid
+        exam_id = session.exam_id
+        scanner_user_id = session.user.maNguoiDung
 
         try:
             async with AsyncSessionLocal() as db:
@@ -168,100 +160,62 @@ class OMRWebSocketHandler:
                 except Exception as e:
                     logger.warning(f"WebSocket: Could not load JSON answer keys: {e}")
 
-                # Decode base64 image and prepare for processing
+                # Frame JPEG/PNG giữ nguyên dạng bytes: worker decode một lần bằng cv2.imdecode,
+                # không qua PIL, NumPy và file tạm
                 image_data = base64.b64decode(frame_data.split(',')[1] if ',' in frame_data else frame_data)
-                image = Image.open(io.BytesIO(image_data))
-                cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+                if sniff_image_format(image_data) is None:
+                    raise Exception("Frame nhận được không phải ảnh JPEG/PNG hợp lệ.")
+
+                # Căn chỉnh, nhận dạng và vẽ annotation (đáp án theo mã đề nhận diện được) đều chạy trong
+                # worker; chỉ bytes JPEG quay về process API. Frame chưa được lưu nên không có URL annotation
+                fname, omr_results, encoded = await omr_result_cache.process_sheet(
+                    SheetImage(image_data, f"frame_{sid}.jpg"), template_path,
+                    template_id=template_id, conf=0.4,
+                    jpeg_quality=settings.OMR_ANNOTATION_JPEG_QUALITY, annotation_keys=exam_answer_keys
+                )
 
-                # Load OMR components (template, model, aligner)
-                template = load_template(template_path)
-                yolo_model = YOLO("app/omr/models/best.pt")
+                if "error" in omr_results:
+                    raise Exception(omr_results["error"])
+
+                annotated_image_base64 = None
+                if encoded is not None:
+                    # Vẽ annotation lỗi thì trả ảnh căn chỉnh
+                    jpeg = encoded.annotated_jpeg or encoded.aligned_jpeg
+                    if jpeg:
+                        annotated_image_base64 = base64.b64encode(jpeg).decode('utf-8')
+
+                # --- Scoring Logic ---
+                sbd = omr_results.get("_metadata", {}).get("sbd", "")
+                if not sbd:
+                    raise Exception("Không thể nhận diện SBD từ phiếu trả lời.")
                 
-                aligner = None
-                template_dir = os.path.dirname(template_path)
-                ref_images = list(Path(template_dir).glob("*.png")) + list(Path(template_dir).glob("*.jpg"))
-                if ref_images:
-                    aligner = OMRAligner(ref_img_path=str(ref_images[0]))
-
-                # Process in a temporary file
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_file:
-                    cv2.imwrite(tmp_file.name, cv_image)
-                    
-                    try:
-                        fname, omr_results, aligned_img = process_single_image(
-                            tmp_file.name, template, yolo_model, conf=0.4, aligner=aligner, save_files=False
-                        )
-
-                        if "error" in omr_results:
-                            raise Exception(omr_results["error"])
-
-                        # --- Annotation Logic (from omr.py) ---
-                        annotated_image_base64 = None
-                        if aligned_img is not None:
-                            try:
-                                from app.omr.detection import draw_scoring_overlay
-                                bubbles = get_all_bubbles(template)
-                                metadata = omr_results.get("_metadata", {})
-                                ma_de = metadata.get("ma_de", "") 
-
-                                # Get the correct answer key for the detected ma_de
-                                answer_key_for_annotation = {}
-                                if ma_de and str(ma_de) in exam_answer_keys:
-                                    answer_key_for_annotation = exam_answer_keys[str(ma_de)]
-                                
-                                # Create a temporary path for the annotated image
-                                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as anno_tmp:
-                                    draw_scoring_overlay(
-                                        aligned_img.copy(), bubbles, omr_results, 
-                                        answer_key_for_annotation, anno_tmp.name
-                                    )
-                                    # Read back and encode
-                                    with open(anno_tmp.name, 'rb') as f_anno:
-                                        annotated_image_base64 = base64.b64encode(f_anno.read()).decode('utf-8')
-                                    os.unlink(anno_tmp.name) # Clean up temp annotated image
-                                logger.info("WebSocket: Successfully created annotated image.")
-
-                            except Exception as e:
-                                logger.error(f"WebSocket: Annotation drawing failed: {e}")
-                                # Fallback to aligned image if annotation fails
-                                _, buffer = cv2.imencode('.png', aligned_img)
-                                annotated_image_base64 = base64.b64encode(buffer).decode('utf-8')
-
-                        # --- Scoring Logic ---
-                        sbd = omr_results.get("_metadata", {}).get("sbd", "")
-                        if not sbd:
-                            raise Exception("Không thể nhận diện SBD từ phiếu trả lời.")
-                        
-                        score_result = await OMRDatabaseService.score_omr_result(
-                            db=db, exam_id=exam_id, student_answers=omr_results, sbd=sbd, save_to_db=False
-                        )
-
-                        if score_result.get("success"):
-                            return {
-                                "success": True,
-                                "data": {
-                                    **score_result, # Unpack all scoring results
-                                    "aligned_image": f"data:image/jpeg;base64,{annotated_image_base64}" if annotated_image_base64 else None,
-                                    "timestamp": datetime.now().isoformat()
-                                }
-                            }
-                        else:
-                            # Scoring failed (e.g., student not found)
-                             return {
-                                "success": True, # The process succeeded, but scoring failed
-                                "data": {
-                                    "sbd": sbd,
-                                    "exam_code": omr_results.get("_metadata", {}).get("ma_de", ""),
-                                    "answers": {k: v for k, v in omr_results.items() if not k.startswith('_')},
-                                    "score": None,
-                                    "message": score_result.get('error', 'Lỗi chấm điểm'),
-                                    "aligned_image": f"data:image/jpeg;base64,{annotated_image_base64}" if annotated_image_base64 else None,
-                                    "timestamp": datetime.now().isoformat()
-                                }
-                            }
-
-                    finally:
-                        os.unlink(tmp_file.name)
+                score_result = await OMRDatabaseService.score_omr_result(
+                    db=db, exam_id=exam_id, student_answers=omr_results, sbd=sbd, save_to_db=False
+                )
+
+                if score_result.get("success"):
+                    return {
+                        "success": True,
+                        "data": {
+                            **score_result, # Unpack all scoring results
+                            "aligned_image": f"data:image/jpeg;base64,{annotated_image_base64}" if annotated_image_base64 else None,
+                            "timestamp": datetime.now().isoformat()
+                        }
+                    }
+                else:
+                    # Scoring failed (e.g., student not found)
+                     return {
+                        "success": True, # The process succeeded, but scoring failed
+                        "data": {
+                            "sbd": sbd,
+                            "exam_code": omr_results.get("_metadata", {}).get("ma_de", ""),
+                            "answers": {k: v for k, v in omr_results.items() if not k.startswith('_')},
+                            "score": None,
+                            "message": score_result.get('error', 'Lỗi chấm điểm'),
+                            "aligned_image": f"data:image/jpeg;base64,{annotated_image_base64}" if annotated_image_base64 else None,
+                            "timestamp": datetime.now().isoformat()
+                        }
+                    }
 
         except Exception as e:
             logger.error(f"Error processing captured frame: {e}", exc_info=True)
@@ -325,13 +279,7 @@ async def connect(sid, environ, auth):
     user = await omr_handler.authenticate_user(auth['token'])
     if user:
         logger.info(f"Authentication successful for sid {sid}, user: {user.email}")
-        active_sessions[sid] = {
-            'user': user,
-            'connected_at': datetime.now(),
-            'exam_id': None,
-            'template_id': None,
-            'scanning': False
-        }
+        scan_sessions.open(sid, user)
         await sio.emit('connected', {'message': 'Kết nối thành công'}, to=sid)
     else:
         logger.warning(f"Authentication failed for sid {sid}. Disconnecting.")
@@ -342,8 +290,7 @@ async def connect(sid, environ, auth):
 async def disconnect(sid):
     """Handle client disconnection"""
     logger.info(f"Client {sid} disconnected")
-    if sid in active_sessions:
-        del active_sessions[sid]
+    scan_sessions.close(sid)
 
 @sio.event
 async def start_scanning(sid, data):
@@ -356,10 +303,9 @@ async def start_scanning(sid, data):
             await sio.emit('error', {'message': 'Thiếu mã bài kiểm tra hoặc template'}, to=sid)
             return
         
-        if sid in active_sessions:
-            active_sessions[sid]['exam_id'] = exam_id
-            active_sessions[sid]['template_id'] = template_id
-            active_sessions[sid]['scanning'] = True
+        session = scan_sessions.get(sid)
+        if session:
+            session.start(exam_id, template_id)
             
         logger.info(f"Started scanning session for sid {sid}, exam {exam_id}, template {template_id}")
         
@@ -377,9 +323,9 @@ async def start_scanning(sid, data):
 async def end_session(sid):
     """End scanning session and disconnect"""
     try:
-        if sid in active_sessions:
-            # logger.info(f"Ending session for sid {sid}")
-            active_sessions[sid]['scanning'] = False
+        session = scan_sessions.get(sid)
+        if session:
+            session.scanning = False
             
         await sio.emit('session_ended', {
             'message': 'Đã kết thúc phiên chấm bài'
@@ -392,28 +338,50 @@ async def end_session(sid):
         logger.error(f"Error ending session: {e}")
         await sio.emit('error', {'message': str(e)}, to=sid)
 
+def _frame_bytes(data) -> Optional[bytes]:
+    """
+    Lấy bytes ảnh từ payload 'capture_frame'.
+    Client mới gửi attachment nhị phân (bytes hoặc {'frame': bytes});
+    client cũ gửi {'frame': data URL base64}.
+    """
+    frame = data.get('frame') if isinstance(data, dict) else data
+    if isinstance(frame, (bytes, bytearray, memoryview)):
+        return bytes(frame)
+    if isinstance(frame, str) and frame:
+        return base64.b64decode(frame.split(',', 1)[1] if ',' in frame else frame)
+    return None
+
+
 @sio.on('capture_frame')
 async def on_capture_frame(sid, data):
-    """Handler for the 'capture_frame' event from the client."""
+    """
+    Handler for the 'capture_frame' event from the client.
+    Frame được đặt vào ô chờ của phiên (frame mới nhất thắng) thay vì tạo task mới cho mỗi frame;
+    giá trị trả về là ack cho client: trạng thái frame và bộ đếm của phiên.
+    """
     try:
-        if sid not in active_sessions or not active_sessions[sid].get('scanning'):
-            return await sio.emit('error', {'message': 'Session không hoạt động hoặc chưa bắt đầu.'}, to=sid)
-        
-        frame_data = data.get('frame')
-        exam_id = active_sessions[sid].get('exam_id')
-        
-        if not frame_data or not exam_id:
-            return await sio.emit('error', {'message': 'Dữ liệu ảnh hoặc ID bài thi bị thiếu.'}, to=sid)
-            
-        # Decode image data
-        image_bytes = base64.b64decode(frame_data.split(',')[1])
+        session = scan_sessions.get(sid)
+        if not session or not session.scanning:
+            await sio.emit('error', {'message': 'Session không hoạt động hoặc chưa bắt đầu.'}, to=sid)
+            return {'status': 'rejected'}
+
+        image_bytes = _frame_bytes(data)
+        if not image_bytes or not session.exam_id:
+            await sio.emit('error', {'message': 'Dữ liệu ảnh hoặc ID bài thi bị thiếu.'}, to=sid)
+            return {'status': 'rejected'}
+
+        # Kiểm tra magic bytes ngay khi nhận để không chiếm ô chờ bằng dữ liệu hỏng
+        if sniff_image_format(image_bytes) is None:
+            await sio.emit('error', {'message': 'Frame nhận được không phải ảnh JPEG/PNG hợp lệ.'}, to=sid)
+            return {'status': 'rejected'}
 
-        # Chạy xử lý trong một task nền để không block server
-        asyncio.create_task(omr_handler.process_and_score(sid, exam_id, image_bytes))
+        status = session.submit(image_bytes, omr_handler.process_and_score)
+        return {'status': status, **session.stats()}
 
     except Exception as e:
         logger.error(f"Lỗi khi xử lý sự kiện capture_frame cho sid {sid}: {e}", exc_info=True)
         await sio.emit('error', {'message': f'Lỗi server: {str(e)}'}, to=sid)
+        return {'status': 'rejected'}
 
 def setup_omr_websocket(app):
     """Setup WebSocket with FastAPI app"""
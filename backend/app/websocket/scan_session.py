@@ -0,0 +1,145 @@
+"""Trạng thái phiên quét trực tiếp qua Socket.IO: mỗi sid một ô frame, frame mới nhất thắng"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Hàm xử lý một frame: nhận (session, bytes ảnh)
+FrameProcessor = Callable[["ScanSession", bytes], Awaitable[Any]]
+
+
+class ScanSession:
+    """
+    Một kết nối quét của giáo viên.
+
+    Client (webcam/điện thoại) có thể gửi frame nhanh hơn tốc độ OMR xử lý. Thay vì
+    xếp hàng tất cả frame, phiên chỉ giữ đúng một frame chờ: frame mới đến sẽ thay
+    frame chờ cũ (frame cũ đã lỗi thời). Mỗi phiên có tối đa một job đang chạy và
+    không bắt đầu job mới sớm hơn `min_interval` giây sau job trước.
+    """
+
+    def __init__(self, sid: str, user: Any, max_fps: float = 0):
+        self.sid = sid
+        self.user = user
+        self.connected_at = datetime.now()
+        self.exam_id: Optional[int] = None
+        self.template_id: Optional[int] = None
+        self.scanning = False
+        self.min_interval = 1.0 / max_fps if max_fps and max_fps > 0 else 0.0
+
+        # Ô frame chờ và job đang xử lý
+        self._pending: Optional[bytes] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._last_started = 0.0
+
+        # Bộ đếm backpressure
+        self.frames_received = 0
+        self.frames_processed = 0
+        self.frames_replaced = 0
+        self.frames_failed = 0
+
+    @property
+    def busy(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    def start(self, exam_id: int, template_id: int):
+        self.exam_id = exam_id
+        self.template_id = template_id
+        self.scanning = True
+
+    def submit(self, frame: bytes, process: FrameProcessor) -> str:
+        """
+        Đặt frame vào ô chờ và khởi động worker nếu chưa chạy.
+        Trả về "queued" hoặc "replaced" (đã thay một frame chờ chưa được xử lý).
+        """
+        self.frames_received += 1
+        status = "queued"
+        if self._pending is not None:
+            self.frames_replaced += 1
+            status = "replaced"
+        self._pending = frame
+
+        if not self.busy:
+            self._worker = asyncio.create_task(self._drain(process))
+        return status
+
+    async def _drain(self, process: FrameProcessor):
+        """Xử lý lần lượt frame mới nhất cho đến khi ô chờ trống"""
+        while self._pending is not None:
+            wait = self._last_started + self.min_interval - time.monotonic()
+            if wait > 0:
+                # Frame đến trong lúc chờ sẽ thay frame chờ hiện tại
+                await asyncio.sleep(wait)
+
+            frame, self._pending = self._pending, None
+            self._last_started = time.monotonic()
+            try:
+                await process(self, frame)
+                self.frames_processed += 1
+            except Exception as e:
+                self.frames_failed += 1
+                logger.error(f"Lỗi xử lý frame cho sid {self.sid}: {e}", exc_info=True)
+
+    def close(self):
+        """Hủy frame chờ và job đang chạy khi client ngắt kết nối"""
+        self.scanning = False
+        self._pending = None
+        if self.busy:
+            self._worker.cancel()
+        self._worker = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "frames_received": self.frames_received,
+            "frames_processed": self.frames_processed,
+            "frames_replaced": self.frames_replaced,
+            "frames_failed": self.frames_failed,
+            "pending": self._pending is not None,
+            "busy": self.busy,
+        }
+
+
+class ScanSessionRegistry:
+    """Danh sách phiên quét theo sid"""
+
+    def __init__(self, max_fps: float = 0):
+        self.max_fps = max_fps
+        self._sessions: Dict[str, ScanSession] = {}
+
+    def open(self, sid: str, user: Any) -> ScanSession:
+        self.close(sid)
+        session = ScanSession(sid, user, self.max_fps)
+        self._sessions[sid] = session
+        return session
+
+    def get(self, sid: str) -> Optional[ScanSession]:
+        return self._sessions.get(sid)
+
+    def close(self, sid: str) -> Optional[ScanSession]:
+        session = self._sessions.pop(sid, None)
+        if session is not None:
+            session.close()
+            logger.info(f"Đóng phiên quét {sid}: {session.stats()}")
+        return session
+
+    def __contains__(self, sid: str) -> bool:
+        return sid in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> Dict[str, Any]:
+        sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "scanning": sum(1 for s in sessions if s.scanning),
+            "busy": sum(1 for s in sessions if s.busy),
+            "frames_received": sum(s.frames_received for s in sessions),
+            "frames_processed": sum(s.frames_processed for s in sessions),
+            "frames_replaced": sum(s.frames_replaced for s in sessions),
+            "frames_failed": sum(s.frames_failed for s in sessions),
+        }
@@ -164,10 +164,10 @@ const ResultsPage = () => {
       id: 'actions',
       header: 'Bài làm',
       cell: ({ row }) => {
-        const { urlHinhAnhXuLy } = row.original;
-        if (!urlHinhAnhXuLy) return null;
+        const { urlHinhAnhXuLy, annotationUrl } = row.original;
+        if (!annotationUrl && !urlHinhAnhXuLy) return null;
 
-        const imageUrl = `${API_HOST}/storage/${urlHinhAnhXuLy}`;
+        const imageUrl = annotationUrl ? `${API_HOST}${annotationUrl}` : `${API_HOST}/storage/${urlHinhAnhXuLy}`;
         
         return (
           <Button
@@ -142,7 +142,7 @@ export default function OMRScanPage() {
 
             if (result.success && result.scoring_result?.results) {
                 const scoringData = result.scoring_result.results;
-                const annotatedImages = result.annotated_images || {};
+                const annotationUrls = result.annotation_urls || {};
                 
                 const newResults: ScanResult[] = scoringData.map((item: any) => {
                     const filename = item.filename || '';
@@ -158,7 +158,7 @@ export default function OMRScanPage() {
                         answers: item.details || {},
                         matched: !!item.student_id,
                         ma_de: item.ma_de || null,
-                        annotated_image: annotatedImages[filename] || item.annotated_image_path || null,
+                        annotated_image: annotationUrls[filename] || null,
                         annotated_image_path: item.annotated_image_path || null,
                     };
                 });
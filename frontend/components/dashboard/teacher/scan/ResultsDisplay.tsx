@@ -8,6 +8,7 @@ import { Save, X, Loader2, Download, List, Grid, BarChart3, CheckCircle, AlertCi
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from '@/components/ui/dialog';
 import type { ScanResult } from '@/types/scan';
 import type { Exam } from '@/lib/api/exams';
+import { annotationImageSrc } from '@/lib/api/omr';
 
 export const ResultsDisplay = ({ 
   results, 
@@ -64,7 +65,7 @@ export const ResultsDisplay = ({
                                 <DialogTitle>Ảnh phiếu đã chấm - {result.filename}</DialogTitle>
                             </DialogHeader>
                             <div className="py-4">
-                                <img src={`data:image/jpeg;base64,${result.annotated_image}`} alt={`Annotated result for ${result.filename}`} className="w-full h-auto rounded-md" />
+                                <img src={annotationImageSrc(result.annotated_image)} alt={`Annotated result for ${result.filename}`} className="w-full h-auto rounded-md" />
                             </div>
                         </DialogContent>
                     </Dialog>
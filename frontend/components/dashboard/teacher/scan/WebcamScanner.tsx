@@ -14,6 +14,7 @@ import Webcam from 'react-webcam'
 
 import { useOMRWebSocket, OMRProgressData, CompleteDetails, RecognitionFailedDetails } from '@/lib/hooks/useOMRWebSocket'
 import { useToast } from '@/components/ui/use-toast'
+import { annotationImageSrc } from '@/lib/api/omr'
 
 // Types
 interface CameraConstraints {
@@ -262,7 +263,7 @@ const WebcamScannerUI: React.FC<WebcamScannerUIProps> = ({
                                     {statusMessage}
                                 </p>
                             </div>
-                            {previewImage && <div className="mt-4"><p className="text-sm font-medium mb-2">Ảnh đã căn chỉnh:</p><img src={previewImage} alt="Preview" className="rounded-md border max-w-full" /></div>}
+                            {previewImage && <div className="mt-4"><p className="text-sm font-medium mb-2">Ảnh đã căn chỉnh:</p><img src={annotationImageSrc(previewImage)} alt="Preview" className="rounded-md border max-w-full" /></div>}
                         </CardContent>
                     </Card>
                     {lastSuccessfulResult && (
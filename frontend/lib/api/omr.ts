@@ -98,6 +98,7 @@ export interface ExamResultDetails {
     soCauSai: number | null;
     ngayCham: string | null;
     urlHinhAnhXuLy: string | null;
+    annotationUrl: string | null;
     trangThai: 'dacom' | 'chuacham';
   }[];
 }
@@ -112,6 +113,18 @@ async function getResultsByExam(examId: number): Promise<ExamResultDetails> {
   throw new Error("Failed to fetch exam results from API");
 }
 
+// Ảnh annotation có thể là URL ký sẵn của API (/api/v1/omr/annotations/...), data URL hoặc base64 thuần
+export function annotationImageSrc(image: string): string {
+  if (image.startsWith('data:') || image.startsWith('http')) return image;
+  if (image.startsWith('/')) {
+    try {
+      return `${new URL(process.env.NEXT_PUBLIC_API_URL || '').origin}${image}`;
+    } catch (e) {
+      return `http://localhost:8000${image}`;
+    }
+  }
+  return `data:image/jpeg;base64,${image}`;
+}
 
 export const omrApi = {
     processBatch,
@@ -39,6 +39,8 @@ export interface RecognitionFailedDetails {
   reason: string;
   suggestion: string;
   aligned_image?: string;
+  stage?: 'quality_gate'; // Frame bị loại ở bước kiểm tra chất lượng, trước pipeline OMR
+  hints?: string[];
 }
 
 export interface MatchingDetails {
@@ -59,7 +61,9 @@ export interface CompleteDetails {
   blank_answers: number;
   total_questions: number;
   details: any[]; // Chi tiết từng câu
-  aligned_image?: string;
+  aligned_image?: string; // URL annotation (khi đã lưu phiếu) hoặc data URL ảnh căn chỉnh
+  annotation_url?: string;
+  answer_sheet_id?: number | null;
   original_image_path?: string;
   annotated_image_path?: string;
 }
@@ -71,6 +75,26 @@ export interface OMRProgressData {
   details?: RecognitionSuccessDetails | RecognitionFailedDetails | MatchingDetails | CompleteDetails | { error?: string };
 }
 
+// Ack của server cho mỗi frame gửi lên
+interface FrameAck {
+  status: 'queued' | 'replaced' | 'rejected';
+  frames_received?: number;
+  frames_processed?: number;
+  frames_replaced?: number;
+  frames_failed?: number;
+}
+
+// Chuyển data URL (webcam screenshot) thành bytes để socket.io gửi dạng nhị phân
+const dataUrlToBytes = (dataUrl: string): Uint8Array => {
+  const base64 = dataUrl.includes(',') ? dataUrl.split(',')[1] : dataUrl;
+  const binary = atob(base64);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return bytes;
+};
+
 interface UseOMRWebSocketProps {
   examId?: number;
   templateId?: number;
@@ -329,7 +353,15 @@ export const useOMRWebSocket = ({ examId, templateId, onProgress, onResultSaved
 
     console.log('Capturing frame for processing...');
     setIsProcessing(true);
-    socketRef.current.emit('capture_frame', { frame: frameData });
+    // Gửi frame dạng attachment nhị phân thay vì chuỗi base64 (nhỏ hơn ~33%, server không cần decode).
+    // Server chỉ giữ frame mới nhất của phiên: ack 'replaced' nghĩa là frame chờ trước đó đã bị bỏ qua.
+    socketRef.current.emit('capture_frame', { frame: dataUrlToBytes(frameData) }, (ack: FrameAck) => {
+      if (ack?.status === 'rejected') {
+        setIsProcessing(false);
+      } else if (ack?.status === 'replaced') {
+        console.log('Pending frame replaced by newer frame:', ack);
+      }
+    });
   }, [isScanning]);
 
   // Save current result to database